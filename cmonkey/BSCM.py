@@ -3,9 +3,9 @@
 This file is part of cMonkey Python. Please see README and LICENSE for
 more information and licensing details.
 
-To Do: Write a 'save' and 'load' function that pickles/writes and unpickles/reads.
-      Integrate that with main cMonkey save and load functions.
-      
+The sampled backgrounds can be kept in a NullDistributionStore in the cache
+directory, which is shared by all runs on the same ratios.
+
 To Do: Write a function for resplitting clusters based on a new ratios matrix
 
 This module implements the algorithm described in:
@@ -13,23 +13,221 @@ Bicluster Sampled Coherence Metric (BSCM) provides an accurate environmental con
 Danziger et al.
 BMC Systems Biology, 2015
 """
+import os
+import hashlib
+import warnings
 import datamatrix
 import util as util
 import numpy as np
 import math
-import random
 import datetime as dt
-import multiprocessing as mp
 import logging
 
-def getVarianceMeanSDvect_mp_wrapper(args):
-    return(getVarianceMeanSDvect(args[0], args[1], args[2], args[3], args[4], args[5], args[6]))
+# the number of chunks that are sampled at once by sample_variances()
+CHUNKS_PER_BATCH = 10
+
+# the directory of the background variance store in the cache directory
+BSCM_STORE_DIR = 'bscm'
+
+
+def sample_variances(ratioVect, ns, rng, tolerance=0.01, maxTime=600, chunkSize=200,
+                     converged=None):
+    """Samples the background variances for all numbers of genes in ns at once.
+       The samples are drawn without replacement, in batches of CHUNKS_PER_BATCH
+       chunks: a partial Fisher-Yates shuffle of the indexes of the ratios gives
+       a random sample for every n as a prefix, and the variances of all the
+       prefixes are computed from their cumulative sums. For each n, the
+       samples are added chunk by chunk until the mean and the variance of the
+       variances change by less than the tolerance fraction, the time limit
+       applies to all of them.
+       Returns a map from n to the array of its variances, which is [nan] if n
+       is not between 2 and the number of non-NaN ratios. The variances of the
+       numbers of genes that did not converge within the time limit are
+       returned, too
+
+     Keyword arguments:
+     ratioVect  -- A a vector of ratios
+     ns         -- The numbers of genes to sample
+     rng        -- The numpy.random.RandomState to draw the samples from
+     tolerance  -- The fraction tolance to use as a stopping condition (DEFAULT: 0.01)
+     maxTime    -- The approximate maximum time to run in seconds (DEFAULT: 600)
+     chunkSize  -- The number of samples to add between test (DEFAULT: 200)
+     converged  -- A set that the numbers of genes which converged are added to (DEFAULT: None)
+    """
+    values = np.asarray(ratioVect, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    # the variance does not depend on the mean, centering the ratios
+    # keeps the cumulative sums small
+    values = values - values.mean() if len(values) > 0 else values
+    num_values = len(values)
+
+    result = {n: np.array([np.nan]) for n in ns if n <= 1 or n > num_values}
+    pending = sorted({n for n in ns if n not in result})
+    samples = {n: [] for n in pending}
+    moments = {n: (0, 0.0, 0.0) for n in pending}  # count, sum, sum of squares
+    batch_size = chunkSize * CHUNKS_PER_BATCH
+    sample_rows = np.arange(batch_size)
+    startTime = dt.datetime.now()
+    while len(pending) > 0:
+        max_n = pending[-1]
+        indexes = np.tile(np.arange(num_values, dtype=np.int32), (batch_size, 1))
+        for i in xrange(max_n):
+            swap = rng.randint(i, num_values, batch_size)
+            chosen = indexes[sample_rows, swap]
+            indexes[sample_rows, swap] = indexes[:, i]
+            indexes[:, i] = chosen
+        sampled = values[indexes[:, :max_n]]
+        sums = np.cumsum(sampled, axis=1)
+        sums_sq = np.cumsum(sampled * sampled, axis=1)
+
+        for n in list(pending):
+            variances = np.maximum(sums_sq[:, n - 1] / n - (sums[:, n - 1] / n) ** 2, 0.0)
+            num_chunks, is_converged = add_variance_chunks(moments, n, variances, chunkSize,
+                                                           tolerance)
+            samples[n].append(variances[:num_chunks * chunkSize])
+            if is_converged:
+                pending.remove(n)
+                if converged is not None:
+                    converged.add(n)
+
+        curTime = dt.datetime.now()
+        if (curTime - startTime).seconds > maxTime:
+            break
+
+    for n in samples:
+        result[n] = np.concatenate(samples[n])
+    return result
+
+
+def add_variance_chunks(moments, n, variances, chunkSize, tolerance):
+    """adds the chunks of variances to the running moments of n until their
+       mean and variance converge. Returns the number of added chunks and
+       whether the moments converged"""
+    count, total, total_sq = moments[n]
+    chunks = variances.reshape(-1, chunkSize)
+    counts = count + chunkSize * np.arange(1, len(chunks) + 1)
+    sums = total + np.cumsum(chunks.sum(axis=1))
+    sums_sq = total_sq + np.cumsum((chunks * chunks).sum(axis=1))
+    means = sums / counts
+    var_of_vars = sums_sq / counts - means ** 2
+    if count > 0:
+        old_means = np.concatenate([[total / count], means[:-1]])
+        old_vars = np.concatenate([[total_sq / count - (total / count) ** 2], var_of_vars[:-1]])
+        checked = np.ones(len(chunks), dtype=bool)
+    else:
+        # there is no test after the first chunk
+        old_means = np.concatenate([[np.nan], means[:-1]])
+        old_vars = np.concatenate([[np.nan], var_of_vars[:-1]])
+        checked = np.arange(len(chunks)) > 0
+    with np.errstate(invalid='ignore'):
+        converged = (checked & (np.abs(means - old_means) < tolerance * np.abs(old_means)) &
+                     (np.abs(old_vars - var_of_vars) < tolerance * np.abs(old_vars)))
+    num_chunks = np.argmax(converged) + 1 if np.any(converged) else len(chunks)
+    moments[n] = (counts[num_chunks - 1], sums[num_chunks - 1], sums_sq[num_chunks - 1])
+    return num_chunks, bool(np.any(converged))
+
+
+def sample_variances_mp_wrapper(args):
+    """samples the variances of a column. With a store directory, the
+       variances that converged are written to the store and returned as None.
+       The others (the [nan] of the invalid numbers of genes and the
+       backgrounds that ran into the time limit) are only returned, so the
+       store never holds a background that depends on the time limit"""
+    directory, key, ratioVect, ns, seed, tolerance, maxTime, chunkSize = args
+    converged = set()
+    colVars = sample_variances(ratioVect, ns, np.random.RandomState(seed), tolerance, maxTime,
+                               chunkSize, converged)
+    if directory is None:
+        return colVars
+    store = NullDistributionStore(directory)
+    for n in converged:
+        store.put(key, n, colVars[n])
+        colVars[n] = None
+    return colVars
+
+
+def column_key(ratioVect, tolerance, chunkSize):
+    """the store key of the background variances of a column of ratios, it
+       identifies the non-NaN ratios and the sampling parameters"""
+    values = np.asarray(ratioVect, dtype=np.float64)
+    digest = hashlib.sha1(values[~np.isnan(values)].tostring()).hexdigest()
+    return '%s-%g-%d' % (digest, tolerance, chunkSize)
+
+
+def background_pvalue(variances, variance):
+    """the fraction of the sorted background variances below variance,
+       1 for a background of an invalid number of genes"""
+    if np.any(np.isnan(variances[:1])):
+        return 1
+    return np.searchsorted(variances, variance, side='left') / float(len(variances))
+
+
+class NullDistributionStore:
+    """An on-disk store of background variance distributions. The variances
+    of a column are stored under its column_key() with one .npy file of the
+    sorted variances per number of genes, they are loaded as read-only memory
+    maps. Since the key only depends on the data, the store can be shared by
+    the runs, resumes and post-processing steps on the same ratios. Only the
+    backgrounds that converged are stored, the ones that were cut off by the
+    time limit of a run are not reused"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.__sizes = {}  # key -> set of the stored numbers of genes
+
+    def __path(self, key, n):
+        return os.path.join(self.directory, key, '%d.npy' % n)
+
+    def sizes(self, key):
+        """the numbers of genes that have variances for key"""
+        if key not in self.__sizes:
+            keydir = os.path.join(self.directory, key)
+            names = os.listdir(keydir) if os.path.isdir(keydir) else []
+            self.__sizes[key] = {int(name[:-4]) for name in names
+                                 if name.endswith('.npy') and name[:-4].isdigit()}
+        return self.__sizes[key]
+
+    def get(self, key, n):
+        """returns the sorted variances of n for key or None"""
+        path = self.__path(key, n)
+        if not os.path.exists(path):
+            return None
+        self.sizes(key).add(n)
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, n, variances):
+        """stores the variances of n for key, sorted. The file is written to
+        a temporary file first and renamed, so concurrent readers never see a
+        partial file"""
+        keydir = os.path.join(self.directory, key)
+        if not os.path.isdir(keydir):
+            try:
+                os.makedirs(keydir)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(keydir):
+                    raise
+        path = self.__path(key, n)
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as outfile:
+            np.save(outfile, np.sort(variances))
+        os.rename(tmp_path, path)
+        self.sizes(key).add(n)
+
+
+def run_null_store(config_params):
+    """returns the background variance store in the cache directory of the
+    run with config_params"""
+    return NullDistributionStore(os.path.join(config_params['cache_dir'], BSCM_STORE_DIR))
+
 
 def getVarianceMeanSDvect(ratioVect, n, tolerance = 0.01, maxTime=600, chunkSize=200, verbose=False, expName=None):
     """Given a ratios matrix and a number of genes, figure out the expected distribution of variances
        Will sample background until the mean and sd converge or the operation times out
        Will return a list of variances to be used for statistical tests, 
        or return nan if only nan values in ratioVect
+       The samples are drawn with sample_variances() from the random number
+       generator of the native statistics backend
 
      Keyword arguments:
      ratioVect  -- A a vector of ratios
@@ -43,62 +241,27 @@ def getVarianceMeanSDvect(ratioVect, n, tolerance = 0.01, maxTime=600, chunkSize
      Useage: 
      varDist = getVarianceMeanSD(ratioVect, n)
     """
-    ratioVect = [x for x in ratioVect if not math.isnan(x)]
-
     if verbose == True:
         logging.info("Calculating background for %d sampled from %d in %s", n, len(ratioVect), expName)
+    return sample_variances(ratioVect, [n], util.STATS_RNG, tolerance, maxTime,
+                            chunkSize)[n].tolist()
 
-    if n <= 1 or n > len(ratioVect):
-        return [np.nan]
-    
-    varList = []
-    repeat = True
-    startTime = dt.datetime.now()
-    while repeat == True:
-        newVars = []
-        for i in range(0, chunkSize):
-            curSample = random.sample(ratioVect, n)
-            try:
-                newVar = np.var(curSample)
-            except:
-                newVar = 0
-            newVars.append(newVar)
-
-        if len(varList) > 0: #True if past the first sample
-            oldMean = np.mean(varList)
-            oldVar = np.var(varList)
-            varList = varList+newVars
-            newMean = np.mean(varList)
-            newVar = np.var(varList)
-            meanWinTol = abs(newMean-oldMean) < tolerance*abs(oldMean)
-            varWinTol = abs(oldVar-newVar) < tolerance*abs(oldVar)
-            if meanWinTol and varWinTol:
-                repeat = False
-        else:
-            varList = varList+newVars
-
-        curTime = dt.datetime.now()
-        if (curTime-startTime).seconds > maxTime:
-            repeat = False
-
-        #if verbose == True:
-        #   print(str((curTime-startTime).seconds) + 's  ')
-
-    return varList
-#def getVarianceMeanSDvect(ratioVect, n, tolerance = 0.05 ,maxTime=600, chunkSize=200, verbose=False):
-    
 class BSCM:
     """This is a class is designed to sample N items from a single vector 
     until it reaches a certain convirgence criteria.  Once that's
     completed, it can be queried to return a p-Value for a specific set of genes
     Right now it copies ratios, which will waste some memory
     """
-    def __init__(self, ratios, tolerance = 0.001, maxTime=600, chunkSize=200, verbose=False):
+    def __init__(self, ratios, tolerance = 0.001, maxTime=600, chunkSize=200, verbose=False,
+                 store=None, interpolation=0):
         """Given a ratios matrix and a number of genes, figure out the expected distribution of variances
            Will sample background until the mean and sd converge or the operation times out
 
          Keyword arguments:
-         ratios     -- A DataMatrix object from 'cmonkey.datamatrix'
+         ratios        -- A DataMatrix object from 'cmonkey.datamatrix'
+         store         -- A NullDistributionStore to keep the backgrounds in (DEFAULT: None)
+         interpolation -- The maximum distance in numbers of genes to interpolate the
+                          p-Values of missing backgrounds over, 0 always samples (DEFAULT: 0)
         """
         self.allVars = {} #Store all of the variances here.  Structure: allVars[expName][numExp]
         self.ratios = ratios
@@ -106,83 +269,116 @@ class BSCM:
         self.maxTime = maxTime
         self.chunkSize = chunkSize
         self.verbose = verbose
+        self.store = store
+        self.interpolation = interpolation
+        self.columnKeys = {}
     #def __init__(self, ratios, tolerance = 0.001, maxTime=600, chunkSize=200, verbose=False):
-           
+
+    def __column_key(self, colIdx):
+        if colIdx not in self.columnKeys:
+            self.columnKeys[colIdx] = column_key(self.ratios.values[:, colIdx], self.tolerance,
+                                                 self.chunkSize)
+        return self.columnKeys[colIdx]
+
+    def __background(self, colIdx, n):
+        """the sorted background variances of the column for n from memory or
+           the store, None if they were not sampled yet"""
+        colVars = self.allVars.setdefault(self.ratios.column_names[colIdx], {})
+        if str(n) not in colVars and self.store is not None:
+            variances = self.store.get(self.__column_key(colIdx), n)
+            if variances is not None:
+                colVars[str(n)] = variances
+        return colVars.get(str(n), None)
+
+    def __neighbours(self, colIdx, n):
+        """the nearest numbers of genes below and above n with backgrounds
+           within the interpolation distance, or None"""
+        if self.interpolation <= 0:
+            return None
+        colVars = self.allVars.get(self.ratios.column_names[colIdx], {})
+        sizes = {int(i) for i, variances in colVars.items() if not np.any(np.isnan(variances[:1]))}
+        if self.store is not None:
+            sizes |= self.store.sizes(self.__column_key(colIdx))
+        lower = [i for i in sizes if max(n - self.interpolation, 2) <= i < n]
+        upper = [i for i in sizes if n < i <= n + self.interpolation]
+        if len(lower) == 0 or len(upper) == 0:
+            return None
+        return max(lower), min(upper)
+
     def getPvals(self, geneNames, num_cores=1):
         """Get p-Values for the the list of genes, one for each column in the ratios matrix
+           The backgrounds that are missing are sampled per column, for all
+           numbers of genes at once. If the backgrounds of the nearest numbers
+           of genes below and above are within the interpolation distance, the
+           p-Value is interpolated between them instead
 
          Keyword arguments:
          geneNames  -- A list of genes in the cluster
-         singleCore -- Set to True to use a single core.  False may not work.
+         num_cores  -- The number of processes that sample the columns
         """
-        pVals = {}
-        
         relGenes = list(set(geneNames) & set(self.ratios.row_names))
         curGeneMatrix = self.ratios.submatrix_by_rows(self.ratios.row_indexes_for(relGenes))
-        
-        noVarNs = []  #These three matrices should have a matched order
-        noVarRats = []  #It would be better to have a single list
-        noVarCns = []   #With 3 named elements in each list item
-        for cn in self.ratios.column_names:
-            colIdx = curGeneMatrix.column_indexes_for(column_names = [cn])
-            geneVect = curGeneMatrix.column_values(column = colIdx)
-            geneVect = [x for x in geneVect if not math.isnan(x)]
-            n = len(geneVect)
-
-            if self.allVars.get(cn, False) == False:
-                self.allVars[cn] = {} 
-
-            #For loop: efficiently use multicore by precalculating additional numbers of genes
+        valid = ~np.isnan(curGeneMatrix.values)
+        geneNs = valid.sum(axis=0)
+        with warnings.catch_warnings():
+            # columns without values have a variance of NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            curVars = np.nanvar(curGeneMatrix.values, axis=0)
+
+        #  1) Collect the numbers of genes without background for each column
+        #     neighbouring numbers of genes are precalculated with multiple cores
+        noVarCols = []  # pairs of column index, numbers of genes
+        for colIdx in xrange(self.ratios.num_columns):
+            n = geneNs[colIdx]
+            if n <= 1 or self.__background(colIdx, n) is not None or \
+                    self.__neighbours(colIdx, n) is not None:
+                continue
             i_s = [n]
             if num_cores > 1:
                 i_s = [n-3, n-2, n-1, n, n+1, n+2, n+3]
-            for i in i_s:
-                if self.allVars[cn].get(str(i), False) == False and i >= 0:
-                    ratioVect = self.ratios.column_values(column = self.ratios.column_indexes_for(column_names = [cn]))
-                    noVarNs.append(i)
-                    noVarRats.append(ratioVect.tolist())
-                    noVarCns.append(cn)                
-
-        #  2) Use a pool of workers to calculate a distribution for each of the tuples
-        if len(noVarNs) > 0:
+            missing = [i for i in i_s if i > 1 and self.__background(colIdx, i) is None]
+            noVarCols.append((colIdx, missing))
+
+        #  2) Sample the backgrounds of the columns, the workers write them
+        #     to the store if there is one
+        if len(noVarCols) > 0:
             logging.info("Calculating some backgrounds for about %d genes", len(geneNames))
+            directory = self.store.directory if self.store is not None else None
+            args = [(directory, self.__column_key(colIdx) if directory is not None else None,
+                     self.ratios.values[:, colIdx], ns, util.STATS_RNG.randint(2 ** 31),
+                     self.tolerance, self.maxTime, self.chunkSize)
+                    for colIdx, ns in noVarCols]
             if num_cores > 1:
-                newargs = []
-                for i in range(0, len(noVarNs)):
-                    newargs.append([noVarRats[i], noVarNs[i], self.tolerance, self.maxTime, self.chunkSize, self.verbose, noVarCns[i]])
-                pool = mp.Pool(num_cores)
-                newVars = pool.map(getVarianceMeanSDvect_mp_wrapper, newargs)
-                pool.close()
-                pool.join()
-                #with util.get_mp_pool(config_params={'num_cores':num_cores}) as pool:
-                #   newVars = pool.map(getVarianceMeanSDvect, [noVarRats, noVarNs])
+                with util.get_mp_pool(config_params={'num_cores': num_cores}) as pool:
+                    newVars = pool.map(sample_variances_mp_wrapper, args)
             else:
-                tolerance = np.repeat(self.tolerance, len(noVarNs)).tolist()
-                maxTime = np.repeat(self.maxTime, len(noVarNs)).tolist()
-                chunkSize = np.repeat(self.chunkSize, len(noVarNs)).tolist()
-                verbose = np.repeat(self.verbose, len(noVarNs)).tolist()
-                newVars = map(getVarianceMeanSDvect, noVarRats, noVarNs, tolerance, maxTime, chunkSize, verbose, noVarCns)
-
-        #  3) Assign the new values into the empty slots
-        for idx in range(0,len(noVarCns)):
-            cn = noVarCns[idx]
-            curN = str(noVarNs[idx])
-            self.allVars[cn][curN] = newVars[idx]
-        
-        #  4) Calculate the p-Values 
+                newVars = map(sample_variances_mp_wrapper, args)
+
+            #  3) Assign the new values into the empty slots, sorted for step 4
+            for (colIdx, ns), colVars in zip(noVarCols, newVars):
+                cn = self.ratios.column_names[colIdx]
+                for n, variances in colVars.items():
+                    if variances is None:
+                        self.__background(colIdx, n)
+                    else:
+                        self.allVars[cn][str(n)] = np.sort(variances)
+
+        #  4) Calculate the p-Values, the fraction of background variances
+        #     below the cluster's variance
         pVals = {}
-        for cn in self.ratios.column_names:
-            colIdx = curGeneMatrix.column_indexes_for(column_names = [cn])
-            geneVect = curGeneMatrix.column_values(column = colIdx)
-            geneVect = [x for x in geneVect if not math.isnan(x)]
-            n = str(len(geneVect))
-    
-            if len(geneVect) <= 1 or np.any(np.isnan(self.allVars[cn][str(n)])) == True:
+        for colIdx, cn in enumerate(self.ratios.column_names):
+            n = geneNs[colIdx]
+            if n <= 1:
                 pVals[cn] = 1
+                continue
+            variances = self.__background(colIdx, n)
+            if variances is not None:
+                pVals[cn] = background_pvalue(variances, curVars[colIdx])
             else:
-                curVar = np.var(geneVect)
-                pVals[cn] = np.mean(self.allVars[cn][str(n)] < curVar)
-
+                lower, upper = self.__neighbours(colIdx, n)
+                lowerPval = background_pvalue(self.__background(colIdx, lower), curVars[colIdx])
+                upperPval = background_pvalue(self.__background(colIdx, upper), curVars[colIdx])
+                pVals[cn] = lowerPval + (upperPval - lowerPval) * (n - lower) / float(upper - lower)
         return pVals
     #def getPvals(self, geneNames):  
     
@@ -213,6 +409,7 @@ class BSCM:
         membership.col_membs = np.zeros((len(membership.col_membs),membership.num_clusters()), dtype='int32')    
         for col in pDict.keys():
             membership.col_membs[membership.colidx[col]] = np.array(pDict[col], dtype='int32')
+        membership.invalidate_index()
             
         return membership
     #def resplit_clusters(membership)
@@ -0,0 +1,146 @@
+# vi: sw=4 ts=4 et:
+"""checkpoint.py - binary checkpoints of the cMonkey run state
+
+A checkpoint holds everything an iteration depends on: the memberships,
+the cached results of the scoring functions, the motif results and the
+state of the random number generators. It is written as a single
+uncompressed NumPy .npz archive, which loads in a fraction of the time
+the scoring functions need to recompute their results. The archive is
+a flat map from '<component>/<name>' to arrays, every component
+(membership, scoring function, ...) provides and restores its own
+entries through checkpoint_state() and restore_checkpoint().
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import os
+import random
+import hashlib
+import logging
+import cPickle
+import numpy as np
+import datamatrix as dm
+import util
+
+
+# increment this when the layout of the checkpoint entries changes,
+# checkpoints of other versions are ignored on resume
+CHECKPOINT_VERSION = 1
+CHECKPOINT_FILE = 'checkpoint.npz'
+
+
+class CheckpointError(Exception):
+    """raised when a checkpoint can not be used for the current run"""
+    pass
+
+
+def checkpoint_path(output_dir):
+    """returns the path of the checkpoint in output_dir"""
+    return os.path.join(output_dir, CHECKPOINT_FILE)
+
+
+def run_fingerprint(row_names, column_names, num_clusters):
+    """identifies the input of a run, a checkpoint can only be restored into
+    a run with the same rows, columns and number of clusters"""
+    digest = hashlib.sha1('%d\0' % num_clusters)
+    for name in row_names:
+        digest.update('%s\n' % name)
+    digest.update('\0')
+    for name in column_names:
+        digest.update('%s\n' % name)
+    return digest.hexdigest()
+
+
+def write_checkpoint(path, iteration, fingerprint, state):
+    """writes the state map atomically to path: the archive is written to a
+    temporary file first and renamed, so an interrupted write leaves the
+    previous checkpoint intact"""
+    start_time = util.current_millis()
+    arrays = dict(state)
+    arrays['checkpoint/version'] = np.array(CHECKPOINT_VERSION)
+    arrays['checkpoint/iteration'] = np.array(iteration)
+    arrays['checkpoint/fingerprint'] = np.array(fingerprint)
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+    os.rename(tmp_path, path)
+    logging.debug("wrote checkpoint of iteration %d in %d ms.", iteration,
+                  util.current_millis() - start_time)
+
+
+def read_checkpoint(path, fingerprint):
+    """returns the (iteration, state) pair of the checkpoint at path, the
+    arrays of the state are loaded. Raises CheckpointError if the checkpoint
+    was written by another checkpoint version or for another input"""
+    with np.load(path) as archive:
+        state = {name: archive[name] for name in archive.files}
+    version = int(state.pop('checkpoint/version'))
+    if version != CHECKPOINT_VERSION:
+        raise CheckpointError("checkpoint version %d, expected %d" %
+                              (version, CHECKPOINT_VERSION))
+    if str(state.pop('checkpoint/fingerprint')) != fingerprint:
+        raise CheckpointError("checkpoint was written for a different input")
+    return int(state.pop('checkpoint/iteration')), state
+
+
+def component_state(state, component):
+    """returns the entries of a component in state, without the prefix"""
+    prefix = component + '/'
+    return {name[len(prefix):]: value for name, value in state.iteritems()
+            if name.startswith(prefix)}
+
+
+def add_component_state(state, component, component_state):
+    """adds the entries of a component to state"""
+    for name, value in component_state.iteritems():
+        state['%s/%s' % (component, name)] = value
+
+
+def object_array(obj):
+    """Python objects that have no array representation (e.g. the motif
+    results) are stored as their pickled bytes"""
+    return np.frombuffer(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+
+
+def array_object(array):
+    """the inverse of object_array()"""
+    return cPickle.loads(array.tostring())
+
+
+def matrix_state(matrix):
+    """the entries of a DataMatrix"""
+    return {'values': matrix.values,
+            'row_names': np.array(matrix.row_names),
+            'column_names': np.array(matrix.column_names)}
+
+
+def state_matrix(state):
+    """the DataMatrix of matrix_state()"""
+    row_names = state['row_names'].tolist()
+    column_names = state['column_names'].tolist()
+    matrix = dm.DataMatrix(len(row_names), len(column_names), row_names, column_names)
+    matrix.values = state['values']
+    return matrix
+
+
+def rng_state():
+    """the state of the Python and the NumPy random number generators.
+    The generator of the R statistics backend is not included"""
+    version, internal_state, gauss_next = random.getstate()
+    _, keys, pos, has_gauss, cached_gaussian = util.STATS_RNG.get_state()
+    return {'python_version': np.array(version),
+            'python': np.array(internal_state, dtype=np.int64),
+            'python_gauss': np.array([] if gauss_next is None else [gauss_next]),
+            'numpy_keys': keys,
+            'numpy_params': np.array([pos, has_gauss, cached_gaussian])}
+
+
+def restore_rng_state(state):
+    """restores the random number generators from rng_state()"""
+    gauss = state['python_gauss']
+    random.setstate((int(state['python_version']),
+                     tuple(int(value) for value in state['python']),
+                     float(gauss[0]) if len(gauss) > 0 else None))
+    pos, has_gauss, cached_gaussian = state['numpy_params']
+    util.STATS_RNG.set_state(('MT19937', state['numpy_keys'], int(pos),
+                              int(has_gauss), float(cached_gaussian)))
@@ -7,12 +7,12 @@ import numpy as np
 import gc
 import re
 import logging
+import collections
 import gzip
-import sqlite3
 from decimal import Decimal
-import cPickle
 import bz2
 import config
+import datamatrix as dm
 
 import microarray
 import membership as memb
@@ -26,9 +26,11 @@ import scoring
 import network as nw
 import stringdb
 import debug
-import sizes
 import thesaurus
 import BSCM
+import resultdb
+import checkpoint
+import scorestore
 
 USER_KEGG_FILE_PATH = 'config/KEGG_taxonomy'
 USER_GO_FILE_PATH = 'config/proteome2taxid'
@@ -61,6 +63,12 @@ class CMonkeyRun:
         self.__membership = None
         self.__organism = None
         self.config_params = args_in
+
+        # the precision policy applies to all matrices created by this run,
+        # the ratios were read before it was known
+        dm.set_precision(args_in.get('precision', 'double'))
+        if ratios.values.dtype != dm.VALUE_TYPE:
+            ratios.values = ratios.values.astype(dm.VALUE_TYPE)
         self.ratios = ratios
         if args_in['resume']:
             self.row_seeder = memb.make_db_row_seeder(args_in['out_database'])
@@ -73,6 +81,10 @@ class CMonkeyRun:
             self.row_seeder = memb.make_kmeans_row_seeder(args_in['num_clusters'])
             self.column_seeder = microarray.seed_column_members
         self.__conn = None
+        self.__result_writer = None
+        self.__membership_history = None
+        self.__worker_pool = None
+        self.__restored_iteration = None
 
         today = date.today()
         logging.info('Input matrix has # rows: %d, # columns: %d',
@@ -89,17 +101,44 @@ class CMonkeyRun:
 
     def cleanup(self):
         """cleanup this run object"""
+        if self.__result_writer is not None:
+            self.__result_writer.close()
+            self.__result_writer = None
         if self.__conn is not None:
             self.__conn.close()
             self.__conn = None
+        if self.__worker_pool is not None:
+            util.RUN_POOL = None
+            self.__worker_pool.close()
+            self.__worker_pool = None
+
+    def start_worker_pool(self):
+        """starts the worker processes that are used by all scoring functions
+        throughout the run"""
+        if self['multiprocessing'] and self.__worker_pool is None:
+            self.__worker_pool = util.WorkerPool(self['num_cores'])
+            util.RUN_POOL = self.__worker_pool
 
     def __dbconn(self):
         """Returns an autocommit database connection. We maintain a single database
         connection throughout the life of this run objec"""
         if self.__conn is None:
-            self.__conn = sqlite3.connect(self['out_database'], 15, isolation_level='DEFERRED')
+            self.__conn = resultdb.connect(self['out_database'])
         return self.__conn
 
+    def result_writer(self):
+        """Returns the writer for the iteration results, with the
+        background_db_writer option, the results are written by a writer thread"""
+        if self.__result_writer is None:
+            self.__result_writer = resultdb.ResultWriter(self['out_database'],
+                                                         background=self['background_db_writer'])
+        return self.__result_writer
+
+    def flush_results(self):
+        """waits until the pending results are written to the database"""
+        if self.__result_writer is not None:
+            self.__result_writer.flush()
+
     def __create_output_database(self):
         conn = self.__dbconn()
         # these are the tables for storing cmonkey run information.
@@ -127,11 +166,9 @@ class CMonkeyRun:
         conn.execute('''create table row_names (order_num int, name text)''')
         conn.execute('''create table column_names (order_num int, name text)''')
 
-        # result tables
-        conn.execute('''create table row_members (iteration int, cluster int,
-                        order_num int)''')
-        conn.execute('''create table column_members (iteration int, cluster int,
-                        order_num int)''')
+        # result tables, row_members and column_members are views on the
+        # membership history
+        resultdb.create_membership_tables(conn)
         conn.execute('create table global_background (subsequence text, pvalue decimal)')
 
         # in case you are wondering about the redundant iteration field here -
@@ -154,29 +191,19 @@ class CMonkeyRun:
         conn.execute('''create table motif_annotations (motif_info_id int,
                         iteration int, gene_num int,
                         position int, reverse boolean, pvalue decimal)''')
-        conn.execute('''create index if not exists colmemb_iter_index
-                        on column_members (iteration)''')
-        conn.execute('''create index if not exists rowmemb_iter_index
-                        on row_members (iteration)''')
-        conn.execute('''create index if not exists cluststat_iter_index
-                        on cluster_stats (iteration)''')
-        conn.execute("create index if not exists rnames_name_index on row_names (name)")
-        conn.execute("create index if not exists rowmemb_order_index on row_members (order_num)")
-        conn.execute("create index if not exists rowmemb_clust_index on row_members (cluster)")
-        conn.execute("create index if not exists motinf_clust_index on motif_infos (cluster)")
+        # the result indexes are created in finalize_results(), results
+        # dumped in debug mode are queried while running
+        if 'dump_results' in self['debug']:
+            resultdb.create_indexes(conn)
 
         logging.debug("created output database schema")
 
         # all cluster members are stored relative to the base ratio matrix
         with conn:
-            for index in xrange(len(self.ratios.row_names)):
-                conn.execute('''insert into row_names (order_num, name) values
-                                (?,?)''',
-                             (index, self.ratios.row_names[index]))
-            for index in xrange(len(self.ratios.column_names)):
-                conn.execute('''insert into column_names (order_num, name) values
-                                (?,?)''',
-                             (index, self.ratios.column_names[index]))
+            conn.executemany('insert into row_names (order_num, name) values (?,?)',
+                             enumerate(self.ratios.row_names))
+            conn.executemany('insert into column_names (order_num, name) values (?,?)',
+                             enumerate(self.ratios.column_names))
         logging.debug("added row and column names to output database")
 
     def report_params(self):
@@ -193,7 +220,7 @@ class CMonkeyRun:
     def __make_membership(self):
         """returns the seeded membership on demand"""
         if 'random_seed' in self['debug']:
-            util.r_set_seed(10)
+            util.set_random_seed(10)
 
         new_membs = memb.create_membership(self.ratios,
                                self.row_seeder, self.column_seeder,
@@ -304,14 +331,15 @@ class CMonkeyRun:
 
             # create and add network
             nw_factories.append(stringdb.get_network_factory(
-                self['organism_code'], stringfile, network_weight))
+                self['organism_code'], stringfile, network_weight,
+                cache_dir=self['cache_dir']))
 
         # do we use operons ?
         if is_microbe and not self['nonetworks'] and self['use_operons']:
             logging.debug('adding operon network factory')
             nw_factories.append(microbes_online.get_network_factory(
                 mo_db, max_operon_size=self.ratios.num_rows / 20,
-                weight=network_weight))
+                weight=network_weight, cache_dir=self['cache_dir']))
 
         orgcode = self['organism_code']
         logging.debug("Creating Microbe object for '%s'", orgcode)
@@ -363,10 +391,15 @@ class CMonkeyRun:
 
     def __clear_output_dir(self):
         output_dir = self['output_dir']
+        scorestore.discard_run_store(self.config_params)
         if os.path.exists(output_dir):
             outfiles = os.listdir(output_dir)
             for filename in outfiles:
-                os.remove('/'.join([output_dir, filename]))
+                path = '/'.join([output_dir, filename])
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
 
     def __check_parameters(self):
         """ensure that we all required parameters before we start running"""
@@ -488,13 +521,24 @@ class CMonkeyRun:
                 conn.execute("insert into statstypes values ('scoring',?)", [scoring_function.id])
             conn.execute("insert into statstypes values ('scoring',?)", [self.column_scoring.id])
 
+        logging.info("score values: %s, %.1f MB per score matrix", np.dtype(dm.VALUE_TYPE).name,
+                     self.ratios.num_rows * self['num_clusters'] *
+                     np.dtype(dm.VALUE_TYPE).itemsize / 1000000.0)
         if 'profile_mem' in self['debug']:
             with open(os.path.join(self['output_dir'], 'memprofile.tsv'), 'w') as outfile:
-                outfile.write('Iteration\tMembership\tOrganism\tCol\tRow\tNetwork\tMotif\n')
+                names = (['Ratios', 'Membership'] +
+                         [scoring_function.id
+                          for scoring_function in self.row_scoring.scoring_functions] +
+                         [self.column_scoring.id])
+                outfile.write('Iteration\t%s\tTotal\n' % '\t'.join(names))
         ## end MOVED
 
         if self['resume']:
-            self['start_iteration'] = self.get_last_iteration()
+            self.__restored_iteration = self.restore_checkpoint()
+            if self.__restored_iteration is not None:
+                self['start_iteration'] = self.__restored_iteration + 1
+            else:
+                self['start_iteration'] = self.get_last_iteration()
 
         ##return row_scoring, col_scoring
 
@@ -503,6 +547,7 @@ class CMonkeyRun:
         #self.row_scoring = row_scoring
         #self.column_scoring = col_scoring
         self.prepare_run()
+        self.start_worker_pool()
         self.run_iterations()
 
     def residual_for(self, row_names, column_names):
@@ -512,64 +557,64 @@ class CMonkeyRun:
             matrix = self.ratios.submatrix_by_name(row_names, column_names)
             return matrix.residual()
 
-    def write_memberships(self, conn, iteration):
+    def membership_history(self):
+        """Returns the membership history, it continues the history of a resumed run"""
+        if self.__membership_history is None:
+            self.__membership_history = resultdb.MembershipHistory(
+                self.__dbconn(), self['membership_snapshot_interval'])
+        return self.__membership_history
+
+    def write_memberships(self, batch, iteration):
+        """adds the cluster members of the iteration to the result batch, the
+        post processing result is always stored as a snapshot"""
+        members = {'row': set(), 'column': set()}
         for cluster in range(1, self['num_clusters'] + 1):
             column_names = self.membership().columns_for_cluster(cluster)
-            for order_num in self.ratios.column_indexes_for(column_names):
-                conn.execute('''insert into column_members (iteration,cluster,order_num)
-                                values (?,?,?)''', (iteration, cluster, order_num))
+            members['column'].update([(cluster, order_num) for order_num
+                                      in self.ratios.column_indexes_for(column_names)])
 
             row_names = self.membership().rows_for_cluster(cluster)
-            for order_num in self.ratios.row_indexes_for(row_names):
-                conn.execute('''insert into row_members (iteration,cluster,order_num)
-                                values (?,?,?)''', (iteration, cluster, order_num))
+            members['row'].update([(cluster, order_num) for order_num
+                                   in self.ratios.row_indexes_for(row_names)])
+        self.membership_history().add(batch, iteration, members,
+                                      snapshot=iteration > self['num_iterations'])
 
     def write_results(self, iteration_result):
         """write iteration results to database"""
         iteration = iteration_result['iteration']
-        conn = self.__dbconn()
-        with conn:
-            self.write_memberships(conn, iteration)
+        writer = self.result_writer()
+        batch = resultdb.ResultBatch()
+        self.write_memberships(batch, iteration)
 
         if 'motifs' in iteration_result:
             motifs = iteration_result['motifs']
-            with conn:
-                for seqtype in motifs:
-                    for cluster in motifs[seqtype]:
-                        motif_infos = motifs[seqtype][cluster]['motif-info']
-                        for motif_info in motif_infos:
-                            c = conn.cursor()
-                            c.execute('''insert into motif_infos (iteration,cluster,seqtype,motif_num,evalue)
-                                        values (?,?,?,?,?)''',
-                                      (iteration, cluster, seqtype, motif_info['motif_num'],
-                                       motif_info['evalue']))
-                            motif_info_id = c.lastrowid
-                            c.close()
-                            pssm_rows = motif_info['pssm']
-                            for row in xrange(len(pssm_rows)):
-                                pssm_row = pssm_rows[row]
-                                conn.execute('''insert into motif_pssm_rows (motif_info_id,iteration,row,a,c,g,t)
-                                                values (?,?,?,?,?,?,?)''',
-                                             (motif_info_id, iteration, row, pssm_row[0], pssm_row[1],
-                                              pssm_row[2], pssm_row[3]))
-                            annotations = motif_info['annotations']
-                            for annotation in annotations:
-                                gene_num = self.gene_indexes[annotation['gene']]
-                                conn.execute('''insert into motif_annotations (motif_info_id,
-                                                iteration,gene_num,
-                                                position,reverse,pvalue) values (?,?,?,?,?,?)''',
-                                             (motif_info_id, iteration, gene_num,
-                                              annotation['position'],
-                                              annotation['reverse'], annotation['pvalue']))
-
-                            sites = motif_info['sites']
-                            if len(sites) > 0 and isinstance(sites[0], tuple):
-                                for seqname, strand, start, pval, flank_left, seq, flank_right in sites:
-                                    conn.execute('''insert into meme_motif_sites (motif_info_id, seq_name, reverse, start, pvalue, flank_left, seq, flank_right)
-                                                    values (?,?,?,?,?,?,?,?)''',
-                                                 (motif_info_id, seqname, strand == '-',
-                                                  start, pval, flank_left, seq,
-                                                  flank_right))
+            for seqtype in motifs:
+                for cluster in motifs[seqtype]:
+                    motif_infos = motifs[seqtype][cluster]['motif-info']
+                    for motif_info in motif_infos:
+                        motif_info_id = writer.next_motif_info_id()
+                        batch.add('motif_infos', [(motif_info_id, iteration, cluster, seqtype,
+                                                   motif_info['motif_num'],
+                                                   motif_info['evalue'])])
+                        batch.add('motif_pssm_rows',
+                                  [(motif_info_id, iteration, row,
+                                    pssm_row[0], pssm_row[1], pssm_row[2], pssm_row[3])
+                                   for row, pssm_row in enumerate(motif_info['pssm'])])
+                        batch.add('motif_annotations',
+                                  [(motif_info_id, iteration,
+                                    self.gene_indexes[annotation['gene']],
+                                    annotation['position'], annotation['reverse'],
+                                    annotation['pvalue'])
+                                   for annotation in motif_info['annotations']])
+
+                        sites = motif_info['sites']
+                        if len(sites) > 0 and isinstance(sites[0], tuple):
+                            batch.add('meme_motif_sites',
+                                      [(motif_info_id, seqname, strand == '-', start, pval,
+                                        flank_left, seq, flank_right)
+                                       for seqname, strand, start, pval, flank_left, seq,
+                                       flank_right in sites])
+        writer.write(batch)
 
     def write_stats(self, iteration_result):
         # write stats for this iteration
@@ -579,58 +624,48 @@ class CMonkeyRun:
         motif_pvalues = iteration_result['motif-pvalue'] if 'motif-pvalue' in iteration_result else {}
         fuzzy_coeff = iteration_result['fuzzy-coeff'] if 'fuzzy-coeff' in iteration_result else 0.0
 
-        residuals = []
-        conn = self.__dbconn()
-        cur = conn.cursor()
-        with conn:
-            for cluster in range(1, self['num_clusters'] + 1):
-                row_names = self.membership().rows_for_cluster(cluster)
-                column_names = self.membership().columns_for_cluster(cluster)
-                residual = self.residual_for(row_names, column_names)
-                residuals.append(residual)
-                try:
-                    conn.execute('''insert into cluster_stats (iteration, cluster, num_rows,
-                                    num_cols, residual) values (?,?,?,?,?)''',
-                                 (iteration, cluster, len(row_names), len(column_names),
-                                  residual))
-                except:
-                    # residual is messed up, insert with 1.0
-                    logging.warn('STATS: residual was messed up, insert with 1.0')
-                    conn.execute('''insert into cluster_stats (iteration, cluster, num_rows,
-                                    num_cols, residual) values (?,?,?,?,?)''',
-                                 (iteration, cluster, len(row_names), len(column_names),
-                                  1.0))
-
-            median_residual = np.median(residuals)
-            conn.execute("insert into iteration_stats (statstype,iteration,score) values (?,?,?)",
-                         (1, iteration, fuzzy_coeff))
-
+        def score_value(value, name):
+            """the value as a float, values that can not be stored are stored as 1.0"""
             try:
-                conn.execute("insert into iteration_stats (statstype,iteration,score) values (?,?,?)", (2, iteration, median_residual))
+                return float(value)
             except:
-                logging.warn('STATS: median was messed up, insert with 1.0')
-                conn.execute("insert into iteration_stats (statstype,iteration,score) values (?,?,?)", (2, iteration, 1.0))
+                logging.warn('STATS: %s was messed up, insert with 1.0', name)
+                return 1.0
 
-            # insert the score means
-            for fun_id in iteration_result['score_means']:
-                cur.execute("select rowid from statstypes where category='scoring' and name=?", [fun_id])
-                type_id = cur.fetchone()[0]
-                conn.execute('insert into iteration_stats (statstype,iteration,score) values (?,?,?)',
-                             [type_id, iteration, iteration_result['score_means'][fun_id]])
+        residuals = []
+        batch = resultdb.ResultBatch()
+        for cluster in range(1, self['num_clusters'] + 1):
+            row_names = self.membership().rows_for_cluster(cluster)
+            column_names = self.membership().columns_for_cluster(cluster)
+            residual = self.residual_for(row_names, column_names)
+            residuals.append(residual)
+            batch.add('cluster_stats', [(iteration, cluster, len(row_names), len(column_names),
+                                         score_value(residual, 'residual'))])
 
-        with conn:
-            for network, score in network_scores.iteritems():
-                cur.execute("select rowid from statstypes where category='network' and name=?", [network])
-                typeid = cur.fetchone()[0]
-                conn.execute("insert into iteration_stats values (?,?,?)",
-                             (typeid, iteration, score))
-        with conn:
-            for seqtype, pval in motif_pvalues.iteritems():
-                cur.execute("select rowid from statstypes where category='seqtype' and name=?", [seqtype])
-                typeid = cur.fetchone()[0]
-                conn.execute("insert into iteration_stats values (?,?,?)",
-                             (typeid, iteration, pval))
+        median_residual = np.median(residuals)
+        batch.add('iteration_stats', [(1, iteration, fuzzy_coeff),
+                                      (2, iteration, score_value(median_residual, 'median'))])
+
+        # insert the score means
+        conn = self.__dbconn()
+        cur = conn.cursor()
+        for fun_id in iteration_result['score_means']:
+            cur.execute("select rowid from statstypes where category='scoring' and name=?", [fun_id])
+            type_id = cur.fetchone()[0]
+            batch.add('iteration_stats',
+                      [(type_id, iteration,
+                        score_value(iteration_result['score_means'][fun_id], fun_id))])
+
+        for network, score in network_scores.iteritems():
+            cur.execute("select rowid from statstypes where category='network' and name=?", [network])
+            typeid = cur.fetchone()[0]
+            batch.add('iteration_stats', [(typeid, iteration, score_value(score, network))])
+        for seqtype, pval in motif_pvalues.iteritems():
+            cur.execute("select rowid from statstypes where category='seqtype' and name=?", [seqtype])
+            typeid = cur.fetchone()[0]
+            batch.add('iteration_stats', [(typeid, iteration, score_value(pval, seqtype))])
         cur.close()
+        self.result_writer().write(batch)
 
     def write_start_info(self):
         conn = self.__dbconn()
@@ -654,9 +689,9 @@ class CMonkeyRun:
                           '$Id$'))
 
     def update_iteration(self, iteration):
-        conn = self.__dbconn()
-        with conn:
-            conn.execute('''update run_infos set last_iteration = ?''', (iteration,))
+        batch = resultdb.ResultBatch()
+        batch.add('last_iteration', [(iteration,)])
+        self.result_writer().write(batch)
             
     def get_last_iteration(self):
         """Return the last iteration listed in cMonkey database.  This is intended to
@@ -671,13 +706,72 @@ class CMonkeyRun:
             iteration = 1
         return iteration
 
+    def finalize_results(self):
+        """waits for the pending result writes and creates the result indexes"""
+        self.flush_results()
+        resultdb.create_indexes(self.__dbconn())
+
     def write_finish_info(self):
+        if self.__result_writer is not None:
+            self.__result_writer.close()
+            self.__result_writer = None
         conn = self.__dbconn()
         with conn:
             conn.execute('''update run_infos set finish_time = ?''', (datetime.now(),))
 
-    def combined_rscores_pickle_path(self):
-        return "%s/combined_rscores_last.pkl" % self.config_params['output_dir']
+    def checkpoint_path(self):
+        return checkpoint.checkpoint_path(self['output_dir'])
+
+    def __checkpoint_fingerprint(self):
+        return checkpoint.run_fingerprint(self.ratios.row_names, self.ratios.column_names,
+                                          self['num_clusters'])
+
+    def write_checkpoint(self, iteration):
+        """writes the run state after the specified iteration to the checkpoint,
+        the results of the iteration are written to the database first"""
+        self.flush_results()
+        state = {}
+        checkpoint.add_component_state(state, 'membership',
+                                       self.membership().checkpoint_state())
+        checkpoint.add_component_state(state, 'row_scoring',
+                                       self.row_scoring.checkpoint_state())
+        checkpoint.add_component_state(state, 'column_scoring',
+                                       self.column_scoring.checkpoint_state())
+        checkpoint.add_component_state(state, 'rng', checkpoint.rng_state())
+        checkpoint.write_checkpoint(self.checkpoint_path(), iteration,
+                                    self.__checkpoint_fingerprint(), state)
+
+    def restore_checkpoint(self):
+        """Restores the run state from the checkpoint in the output directory.
+        The results written after the checkpoint are deleted from the output
+        database. Returns the iteration the checkpoint was written after or
+        None if there is no checkpoint that fits this run"""
+        path = self.checkpoint_path()
+        if not os.path.exists(path):
+            return None
+        start_time = util.current_millis()
+        try:
+            iteration, state = checkpoint.read_checkpoint(path, self.__checkpoint_fingerprint())
+            self.membership().restore_checkpoint(checkpoint.component_state(state, 'membership'))
+        except checkpoint.CheckpointError, e:
+            logging.warn("can not resume from checkpoint '%s': %s", path, str(e))
+            return None
+        self.row_scoring.restore_checkpoint(checkpoint.component_state(state, 'row_scoring'))
+        self.column_scoring.restore_checkpoint(
+            checkpoint.component_state(state, 'column_scoring'))
+        checkpoint.restore_rng_state(checkpoint.component_state(state, 'rng'))
+        # the iterations after the checkpoint are run again
+        resultdb.delete_after_iteration(self.__dbconn(), iteration)
+        logging.info("restored the checkpoint of iteration %d in %d ms.", iteration,
+                     util.current_millis() - start_time)
+        return iteration
+
+    def checkpoint_due(self, iteration):
+        """checkpoints are written every checkpoint_interval iterations
+        and after the last iteration, an interval of 0 disables them"""
+        interval = self['checkpoint_interval']
+        return interval > 0 and (iteration % interval == 0 or
+                                 iteration == self['num_iterations'])
 
     def run_iteration(self, iteration, force=False):
         """Run a single cMonkey iteration
@@ -736,21 +830,34 @@ class CMonkeyRun:
         if 'dump_results' in self['debug'] and (iteration == 1 or
                                                 (iteration % self['debug_freq'] == 0)):
             # write complete result into a cmresults.tsv
+            self.flush_results()
             conn = self.__dbconn()
             path =  os.path.join(self['output_dir'], 'cmresults-%04d.tsv.bz2' % iteration)
             with bz2.BZ2File(path, 'w') as outfile:
                 debug.write_iteration(conn, outfile, iteration,
                                       self['num_clusters'], self['output_dir'])
 
+    def memory_report(self):
+        """Returns the number of bytes of the arrays of the run's components:
+        the ratios, the memberships and the data each scoring function keeps
+        between iterations"""
+        membership = self.membership()
+        report = collections.OrderedDict()
+        report['Ratios'] = self.ratios.values.nbytes
+        report['Membership'] = membership.row_membs.nbytes + membership.col_membs.nbytes
+        for scoring_function in self.row_scoring.scoring_functions:
+            report[scoring_function.id] = scoring_function.memory_usage()
+        report[self.column_scoring.id] = self.column_scoring.memory_usage()
+        return report
+
     def write_mem_profile(self, outfile, iteration):
-        membsize = sizes.asizeof(self.membership()) / 1000000.0
-        orgsize = sizes.asizeof(self.organism()) / 1000000.0
-        colsize = sizes.asizeof(self.column_scoring) / 1000000.0
-        funs = self.row_scoring.scoring_functions
-        rowsize = sizes.asizeof(funs[0]) / 1000000.0
-        netsize = sizes.asizeof(funs[1]) / 1000000.0
-        motsize = sizes.asizeof(funs[2]) / 1000000.0
-        outfile.write('%d\t%.4f\t%.4f\t%.4f\t%.4f\t%.4f\t%.4f\n' % (iteration, membsize, orgsize, colsize, rowsize, netsize, motsize))
+        report = self.memory_report()
+        logging.info("memory (MB): %s", ', '.join(['%s: %.1f' % (name, size / 1000000.0)
+                                                   for name, size in report.items()]))
+        outfile.write('%d\t%s\t%.4f\n' % (iteration,
+                                           '\t'.join(['%.4f' % (size / 1000000.0)
+                                                      for size in report.values()]),
+                                           sum(report.values()) / 1000000.0))
 
     def run_iterations(self, start_iter=None, num_iter=None):
         if start_iter is None:
@@ -766,11 +873,15 @@ class CMonkeyRun:
         for iteration in range(start_iter, num_iter):
             start_time = util.current_millis()
             
-            #02-09-15 Force recalculation if first iteration of a resume
+            #02-09-15 Force recalculation if first iteration of a resume,
+            # unless the scores were restored from a checkpoint
             force = False
-            if (iteration == start_iter) and (self['resume'] == True):
+            if ((iteration == start_iter) and (self['resume'] == True) and
+                self.__restored_iteration is None):
                 force=True
             self.run_iteration(iteration, force=force) 
+            if self.checkpoint_due(iteration):
+                self.write_checkpoint(iteration)
             # garbage collection after everything in iteration went out of scope
             gc.collect()
             elapsed = util.current_millis() - start_time
@@ -781,6 +892,8 @@ class CMonkeyRun:
                     self.write_mem_profile(outfile, iteration)
 
 
+        self.finalize_results()
+
         """run post processing after the last iteration. We store the results in
         num_iterations + 1 to have a clean separation"""
         if self['postadjust']:
@@ -804,8 +917,8 @@ class CMonkeyRun:
             combined_scores = self.row_scoring.compute_force(iteration_result)
 
             # write the combined scores for benchmarking/diagnostics
-            with open(self.combined_rscores_pickle_path(), 'w') as outfile:
-                cPickle.dump(combined_scores, outfile)
+            scorestore.run_store(self.config_params).write('combined_rscores',
+                                                           combined_scores)
 
             self.write_results(iteration_result)
             self.write_stats(iteration_result)
@@ -814,6 +927,7 @@ class CMonkeyRun:
             # default behaviour:
             # always write complete result into a cmresults.tsv for R/cmonkey
             # compatibility
+            self.flush_results()
             conn = self.__dbconn()
             path =  os.path.join(self['output_dir'], 'cmresults-postproc.tsv.bz2')
             with bz2.BZ2File(path, 'w') as outfile:
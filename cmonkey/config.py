@@ -106,6 +106,8 @@ def set_config_general(config, params):
     params['postadjust'] = config.getboolean('General', 'postadjust')
     params['log_subresults'] = config.getboolean('General', 'log_subresults')
     params['add_fuzz'] = config.get('General', 'add_fuzz')
+    params['stats_backend'] = get_config_str(config, 'General', 'stats_backend',
+                                             util.STATS_BACKEND)
 
     # python can have large seeds, R, however has a 32 bit limit it seems
     params['random_seed'] = get_config_int(config, 'General', 'random_seed',
@@ -113,6 +115,15 @@ def set_config_general(config, params):
     params['stats_freq'] = config.getint('General', 'stats_frequency')
     params['result_freq'] = config.getint('General', 'result_frequency')
     params['debug_freq'] = config.getint('General', 'debug_frequency')
+    params['background_db_writer'] = get_config_boolean(config, 'General',
+                                                        'background_db_writer', False)
+    params['membership_snapshot_interval'] = get_config_int(config, 'General',
+                                                            'membership_snapshot_interval', 100)
+    params['checkpoint_interval'] = get_config_int(config, 'General', 'checkpoint_interval', 100)
+    params['score_cache_mb'] = get_config_int(config, 'General', 'score_cache_mb', None)
+    params['row_score_chunk_bytes'] = get_config_int(config, 'General',
+                                                     'row_score_chunk_bytes', None)
+    params['precision'] = get_config_str(config, 'General', 'precision', 'double')
 
     # implicit parameters for compatibility
     params['use_operons'] = get_config_boolean(config, 'General', 'use_operons', True)
@@ -121,6 +132,7 @@ def set_config_general(config, params):
     params['organism_code'] = get_config_str(config, 'General', 'organism_code', None)
 
     params['use_BSCM'] = get_config_boolean(config, 'General', 'use_BSCM', False)
+    params['bscm_interpolation'] = get_config_int(config, 'General', 'bscm_interpolation', 0)
 
 def set_config_membership(config, params):
     """membership default parameters"""
@@ -368,6 +380,7 @@ def setup_resume(args_in, config_parser):
         params['interactive'] = True
     # TODO END
 
+    util.set_stats_backend(params['stats_backend'])
     return args_in, params, ratios
 
 def setup_default(args, config_parser):
@@ -466,9 +479,10 @@ def setup_default(args, config_parser):
     for key, value in overrides.iteritems():
         params[key] = value
 
+    util.set_stats_backend(params['stats_backend'])
     if params['random_seed'] is not None:
         random.seed(params['random_seed'])
-        util.r_set_seed(params['random_seed'])
+        util.set_random_seed(params['random_seed'])
 
     params['out_database'] = os.path.join(params['output_dir'], params['dbfile_name'])
 
@@ -511,17 +525,13 @@ def read_ratios(params, args_in):
     matrix_factory = dm.DataMatrixFactory(ratio_filters)
     matrix_filename = args_in.ratios
 
+    case_sensitive = params['case_sensitive'] or args_in.case_sensitive
     if matrix_filename.startswith('http://'):
         indata = util.read_url(matrix_filename)
         infile = util.dfile_from_text(indata, has_header=True, quote='\"')
+        return matrix_factory.create_from(infile, case_sensitive)
     else:
-        infile = util.read_dfile(matrix_filename, has_header=True, quote='\"')
-
-    if params['case_sensitive'] or args_in.case_sensitive:
-        ratios = matrix_factory.create_from(infile, True)
-    else:
-        ratios = matrix_factory.create_from(infile, False)
-    return ratios
+        return matrix_factory.create_from_file(matrix_filename, case_sensitive)
 
 
 def write_setup(config_params):
@@ -566,8 +576,23 @@ def write_general_settings(outfile, config_params):
     outfile.write('stats_frequency = %d\n' % config_params['stats_freq'])
     outfile.write('result_frequency = %d\n' % config_params['result_freq'])
     outfile.write('debug_frequency = %d\n' % config_params['debug_freq'])
+    outfile.write('background_db_writer = %s\n' % str(config_params['background_db_writer']))
+    outfile.write('membership_snapshot_interval = %d\n' %
+                  config_params['membership_snapshot_interval'])
+    outfile.write('checkpoint_interval = %d\n' % config_params['checkpoint_interval'])
+    if config_params['score_cache_mb'] is None:
+        outfile.write('score_cache_mb =\n')
+    else:
+        outfile.write('score_cache_mb = %d\n' % config_params['score_cache_mb'])
+    if config_params['row_score_chunk_bytes'] is None:
+        outfile.write('row_score_chunk_bytes =\n')
+    else:
+        outfile.write('row_score_chunk_bytes = %d\n' % config_params['row_score_chunk_bytes'])
+    outfile.write('precision = %s\n' % config_params['precision'])
+    outfile.write('bscm_interpolation = %d\n' % config_params['bscm_interpolation'])
     outfile.write('postadjust = %s\n' % str(config_params['postadjust']))
     outfile.write('add_fuzz = %s\n' % str(config_params['add_fuzz']))
+    outfile.write('stats_backend = %s\n' % config_params['stats_backend'])
     outfile.write('num_clusters = %d\n' % config_params['num_clusters'])
     outfile.write('random_seed = %s\n' % strparam(config_params['random_seed']))
     outfile.write('log_subresults = %s\n' % str(config_params['log_subresults']))
@@ -14,6 +14,23 @@ import os
 import random
 
 
+# The precision policy: the type of the values of new matrices. With
+# 'single', ratios and scores are stored as float32, which halves the
+# memory of the score matrices and their temporaries. Means and variances
+# are accumulated in float64 in both cases (see util.mean() etc.)
+PRECISIONS = {'double': np.float64, 'single': np.float32}
+VALUE_TYPE = np.float64
+
+
+def set_precision(precision):
+    """sets the precision policy, 'double' or 'single'"""
+    global VALUE_TYPE
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision '%s', use one of: %s" %
+                         (precision, ', '.join(sorted(PRECISIONS))))
+    VALUE_TYPE = PRECISIONS[precision]
+
+
 class DataMatrix:
     """
     A two-dimensional data matrix class, with optional row and column names
@@ -21,12 +38,13 @@ class DataMatrix:
     be resized after initialization.
     Names and values of a matrix instance can be modified.
     The values themselves are implemented as a two-dimensional numpy array
-    and returned values are all based on numpy arrays.
+    and returned values are all based on numpy arrays. Unless dtype is
+    specified, the values have the type of the precision policy.
     """
 
     # pylint: disable-msg=R0913
     def __init__(self, nrows, ncols, row_names=None, col_names=None,
-                 values=None, init_value=None):
+                 values=None, init_value=None, dtype=None):
         """create a DataMatrix instance"""
         def check_values():
             """Sets values from a two-dimensional list"""
@@ -53,11 +71,13 @@ class DataMatrix:
                 raise ValueError("number of column names should be %d" % ncols)
             self.column_names = col_names
 
+        if dtype is None:
+            dtype = VALUE_TYPE
         if values is not None:
             check_values()
-            self.values = np.array(values, dtype=np.float64)
+            self.values = np.array(values, dtype=dtype)
         else:
-            self.values = np.zeros((nrows, ncols))
+            self.values = np.zeros((nrows, ncols), dtype=dtype)
             if init_value is not None:
                 self.values.fill(init_value)
 
@@ -149,7 +169,7 @@ class DataMatrix:
         row_pairs = [(row_names[row], row) for row in xrange(len(self.row_names))]
         row_pairs.sort()
         new_row_names = [row_pair[0] for row_pair in row_pairs]
-        new_rows = [self.values[row_pair[1]] for row_pair in row_pairs]
+        new_rows = self.values[[row_pair[1] for row_pair in row_pairs]]
         return DataMatrix(self.num_rows, self.num_columns,
                           new_row_names, self.column_names,
                           values=new_rows)
@@ -220,15 +240,16 @@ class DataMatrix:
         """replaces values < -20 with the smallest value that is >= -20
         replaces all NA/Inf values with the maximum value in the matrix
         """
-        masked = self.values[np.isfinite(self.values)]
+        finite = np.isfinite(self.values)
+        masked = self.values[finite]
         minval = np.min(masked[masked >= min_value])
         maxval = np.max(masked)
-        
-        self.values[np.isinf(self.values)] = maxval
-        self.values[np.isnan(self.values)] = maxval #Should this actually be 0 or median?
+
+        # NA and Inf values, should NA actually be 0 or median?
+        self.values[~finite] = maxval
 
         #01-28-15 reordered to make sure that NAs are removed before this test
-        self.values[self.values < min_value] = np.min(masked[masked >= min_value])
+        self.values[self.values < min_value] = minval
 
     def __repr__(self):
         """returns a string representation of this matrix"""
@@ -312,10 +333,108 @@ class DataMatrixFactory:
 
         data_matrix = DataMatrix(nrows, ncols, rownames, colnames,
                                  values=values)
+        return self.__filter(data_matrix)
+
+    def create_from_file(self, filepath, case_sensitive=True, sep='\t', quote='"'):
+        """creates and returns an initialized, filtered DataMatrix instance
+        directly from a (optionally gzipped) file, see read_matrix_file()"""
+        return self.__filter(read_matrix_file(filepath, sep, quote, case_sensitive))
+
+    def __filter(self, data_matrix):
+        """applies the filters and sorts the result by row name"""
+        return filter_pipeline(self.filters)(data_matrix).sorted_by_row_name()
+
+
+MATRIX_BLOCK_ROWS = 4096
+
+
+def __line_blocks(lines, block_rows):
+    """generator over lists of at most block_rows non-empty lines"""
+    block = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if len(line) > 0:
+            block.append(line)
+            if len(block) == block_rows:
+                yield block
+                block = []
+    if len(block) > 0:
+        yield block
+
+
+def __parse_cells(cells, ncols, sep):
+    """parses the value cells of a block of rows into a (rows x ncols) array.
+    If all rows have ncols cells, the block is parsed as a whole, with 'NA'
+    and empty cells replaced by 'nan', otherwise cell by cell as in
+    DataMatrixFactory.create_from()"""
+    if all([row_cells.count(sep) == ncols - 1 for row_cells in cells]):
+        text = sep + sep.join(cells) + sep
+        for na_cell in [sep + 'NA' + sep, sep + sep]:
+            # two passes, since adjacent NA cells share their separator
+            for _ in xrange(2):
+                text = text.replace(na_cell, sep + 'nan' + sep)
+        values = np.fromstring(text[len(sep):-len(sep)], sep=sep)
+        if values.size == len(cells) * ncols:
+            return values.reshape((len(cells), ncols))
+
+    values = np.empty((len(cells), ncols))
+    for row, row_cells in enumerate(cells):
+        row_cells = row_cells.split(sep)
+        for col in xrange(ncols):
+            strval = row_cells[col]
+            values[row, col] = np.nan if len(strval) == 0 or strval == 'NA' else float(strval)
+    return values
+
+
+def read_matrix_file(filepath, sep='\t', quote='"', case_sensitive=True,
+                     block_rows=MATRIX_BLOCK_ROWS):
+    """Fast path for reading a ratio matrix: the file is read in blocks
+    of rows, each block's numeric cells are parsed in one step straight
+    into a preallocated value array, which grows as needed. The header
+    and cell conventions are the same as in DataMatrixFactory.create_from(),
+    'NA' and empty cells are NaN. Files ending in '.gz' are decompressed
+    on the fly. Returns the unfiltered DataMatrix"""
+    rownames = []
+    colnames = None
+    values = None
+    nrows = 0
+    with util.open_file(filepath) as infile:
+        header = util.read_header(infile, sep, quote=quote)
+        if header is None:
+            raise ValueError("no header in matrix file '%s'" % filepath)
+        ncols = len(header) - 1
 
-        for matrix_filter in self.filters:
-            data_matrix = matrix_filter(data_matrix)
-        return data_matrix.sorted_by_row_name()
+        for block in __line_blocks(infile, block_rows):
+            if quote:
+                block = [line.replace(quote, '') for line in block]
+            rows = [line.split(sep, 1) for line in block]
+            if values is None:
+                # This handles header formats that omit the 0-column
+                if len(block[0].split(sep)) - 1 > ncols:
+                    ncols = len(block[0].split(sep)) - 1
+                    colnames = header
+                values = np.empty((block_rows, ncols))
+            if nrows + len(rows) > values.shape[0]:
+                values.resize((2 * values.shape[0], ncols), refcheck=False)
+
+            if case_sensitive:
+                rownames.extend([intern(row[0]) for row in rows])
+            else:
+                rownames.extend([intern(row[0].upper()) for row in rows])
+            values[nrows:nrows + len(rows)] = __parse_cells(
+                [row[1] if len(row) > 1 else '' for row in rows], ncols, sep)
+            nrows += len(rows)
+
+    if colnames is None:
+        colnames = header[1:len(header)]
+    if values is None:
+        values = np.empty((0, ncols))
+    else:
+        values.resize((nrows, ncols), refcheck=False)
+    # the matrix takes over the parsed values without copying them
+    data_matrix = DataMatrix(nrows, ncols, rownames, map(intern, colnames))
+    data_matrix.values = values
+    return data_matrix
 
 
 FILTER_THRESHOLD = 0.98
@@ -323,55 +442,23 @@ ROW_THRESHOLD = 0.17
 COLUMN_THRESHOLD = 0.1
 
 
+def nochange_selection(values):
+    """returns the indexes of the rows and columns that have large enough
+    measurements, i.e. where the fraction of NaN or near-zero values is
+    below FILTER_THRESHOLD"""
+    with np.errstate(invalid='ignore'):
+        nochange = np.isnan(values) | (np.abs(values) <= ROW_THRESHOLD)
+        rows_to_keep = np.where(nochange.mean(axis=1) < FILTER_THRESHOLD)[0]
+        np.logical_or(np.isnan(values), np.abs(values) <= COLUMN_THRESHOLD,
+                      out=nochange)
+        cols_to_keep = np.where(nochange.mean(axis=0) < FILTER_THRESHOLD)[0]
+    return rows_to_keep, cols_to_keep
+
+
 def nochange_filter(matrix):
     """returns a new filtered DataMatrix containing only the columns and
     rows that have large enough measurements"""
-
-    def nochange_filter_rows(data_matrix):
-        """subfunction of nochange_filter to filter row-wise"""
-        keep = []
-        dmvalues = data_matrix.values
-        for row_index in xrange(data_matrix.num_rows):
-            count = 0
-            for col_index in xrange(data_matrix.num_columns):
-                value = dmvalues[row_index, col_index]
-                if np.isnan(value) or abs(value) <= ROW_THRESHOLD:
-                    count += 1
-            mean = float(count) / data_matrix.num_columns
-            if mean < FILTER_THRESHOLD:
-                keep.append(row_index)
-        return keep
-
-    def nochange_filter_columns(data_matrix):
-        """subfunction of nochange_filter to filter column-wise"""
-        keep = []
-        dmvalues = data_matrix.values
-        for col_index in xrange(data_matrix.num_columns):
-            count = 0
-            for row_index in xrange(data_matrix.num_rows):
-                value = dmvalues[row_index, col_index]
-                if np.isnan(value) or abs(value) <= COLUMN_THRESHOLD:
-                    count += 1
-            mean = float(count) / data_matrix.num_rows
-            if mean < FILTER_THRESHOLD:
-                keep.append(col_index)
-        return keep
-
-    rows_to_keep = nochange_filter_rows(matrix)
-    cols_to_keep = nochange_filter_columns(matrix)
-    colnames = map(lambda col: matrix.column_names[col], cols_to_keep)
-    rownames = map(lambda row: matrix.row_names[row], rows_to_keep)
-    numrows = len(rows_to_keep)
-    numcols = len(cols_to_keep)
-
-    result = DataMatrix(numrows, numcols, rownames, colnames)
-    rvalues = result.values
-    mvalues = matrix.values
-    for row_index in xrange(numrows):
-        for col_index in xrange(numcols):
-            value = mvalues[rows_to_keep[row_index], cols_to_keep[col_index]]
-            rvalues[row_index, col_index] = value
-    return result
+    return filter_pipeline([nochange_filter])(matrix)
 
 
 def row_filter(matrix, fun):
@@ -385,20 +472,80 @@ def row_filter(matrix, fun):
     return result
 
 
+def center_scale_transform(values):
+    """centers the values of each row around the median of its finite values
+    and scales them by their standard deviation, R's sd() rounded to 8
+    digits. The values are modified in place"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        finite = np.where(np.isfinite(values), values, np.nan)
+        num_finite = np.isfinite(finite).sum(axis=1)
+        center = np.nanmedian(finite, axis=1)
+        scale = np.round(np.nanstd(finite, axis=1) /
+                         np.sqrt((num_finite - 1.0) / num_finite), 8)
+        values -= center[:, np.newaxis]
+        values /= scale[:, np.newaxis]
+
+
 def center_scale_filter(matrix):
     """center the values of each row around their median and scale
     by their standard deviation"""
+    return filter_pipeline([center_scale_filter])(matrix)
+
+
+# The array implementations of the standard filters, which can be run on
+# the value array: a selection returns the row and column indexes to keep,
+# a transform modifies the values in place
+FILTER_SELECTIONS = {nochange_filter: nochange_selection}
+FILTER_TRANSFORMS = {center_scale_filter: center_scale_transform}
+
+
+def filter_pipeline(filters):
+    """composes the filters into a single filter function. The standard
+    filters are run on the value array in one pass: selections only narrow
+    down the kept row and column indexes, the selected values are copied
+    once and transformed in place. Other filters are applied to a
+    DataMatrix as usual"""
+    def apply_filters(matrix):
+        values = matrix.values
+        row_names = matrix.row_names
+        column_names = matrix.column_names
+        rows = cols = None
+        owned = False
+
+        def select():
+            if rows is None:
+                return values, owned
+            return values[np.ix_(rows, cols)], True
+
+        for matrix_filter in filters:
+            if matrix_filter in FILTER_SELECTIONS:
+                values, owned = select()
+                rows, cols = FILTER_SELECTIONS[matrix_filter](values)
+                row_names = [row_names[row] for row in rows]
+                column_names = [column_names[col] for col in cols]
+            elif matrix_filter in FILTER_TRANSFORMS:
+                values, owned = select()
+                rows = cols = None
+                if not owned:
+                    values, owned = values.copy(), True
+                FILTER_TRANSFORMS[matrix_filter](values)
+            else:
+                values, owned = select()
+                rows = cols = None
+                result = DataMatrix(values.shape[0], values.shape[1],
+                                    row_names, column_names)
+                result.values = values if owned else values.copy()
+                result = matrix_filter(result)
+                values = result.values
+                row_names, column_names = result.row_names, result.column_names
+                owned = False
+
+        values, owned = select()
+        result = DataMatrix(values.shape[0], values.shape[1], row_names, column_names)
+        result.values = values if owned else values.copy()
+        return result
 
-    def center_scale(row):
-        """centers the provided row around the median"""
-        filtered = row[np.isfinite(row)]
-        center = scipy.median(filtered)
-        scale = util.r_stddev(filtered)
-        nurow = [((value - center) / scale)
-                 if not np.isnan(value) else value for value in row]
-        return nurow
-
-    return row_filter(matrix, center_scale)
+    return apply_filters
 
 
 def quantile_normalize_scores(matrices, weights=None):
@@ -409,9 +556,16 @@ def quantile_normalize_scores(matrices, weights=None):
 
     # rearranges the scores in the input matrices into a matrix
     # with |matrices| columns where the columns contain the values
-    # of each matrix in sorted order
-    flat_values = np.transpose(np.asarray([np.sort(matrix.values.flatten())
-                                           for matrix in matrices]))
+    # of each matrix in sorted order. The sort orders are kept for ranking
+    num_values = matrices[0].values.size
+    orders = np.empty((len(matrices), num_values), dtype=np.int64)
+    sorted_values = np.empty((len(matrices), num_values),
+                             dtype=np.result_type(*[matrix.values for matrix in matrices]))
+    for index, matrix in enumerate(matrices):
+        values = matrix.values.ravel()
+        orders[index] = np.argsort(values)
+        np.take(values, orders[index], out=sorted_values[index])
+    flat_values = sorted_values.T
 
     elapsed = util.current_millis() - start_time
     logging.info("flattened/sorted score matrices in %f s.", elapsed / 1000.0)
@@ -426,11 +580,13 @@ def quantile_normalize_scores(matrices, weights=None):
         tmp_mean = util.row_means(scaled) / scale
     else:
         tmp_mean = util.row_means(flat_values)
+    # the means are accumulated in float64, but stored like the scores
+    tmp_mean = np.asarray(tmp_mean, dtype=flat_values.dtype)
     elapsed = util.current_millis() - start_time
     logging.info("weighted means in %f s.", elapsed / 1000.0)
     start_time = util.current_millis()
 
-    result = qm_result_matrices(matrices, tmp_mean)
+    result = qm_result_matrices(matrices, tmp_mean, orders, sorted_values)
 
     elapsed = util.current_millis() - start_time
     logging.info("result matrices built in %f s.", elapsed / 1000.0)
@@ -450,42 +606,45 @@ def ranks(values):
     return ranks
 
 
-def rank_fun(mat_mean):
-    """ranking function that is run within Pool.map()"""
-    values, row_names, column_names, tmp_mean = mat_mean
-    num_rows, num_cols = values.shape
-    rankvals = util.rrank_matrix(values)
-    values = np.reshape(tmp_mean[rankvals], (num_rows, num_cols))
-    return DataMatrix(num_rows, num_cols, row_names, column_names,
-                      values=values)
+def sorted_min_ranks(sorted_values, out):
+    """writes the 0-based ranks of the sorted values with R's ties='min' to
+    out: the position of the first value that is equal. Like in
+    util.rrank_matrix(), NaN values are not equal to each other"""
+    out[0] = 0
+    np.not_equal(sorted_values[1:], sorted_values[:-1], out=out[1:])
+    np.multiply(out, np.arange(len(out)), out=out)
+    np.maximum.accumulate(out, out=out)
+    return out
 
 
-def qm_result_matrices(matrices, tmp_mean, multiprocessing=True):
+def qm_result_matrices(matrices, tmp_mean, orders=None, sorted_values=None):
     """builds the resulting matrices by looking at the rank of their
-    original values and retrieving the means at the specified position"""
-    if multiprocessing:
-        # parallelized ranking
-        with util.get_mp_pool() as pool:
-            results = pool.map(rank_fun,
-                               [(matrix.values, matrix.row_names, matrix.column_names, tmp_mean)
-                                for matrix in matrices])
-        return results
-    else:
-        # non-parallelized
-        result = []
-        for i in range(len(matrices)):
-            matrix = matrices[i]
-            values = matrix.values
-            num_rows, num_cols = values.shape
-            rankvals = util.rrank_matrix(values)
-            values = np.reshape(tmp_mean[rankvals], (num_rows, num_cols))
-            outmatrix = DataMatrix(num_rows,
-                                   num_cols,
-                                   matrix.row_names,
-                                   matrix.column_names,
-                                   values=values)
-            result.append(outmatrix)
+    original values and retrieving the means at the specified position.
+    orders and sorted_values are the sort orders and the sorted values
+    of the matrices, if they are already known. The ranks are
+    determined in the sort order and the means are written to the
+    result matrices in place"""
+    result = []
+    if len(matrices) == 0:
         return result
+    num_values = matrices[0].values.size
+    min_ranks = np.empty(num_values, dtype=np.int64)
+    means = np.empty(num_values, dtype=tmp_mean.dtype)
+    for index, matrix in enumerate(matrices):
+        if orders is None:
+            order = np.argsort(matrix.values.ravel())
+            matrix_sorted = matrix.values.ravel()[order]
+        else:
+            order = orders[index]
+            matrix_sorted = sorted_values[index]
+        sorted_min_ranks(matrix_sorted, min_ranks)
+        np.take(tmp_mean, min_ranks, out=means)
+        outmatrix = DataMatrix(matrix.num_rows, matrix.num_columns,
+                               matrix.row_names, matrix.column_names,
+                               dtype=tmp_mean.dtype)
+        outmatrix.values.ravel()[order] = means
+        result.append(outmatrix)
+    return result
 
 
 # Ensemble functionality
@@ -508,9 +667,9 @@ def prepare_ensemble_matrix(ratiofile, outdir, n, kmin):
     matrix_factory = DataMatrixFactory([nochange_filter,
                                         center_scale_filter])
     if os.path.exists(ratiofile):
-        infile = util.read_dfile(ratiofile, has_header=True, quote='\"')
-        matrix = matrix_factory.create_from(infile)
+        matrix = matrix_factory.create_from_file(ratiofile)
         split_matrix(matrix, outdir, n, kmin, matrix.num_columns)
 
 
-__all__ = ['DataMatrix', 'DataMatrixFactory', 'nochange_filter', 'center_scale_filter']
+__all__ = ['DataMatrix', 'DataMatrixFactory', 'read_matrix_file', 'nochange_filter',
+           'center_scale_filter', 'filter_pipeline']
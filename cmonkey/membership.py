@@ -12,12 +12,22 @@ import util
 import random
 import logging
 import sys
+import warnings
+import multiprocessing as mp
 import numpy as np
-import rpy2.robjects as robjects
-import cPickle
+import scipy.cluster.vq
 import array
 from collections import defaultdict
 import sqlite3
+import resultdb
+import checkpoint
+import scorestore
+
+# rpy2 is only needed for k-means seeding with the R statistics backend
+try:
+    import rpy2.robjects as robjects
+except ImportError:
+    robjects = None
 
 
 # Default values for membership creation
@@ -38,6 +48,44 @@ KEY_ROW_IS_MEMBER_OF = 'memb.row_is_member_of'
 KEY_COL_IS_MEMBER_OF = 'memb.col_is_member_of'
 
 
+EMPTY_MEMBERS = np.zeros(0, dtype=np.int32)
+
+
+def make_cluster_index(membs):
+    """builds the inverted index cluster -> sorted int32 array of row indexes
+    from a membership array (one cluster number per slot, 0 for empty)"""
+    rows, slots = np.nonzero(membs)
+    clusters = membs[rows, slots]
+    order = np.lexsort((rows, clusters))
+    rows, clusters = rows[order].astype(np.int32), clusters[order]
+    # a row can be in the same cluster in several slots
+    keep = np.ones(len(rows), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (clusters[1:] != clusters[:-1])
+    rows, clusters = rows[keep], clusters[keep]
+    index_clusters, starts = np.unique(clusters, return_index=True)
+    ends = np.append(starts[1:], len(rows))
+    return {int(cluster): rows[start:end]
+            for cluster, start, end in zip(index_clusters, starts, ends)}
+
+
+def add_to_cluster_index(index, cluster, member):
+    """adds the member index to the cluster in an inverted index"""
+    if cluster == 0:
+        return
+    members = index.get(cluster, EMPTY_MEMBERS)
+    pos = np.searchsorted(members, member)
+    if pos == len(members) or members[pos] != member:
+        index[cluster] = np.insert(members, pos, member).astype(np.int32)
+
+
+def remove_from_cluster_index(index, cluster, member):
+    """removes the member index from the cluster in an inverted index"""
+    members = index.get(cluster, EMPTY_MEMBERS)
+    pos = np.searchsorted(members, member)
+    if pos < len(members) and members[pos] == member:
+        index[cluster] = np.delete(members, pos)
+
+
 class OrigMembership:
     """This is an implementation of a membership data structure that more
     closely resembles the R original. It is much simpler than
@@ -82,6 +130,34 @@ class OrigMembership:
             for i in range(len(tmp)):
                 self.col_membs[self.colidx[col]][i] = tmp[i]
 
+        # inverted indexes cluster -> sorted row/column indexes, they are
+        # built on demand from the arrays they refer to and updated
+        # incrementally on membership changes
+        self.__row_members = None
+        self.__row_members_source = None
+        self.__col_members = None
+        self.__col_members_source = None
+
+    def __row_member_index(self):
+        """the cluster -> row indexes map, rebuilt if row_membs was replaced"""
+        if self.__row_members_source is not self.row_membs:
+            self.__row_members = make_cluster_index(self.row_membs)
+            self.__row_members_source = self.row_membs
+        return self.__row_members
+
+    def __col_member_index(self):
+        """the cluster -> column indexes map, rebuilt if col_membs was replaced"""
+        if self.__col_members_source is not self.col_membs:
+            self.__col_members = make_cluster_index(self.col_membs)
+            self.__col_members_source = self.col_membs
+        return self.__col_members
+
+    def invalidate_index(self):
+        """discards the cluster member indexes. This needs to be called
+        after row_membs or col_membs were modified in place"""
+        self.__row_members_source = None
+        self.__col_members_source = None
+
     def write_column_members(self, filename):
         """Mostly for debugging, write out the current column membership state into a TSV file"""
         with open(filename, 'w') as outfile:
@@ -166,19 +242,36 @@ class OrigMembership:
         """returns the number of clusters for the column"""
         return len(self.clusters_for_column(column))
 
+    def row_indexes_for_cluster(self, cluster):
+        """sorted int32 array of the indexes of the rows in the cluster,
+        the result is shared with the index and must not be modified"""
+        return self.__row_member_index().get(cluster, EMPTY_MEMBERS)
+
+    def column_indexes_for_cluster(self, cluster):
+        """sorted int32 array of the indexes of the columns in the cluster,
+        the result is shared with the index and must not be modified"""
+        return self.__col_member_index().get(cluster, EMPTY_MEMBERS)
+
+    def row_member_mask(self, row_names):
+        """boolean matrix with the rows in the order of row_names and a
+        column for each cluster that is True for the cluster's rows"""
+        mask = member_mask(self.row_membs, self.num_clusters())
+        indexes = np.array([self.rowidx.get(name, -1) for name in row_names], dtype=np.int64)
+        result = mask[indexes]
+        result[indexes < 0] = False
+        return result
+
     def rows_for_cluster(self, cluster):
-        idx = set(np.where(self.row_membs == cluster)[0])
-        return {self.row_names[i] for i in idx}
+        return {self.row_names[i] for i in self.row_indexes_for_cluster(cluster)}
 
     def columns_for_cluster(self, cluster):
-        idx = set(np.where(self.col_membs == cluster)[0])
-        return {self.col_names[i] for i in idx}
+        return {self.col_names[i] for i in self.column_indexes_for_cluster(cluster)}
 
     def num_row_members(self, cluster):
-        return len(self.rows_for_cluster(cluster))
+        return len(self.row_indexes_for_cluster(cluster))
 
     def num_column_members(self, cluster):
-        return len(self.columns_for_cluster(cluster))
+        return len(self.column_indexes_for_cluster(cluster))
 
     def clusters_not_in_row(self, row, clusters):
         return [cluster for cluster in clusters
@@ -202,6 +295,7 @@ class OrigMembership:
 
     def add_cluster_to_row(self, row, cluster, force=False):
         rowidx = self.rowidx[row]
+        members = self.__row_member_index()
         free_slots = np.where(self.row_membs[rowidx] == 0)[0]
         if len(free_slots > 0):
             index = free_slots[0]
@@ -214,9 +308,12 @@ class OrigMembership:
             tmp[:, :-1] = self.row_membs
             self.row_membs = tmp
             self.row_membs[rowidx][-1] = cluster
+            self.__row_members_source = self.row_membs
+        add_to_cluster_index(members, cluster, rowidx)
 
     def add_cluster_to_column(self, col, cluster, force=False):
         colidx = self.colidx[col]
+        members = self.__col_member_index()
         free_slots = np.where(self.col_membs[colidx] == 0)[0]
         if len(free_slots) > 0:
             index = free_slots[0]
@@ -229,16 +326,48 @@ class OrigMembership:
             tmp[:, :-1] = self.col_membs
             self.col_membs = tmp
             self.col_membs[colidx][-1] = cluster
+            self.__col_members_source = self.col_membs
+        add_to_cluster_index(members, cluster, colidx)
 
     def replace_row_cluster(self, row, index, new):
-        self.row_membs[self.rowidx[row], index] = new
+        rowidx = self.rowidx[row]
+        members = self.__row_member_index()
+        old = self.row_membs[rowidx, index]
+        self.row_membs[rowidx, index] = new
+        if old not in self.row_membs[rowidx]:
+            remove_from_cluster_index(members, old, rowidx)
+        add_to_cluster_index(members, new, rowidx)
 
     def replace_column_cluster(self, col, index, new):
-        self.col_membs[self.colidx[col], index] = new
-
-    def pickle_path(self):
-        """returns the function-specific pickle-path"""
-        return '%s/last_row_scores.pkl' % (self.__config_params['output_dir'])
+        colidx = self.colidx[col]
+        members = self.__col_member_index()
+        old = self.col_membs[colidx, index]
+        self.col_membs[colidx, index] = new
+        if old not in self.col_membs[colidx]:
+            remove_from_cluster_index(members, old, colidx)
+        add_to_cluster_index(members, new, colidx)
+
+    def worker_delta(self):
+        """the membership state that changes during a run, it is used to update
+        the copies of the membership in the workers of a util.WorkerPool"""
+        return (self.row_membs, self.col_membs)
+
+    def apply_worker_delta(self, delta):
+        """updates a worker's membership copy with a worker_delta()"""
+        self.row_membs = np.array(delta[0])
+        self.col_membs = np.array(delta[1])
+
+    def checkpoint_state(self):
+        """the membership arrays for a run checkpoint"""
+        return {'row_membs': self.row_membs, 'col_membs': self.col_membs}
+
+    def restore_checkpoint(self, state):
+        """restores the memberships of checkpoint_state()"""
+        if (state['row_membs'].shape != self.row_membs.shape or
+            state['col_membs'].shape != self.col_membs.shape):
+            raise checkpoint.CheckpointError("memberships do not match the membership dimensions")
+        self.row_membs = np.array(state['row_membs'], dtype='int32')
+        self.col_membs = np.array(state['col_membs'], dtype='int32')
 
     def update(self, matrix, row_scores, column_scores,
                num_iterations, iteration_result):
@@ -250,17 +379,17 @@ class OrigMembership:
         elapsed = util.current_millis() - start
         logging.debug("fuzzify took %f s.", elapsed / 1000.0)
 
-        # pickle the (potentially fuzzed) row scores to use them
+        # write the (potentially fuzzed) row scores to use them
         # in the post adjustment step. We only need to do that in the last
         # iteration
         iteration = iteration_result['iteration']
         if iteration == num_iterations:
-            with open(self.pickle_path(), 'w') as outfile:
-                cPickle.dump(row_scores, outfile)
+            scorestore.run_store(self.__config_params).write('last_row_scores', row_scores)
 
         start = util.current_millis()
         rd_scores, cd_scores = get_density_scores(self, row_scores,
-                                                  column_scores)
+                                                  column_scores,
+                                                  self.__config_params)
         elapsed = util.current_millis() - start
         logging.debug("GET_DENSITY_SCORES() took %f s.", elapsed / 1000.0)
 
@@ -490,7 +619,7 @@ def get_best_clusters(scores, n, sort=False):
                 for row in xrange(scores.num_rows)}
 
 
-def get_row_density_scores(membership, row_scores):
+def get_row_density_scores(membership, row_scores, config_params=None):
     """getting density scores improves small clusters"""
     num_clusters = membership.num_clusters()
     rscore_range = abs(row_scores.max() - row_scores.min())
@@ -502,19 +631,28 @@ def get_row_density_scores(membership, row_scores):
     rds_values = rd_scores.values
 
     start_time = util.current_millis()
-    for cluster in xrange(1, num_clusters + 1):
-        # instead of assigning the rr_scores values per row, we can assign to the
-        # transpose and let numpy do the assignment
-        rds_values.T[cluster - 1] = get_rr_scores(membership, row_scores,
-                                                  rowscore_bandwidth,
-                                                  cluster)
+    if util.use_native_stats():
+        row_mask = member_mask(membership.row_membs, num_clusters)
+        num_rows = row_mask.sum(axis=0)
+        num_cols = member_mask(membership.col_membs, num_clusters).sum(axis=0)
+        score_mask = row_mask[[membership.rowidx[row] for row in row_scores.row_names]]
+        bandwidths = rowscore_bandwidth * np.exp(-num_rows / 10.0) * 10.0
+        compute_density_scores(rds_values, row_scores.values, score_mask, bandwidths,
+                               (num_rows > 0) & (num_cols > 0), config_params)
+    else:
+        for cluster in xrange(1, num_clusters + 1):
+            # instead of assigning the rr_scores values per row, we can assign to the
+            # transpose and let numpy do the assignment
+            rds_values.T[cluster - 1] = get_rr_scores(membership, row_scores,
+                                                      rowscore_bandwidth,
+                                                      cluster)
 
     elapsed = util.current_millis() - start_time
     logging.debug("RR_SCORES IN %f s.", elapsed / 1000.0)
     return rd_scores
 
 
-def get_col_density_scores(membership, col_scores):
+def get_col_density_scores(membership, col_scores, config_params=None):
     num_clusters = membership.num_clusters()
     cscore_range = abs(col_scores.max() - col_scores.min())
     colscore_bandwidth = max(cscore_range / 100.0, 0.001)
@@ -525,21 +663,80 @@ def get_col_density_scores(membership, col_scores):
     cds_values = cd_scores.values
 
     start_time = util.current_millis()
-    for cluster in xrange(1, num_clusters + 1):
-        # instead of assigning the cc_scores values per row, we can assign to the
-        # transpose and let numpy do the assignment
-        cds_values.T[cluster - 1] = get_cc_scores(membership, col_scores,
-                                                  colscore_bandwidth,
-                                                  cluster)
+    if util.use_native_stats():
+        col_mask = member_mask(membership.col_membs, num_clusters)
+        num_rows = member_mask(membership.row_membs, num_clusters).sum(axis=0)
+        num_cols = col_mask.sum(axis=0)
+        score_mask = col_mask[[membership.colidx[col] for col in col_scores.row_names]]
+        bandwidths = np.repeat(colscore_bandwidth, num_clusters)
+        compute_density_scores(cds_values, col_scores.values, score_mask, bandwidths,
+                               (num_rows > 0) & (num_cols > 1), config_params)
+    else:
+        for cluster in xrange(1, num_clusters + 1):
+            # instead of assigning the cc_scores values per row, we can assign to the
+            # transpose and let numpy do the assignment
+            cds_values.T[cluster - 1] = get_cc_scores(membership, col_scores,
+                                                      colscore_bandwidth,
+                                                      cluster)
 
     elapsed = util.current_millis() - start_time
     logging.debug("CC_SCORES IN %f s.", elapsed / 1000.0)
     return cd_scores
 
 
-def get_density_scores(membership, row_scores, col_scores):
-    return (get_row_density_scores(membership, row_scores),
-            get_col_density_scores(membership, col_scores))
+def get_density_scores(membership, row_scores, col_scores, config_params=None):
+    return (get_row_density_scores(membership, row_scores, config_params),
+            get_col_density_scores(membership, col_scores, config_params))
+
+
+def member_mask(membs, num_clusters):
+    """turns a membership array (one row per gene/condition, one cluster number
+    per slot, 0 for empty) into a boolean matrix with a column per cluster"""
+    mask = np.zeros((membs.shape[0], max(num_clusters, membs.max()) + 1), dtype=bool)
+    mask[np.arange(membs.shape[0])[:, np.newaxis], membs] = True
+    return mask[:, 1:num_clusters + 1]
+
+
+# Parallelized density scoring: clusters are split into blocks of at least
+# MIN_DENSITY_BLOCK_SIZE columns, which are scored in separate processes
+MIN_DENSITY_BLOCK_SIZE = 100
+DENSITY_SCORE_INPUT = None
+
+
+def compute_density_block(columns):
+    """batched density scores for a block of cluster columns"""
+    values, mask, bandwidths = DENSITY_SCORE_INPUT
+    return util.batch_density(values[:, columns], mask[:, columns], bandwidths[columns])
+
+
+def compute_density_scores(result, values, mask, bandwidths, valid, config_params=None):
+    """batched computation of the density scores of all clusters into result.
+    The columns of values hold the scores for each cluster, mask the cluster
+    memberships. Clusters that are not valid or don't have finite member
+    scores get uniform scores"""
+    global DENSITY_SCORE_INPUT
+
+    columns = np.where(valid & np.any(mask & np.isfinite(values), axis=0))[0]
+    result[:, :] = 1.0 / values.shape[0]
+    if len(columns) == 0:
+        return
+
+    num_blocks = 1
+    if config_params is not None and config_params['multiprocessing']:
+        num_cores = config_params.get('num_cores', None) or mp.cpu_count()
+        num_blocks = min(num_cores, len(columns) / MIN_DENSITY_BLOCK_SIZE)
+
+    if num_blocks > 1:
+        DENSITY_SCORE_INPUT = (values, mask, bandwidths)
+        blocks = np.array_split(columns, num_blocks)
+        with util.get_mp_pool(config_params, shared=['DENSITY_SCORE_INPUT']) as pool:
+            block_results = pool.map(compute_density_block, blocks)
+        DENSITY_SCORE_INPUT = None
+        for block, block_result in zip(blocks, block_results):
+            result[:, block] = block_result
+    else:
+        result[:, columns] = util.batch_density(values[:, columns], mask[:, columns],
+                                                bandwidths[columns])
 
 
 def get_rr_scores(membership, rowscores, bandwidth, cluster):
@@ -642,6 +839,32 @@ def old_fuzzy_coefficient(iteration, num_iterations):
     return 0.75 * math.exp(-iteration/(num_iterations/4.0))
 
 
+def native_kmeans(values, num_clusters, iterations=20):
+    """k-means clustering of the rows of values for the native statistics
+    backend. The initial centers are distinct rows drawn from util.STATS_RNG,
+    so the clustering follows the random seed of the run. Like R's kmeans(),
+    it never returns empty clusters: an empty cluster takes over the row that
+    is farthest from the center of a cluster with more than one row.
+    Returns the 0-based cluster of each row"""
+    centers = values[util.STATS_RNG.choice(values.shape[0], num_clusters, replace=False)]
+    with warnings.catch_warnings():
+        # empty clusters are handled below
+        warnings.simplefilter('ignore', UserWarning)
+        _, labels = scipy.cluster.vq.kmeans2(values, centers, iter=iterations,
+                                             minit='matrix')
+    sizes = np.bincount(labels, minlength=num_clusters)
+    for cluster in np.where(sizes == 0)[0]:
+        centers = np.array([values[labels == i].mean(axis=0) if sizes[i] > 0
+                            else values[0] for i in xrange(num_clusters)])
+        distances = ((values - centers[labels]) ** 2).sum(axis=1)
+        distances[sizes[labels] <= 1] = -1.0
+        row = np.argmax(distances)
+        sizes[labels[row]] -= 1
+        labels[row] = cluster
+        sizes[cluster] = 1
+    return labels
+
+
 def make_kmeans_row_seeder(num_clusters):
     """creates a row seeding function based on k-means"""
 
@@ -649,6 +872,13 @@ def make_kmeans_row_seeder(num_clusters):
         """uses k-means seeding to seed row membership"""        
         flat_values = matrix.values.flatten()
         flat_values[np.isnan(flat_values)] = 0.0
+        if util.use_native_stats():
+            values = flat_values.reshape(matrix.num_rows, matrix.num_columns)
+            seeding = native_kmeans(values, num_clusters)
+            for row in xrange(len(seeding)):
+                row_membership[row][0] = seeding[row] + 1
+            return
+
         matrix_values = robjects.r.matrix(
             robjects.FloatVector(flat_values), nrow=matrix.num_rows, byrow=True)
         kmeans = robjects.r['kmeans']
@@ -705,12 +935,12 @@ def make_db_row_seeder(outdb):
         conn = sqlite3.connect(outdb)
         cursor = conn.cursor()
         try:
-            cursor.execute('select max(iteration) from row_members')
-            iteration = cursor.fetchone()[0]
-            cursor.execute('select cluster, name from row_members rm join row_names rn on rm.order_num=rn.order_num where iteration=?', [iteration])
+            iteration = resultdb.last_member_iteration(conn)
+            cursor.execute('select order_num, name from row_names')
+            row_names = dict(cursor.fetchall())
             row_clusters = defaultdict(list)
-            for cluster, row_name in cursor.fetchall():
-                row_clusters[row_name].append(cluster)
+            for cluster, order_num in resultdb.read_members(conn, 'row', iteration):
+                row_clusters[row_names[order_num]].append(cluster)
 
             # copy memberships
             #for row_name in matrix.row_names:
@@ -740,12 +970,12 @@ def make_db_column_seeder(outdb):
         conn = sqlite3.connect(outdb)
         cursor = conn.cursor()
         try:
-            cursor.execute('select max(iteration) from column_members')
-            iteration = cursor.fetchone()[0]
-            cursor.execute('select cluster, name from column_members cm join column_names cn on cm.order_num=cn.order_num where iteration=?', [iteration])
+            iteration = resultdb.last_member_iteration(conn)
+            cursor.execute('select order_num, name from column_names')
+            column_names = dict(cursor.fetchall())
             col_clusters = defaultdict(list)
-            for cluster, col_name in cursor.fetchall():
-                col_clusters[col_name].append(cluster)
+            for cluster, order_num in resultdb.read_members(conn, 'column', iteration):
+                col_clusters[column_names[order_num]].append(cluster)
             result = [[0] * num_clusters_per_column for col in matrix.column_names]
             for col_name in matrix.column_names:
                 cur_map = column_map[col_name]
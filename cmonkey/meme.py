@@ -10,11 +10,15 @@ import subprocess
 import tempfile
 import logging
 import seqtools as st
+import motifscan
 import os
 import util
 import shutil
 import re
 import collections
+import itertools
+import hashlib
+import atexit
 import xml.etree.ElementTree as ET
 
 
@@ -44,12 +48,48 @@ class MemeSuite:
         self.bgmodel = bgmodel
         self.__remove_tempfiles = remove_tempfiles
         self.arg_mod = config_params['MEME']['arg_mod']
+        self.__native_scan = config_params['MEME'].get('scanner', 'mast') == 'native'
+        self.__scan_database = None
 
     def global_background_file(self):
         """returns the global background file used with this meme suite
         instance"""
         return self.__background_file
 
+    def update_scan_database(self, all_seqs):
+        """makes the MAST database and background counts for the sequences
+        in all_seqs available to the subsequent motif runs of this suite"""
+        if self.__scan_database is None:
+            self.__scan_database = ScanDatabase(self.__use_revcomp, self.background_order)
+        self.__scan_database.update(all_seqs)
+
+    def scan_database(self):
+        """returns the shared scan database or None if there is none"""
+        return self.__scan_database
+
+    def uses_native_scanner(self):
+        """True if the MEME results are scanned with scan_motifs() instead
+        of MAST"""
+        return self.__native_scan
+
+    def scan_motifs(self, runs, all_seqs):
+        """scans the motifs of several MEME runs in one batch with the native
+        scanner. runs is a list of (feature_ids, genes, motif_infos) and
+        the result is a list of (pe_values, annotations) in the same order,
+        the format is the same as read_mast_output()"""
+        self.update_scan_database(all_seqs)
+        motif_sets = []
+        for feature_ids, genes, motif_infos in runs:
+            if self.bgmodel is not None:
+                bgmodel = self.bgmodel
+            else:
+                bgmodel = self.__scan_database.leave_out_model(feature_ids, all_seqs)
+            frequencies = [bgmodel[0].get(base, 0.0) for base in motifscan.ALPHABET]
+            total = sum(frequencies)
+            motif_sets.append(motifscan.MotifSet(
+                motif_infos, [frequency / total for frequency in frequencies], genes))
+        return self.__scan_database.scanner().scan(motif_sets)
+
     def remove_low_complexity(self, seqs):
         """send sequences through dust filter, send only those
         to dust that are larger than max_width"""
@@ -97,12 +137,16 @@ class MemeSuite:
         feature_ids = set(params.feature_ids)  # optimization: reduce lookup time
         input_seqs = params.seqs
         all_seqs = params.used_seqs
+        scan_database = self.__scan_database
 
         def background_file():
             """decide whether to use global or specific background file"""
             if self.__background_file is not None:
                 #logging.info("using global background: '%s'", self.__background_file)
                 return self.__background_file
+            elif scan_database is not None:
+                return write_background_file(
+                    scan_database.leave_out_model(feature_ids, all_seqs))
             else:
                 bgseqs = {feature_id: all_seqs[feature_id]
                           for feature_id in all_seqs
@@ -129,18 +173,27 @@ class MemeSuite:
                                         'meme-out-%04d-%04d' % (params.iteration, params.cluster))
             with open(meme_outfile, 'w') as outfile:
                 outfile.write(output)
-        else:
+        elif not self.__native_scan:
+            # MAST reads the motifs from a file, the native scanner uses motif_infos
             with tempfile.NamedTemporaryFile(prefix='meme.out.',
                                              delete=False) as outfile:
                 meme_outfile = outfile.name
                 outfile.write(output)
 
         #logging.info('wrote meme output to %s', meme_outfile)
-        dbfile = self.make_sequence_file(
-            [(feature_id, locseq[1])
-             for feature_id, locseq in all_seqs.iteritems()])
+        if self.__native_scan:
+            dbfile = None
+        elif scan_database is not None:
+            dbfile = scan_database.dbfile
+        else:
+            dbfile = self.make_sequence_file(
+                [(feature_id, locseq[1])
+                 for feature_id, locseq in all_seqs.iteritems()])
         #logging.info('created mast database in %s', dbfile)
         try:
+            if self.__native_scan:
+                # the motifs of all runs are scanned together, see scan_motifs()
+                return MemeRunResult(None, None, motif_infos)
             mast_output = self.mast(meme_outfile, dbfile, bgfile)
             if 'keep_mastout' in params.debug:
                 with open('%s.mast' % meme_outfile, 'w') as outfile:
@@ -163,12 +216,14 @@ class MemeSuite:
                 except:
                     logging.warn("could not remove tmp file: '%s'", seqfile)
                 try:
-                    if 'keep_memeout' not in params.debug and not is_last_iteration:
+                    if (meme_outfile is not None and 'keep_memeout' not in params.debug and
+                        not is_last_iteration):
                         os.remove(meme_outfile)
                 except:
                     logging.warn("could not remove tmp file: '%s'", meme_outfile)
                 try:
-                    os.remove(dbfile)
+                    if dbfile is not None and scan_database is None:
+                        os.remove(dbfile)
                 except:
                     logging.warn("could not remove tmp file: '%s'", dbfile)
 
@@ -245,8 +300,7 @@ class MemeSuite430(MemeSuite):
             command.extend(['-psp', pspfile_path])
 
         #logging.info("running: %s", " ".join(command))
-        output = subprocess.check_output(command)
-        return (read_meme_output(output, num_motifs), output)
+        return run_meme(command, num_motifs)
 
     def mast(self, meme_outfile_path, database_file_path,
              bgfile_path):
@@ -307,8 +361,7 @@ class MemeSuite481(MemeSuite):
 
         #logging.info("running: %s", " ".join(command))
         try:
-            output = subprocess.check_output(command)
-            return (read_meme_output(output, num_motifs), output)
+            return run_meme(command, num_motifs)
         except:
             print command
             raise
@@ -384,95 +437,105 @@ class MemeMotifInfo:
                  str(self.evalue)))
 
 
-def read_meme_output(output_text, num_motifs):
-    """Reads meme output file into a list of MotifInfo objects"""
+# MEME text output, the motif numbers are either on the info line
+# ("MOTIF  1\twidth = ...") or after the consensus ("MOTIF ACGT MEME-1\twidth = ...")
+MEME_INFO_LINE = re.compile('MOTIF\s+(\S+)(?:\s+MEME-(\d+))?\s+width =\s+(\d+)\s+' +
+                            'sites =\s+(\d+)\s+llr =\s+(\d+)\s+E-value =\s+(\S+)')
+MEME_SITES_HEADER = re.compile('[\t]Motif \S+(?: MEME-\d+)? sites sorted by position p-value')
+MEME_PSSM_HEADER = re.compile('[\t]Motif \S+(?: MEME-\d+)? position-specific ' +
+                              'probability matrix')
+MEME_SITE_LINE = re.compile("(\S+)\s+([+-])\s+(\d+)\s+(\S+)\s+(\S+) (\S+) (\S+)?")
+MEME_PSSM_ROW = re.compile("\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)")
+MEME_SECTION_END = '----------------------'
 
-    def extract_width(infoline):
-        """extract the width value from the info line"""
-        return int(__extract_regex('width =\s+\d+', infoline))
-
-    def extract_num_sites(infoline):
-        """extract the sites value from the info line"""
-        return int(__extract_regex('sites =\s+\d+', infoline))
-
-    def extract_llr(infoline):
-        """extract the llr value from the info line"""
-        return int(__extract_regex('llr =\s+\d+', infoline))
-
-    def extract_evalue(infoline):
-        """extract the e-value from the info line"""
-        return float(__extract_regex('E-value =\s+\S+', infoline))
-
-    def next_info_line(motif_number, lines):
-        """finds the index of the next info line for the specified motif number
-        1-based """
-        return __next_regex_index('MOTIF\s+' + str(motif_number) + '.*',
-                                  0, lines)
-
-    def next_sites_index(start_index, lines):
-        """returns the next sites index"""
-        return __next_regex_index('[\t]Motif \d+ sites sorted by position ' +
-                                  'p-value', start_index, lines)
-
-    def read_sites(start_index, lines):
-        """reads the sites"""
-        sites_index = next_sites_index(start_index, lines)
-        pattern = re.compile(
-            "(\S+)\s+([+-])\s+(\d+)\s+(\S+)\s+(\S+) (\S+) (\S+)?")
-        current_index = sites_index + 4
-        line = lines[current_index]
+
+def iter_meme_motifs(lines):
+    """Reads MEME text output from an iterable of lines, e.g. a file or
+    a pipe, in a single pass and yields a MemeMotifInfo as soon as the
+    probability matrix of a motif was read"""
+
+    def read_sites(lines):
+        """reads the sites, lines is positioned at the section header"""
+        for _ in xrange(3):
+            next(lines)
         sites = []
-        while not line.startswith('----------------------'):
-            match = pattern.match(line)
+        for line in lines:
+            if line.startswith(MEME_SECTION_END):
+                break
+            match = MEME_SITE_LINE.match(line)
             if match is None:
-                logging.error("ERROR in read_sites(), line(#%d) is: '%s'", current_index, line)
+                logging.error("ERROR in read_sites(), line is: '%s'", line)
             sites.append((match.group(1), match.group(2), int(match.group(3)),
                           float(match.group(4)),
                           match.group(5), match.group(6), match.group(7)))
-            current_index += 1
-            line = lines[current_index]
         return sites
 
-    def read_pssm(start_index, lines):
+    def read_pssm(lines):
         """reads the PSSM, in this case it's what is called the probability
         matrix in the meme output"""
-        pssm_index = next_pssm_index(start_index, lines)
-        current_index = pssm_index + 3
-        line = lines[current_index]
-        pattern = re.compile("\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)")
+        for _ in xrange(2):
+            next(lines)
         rows = []
-        while not line.startswith('----------------------'):
-            match = pattern.match(line)
+        for line in lines:
+            if line.startswith(MEME_SECTION_END):
+                break
+            match = MEME_PSSM_ROW.match(line)
             if match is None:
-                logging.error("ERROR in read_pssm(), line(#%d) is: '%s'", current_index, line)
+                logging.error("ERROR in read_pssm(), line is: '%s'", line)
             rows.append([float(match.group(1)), float(match.group(2)),
                          float(match.group(3)), float(match.group(4))])
-            current_index += 1
-            line = lines[current_index]
         return rows
 
-    def next_pssm_index(start_index, lines):
-        """determines the next PSSM start index"""
-        return __next_regex_index('[\t]Motif \d+ position-specific ' +
-                                  'probability matrix', start_index, lines)
-
-    def read_motif_info(motif_number, lines):
-        """Reads the MemeMotifInfo with the specified number from the input"""
-        info_line_index = next_info_line(motif_number, lines)
-        info_line = lines[info_line_index]
-        return MemeMotifInfo(read_pssm(info_line_index + 1, lines),
-                             motif_number,
-                             extract_width(info_line),
-                             extract_num_sites(info_line),
-                             extract_llr(info_line),
-                             extract_evalue(info_line),
-                             read_sites(info_line_index + 1, lines))
-
-    lines = output_text.split('\n')
-    result = []
-    for motif_number in xrange(1, num_motifs + 1):
-        result.append(read_motif_info(motif_number, lines))
-    return result
+    lines = (line.rstrip('\r\n') for line in lines)
+    info = None
+    sites = []
+    for line in lines:
+        if line.startswith('MOTIF'):
+            match = MEME_INFO_LINE.match(line)
+            if match is not None:
+                info = match
+                sites = []
+        elif info is not None and line.startswith('\tMotif'):
+            if MEME_SITES_HEADER.match(line):
+                sites = read_sites(lines)
+            elif MEME_PSSM_HEADER.match(line):
+                yield MemeMotifInfo(read_pssm(lines),
+                                    int(info.group(2) or info.group(1)),
+                                    int(info.group(3)), int(info.group(4)),
+                                    int(info.group(5)), float(info.group(6)),
+                                    sites)
+                info = None
+
+
+def read_meme_output(output_text, num_motifs):
+    """Reads meme output file into a list of MotifInfo objects"""
+    return list(itertools.islice(iter_meme_motifs(output_text.split('\n')),
+                                 num_motifs))
+
+
+def run_meme(command, num_motifs):
+    """runs the specified meme command and reads the motifs from its output
+    pipe while it is running. Returns a tuple of
+    (list of MemeMotifInfo objects, meme output)"""
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    lines = []
+
+    def output_lines():
+        """the output lines, they are kept for the output text"""
+        for line in iter(process.stdout.readline, ''):
+            lines.append(line)
+            yield line
+
+    try:
+        motif_infos = list(itertools.islice(iter_meme_motifs(output_lines()), num_motifs))
+        lines.extend(iter(process.stdout.readline, ''))
+    finally:
+        process.stdout.close()
+        retcode = process.wait()
+    output = ''.join(lines)
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, command, output=output)
+    return motif_infos, output
 
 
 def read_mast_output_xml(output_text, genes):
@@ -705,18 +768,27 @@ def make_background_file(bgseqs, use_revcomp, bgorder):
         This means only taking the unique sequences and their reverse
         complement if desired"""
         meme_input_seqs = []
+        unique_seqs = set()
         for locseq in seqs.values():
             seq = locseq[1]
-            if seq not in meme_input_seqs:
+            if seq not in unique_seqs:
                 meme_input_seqs.append(seq)
+                unique_seqs.add(seq)
             if use_revcomp:
                 revseq = st.revcomp(seq)
-                if revseq not in meme_input_seqs:
+                if revseq not in unique_seqs:
                     meme_input_seqs.append(revseq)
+                    unique_seqs.add(revseq)
         return meme_input_seqs
 
-    filename = None
     bgmodel = st.markov_background(make_seqs(bgseqs), bgorder)
+    return (write_background_file(bgmodel), bgmodel)
+
+
+def write_background_file(bgmodel):
+    """writes the Markov background model to a meme background file
+    and returns its name"""
+    filename = None
     with tempfile.NamedTemporaryFile(prefix='memebg',
                                      delete=False) as outfile:
         filename = outfile.name
@@ -727,7 +799,104 @@ def make_background_file(bgseqs, use_revcomp, bgorder):
             for seq, frequency in order_row.iteritems():
                 outfile.write('%s %10s\n' %
                               (seq, str(round(frequency, 8))))
-    return (filename, bgmodel)
+    return filename
+
+
+class ScanDatabase:
+    """The data that all motif runs of a sequence type share: the MAST
+    database of all scanned sequences, the native scanner over them and
+    the k-mer counts of the Markov background model over these sequences.
+    The background of a single cluster is derived from the counts by
+    subtracting the k-mers of the cluster's sequences instead of recounting
+    all other sequences. The database is only rewritten when the sequence
+    set changes"""
+
+    def __init__(self, use_revcomp, bgorder):
+        self.use_revcomp = use_revcomp
+        self.bgorder = bgorder
+        self.digest = None
+        self.dbfile = None
+        self.__counts = None  # for each k-mer length, an array of counts
+        self.__support = None  # hash(sequence) -> # of features that contribute it
+        self.__seqs = None
+        self.__scanner = None
+        self.__atexit_registered = False
+
+    def __background_seqs(self, seq):
+        """the distinct background sequences contributed by a feature"""
+        if self.use_revcomp:
+            return {seq, st.revcomp(seq)}
+        else:
+            return {seq}
+
+    def __kmer_counts(self, seqs):
+        """k-mer count arrays of length 1,...,(bgorder + 1), degenerate residues
+        are replaced reproducibly, so the same counts can later be subtracted"""
+        seqs = st.replace_degenerate_residues(seqs, seeded=True)
+        return st.kmer_count_arrays(st.encode_sequences(seqs), self.bgorder + 1)
+
+    def update(self, all_seqs):
+        """rebuilds the database if the sequences in all_seqs, a map
+        feature_id -> (location, sequence), have changed"""
+        digest = hashlib.sha1()
+        for feature_id in sorted(all_seqs):
+            digest.update('%s\t%s\n' % (feature_id, all_seqs[feature_id][1]))
+        digest = digest.hexdigest()
+        if digest == self.digest:
+            return
+
+        self.close()
+        self.__seqs = [(feature_id, locseq[1]) for feature_id, locseq in all_seqs.iteritems()]
+        self.__scanner = None
+        with tempfile.NamedTemporaryFile(prefix='mastdb', delete=False) as outfile:
+            st.write_sequences_to_fasta_file(outfile, self.__seqs)
+            self.dbfile = outfile.name
+        if not self.__atexit_registered:
+            atexit.register(self.close)
+            self.__atexit_registered = True
+
+        support = collections.defaultdict(int)
+        for locseq in all_seqs.itervalues():
+            for bgseq in self.__background_seqs(locseq[1]):
+                support[bgseq] += 1
+        self.__counts = self.__kmer_counts(support.keys())
+        self.__support = {hash(bgseq): count for bgseq, count in support.iteritems()}
+        self.digest = digest
+        logging.debug("created scan database '%s' with %d sequences",
+                      self.dbfile, len(all_seqs))
+
+    def leave_out_model(self, feature_ids, all_seqs):
+        """returns the Markov background model of all sequences except the
+        ones of the features in feature_ids"""
+        removed = collections.defaultdict(int)
+        for feature_id in set(feature_ids):
+            if feature_id in all_seqs:
+                for bgseq in self.__background_seqs(all_seqs[feature_id][1]):
+                    removed[bgseq] += 1
+        # a sequence only leaves the background if no other feature has it
+        dropped = [bgseq for bgseq, count in removed.iteritems()
+                   if self.__support.get(hash(bgseq), 0) <= count]
+
+        return st.markov_background_from_counts(
+            [counts - dropped_counts
+             for counts, dropped_counts in zip(self.__counts, self.__kmer_counts(dropped))])
+
+    def scanner(self):
+        """the native motif scanner for the database sequences, the sequences
+        are only encoded once"""
+        if self.__scanner is None:
+            self.__scanner = motifscan.MotifScanner(self.__seqs, self.use_revcomp)
+        return self.__scanner
+
+    def close(self):
+        """removes the database file"""
+        if self.dbfile is not None:
+            try:
+                os.remove(self.dbfile)
+            except OSError:
+                logging.warn("could not remove tmp file: '%s'", self.dbfile)
+            self.dbfile = None
+            self.digest = None
 
 
 def global_background_file(organism, gene_aliases, seqtype, bgorder=3,
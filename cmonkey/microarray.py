@@ -11,6 +11,7 @@ import logging
 import datamatrix as dm
 import util
 import scoring
+import membership as memb
 
 
 def seed_column_members(data_matrix, row_membership, num_clusters,
@@ -40,91 +41,135 @@ def seed_column_members(data_matrix, row_membership, num_clusters,
     return column_members
 
 
-def compute_row_scores(membership, matrix, num_clusters, config_params):
+def compute_row_scores(membership, matrix, num_clusters, config_params,
+                       column_means=None):
     """for each cluster 1, 2, .. num_clusters compute the row scores
-    for the each row name in the input name matrix"""
+    for the each row name in the input name matrix.
+    The scores of all clusters are computed in one batch from the membership
+    arrays. A ClusterColumnMeans object for the matrix can be passed to reuse
+    the cluster column means of clusters that did not change"""
     start_time = util.current_millis()
-    cluster_row_scores = __compute_row_scores_for_clusters(
-        membership, matrix, num_clusters, config_params)
-    # TODO: replace the nan/inf-Values with the quantile-thingy in the R-version
-
-    logging.debug("__compute_row_scores_for_clusters() in %f s.",
-                  (util.current_millis() - start_time) / 1000.0)
-
-    # rearrange result into a DataMatrix, where rows are indexed by gene
-    # and columns represent clusters
-    start_time = util.current_millis()
-    values = np.zeros((matrix.num_rows, num_clusters))
-
-    # note that cluster is 0 based on a matrix
-    for cluster in xrange(num_clusters):
-        row_scores = cluster_row_scores[cluster]
-        values[:, cluster] = row_scores
+    if column_means is None:
+        column_means = ClusterColumnMeans(matrix)
+
+    row_map = membership_index_map(membership.row_names, membership.rowidx,
+                                   matrix.row_indexes_for(membership.row_names))
+    col_map = membership_index_map(membership.col_names, membership.colidx,
+                                   matrix.column_indexes_for(membership.col_names))
+    row_mask = __matrix_mask(memb.member_mask(membership.row_membs, num_clusters),
+                             row_map, matrix.num_rows)
+    col_mask = __matrix_mask(memb.member_mask(membership.col_membs, num_clusters),
+                             col_map, matrix.num_columns)
+
+    chunk_bytes = config_params.get('row_score_chunk_bytes', None)
+    values = compute_row_scores_for_masks(column_means.values, column_means.valid,
+                                          row_mask, col_mask, column_means.get(row_mask),
+                                          ROW_SCORE_CHUNK_BYTES if chunk_bytes is None
+                                          else chunk_bytes)
     result = dm.DataMatrix(matrix.num_rows, num_clusters,
                            row_names=matrix.row_names,
                            values=values)
-    logging.debug("made result matrix in %f s.",
+    logging.debug("compute_row_scores() in %f s.",
                   (util.current_millis() - start_time) / 1000.0)
     return result
 
-ROW_SCORE_MATRIX = None
-ROW_SCORE_MEMBERSHIP = None
-
-
-def __compute_row_scores_for_clusters(membership, matrix, num_clusters,
-                                      config_params):
-    """compute the pure row scores for the specified clusters
-    without nowmalization"""
-    # note that we set the data into globals before we fork it off
-    # to save memory and pickling time
-    global ROW_SCORE_MATRIX, ROW_SCORE_MEMBERSHIP
-    ROW_SCORE_MATRIX = matrix
-    ROW_SCORE_MEMBERSHIP = membership
-
-    if config_params['multiprocessing']:
-        with util.get_mp_pool(config_params) as pool:
-            result = pool.map(compute_row_scores_for_cluster, xrange(1, num_clusters + 1))
-    else:
-        result = []
-        for cluster in range(1, num_clusters + 1):
-            result.append(compute_row_scores_for_cluster(cluster))
-    # cleanup
-    ROW_SCORE_MATRIX = None
-    ROW_SCORE_MEMBERSHIP = None
+
+def membership_index_map(names, membership_indexes, matrix_indexes):
+    """maps the membership index of each name to the matrix index of the
+    name, which is -1 if the name is not in the matrix"""
+    result = np.repeat(-1, len(names))
+    result[[membership_indexes[name] for name in names]] = matrix_indexes
     return result
 
 
-def compute_row_scores_for_cluster(cluster):
-    """This function computes the row score for a cluster"""
-    global ROW_SCORE_MATRIX, ROW_SCORE_MEMBERSHIP
-    membership = ROW_SCORE_MEMBERSHIP
-    matrix = ROW_SCORE_MATRIX
-
-    rnames = membership.rows_for_cluster(cluster)
-    cnames = membership.columns_for_cluster(cluster)
-    sm1 = matrix.submatrix_by_name(row_names=rnames, column_names=cnames)
-
-    if sm1.num_columns > 1:
-        matrix_filtered = matrix.submatrix_by_name(column_names=cnames)
-        row_scores_for_cluster = __compute_row_scores_for_submatrix(
-            matrix_filtered, sm1)
-        return row_scores_for_cluster
-    else:
-        return None
-
-
-def __compute_row_scores_for_submatrix(matrix, submatrix):
-    """For a given matrix, compute the row scores. The second submatrix is
-    used to calculate the column means on and should be derived from
-    datamatrix filtered by the row names and column names of a specific
-    cluster.
-    matrix should be filtered by the columns of a specific cluster in
-    order for the column means to be applied properly.
-    The result is a DataMatrix with one row containing all the row scores"""
-    rm = util.row_means(np.square(matrix.values - util.column_means(submatrix.values)))
+def __matrix_mask(mask, index_map, num_matrix_indexes):
+    """reorders the rows of a membership mask into the matrix order"""
+    result = np.zeros((num_matrix_indexes, mask.shape[1]), dtype=bool)
+    in_matrix = index_map >= 0
+    result[index_map[in_matrix]] = mask[in_matrix]
+    return result
+
+
+class ClusterColumnMeans:
+    """The column means of the ratio matrix over the rows of each cluster.
+    They are cached between calls and only recomputed for clusters whose
+    rows have changed"""
+
+    def __init__(self, matrix):
+        """create a cache for the values of the specified DataMatrix"""
+        self.valid = (~np.isnan(matrix.values)).astype(matrix.values.dtype)
+        self.values = np.nan_to_num(matrix.values)
+        self.row_mask = None
+        self.means = None
+
+    def get(self, row_mask):
+        """returns a num_columns x num_clusters matrix of the column means
+        for the cluster rows in the row mask"""
+        if self.row_mask is None or self.row_mask.shape != row_mask.shape:
+            self.means = np.empty((self.values.shape[1], row_mask.shape[1]))
+            changed = np.arange(row_mask.shape[1])
+        else:
+            changed = np.where(np.any(self.row_mask != row_mask, axis=0))[0]
+
+        if len(changed) > 0:
+            members = row_mask[:, changed].astype(self.values.dtype)
+            sums = np.dot(self.values.T, members)
+            counts = np.dot(self.valid.T, members)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.means[:, changed] = np.where(counts > 0, sums / counts, np.nan)
+        self.row_mask = row_mask.copy()
+        return self.means
+
+    def memory_usage(self):
+        """the number of bytes of the cached arrays"""
+        return sum([array.nbytes for array in [self.valid, self.values, self.row_mask,
+                                               self.means] if array is not None])
+
+
+# the memory for the intermediate rows x columns x clusters deviations
+# is limited to this size, the clusters are processed in chunks if necessary
+ROW_SCORE_CHUNK_BYTES = 256 * 1024 * 1024
+
+
+def compute_row_scores_for_masks(values, valid, row_mask, col_mask, column_means,
+                                 chunk_bytes=ROW_SCORE_CHUNK_BYTES):
+    """For all clusters, compute the row scores, the log of the mean squared
+    deviations of each row from the cluster column means over the cluster's
+    columns. values are the ratios with 0 for NaN and valid is 1 for the
+    non-NaN ratios, both of the ratio type, as cached by ClusterColumnMeans.
+    row_mask and col_mask are the boolean cluster membership matrices
+    for rows and columns. Clusters with less than 2 columns get NaN scores.
+    The result is a num_rows x num_clusters array"""
+    num_rows, num_columns = values.shape
+    num_clusters = col_mask.shape[1]
+    dtype = values.dtype
+
+    # only the column means of cluster columns with rows are used
+    used = col_mask & ~np.isnan(column_means)
+    means = np.where(used, column_means, 0.0).astype(dtype, copy=False)
+    used = used.astype(dtype)
+    counts = np.dot(valid, used)
+
+    result = np.empty((num_rows, num_clusters), dtype=dtype)
+    result[:, :] = np.nan
+    clusters = np.where(col_mask.sum(axis=0) > 1)[0]
+    chunk_size = max(1, int(chunk_bytes / (dtype.itemsize * num_rows * num_columns)))
+    for start in xrange(0, len(clusters), chunk_size):
+        chunk = clusters[start:start + chunk_size]
+        # the deviations are computed directly instead of expanding the squares
+        # into matrix products, which would lose precision for tight clusters
+        deviations = values[:, :, np.newaxis] - means[np.newaxis, :, chunk]
+        np.square(deviations, out=deviations)
+        deviations *= used[np.newaxis, :, chunk]
+        sums = np.einsum('ijk,ij->ik', deviations, valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[:, chunk] = np.where(counts[:, chunk] > 0,
+                                        sums / counts[:, chunk], np.nan)
+
     # we clip the values to make sure the argument to log will be
     # sufficiently above 0 to avoid errors
-    return np.log(np.clip(rm, 1e-20, 1000.0) + 1e-99)
+    with np.errstate(invalid='ignore'):
+        return np.log(np.clip(result, 1e-20, 1000.0) + 1e-99)
 
 
 class RowScoringFunction(scoring.ScoringFunctionBase):
@@ -135,13 +180,20 @@ class RowScoringFunction(scoring.ScoringFunctionBase):
         scoring.ScoringFunctionBase.__init__(self, "Rows", organism, membership,
                                              ratios, config_params)
         self.run_log = scoring.RunLog("row_scoring", config_params)
+        self.column_means = ClusterColumnMeans(ratios)
 
     def do_compute(self, iteration_result, ref_matrix=None):
         """the row scoring function"""
         return compute_row_scores(self.membership,
                                   self.ratios,
                                   self.num_clusters(),
-                                  self.config_params)
+                                  self.config_params,
+                                  self.column_means)
+
+    def memory_usage(self):
+        """the last result and the cluster column means"""
+        return (scoring.ScoringFunctionBase.memory_usage(self) +
+                self.column_means.memory_usage())
 
     def run_logs(self):
         """return the run logs"""
@@ -11,6 +11,7 @@ more information and licensing details.
 """
 import sys
 import logging
+import hashlib
 import util
 import network
 import patches
@@ -205,8 +206,9 @@ def __get_predictions(microbes_online, organism):
     return preds
 
 
-def get_network_factory(microbes_online, max_operon_size, weight):
-    """function to create a network factory method"""
+def get_network_factory(microbes_online, max_operon_size, weight, cache_dir=None):
+    """function to create a network factory method. If cache_dir is
+    specified, the network is stored in the binary network cache"""
 
     def get_operon_edges(microbes_online, organism):
         """gets network edges"""
@@ -226,11 +228,19 @@ def get_network_factory(microbes_online, max_operon_size, weight):
     def make_network(organism, ratios=None, check_size=True):
         """factory method to create a network from operon predictions"""
 
-        logging.info("MicrobesOnline - make_network()")
-        edges = get_operon_edges(microbes_online, organism)
-        logging.info("%d edges computed", len(edges))
-        return network.Network.create('operons', edges, weight, organism,
-                                      ratios, check_size)
+        def create():
+            logging.info("MicrobesOnline - make_network()")
+            edges = get_operon_edges(microbes_online, organism)
+            logging.info("%d edges computed", len(edges))
+            return network.Network.create('operons', edges, weight, organism,
+                                          ratios, check_size)
+
+        if cache_dir is None:
+            return create()
+        preds_text = microbes_online.get_operon_predictions_for(organism.taxonomy_id())
+        key = network.network_cache_key(hashlib.sha1(preds_text).hexdigest(),
+                                        organism.code, ratios, max_operon_size)
+        return network.cached_network(cache_dir, 'operons', weight, key, create)
 
     return make_network
 
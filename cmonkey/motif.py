@@ -21,6 +21,14 @@ import collections
 import sys
 import subprocess
 import sqlite3
+import hashlib
+import multiprocessing as mp
+import Queue
+import signal
+import time
+import atexit
+import traceback
+import checkpoint
 
 
 ComputeScoreParams = collections.namedtuple('ComputeScoreParams',
@@ -32,6 +40,11 @@ ComputeScoreParams = collections.namedtuple('ComputeScoreParams',
                                              'outdir', 'num_iterations',
                                              'debug'])
 
+# the motif runs of an iteration: the clusters, their feature ids, the results
+# that are already known, the parameters of the runs and their cache keys
+MotifRuns = collections.namedtuple('MotifRuns',
+                                   ['clusters', 'feature_ids', 'results', 'params',
+                                    'cache_keys', 'background'])
 
 
 # Applicable sequence filters
@@ -45,25 +58,38 @@ def unique_filter(seqs, feature_ids):
     return unique_seqs
 
 
-def get_remove_low_complexity_filter(meme_suite):
-    """Factory method that returns a low complexity filter"""
-    def remove_low_complexity(seqs, feature_ids):
-        """low-complexity filter that depends on meme"""
-        return meme_suite.remove_low_complexity(seqs)
-    return remove_low_complexity
+class RemoveLowComplexityFilter:
+    """low-complexity filter that depends on meme. The filters are classes
+    instead of closures, so they can be published to the worker pool"""
+    def __init__(self, meme_suite):
+        self.meme_suite = meme_suite
 
+    def __call__(self, seqs, feature_ids):
+        return self.meme_suite.remove_low_complexity(seqs)
 
-def get_remove_atgs_filter(distance):
-    """returns a remove ATG filter"""
-    def remove_atgs_filter(seqs, feature_ids):
-        """a filter removes the ATG's from the sequence, this
-        just masks a window of 4 letters with N's"""
+
+class RemoveATGsFilter:
+    """a filter removes the ATG's from the sequence, this
+    just masks a window of 4 letters with N's"""
+    def __init__(self, distance):
+        self.distance = distance
+
+    def __call__(self, seqs, feature_ids):
         for feature_id in seqs:
             chars = [c for c in seqs[feature_id]]
-            chars[distance[1]:distance[1] + 4] = "NNNN"
+            chars[self.distance[1]:self.distance[1] + 4] = "NNNN"
             seqs[feature_id] = "".join(chars)
         return seqs
-    return remove_atgs_filter
+
+
+def get_remove_low_complexity_filter(meme_suite):
+    """Factory method that returns a low complexity filter"""
+    return RemoveLowComplexityFilter(meme_suite)
+
+
+def get_remove_atgs_filter(distance):
+    """returns a remove ATG filter"""
+    return RemoveATGsFilter(distance)
 
 
 def compute_mean_score(pvalue_matrix, membership, organism):
@@ -76,7 +102,7 @@ def compute_mean_score(pvalue_matrix, membership, organism):
         cluster_rows = membership.rows_for_cluster(cluster)
         row_indexes = pvalue_matrix.row_indexes_for(cluster_rows)
         values.extend(pvalues[row_indexes, cluster - 1])
-    return np.mean(values)  # median can result in 0 if there are a lot of 0
+    return float(np.mean(values))  # median can result in 0 if there are a lot of 0
 
 # Readonly structure to avoid passing it to the forked child processes for efficiency.
 # non-serializable parameters go here, too
@@ -103,6 +129,292 @@ def pvalues2matrix(all_pvalues, num_clusters, gene_names, reverse_map):
     return matrix
 
 
+MOTIF_CACHE_VERSION = 1
+MOTIF_CACHE_MAX_MB = 1024
+MAX_RECENT_MOTIF_RESULTS = 1000
+MIN_SEED_SIMILARITY = 0.8
+
+# options that do not change the result of a single motif run
+MOTIF_CACHE_IGNORED_OPTIONS = {'schedule', 'scaling', 'nmotifs', 'nmotifs_rvec',
+                               'result_cache', 'result_cache_max_mb', 'max_jobs',
+                               'job_timeout', 'job_retries', 'abort_on_job_failure',
+                               'async_motifs'}
+
+
+class MotifResultCache:
+    """Persistent cache of cluster motif results, stored as one pickle file
+    per entry in cache_dir. An entry is identified by a hash of the
+    cluster's sorted feature ids, the number of motifs and a fingerprint
+    of everything else that determines a motif run (sequence type, MEME
+    version and arguments, background and scanned sequences).
+    Entries are evicted in least recently used order when the cache grows
+    beyond max_bytes, reading an entry marks it as used"""
+
+    def __init__(self, cache_dir, fingerprint, max_bytes=MOTIF_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        # results that were read or stored in this run, used to find seeds
+        self.__recent = collections.OrderedDict()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, feature_ids, num_motifs):
+        """returns the cache key for a cluster"""
+        digest = hashlib.sha1(self.fingerprint)
+        digest.update('%d\0' % num_motifs)
+        for feature_id in sorted(feature_ids):
+            digest.update('%s\n' % feature_id)
+        return digest.hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def __remember(self, key, feature_ids, run_result):
+        if key in self.__recent:
+            del self.__recent[key]
+        elif len(self.__recent) >= MAX_RECENT_MOTIF_RESULTS:
+            self.__recent.popitem(last=False)
+        self.__recent[key] = (frozenset(feature_ids), run_result)
+
+    def get(self, key):
+        """returns the (pvalues, run_result) pair stored for key or None"""
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as infile:
+                feature_ids, pvalues, run_result = cPickle.load(infile)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            return None
+        self.__remember(key, feature_ids, run_result)
+        return pvalues, run_result
+
+    def put(self, key, feature_ids, pvalues, run_result):
+        """stores the motif result of a cluster"""
+        path = self.__path(key)
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as outfile:
+            cPickle.dump((feature_ids, pvalues, run_result), outfile,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        self.__remember(key, feature_ids, run_result)
+
+    def similar_motif_infos(self, feature_ids, min_similarity=MIN_SEED_SIMILARITY):
+        """returns the motif infos of the result of this run whose cluster is
+        most similar to feature_ids (Jaccard index of at least min_similarity)
+        or None. They can be used to seed the motif run of a cluster"""
+        feature_ids = frozenset(feature_ids)
+        best_similarity, best_infos = min_similarity, None
+        for other_ids, run_result in self.__recent.itervalues():
+            if run_result is None or len(run_result.motif_infos) == 0:
+                continue
+            union = len(feature_ids | other_ids)
+            similarity = float(len(feature_ids & other_ids)) / union if union > 0 else 0.0
+            if similarity >= best_similarity:
+                best_similarity, best_infos = similarity, run_result.motif_infos
+        return best_infos
+
+    def evict(self):
+        """removes the least recently used entries until the cache size
+        is within max_bytes"""
+        entries = []
+        total_bytes = 0
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith('.pkl'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total_bytes += stat.st_size
+        entries.sort()
+        for _, size, filename in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+                self.__recent.pop(filename[:-len('.pkl')], None)
+            except OSError:
+                pass
+            total_bytes -= size
+
+
+# seconds between the checks of the running motif jobs
+JOB_POLL_INTERVAL = 0.5
+
+
+class MotifJobError(Exception):
+    """raised when a motif job finally fails and failures abort the run"""
+    pass
+
+
+def run_motif_job(job):
+    """runs compute_cluster_score() in a motif job process and sends the
+    result or the error back to the scheduler. The job gets its own process
+    group, so a timeout also stops the MEME and MAST processes it started"""
+    params, attempt, result_queue = job
+    try:
+        os.setpgrp()
+    except OSError:
+        pass
+    try:
+        result_queue.put((params.cluster, attempt, compute_cluster_score(params), None))
+    except:
+        result_queue.put((params.cluster, attempt, None, traceback.format_exc()))
+
+
+class MotifJobScheduler:
+    """Runs motif jobs (ComputeScoreParams) as independent processes, at most
+    max_jobs at a time, the clusters with the most sequences first, so a
+    single slow cluster does not stall the others. Jobs that fail, exit without
+    a result or run longer than timeout seconds are retried up to retries times.
+    If a job still fails, a MotifJobError is raised if abort_on_failure is
+    True, otherwise the job has no result.
+    run() returns the results as the jobs finish, start() and wait() run the
+    jobs in the background, so that the caller can continue with other work"""
+
+    def __init__(self, max_jobs, timeout=None, retries=0, abort_on_failure=True):
+        self.max_jobs = max(1, max_jobs)
+        self.timeout = timeout
+        self.retries = retries
+        self.abort_on_failure = abort_on_failure
+        self.__running = {}  # cluster -> (process, attempt, start time, params)
+        self.__server = None
+        self.__server_queue = None
+        atexit.register(self.terminate)
+
+    def run(self, jobs):
+        """runs the jobs and yields a (cluster, pvalues, run_result) tuple
+        for each job as it finishes. Jobs that finally fail result in
+        (cluster, None, None) unless abort_on_failure is True"""
+        waiting = sorted(jobs, key=lambda params: len(params.seqs), reverse=True)
+        attempts = collections.defaultdict(int)
+        result_queue = mp.Queue()
+        try:
+            while len(waiting) > 0 or len(self.__running) > 0:
+                while len(waiting) > 0 and len(self.__running) < self.max_jobs:
+                    params = waiting.pop(0)
+                    attempts[params.cluster] += 1
+                    process = mp.Process(target=run_motif_job,
+                                         args=((params, attempts[params.cluster],
+                                                result_queue),))
+                    process.daemon = True
+                    process.start()
+                    self.__running[params.cluster] = (process, attempts[params.cluster],
+                                                      time.time(), params)
+
+                # the results of the jobs that had finished before the queue
+                # is read are in the queue
+                finished = {cluster for cluster, (process, _, _, _) in self.__running.items()
+                            if not process.is_alive()}
+                messages = []
+                try:
+                    messages.append(result_queue.get(timeout=JOB_POLL_INTERVAL))
+                    while True:
+                        messages.append(result_queue.get_nowait())
+                except Queue.Empty:
+                    pass
+
+                failed = []
+                for cluster, attempt, result, error in messages:
+                    if cluster in self.__running and self.__running[cluster][1] == attempt:
+                        process, _, _, params = self.__running.pop(cluster)
+                        process.join()
+                        if error is None:
+                            yield result
+                        else:
+                            failed.append((params, error))
+
+                now = time.time()
+                for cluster, (process, _, start_time, params) in self.__running.items():
+                    if self.timeout is not None and now - start_time > self.timeout:
+                        self.__kill(process)
+                        failed.append((params, 'timed out after %g s' % self.timeout))
+                    elif cluster in finished:
+                        process.join()
+                        failed.append((params, 'exit code %s without a result' %
+                                       str(process.exitcode)))
+                    else:
+                        continue
+                    del self.__running[cluster]
+
+                for params, error in failed:
+                    if attempts[params.cluster] <= self.retries:
+                        logging.warn("motif job for cluster %d failed (%s), retrying",
+                                     params.cluster, error.strip().split('\n')[-1])
+                        waiting.insert(0, params)
+                    elif self.abort_on_failure:
+                        raise MotifJobError("motif job for cluster %d failed: %s" %
+                                            (params.cluster, error))
+                    else:
+                        logging.error("motif job for cluster %d failed: %s",
+                                      params.cluster, error)
+                        yield (params.cluster, None, None)
+        finally:
+            self.__stop_running()
+
+    def __kill(self, process):
+        """kills a job process and the processes it started"""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            process.terminate()
+        process.join()
+
+    def __stop_running(self):
+        for process, _, _, _ in self.__running.values():
+            if process.is_alive():
+                self.__kill(process)
+        self.__running = {}
+
+    def start(self, jobs):
+        """runs the jobs in a background process, the results are returned by wait()"""
+        self.__server_queue = mp.Queue()
+        self.__server = mp.Process(target=self.__serve, args=(jobs, self.__server_queue))
+        self.__server.start()
+
+    def __serve(self, jobs, server_queue):
+        """the background process, it stops its jobs when it is terminated.
+        A failure is sent as its message"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        try:
+            for result in self.run(jobs):
+                server_queue.put(result)
+        except Exception:
+            server_queue.put(traceback.format_exc())
+        server_queue.put(None)
+
+    def is_started(self):
+        """True if there are background jobs whose results were not collected"""
+        return self.__server is not None
+
+    def wait(self):
+        """waits for the jobs of start() and returns their results. A failure
+        of the background process is raised as a MotifJobError"""
+        results = []
+        error = None
+        for result in iter(self.__server_queue.get, None):
+            if isinstance(result, str):
+                error = result
+            else:
+                results.append(result)
+        self.__server.join()
+        self.__server = None
+        self.__server_queue = None
+        if error is not None:
+            raise MotifJobError(error.strip().split('\n')[-1])
+        return results
+
+    def terminate(self):
+        """stops all jobs"""
+        if self.__server is not None and self.__server.is_alive():
+            self.__server.terminate()
+            self.__server.join()
+        self.__server = None
+        self.__stop_running()
+
+
 class MotifScoringFunctionBase(scoring.ScoringFunctionBase):
     """Base class for motif scoring functions that use MEME
     This class of scoring function has 2 schedules:
@@ -175,6 +487,51 @@ class MotifScoringFunctionBase(scoring.ScoringFunctionBase):
                       util.current_millis() - start_time)
 
         self.__last_results = None  # caches the results of the previous meme run
+        self.__motif_cache = self.__make_motif_cache()
+        self.__job_scheduler = self.__make_job_scheduler()
+        self.__async_motifs = (self.__job_scheduler is not None and
+                               config_params['MEME'].get('async_motifs', 'False') == 'True')
+        self.__pending_runs = None
+        self.num_failed_jobs = 0
+
+    def __make_job_scheduler(self):
+        """creates the scheduler for the motif jobs if multiprocessing is enabled"""
+        if not self.config_params[scoring.KEY_MULTIPROCESSING]:
+            return None
+        meme_params = self.config_params['MEME']
+        max_jobs = meme_params.get('max_jobs', '')
+        if max_jobs:
+            max_jobs = int(max_jobs)
+        else:
+            max_jobs = self.config_params.get('num_cores', None) or mp.cpu_count()
+        timeout = float(meme_params.get('job_timeout', '') or 0) or None
+        retries = int(meme_params.get('job_retries', '') or 0)
+        abort_on_failure = meme_params.get('abort_on_job_failure', 'True') == 'True'
+        return MotifJobScheduler(max_jobs, timeout, retries, abort_on_failure)
+
+    def __make_motif_cache(self):
+        """creates the persistent motif result cache if it is enabled"""
+        meme_params = self.config_params['MEME']
+        if meme_params.get('result_cache', 'False') != 'True':
+            return None
+        digest = hashlib.sha1()
+        for part in [MOTIF_CACHE_VERSION, self.__class__.__name__, self.organism.code,
+                     self.seqtype, self.config_params['search_distances'][self.seqtype]]:
+            digest.update('%s\0' % str(part))
+        for section in ['MEME', 'Weeder']:
+            options = self.config_params.get(section, {})
+            for option in sorted(options):
+                if option not in MOTIF_CACHE_IGNORED_OPTIONS and not callable(options[option]):
+                    digest.update('%s.%s=%s\0' % (section, option, str(options[option])))
+        background_file = self.meme_suite.global_background_file()
+        if background_file is not None:
+            digest.update(util.file_digest(background_file))
+        for feature_id in sorted(self.used_seqs):
+            digest.update('%s\t%s\n' % (feature_id, self.used_seqs[feature_id][1]))
+
+        max_mb = float(meme_params.get('result_cache_max_mb', MOTIF_CACHE_MAX_MB))
+        return MotifResultCache(os.path.join(self.config_params['cache_dir'], 'motifs'),
+                                digest.hexdigest(), int(max_mb * 1024 * 1024))
 
     def run_logs(self):
         return [self.update_log, self.motif_log]
@@ -215,32 +572,72 @@ class MotifScoringFunctionBase(scoring.ScoringFunctionBase):
         """override base class compute() method, behavior is more complicated,
         since it nests Motif and MEME runs"""
         result = self.__compute(iteration_result, True, ref_matrix)
-        # and pickle the last result for diagnostics
-        with open(self.pickle_path(), 'w') as outfile:
-            cPickle.dump(result, outfile)
+        # and write the last result for diagnostics
+        if result is not None:
+            self.score_store().write(self.id, result)
         return result
 
     def last_cached(self):
         return self.last_result
 
+    def memory_usage(self):
+        """the last score matrix, the p-values and motif results are not counted"""
+        return 0 if self.last_result is None else self.last_result.values.nbytes
+
+    def checkpoint_state(self):
+        """the last score matrix and the motif results the next iterations
+        reuse. Motif runs that are still running in the background are not
+        included, they are started again after a resume"""
+        state = {}
+        if self.last_result is not None:
+            state.update(checkpoint.matrix_state(self.last_result))
+        state['motif_results'] = checkpoint.object_array((self.all_pvalues,
+                                                          self.__last_results,
+                                                          self.__last_motif_infos,
+                                                          self.__last_iteration_result))
+        return state
+
+    def restore_checkpoint(self, state):
+        """restores the state of checkpoint_state()"""
+        if 'values' in state:
+            self.last_result = checkpoint.state_matrix(state)
+        if 'motif_results' in state:
+            (self.all_pvalues, self.__last_results, self.__last_motif_infos,
+             self.__last_iteration_result) = checkpoint.array_object(state['motif_results'])
+
+    def __dump_last_iteration_result(self):
+        with open(os.path.join(self.config_params['output_dir'],
+                               'motif_pvalues_last.pkl'), 'w') as outfile:
+            cPickle.dump(self.__last_iteration_result, outfile)
+
     def __compute(self, iteration_result, force, ref_matrix=None):
         """compute method for the specified iteration
         Note: will return None if not computed yet and the result of a previous
         scoring if the function is not supposed to actually run in this iteration
         """
         iteration = iteration_result['iteration']
+        if self.__pending_runs is not None:
+            # the motif runs that were started in the background in the previous
+            # iteration
+            self.__last_iteration_result = {'iteration': iteration}
+            self.all_pvalues = self.__finish_motif_runs(self.__last_iteration_result)
+            self.__dump_last_iteration_result()
+
         if force or self.motif_in_iteration(iteration):  # meme.iter in R
             logging.debug("Running Motifing for sequence type '%s'...", self.seqtype)
             # running MEME and store the result for the non-motifing iterations
             # to reuse
             # Note: currently, iteration results are only computed here
             num_motifs = int(self.num_motif_func(iteration))
-            self.__last_iteration_result = {'iteration': iteration}
-            self.all_pvalues = self.compute_pvalues(self.__last_iteration_result,
-                                                    num_motifs, force)
-            with open(os.path.join(self.config_params['output_dir'],
-                                   'motif_pvalues_last.pkl'), 'w') as outfile:
-                cPickle.dump(self.__last_iteration_result, outfile)            
+            if self.__async_motifs and not force and self.all_pvalues is not None:
+                # the results are used from the next iteration on, the
+                # scores of this iteration are based on the previous results
+                self.__start_motif_runs(iteration, num_motifs, force, background=True)
+            else:
+                self.__last_iteration_result = {'iteration': iteration}
+                self.all_pvalues = self.compute_pvalues(self.__last_iteration_result,
+                                                        num_motifs, force)
+                self.__dump_last_iteration_result()
 
         if self.all_pvalues is not None and (force or self.run_in_iteration(iteration)):  # mot.iter in R
             logging.debug("UPDATING MOTIF SCORES in iteration %d with scaling: %f",
@@ -281,12 +678,53 @@ class MotifScoringFunctionBase(scoring.ScoringFunctionBase):
         (seqs, feature_ids, distance) -> seqs
         These filters are applied in the order they appear in the list.
         """
+        self.__start_motif_runs(iteration_result['iteration'], num_motifs, force)
+        return self.__finish_motif_runs(iteration_result)
+
+    def __start_motif_runs(self, iteration, num_motifs, force, background=False):
+        """determines the clusters that need a motif run and prepares their
+        parameters. If background is True, the runs are started in the
+        background, __finish_motif_runs() collects the results"""
         global SEQUENCE_FILTERS, ORGANISM, MEMBERSHIP
 
-        cluster_pvalues = {}
         min_cluster_rows_allowed = self.config_params['memb.min_cluster_rows_allowed']
         max_cluster_rows_allowed = self.config_params['memb.max_cluster_rows_allowed']
-        use_multiprocessing = self.config_params[scoring.KEY_MULTIPROCESSING]
+        clusters = range(1, self.num_clusters() + 1)
+
+        # Optimization:
+        # if the cluster hasn't changed since last time, reuse the last results,
+        # otherwise try the motif result cache. Sequences are only extracted
+        # for the clusters that actually need a motif run.
+        # Forced runs and runs that keep the MEME output always run the motif tools
+        if self.__last_results is None:
+            self.__last_results = {}
+        use_cache = (self.__motif_cache is not None and not force and
+                     'keep_memeout' not in self.config_params['debug'])
+        cluster_feature_ids = {}
+        results = {}  # cluster -> (pvalues, run_result)
+        cache_keys = {}
+        num_unchanged = 0
+        for cluster in clusters:
+            feature_ids = self.organism.feature_ids_for(
+                sorted(self.membership.rows_for_cluster(cluster)))
+            cluster_feature_ids[cluster] = feature_ids
+            if (not force and cluster in self.__last_results and
+                feature_ids == self.__last_results[cluster][0]):
+                results[cluster] = self.__last_results[cluster][1:]
+                num_unchanged += 1
+                continue
+            if self.__motif_cache is not None:
+                cache_keys[cluster] = self.__motif_cache.key(feature_ids, num_motifs)
+                if use_cache:
+                    cached = self.__motif_cache.get(cache_keys[cluster])
+                    if cached is not None:
+                        results[cluster] = cached
+        if num_unchanged > 0:
+            logging.debug("%d clusters did not change !!!", num_unchanged)
+        if len(cache_keys) > 0:
+            logging.debug("%d clusters found in motif result cache",
+                          len(results) - num_unchanged)
+        run_clusters = [cluster for cluster in clusters if cluster not in results]
 
         # extract the sequences for each cluster, slow
         start_time = util.current_millis()
@@ -294,9 +732,9 @@ class MotifScoringFunctionBase(scoring.ScoringFunctionBase):
         ORGANISM = self.organism
         MEMBERSHIP = self.membership
 
-        with util.get_mp_pool(self.config_params) as pool:
-            cluster_seqs_params = [(cluster, self.seqtype)
-                                   for cluster in xrange(1, self.num_clusters() + 1)]
+        with util.get_mp_pool(self.config_params,
+                              shared=['SEQUENCE_FILTERS', 'ORGANISM', 'MEMBERSHIP']) as pool:
+            cluster_seqs_params = [(cluster, self.seqtype) for cluster in run_clusters]
             seqs_list = pool.map(cluster_seqs, cluster_seqs_params)
 
         SEQUENCE_FILTERS = None
@@ -307,15 +745,16 @@ class MotifScoringFunctionBase(scoring.ScoringFunctionBase):
         # Make the parameters, this is fast enough
         start_time = util.current_millis()
         params = {}
-        for cluster in xrange(1, self.num_clusters() + 1):
-            # Pass the previous run's seed if possible
+        for cluster, (seqs, feature_ids) in zip(run_clusters, seqs_list):
+            # Pass the previous run's seed if possible, clusters without one
+            # borrow the cached result of a near-identical cluster
+            previous_motif_infos = None
             if self.__last_motif_infos is not None:
                 previous_motif_infos = self.__last_motif_infos.get(cluster, None)
-            else:
-                previous_motif_infos = None
+            if previous_motif_infos is None and self.__motif_cache is not None:
+                previous_motif_infos = self.__motif_cache.similar_motif_infos(feature_ids)
 
-            seqs, feature_ids = seqs_list[cluster - 1]
-            params[cluster] = ComputeScoreParams(iteration_result['iteration'], cluster,
+            params[cluster] = ComputeScoreParams(iteration, cluster,
                                                  feature_ids,
                                                  seqs,
                                                  self.used_seqs,
@@ -331,63 +770,97 @@ class MotifScoringFunctionBase(scoring.ScoringFunctionBase):
         logging.debug("prepared MEME parameters in %d ms.",
                       util.current_millis() - start_time)
 
-        # create motif result map if necessary
-        for cluster in xrange(1, self.num_clusters() + 1):
-            if not cluster in iteration_result:
-                iteration_result[cluster] = {}
+        # all runs scan the same database
+        if len(run_clusters) > 0:
+            self.meme_suite.update_scan_database(self.used_seqs)
+        if background:
+            self.__job_scheduler.start(params.values())
+        self.__pending_runs = MotifRuns(clusters, cluster_feature_ids, results,
+                                        params, cache_keys, background)
+
+    def __finish_motif_runs(self, iteration_result):
+        """runs or waits for the motif runs of __start_motif_runs(), stores
+        the results and returns the p-values of all clusters"""
+        runs = self.__pending_runs
+        self.__pending_runs = None
+        if runs.background:
+            computed = self.__job_scheduler.wait()
+        elif self.__job_scheduler is not None:
+            computed = self.__job_scheduler.run(runs.params.values())
+        else:
+            computed = [compute_cluster_score(runs.params[cluster])
+                        for cluster in sorted(runs.params)]
+
+        # results are stored as they arrive, except the ones that still
+        # need the batch scan of the native scanner. The clusters of failed
+        # jobs have no motifs and are not cached
+        num_computed = 0
+        num_failed = 0
+        unscanned = []
+        for cluster, pvalues, run_result in computed:
+            num_computed += 1
+            if pvalues is None:
+                num_failed += 1
+                runs.results[cluster] = ({}, None)
+            elif run_result is not None and run_result.pe_values is None:
+                unscanned.append((cluster, pvalues, run_result))
+            else:
+                self.__store_motif_result(runs, cluster, pvalues, run_result)
+        for cluster, pvalues, run_result in self.__scan_motifs(unscanned, runs.params):
+            self.__store_motif_result(runs, cluster, pvalues, run_result)
+        if num_failed > 0:
+            self.num_failed_jobs += num_failed
+            logging.error("%d of %d motif jobs failed, %d failed in this run",
+                          num_failed, num_computed, self.num_failed_jobs)
 
-        # Optimization:
-        # if the cluster hasn't changed since last time, reuse the last results
-        # we do this by filtering out the parameters of the clusters that did not
-        # change
-        if not force and self.__last_results is not None:
-            oldlen = len(params)
-            params = {cluster: params[cluster]
-                      for cluster in xrange(1, self.num_clusters() + 1)
-                      if params[cluster].feature_ids != self.__last_results[cluster][0]}
-            newlen = len(params)
-            if oldlen - newlen > 0:
-                logging.debug("%d clusters did not change !!!", oldlen - newlen)
-
-        # compute and store motif results
+        cluster_pvalues = {}
         self.__last_motif_infos = {}
-        if self.__last_results is None:
-            self.__last_results = {}
+        for cluster in runs.clusters:
+            if not cluster in iteration_result:
+                iteration_result[cluster] = {}
+            pvalues, run_result = runs.results[cluster]
+            self.__last_results[cluster] = (runs.feature_ids[cluster], pvalues, run_result)
+            cluster_pvalues[cluster] = pvalues
+            if run_result:
+                self.__last_motif_infos[cluster] = run_result.motif_infos
+            iteration_result[cluster]['motif-info'] = meme_json(run_result)
+            iteration_result[cluster]['pvalues'] = pvalues
+
+        if self.__motif_cache is not None and num_computed > 0:
+            self.__motif_cache.evict()
+        return cluster_pvalues
 
-        if use_multiprocessing:
-            with util.get_mp_pool(self.config_params) as pool:
-                results = pool.map(compute_cluster_score, params.values())
-                results = {r[0]: r[1:] for r in results}  # indexed by cluster
+    def __store_motif_result(self, runs, cluster, pvalues, run_result):
+        runs.results[cluster] = (pvalues, run_result)
+        if cluster in runs.cache_keys:
+            self.__motif_cache.put(runs.cache_keys[cluster], runs.params[cluster].feature_ids,
+                                   pvalues, run_result)
 
-                for cluster in xrange(1, self.num_clusters() + 1):
-                    if cluster in results:
-                        pvalues, run_result = results[cluster]
-                        self.__last_results[cluster] = (params[cluster].feature_ids,
-                                                        pvalues, run_result)
-                    else:
-                        feature_ids, pvalues, run_result = self.__last_results[cluster]
+    def __scan_motifs(self, computed, params):
+        """runs the native motif scanner on all results whose motifs still
+        need to be scanned in one batch and computes their p-values"""
+        pending = [index for index, (cluster, pvalues, run_result) in enumerate(computed)
+                   if run_result is not None and run_result.pe_values is None]
+        if len(pending) == 0:
+            return computed
 
-                    cluster_pvalues[cluster] = pvalues
-                    if run_result:
-                        self.__last_motif_infos[cluster] = run_result.motif_infos
-                    iteration_result[cluster]['motif-info'] = meme_json(run_result)
-                    iteration_result[cluster]['pvalues'] = pvalues                    
-        else:
-            for cluster in xrange(1, self.num_clusters() + 1):
-                if cluster in params:
-                    _, pvalues, run_result = compute_cluster_score(params[cluster])
-                    self.__last_results[cluster] = (params[cluster].feature_ids,
-                                                    pvalues, run_result)
-                else:
-                    _, pvalues, run_result = self.__last_results[cluster]
-
-                cluster_pvalues[cluster] = pvalues
-                if run_result:
-                    self.__last_motif_infos[cluster] = run_result.motif_infos
-                iteration_result[cluster]['motif-info'] = meme_json(run_result)
-                iteration_result[cluster]['pvalues'] = pvalues
-
-        return cluster_pvalues
+        start_time = util.current_millis()
+        runs = []
+        for index in pending:
+            cluster, _, run_result = computed[index]
+            runs.append((params[cluster].feature_ids, params[cluster].seqs.keys(),
+                         run_result.motif_infos))
+        scanned = self.meme_suite.scan_motifs(runs, self.used_seqs)
+
+        result = list(computed)
+        for index, (pe_values, annotations) in zip(pending, scanned):
+            cluster, _, run_result = computed[index]
+            pvalues = {feature_id: pvalue for feature_id, pvalue, evalue in pe_values}
+            result[index] = (cluster, pvalues,
+                             meme.MemeRunResult(pe_values, annotations, run_result.motif_infos))
+        logging.debug("scanned the motifs of %d clusters in %d ms.", len(pending),
+                      util.current_millis() - start_time)
+        return result
 
 
 def cluster_seqs(params):
@@ -445,7 +918,10 @@ def compute_cluster_score(params):
     logging.info('running meme/mast on cluster %d, # sequences: %d', params.cluster, nseqs)
     if (nseqs >= params.min_cluster_rows and nseqs <= params.max_cluster_rows):
         run_result = params.meme_runner(params)
-        pvalues = {feature_id: pvalue for feature_id, pvalue, evalue in run_result.pe_values}
+        # results of the native scanner get their p-values after the batch scan
+        if run_result.pe_values is not None:
+            pvalues = {feature_id: pvalue
+                       for feature_id, pvalue, evalue in run_result.pe_values}
     else:
         logging.debug("# seqs (= %d) outside of defined limits, "
                       "skipping cluster %d", len(params.seqs), params.cluster)
@@ -527,9 +1003,12 @@ class WeederRunner:
                 logging.debug('no PSSMS generated, skipping cluster')
                 return meme.MemeRunResult([], {}, [])
 
-            dbfile = self.meme_suite.make_sequence_file(
-                [(feature_id, locseq[1])
-                 for feature_id, locseq in params.used_seqs.iteritems()])
+            if self.meme_suite.scan_database() is not None:
+                dbfile = self.meme_suite.scan_database().dbfile
+            else:
+                dbfile = self.meme_suite.make_sequence_file(
+                    [(feature_id, locseq[1])
+                     for feature_id, locseq in params.used_seqs.iteritems()])
             logging.debug("# PSSMS created: %d %s", len(pssms), str([i.consensus_motif() for i in pssms]))
             logging.debug("run MAST on '%s', dbfile: '%s'", meme_outfile, dbfile)
 
@@ -564,7 +1043,7 @@ class WeederRunner:
                         except:
                             logging.warn("could not remove tmp file:'%s'", tmpName)
                 try:
-                    if dbfile:
+                    if dbfile and self.meme_suite.scan_database() is None:
                         os.remove(dbfile)
                 except:
                     logging.warn("could not remove tmp file:'%s'", dbfile)
@@ -0,0 +1,263 @@
+# vi: sw=4 ts=4 et:
+"""motifscan.py - native motif scanning
+An in-process alternative to running MAST on every MEME result. The motifs
+of all clusters are scored against the encoded scan sequences in one batched
+log-odds convolution over both strands and the per-motif sequence p-values
+are combined with MAST's product of p-values method. The results have the
+format of meme.read_mast_output_xml() and follow the MAST options used by
+MemeSuite481.mast():
+
+-mt 0.99   hits are reported if their p-value is below MAX_HIT_PVALUE
+-mev 99999 motifs with a larger E-value than MAX_MOTIF_EVALUE are ignored
+-seqp      hit p-values are adjusted to the length of the sequence
+
+Correlated motifs (-remcorr) are not removed.
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import collections
+import numpy as np
+
+
+ALPHABET = 'ACGT'
+AMBIGUOUS_CODE = len(ALPHABET)  # all other letters, scored as background average
+BREAK_CODE = AMBIGUOUS_CODE + 1  # separates the sequences
+NUM_CODES = BREAK_CODE + 1
+SCAN_CODES = np.array([ALPHABET.find(chr(c).upper()) if chr(c).upper() in ALPHABET
+                       else (AMBIGUOUS_CODE if chr(c).isalpha() else BREAK_CODE)
+                       for c in xrange(256)], dtype=np.uint8)
+
+SCORE_RANGE = 100  # MAST scales log-odds scores to integers in [0, SCORE_RANGE]
+MOTIF_PSEUDOCOUNT = 0.01
+MAX_HIT_PVALUE = 0.99
+MAX_MOTIF_EVALUE = 99999
+
+# columns are scored in groups of GROUP_LENGTH with a table lookup per group,
+# the scores of a block of motifs take at most MAX_BLOCK_CELLS values
+GROUP_LENGTH = 3
+MAX_BLOCK_CELLS = 2 ** 23
+
+# the motifs of a MEME run, their background letter frequencies (ACGT) and
+# the genes that annotations are reported for
+MotifSet = collections.namedtuple('MotifSet', ['motif_infos', 'bg_frequencies', 'genes'])
+
+
+def log_odds_matrix(pssm, bg_frequencies):
+    """converts a probability matrix with ACGT columns into base 2 log-odds"""
+    probs = np.array(pssm, dtype=np.float64)
+    probs = (probs + MOTIF_PSEUDOCOUNT * bg_frequencies) / (1.0 + MOTIF_PSEUDOCOUNT)
+    return np.log2(probs / bg_frequencies)
+
+
+def scaled_matrix(log_odds, bg_frequencies):
+    """scales a log-odds matrix to integers in [0, SCORE_RANGE] like MAST does.
+    The result has a column for each code, ambiguous letters score the
+    background weighted average and BREAK_CODE scores 0"""
+    small, large = log_odds.min(), log_odds.max()
+    scale = SCORE_RANGE / (large - small) if large > small else 1.0
+    result = np.zeros((len(log_odds), NUM_CODES), dtype=np.int16)
+    result[:, :AMBIGUOUS_CODE] = np.round((log_odds - small) * scale)
+    result[:, AMBIGUOUS_CODE] = np.round((np.dot(log_odds, bg_frequencies) - small) * scale)
+    return result
+
+
+def score_pvalues(matrix, bg_frequencies):
+    """the exact p-values P(score >= s) of the scaled matrix' scores s under
+    the 0-order background. The last element is 1.0, so a score of -1 can
+    denote 'no valid position'"""
+    pdf = np.ones(1)
+    for column in matrix[:, :AMBIGUOUS_CODE]:
+        column_pdf = np.zeros(len(pdf) + column.max())
+        for score, frequency in zip(column, bg_frequencies):
+            column_pdf[score:score + len(pdf)] += frequency * pdf
+        pdf = column_pdf
+    pvalues = np.minimum(np.cumsum(pdf[::-1])[::-1], 1.0)
+    return np.append(pvalues, 1.0)
+
+
+def sequence_pvalues(position_pvalues, num_positions, num_strands):
+    """probability that a random sequence with num_positions motif positions
+    on each of num_strands strands has a match with the given position p-value
+    or better"""
+    num_positions = np.maximum(num_positions, 0) * num_strands
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = -np.expm1(num_positions * np.log1p(-position_pvalues))
+    return np.where(num_positions > 0, result, 1.0)
+
+
+def qfast(num_pvalues, products):
+    """MAST's p-values of products of num_pvalues independent uniform
+    p-values"""
+    products = np.asarray(products, dtype=np.float64)
+    if num_pvalues <= 1:
+        return products
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = -np.log(products)
+        term = np.ones(products.shape)
+        total = np.ones(products.shape)
+        for i in xrange(1, num_pvalues):
+            term *= x / i
+            total += term
+        return np.where(products > 0.0, np.minimum(products * total, 1.0), 0.0)
+
+
+def mast_round(value, digits):
+    """rounds to the significant digits that MAST reports"""
+    return float('%.*e' % (digits - 1, value))
+
+
+class MotifScanner:
+    """Scans motifs against a fixed set of sequences. The sequences are
+    encoded once, concatenated and separated by BREAK_CODE"""
+
+    def __init__(self, seqs, use_revcomp=True):
+        """seqs is a list of (name, sequence) pairs"""
+        self.names = [name for name, _ in seqs]
+        self.__index = {name: index for index, name in enumerate(self.names)}
+        self.num_strands = 2 if use_revcomp else 1
+        self.lengths = np.array([len(seq) for _, seq in seqs], dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.lengths + 1)[:-1]]).astype(np.int64)
+        text = ' '.join([seq for _, seq in seqs]) + ' '
+        self.codes = SCAN_CODES[np.frombuffer(text, dtype=np.uint8)]
+        self.seqnums = np.repeat(np.arange(len(seqs)), self.lengths + 1)
+
+        # number of scannable positions starting at each position
+        is_break = self.codes == BREAK_CODE
+        next_break = np.where(is_break, np.arange(len(self.codes)), len(self.codes))
+        next_break = np.minimum.accumulate(next_break[::-1])[::-1]
+        self.run_lengths = next_break - np.arange(len(self.codes))
+
+    def __grouped_codes(self, width):
+        """the number of the GROUP_LENGTH-mer starting at each position,
+        the codes are padded to cover motifs of the given width"""
+        num_groups = -(-width // GROUP_LENGTH)
+        padded = np.concatenate([self.codes,
+                                 np.repeat(np.uint8(BREAK_CODE), num_groups * GROUP_LENGTH)])
+        padded = padded.astype(np.int32)
+        size = len(self.codes) + (num_groups - 1) * GROUP_LENGTH
+        result = np.zeros(size, dtype=np.int32)
+        for offset in xrange(GROUP_LENGTH):
+            result = result * NUM_CODES + padded[offset:offset + size]
+        return result
+
+    def __block_scores(self, matrices, grouped_codes):
+        """scores of the scaled matrices at each position, the matrices are
+        zero-padded to a multiple of GROUP_LENGTH columns"""
+        num_groups = -(-max([len(matrix) for matrix in matrices]) // GROUP_LENGTH)
+        padded = np.zeros((len(matrices), num_groups * GROUP_LENGTH, NUM_CODES),
+                          dtype=np.int16)
+        for index, matrix in enumerate(matrices):
+            padded[index, :len(matrix)] = matrix
+        # tables[motif, group, number of the GROUP_LENGTH-mer]
+        tables = np.zeros((len(matrices), num_groups, 1), dtype=np.int16)
+        for offset in xrange(GROUP_LENGTH):
+            tables = (tables[:, :, :, np.newaxis] +
+                      padded[:, offset::GROUP_LENGTH, np.newaxis, :])
+            tables = tables.reshape(len(matrices), num_groups, -1)
+
+        size = len(self.codes)
+        scores = np.zeros((len(matrices), size), dtype=np.int16)
+        for group in xrange(num_groups):
+            start = group * GROUP_LENGTH
+            scores += np.take(tables[:, group], grouped_codes[start:start + size], axis=1)
+        return scores
+
+    def scan(self, motif_sets):
+        """scans the motifs of all MotifSets, returns a list with a
+        (pe_values, annotations) pair for each set, see
+        meme.read_mast_output_xml()"""
+        motifs = []  # (set index, motif number, width, forward, reverse, p-values)
+        for set_index, motif_set in enumerate(motif_sets):
+            bg_frequencies = np.array(motif_set.bg_frequencies, dtype=np.float64)
+            for motif_info in motif_set.motif_infos:
+                if motif_info.evalue > MAX_MOTIF_EVALUE:
+                    continue
+                log_odds = log_odds_matrix(motif_info.pssm, bg_frequencies)
+                forward = scaled_matrix(log_odds, bg_frequencies)
+                # reversing the ACGT columns complements them
+                reverse = scaled_matrix(log_odds[::-1, ::-1], bg_frequencies)
+                motifs.append((set_index, motif_info.motif_num, len(log_odds), forward,
+                               reverse, score_pvalues(forward, bg_frequencies)))
+
+        gene_positions = []
+        for motif_set in motif_sets:
+            seqnums = [self.__index[gene] for gene in motif_set.genes if gene in self.__index]
+            gene_positions.append(
+                np.concatenate([np.arange(self.starts[seqnum],
+                                          self.starts[seqnum] + self.lengths[seqnum])
+                                for seqnum in seqnums] + [np.zeros(0, dtype=np.int64)]))
+
+        seq_pvalues = [[] for _ in motif_sets]
+        hits = [[] for _ in motif_sets]  # (p-value, sequence, position, motif, width)
+        if len(motifs) > 0:
+            grouped_codes = self.__grouped_codes(max([motif[2] for motif in motifs]))
+        block_size = max(1, MAX_BLOCK_CELLS // len(self.codes))
+        for block_start in xrange(0, len(motifs), block_size):
+            block = motifs[block_start:block_start + block_size]
+            best = self.__block_scores([motif[3] for motif in block], grouped_codes)
+            is_reverse = None
+            if self.num_strands == 2:
+                reverse = self.__block_scores([motif[4] for motif in block], grouped_codes)
+                is_reverse = reverse > best
+                best = np.maximum(best, reverse)
+            widths = np.array([motif[2] for motif in block])
+            best[self.run_lengths[np.newaxis, :] < widths[:, np.newaxis]] = -1
+            seq_best = np.maximum.reduceat(best, self.starts, axis=1)
+
+            for index, (set_index, motif_num, width, _, _, pvalues) in enumerate(block):
+                num_positions = self.lengths - width + 1
+                seq_pvalues[set_index].append(
+                    sequence_pvalues(pvalues[seq_best[index]], num_positions,
+                                     self.num_strands))
+
+                positions = gene_positions[set_index]
+                scores = best[index, positions]
+                seqnums = self.seqnums[positions]
+                hit_pvalues = sequence_pvalues(pvalues[scores], num_positions[seqnums], 1)
+                is_hit = (scores >= 0) & (hit_pvalues < MAX_HIT_PVALUE)
+                for position, seqnum, pvalue in zip(positions[is_hit], seqnums[is_hit],
+                                                    hit_pvalues[is_hit]):
+                    signed_num = motif_num
+                    if is_reverse is not None and is_reverse[index, position]:
+                        signed_num = -motif_num
+                    hits[set_index].append((pvalue, seqnum, position - self.starts[seqnum],
+                                            signed_num, width))
+
+        result = []
+        for set_index, motif_set in enumerate(motif_sets):
+            if len(seq_pvalues[set_index]) == 0:
+                result.append(([], {}))  # no motif passed the E-value
+            else:
+                result.append((self.__pe_values(seq_pvalues[set_index]),
+                               self.__annotations(motif_set.genes, hits[set_index])))
+        return result
+
+    def __pe_values(self, seq_pvalues):
+        """combines the sequence p-values of the motifs into
+        [(name, combined p-value, E-value)], sorted by p-value"""
+        products = np.prod(seq_pvalues, axis=0)
+        combined = qfast(len(seq_pvalues), products)
+        order = np.argsort(combined, kind='mergesort')
+        return [(self.names[seqnum], mast_round(combined[seqnum], 3),
+                 mast_round(combined[seqnum] * len(self.names), 2))
+                for seqnum in order]
+
+    def __annotations(self, genes, hits):
+        """the best non-overlapping hits of each gene as a map
+        gene -> [(p-value, position, motif number)], the position has the
+        same offset as in read_mast_output_xml() and reverse strand hits
+        have negative motif numbers"""
+        result = {gene: [] for gene in genes if gene in self.__index}
+        occupied = collections.defaultdict(set)
+        selected = collections.defaultdict(list)
+        for pvalue, seqnum, position, motif_num, width in sorted(hits):
+            covered = occupied[seqnum]
+            if any([pos in covered for pos in xrange(position, position + width)]):
+                continue
+            covered.update(xrange(position, position + width))
+            selected[seqnum].append((position, pvalue, motif_num))
+        for seqnum, seq_hits in selected.iteritems():
+            result[self.names[seqnum]] = [(mast_round(pvalue, 2), int(position) + 3, motif_num)
+                                          for position, pvalue, motif_num in sorted(seq_hits)]
+        return result
@@ -5,18 +5,25 @@ This file is part of cMonkey Python. Please see README and LICENSE for
 more information and licensing details.
 """
 import numpy as np
+import scipy.sparse
 import logging
 import util
 import datamatrix as dm
 import scoring
+import checkpoint
 import cPickle
+import os
 import os.path
+import hashlib
 
 
 class Network:
     """class to represent a network graph.
     The graph is considered undirected
     For efficiency reasons, edges is a list of [source, target, weight]
+    Networks that were loaded from the binary cache keep their edges as
+    index arrays into a node name table and only build the edge list when
+    it is actually needed
     """
 
     def __init__(self, name, edges, weight, dummy):
@@ -24,7 +31,43 @@ class Network:
         self.name = name
         self.edges = edges
         self.weight = weight
-        self.__compute_edges_with_source()
+        self.__adjacency = None
+        self.__arrays = None
+        self.edges_with_source = None
+        if edges is not None:
+            self.__compute_edges_with_source()
+
+    @classmethod
+    def from_arrays(cls, name, nodes, sources, targets, weights, weight):
+        """creates a network from the node name table and the source index,
+        target index and weight arrays of its edges"""
+        network = cls(name, None, weight, 0)
+        network.__arrays = (nodes, sources, targets, weights)
+        return network
+
+    def __materialize(self):
+        """builds the edge list of an array based network"""
+        if self.edges is None:
+            nodes, sources, targets, weights = self.__arrays
+            self.edges = [(nodes[source], nodes[target], float(score))
+                          for source, target, score in zip(sources.tolist(),
+                                                           targets.tolist(),
+                                                           weights.tolist())]
+            self.__arrays = None
+            self.__compute_edges_with_source()
+
+    def edge_arrays(self):
+        """returns the edges as a tuple (nodes, sources, targets, weights),
+        where sources and targets are index arrays into the node name list"""
+        if self.__arrays is not None:
+            return self.__arrays
+        nodes = sorted({edge[0] for edge in self.edges} |
+                       {edge[1] for edge in self.edges})
+        node_indexes = {node: index for index, node in enumerate(nodes)}
+        sources = np.array([node_indexes[edge[0]] for edge in self.edges], dtype=np.int32)
+        targets = np.array([node_indexes[edge[1]] for edge in self.edges], dtype=np.int32)
+        weights = np.array([edge[2] for edge in self.edges], dtype=np.float64)
+        return nodes, sources, targets, weights
 
     def __compute_edges_with_source(self):
         self.edges_with_source = {}
@@ -50,12 +93,14 @@ class Network:
         """
 
         # remap first
+        self.__materialize()
         new_edges = []
         for n0, n1, score in self.edges:
             n0 = synonyms[n0] if n0 in synonyms else n0
             n1 = synonyms[n1] if n1 in synonyms else n1
             new_edges.append((n0, n1, score))
         self.edges = new_edges
+        self.__adjacency = None
         self.__compute_edges_with_source()
 
         # then validate
@@ -71,10 +116,14 @@ class Network:
 
     def num_edges(self):
         """returns the number of edges in this graph"""
+        if self.edges is None:
+            return len(self.__arrays[1])
         return len(self.edges)
 
     def total_score(self):
         """returns the sum of edge scores"""
+        if self.edges is None:
+            return float(np.sum(self.__arrays[3], dtype=np.float64)) * 2
         return sum(edge[2] for edge in self.edges) * 2
 
     def normalize_scores_to(self, score):
@@ -85,11 +134,55 @@ class Network:
             # score_e / score_total * score == score_e * (score_total / score)
             # we use this to save a division per loop iteration
             scale = float(score) / float(total)
-            self.edges = [(edge[0], edge[1], edge[2] * scale) for edge in self.edges]
-        self.__compute_edges_with_source()
+            if self.edges is None:
+                nodes, sources, targets, weights = self.__arrays
+                self.__arrays = (nodes, sources, targets, weights * scale)
+            else:
+                self.edges = [(edge[0], edge[1], edge[2] * scale) for edge in self.edges]
+            if self.__adjacency is not None:
+                self.__adjacency[1].data *= scale
+        if self.edges is not None:
+            self.__compute_edges_with_source()
+
+    def adjacency_matrix(self, row_names):
+        """returns the network as a symmetric sparse (CSR) matrix over the
+        indexes of row_names, edges to nodes that are not in row_names are
+        dropped. The matrix is cached for the row_names list"""
+        if self.__adjacency is None or self.__adjacency[0] is not row_names:
+            row_indexes = {name: index for index, name in enumerate(row_names)}
+            nodes, sources, targets, weights = self.edge_arrays()
+            node_rows = np.array([row_indexes.get(node, -1) for node in nodes],
+                                 dtype=np.int64)
+            if len(node_rows) > 0:
+                sources = node_rows[sources]
+                targets = node_rows[targets]
+            else:
+                sources = targets = np.zeros(0, dtype=np.int64)
+            keep = (sources >= 0) & (targets >= 0)
+            sources, targets, weights = sources[keep], targets[keep], weights[keep]
+            # duplicate entries are summed up by the conversion to CSR
+            adjacency = scipy.sparse.coo_matrix(
+                (np.concatenate([weights, weights]).astype(dm.VALUE_TYPE),
+                 (np.concatenate([sources, targets]), np.concatenate([targets, sources]))),
+                shape=(len(row_names), len(row_names))).tocsr()
+            self.__adjacency = (row_names, adjacency)
+        return self.__adjacency[1]
+
+    def memory_usage(self):
+        """the number of bytes of the edge arrays and the adjacency matrix"""
+        result = 0
+        if self.__arrays is not None:
+            result += sum([array.nbytes for array in self.__arrays
+                           if isinstance(array, np.ndarray)])
+        if self.__adjacency is not None:
+            adjacency = self.__adjacency[1]
+            result += (adjacency.data.nbytes + adjacency.indices.nbytes +
+                       adjacency.indptr.nbytes)
+        return result
 
     def edges_with_node(self, node):
         """returns the edges where node is a node of"""
+        self.__materialize()
         if node in self.edges_with_source:
             return self.edges_with_source[node]
         else:
@@ -97,7 +190,7 @@ class Network:
 
     def __repr__(self):
         return "Network: %s\n# edges: %d\n" % (self.name,
-                                               len(self.edges))
+                                               self.num_edges())
 
     @classmethod
     def create(cls, name, edges, weight, organism=None, ratios=None,
@@ -144,41 +237,91 @@ class Network:
         if check_size and len(network_edges) < 10:
             raise Exception("Error: only %d edges in network '%s'" % (len(network_edges), name))
         logging.debug("Created network '%s' with %d edges", name, len(network_edges))
-        return Network(name, network_edges, weight, 0)
-
-
-COMPUTE_NETWORK = None
-ALL_GENES = None
-NETWORK_SCORE_MEMBERSHIP = None
-
-
-def compute_network_scores(cluster):
-    """Generic method to compute network scores"""
-    global COMPUTE_NETWORK, ALL_GENES, NETWORK_SCORE_MEMBERSHIP
-    network = COMPUTE_NETWORK
-
-    genes = sorted(NETWORK_SCORE_MEMBERSHIP.rows_for_cluster(cluster))
-    gene_scores = {}
-    
-    for gene in genes:
-        # TODO: optimization: we can use numpy arrays for the scores array
-        # and then sum
-        edges = network.edges_with_node(gene)
-        for edge in edges:
-            other_gene = edge[0]
-            if other_gene == gene:
-                other_gene = edge[1]
-            if other_gene in ALL_GENES:
-                if other_gene not in gene_scores:
-                    gene_scores[other_gene] = []
-                gene_scores[other_gene].append(edge[2])
-
-    final_gene_scores = {}
-    for gene, scores in gene_scores.iteritems():
-        final_gene_scores[gene] = sum(scores) / len(genes)
-        final_gene_scores[gene] = -np.log(final_gene_scores[gene] + 1)
-    return final_gene_scores
-
+        network = Network(name, network_edges, weight, 0)
+        if ratios:
+            network.adjacency_matrix(ratios.row_names)
+        return network
+
+
+NETWORK_CACHE_VERSION = 1
+NETWORK_CACHE_DIR = 'networks'
+NETWORK_CACHE_ARRAYS = [('sources', np.int32), ('targets', np.int32), ('weights', np.float32)]
+
+
+def network_cache_key(source_digest, organism_code, ratios, *params):
+    """returns the key of a cached network. A network is determined by
+    the digest of its source, the organism, the row names of the ratios
+    and the parameters of its construction, e.g. the score normalization"""
+    digest = hashlib.sha1()
+    for part in [NETWORK_CACHE_VERSION, source_digest, organism_code] + list(params):
+        digest.update('%s\0' % str(part))
+    if ratios is not None:
+        digest.update('ratios\0')
+        for row_name in sorted(set(ratios.row_names)):
+            digest.update('%s\n' % row_name)
+    return digest.hexdigest()
+
+
+def write_network_cache(path, network):
+    """stores the edges of the network as int32 index arrays, a float32
+    weight array and a node name table. The node table is written last,
+    so a cache entry is complete when it exists"""
+    nodes, sources, targets, weights = network.edge_arrays()
+    arrays = {'sources': sources, 'targets': targets, 'weights': weights}
+    tmp_suffix = '.tmp%d' % os.getpid()
+    for array_name, dtype in NETWORK_CACHE_ARRAYS:
+        filename = '%s.%s.npy' % (path, array_name)
+        with open(filename + tmp_suffix, 'wb') as outfile:
+            np.save(outfile, np.asarray(arrays[array_name], dtype=dtype))
+        os.rename(filename + tmp_suffix, filename)
+    with open(path + '.nodes' + tmp_suffix, 'w') as outfile:
+        for node in nodes:
+            outfile.write('%s\n' % node)
+    os.rename(path + '.nodes' + tmp_suffix, path + '.nodes')
+
+
+def read_network_cache(path, name, weight):
+    """reads a network from the cache, the edge arrays are memory mapped"""
+    with open(path + '.nodes') as infile:
+        nodes = [intern(line.rstrip('\n')) for line in infile]
+    sources, targets, weights = [np.load('%s.%s.npy' % (path, array_name), mmap_mode='r')
+                                 for array_name, _ in NETWORK_CACHE_ARRAYS]
+    return Network.from_arrays(name, nodes, sources, targets, weights, weight)
+
+
+def cached_network(cache_dir, name, weight, key, make_network):
+    """returns the network stored under key in the network cache of
+    cache_dir. On a cache miss, the network is created by calling
+    make_network() and stored in the cache"""
+    if cache_dir is None:
+        return make_network()
+    network_dir = os.path.join(cache_dir, NETWORK_CACHE_DIR)
+    path = os.path.join(network_dir, key)
+    if os.path.exists(path + '.nodes'):
+        try:
+            network = read_network_cache(path, name, weight)
+            logging.info("Network '%s' read from cache '%s'", name, path)
+            return network
+        except (IOError, ValueError):
+            logging.warn("could not read cached network '%s', rebuilding", path)
+
+    network = make_network()
+    if not os.path.exists(network_dir):
+        os.makedirs(network_dir)
+    write_network_cache(path, network)
+    # always continue with the cached representation, so that runs behave
+    # the same on cache hits and misses
+    return read_network_cache(path, name, weight)
+
+
+def compute_network_scores(adjacency, member_mask, cluster_sizes):
+    """Generic method to compute network scores for all clusters: for each gene
+    and cluster, the sum of the weights of the gene's edges to the cluster
+    members, divided by the cluster size and scaled to -log(x + 1).
+    member_mask is the gene x cluster membership indicator matrix"""
+    scores = adjacency.dot(member_mask.astype(adjacency.dtype))
+    scores /= np.maximum(cluster_sizes, 1)
+    return -np.log(scores + 1)
 
 
 class ScoringFunction(scoring.ScoringFunctionBase):
@@ -215,6 +358,26 @@ class ScoringFunction(scoring.ScoringFunctionBase):
         
         return result
 
+    def checkpoint_state(self):
+        """the last result and the score means of the networks"""
+        state = scoring.ScoringFunctionBase.checkpoint_state(self)
+        if 'score_means' in dir(self):
+            state['score_means'] = checkpoint.object_array(self.score_means)
+        return state
+
+    def memory_usage(self):
+        """the last result and the networks"""
+        result = scoring.ScoringFunctionBase.memory_usage(self)
+        if self.__networks is not None:
+            result += sum([network.memory_usage() for network in self.__networks])
+        return result
+
+    def restore_checkpoint(self, state):
+        """restores the state of checkpoint_state()"""
+        scoring.ScoringFunctionBase.restore_checkpoint(self, state)
+        if 'score_means' in state:
+            self.score_means = checkpoint.array_object(state['score_means'])
+
     def networks(self):
         """networks are cached"""
         if self.__networks is None:
@@ -227,86 +390,36 @@ class ScoringFunction(scoring.ScoringFunctionBase):
                                      self.gene_names())
         return self.__networks
 
-    def __update_score_means(self, network_scores):
-        """returns the score means, adjusted to the current cluster setup"""
-        # a dictionary that holds the network score means for
-        # each cluster, separated for each network
-        if network_scores:
-            score_means = {network.name: self.__compute_cluster_score_means(network_scores[network.name])
-                           for network in self.networks()}
-            return {network: np.average(np.array(cluster_score_means.values()))
-                    for network, cluster_score_means in score_means.iteritems()}
-        return {}
-
     def do_compute(self, iteration_result, ref_matrix=None):
         """compute method, iteration is the 0-based iteration number"""
 
         matrix = dm.DataMatrix(len(self.gene_names()), self.num_clusters(),
                                self.gene_names())
-        network_scores = {}
+        member_mask = self.membership.row_member_mask(self.gene_names())
+        cluster_sizes = np.array([self.membership.num_row_members(cluster)
+                                  for cluster in xrange(1, self.num_clusters() + 1)])
+        self.score_means = {}
         for network in self.networks():
             logging.debug("Compute scores for network '%s', WEIGHT: %f",
                           network.name, network.weight)
             start_time = util.current_millis()
-            network_score = self.__compute_network_cluster_scores(network)
-            network_scores[network.name] = network_score
-            self.__update_score_matrix(matrix, network_score, network.weight)
+            network_score = compute_network_scores(
+                network.adjacency_matrix(self.gene_names()), member_mask, cluster_sizes)
+            matrix.values += network_score * network.weight
+            self.score_means[network.name] = compute_score_mean(network_score, member_mask)
             elapsed = util.current_millis() - start_time
             logging.debug("NETWORK '%s' SCORING TIME: %f s.",
                           network.name, (elapsed / 1000.0))
-
-        # compute and store score means
-        self.score_means = self.__update_score_means(network_scores)
         return matrix
 
-    def __compute_network_cluster_scores(self, network):
-        """computes the cluster scores for the given network"""
-        global COMPUTE_NETWORK, ALL_GENES, NETWORK_SCORE_MEMBERSHIP
-        result = {}
-        use_multiprocessing = self.config_params[
-            scoring.KEY_MULTIPROCESSING]
-        # Set the huge memory objects into globals
-        # These are readonly anyways, but using Manager.list() or something
-        # similar brings this down to a crawl
-        COMPUTE_NETWORK = network
-        ALL_GENES = set(self.gene_names())  # optimization: O(1) lookup
-        NETWORK_SCORE_MEMBERSHIP = self.membership
-
-        if use_multiprocessing:
-            with util.get_mp_pool(self.config_params) as pool:
-                map_results = pool.map(compute_network_scores, xrange(1, self.num_clusters() + 1))
-            for cluster in xrange(1, self.num_clusters() + 1):
-                result[cluster] = map_results[cluster - 1]
-        else:
-            for cluster in xrange(1, self.num_clusters() + 1):
-                result[cluster] = compute_network_scores(cluster)
-        # cleanup
-        COMPUTE_NETWORK = None
-        ALL_GENES = None
-        NETWORK_SCORE_MEMBERSHIP = None
-        return result
 
-    def __update_score_matrix(self, matrix, network_score, weight):
-        """add values into the result score matrix"""
-        mvalues = matrix.values
-        gene_names = self.gene_names()
-        for cluster in xrange(1, self.num_clusters() + 1):
-            cluster_genes = set(network_score[cluster].keys())
-            for row_index in xrange(self.ratios.num_rows):
-                gene = gene_names[row_index]
-                if gene in cluster_genes:
-                    weighted_score = network_score[cluster][gene] * weight
-                    mvalues[row_index][cluster - 1] += weighted_score
-
-    def __compute_cluster_score_means(self, network_score):
-        """compute the score means on the given network score"""
-        result = {}
-        for cluster in xrange(1, self.num_clusters() + 1):
-            cluster_scores = [network_score[cluster][gene]
-                              if gene in network_score[cluster] else 0.0
-                              for gene in self.rows_for_cluster(cluster)]
-            result[cluster] = util.trim_mean(cluster_scores, 0.05)
-        return result
+def compute_score_mean(network_score, member_mask, trim=0.05):
+    """the network score mean over all clusters, which is the average of
+    the trimmed means of the cluster members' scores"""
+    cluster_means = [util.trim_mean(network_score[member_mask[:, cluster], cluster].tolist(),
+                                    trim)
+                     for cluster in xrange(network_score.shape[1])]
+    return float(np.average(cluster_means))
 
 
 def retrieve_networks(organism):
@@ -0,0 +1,386 @@
+# vi: sw=4 ts=4 et:
+"""resultdb.py - batched writing of the cMonkey results to the
+output database
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import sqlite3
+import threading
+import Queue
+import logging
+import collections
+import sys
+import time
+
+
+# Applied to every connection to the output database. The write-ahead log
+# lets readers work while results are written, and with synchronous=NORMAL
+# the log is only synced at checkpoints. The page cache is 64 MB.
+PRAGMAS = ['pragma journal_mode=WAL', 'pragma synchronous=NORMAL',
+           'pragma cache_size=-65536']
+
+# The indexes are created when the run is finalized, building them once
+# is cheaper than maintaining them on every result write.
+# (name, table, columns)
+INDEXES = [('membiter_iter_index', 'membership_iterations', 'iteration'),
+           ('colsnap_iter_index', 'column_member_snapshots', 'iteration'),
+           ('rowsnap_iter_index', 'row_member_snapshots', 'iteration'),
+           ('colchg_iter_index', 'column_member_changes', 'iteration'),
+           ('rowchg_iter_index', 'row_member_changes', 'iteration'),
+           ('colchg_order_index', 'column_member_changes', 'order_num, old_cluster'),
+           ('rowchg_order_index', 'row_member_changes', 'order_num, old_cluster'),
+           ('cluststat_iter_index', 'cluster_stats', 'iteration'),
+           ('rnames_name_index', 'row_names', 'name'),
+           ('motinf_clust_index', 'motif_infos', 'cluster')]
+
+MEMBER_TYPES = ['row', 'column']
+
+# The members of an iteration are the members of its snapshot that were
+# not removed since, and the members that were added since the snapshot
+# and not removed after they were added
+MEMBERS_VIEW = """create view %(type)s_members as
+select mi.iteration, s.cluster, s.order_num
+from membership_iterations mi join %(type)s_member_snapshots s
+on s.iteration = mi.snapshot_iteration
+where not exists (select 1 from %(type)s_member_changes r
+                  where r.order_num = s.order_num and r.old_cluster = s.cluster and
+                  r.iteration > mi.snapshot_iteration and r.iteration <= mi.iteration)
+union all
+select mi.iteration, c.new_cluster, c.order_num
+from membership_iterations mi join %(type)s_member_changes c
+on c.iteration > mi.snapshot_iteration and c.iteration <= mi.iteration
+where c.new_cluster is not null and
+not exists (select 1 from %(type)s_member_changes r
+            where r.order_num = c.order_num and r.old_cluster = c.new_cluster and
+            r.iteration > c.iteration and r.iteration <= mi.iteration)"""
+
+# the statements a ResultBatch can hold rows for
+STATEMENTS = {
+    'row_members': 'insert into row_members (iteration,cluster,order_num) values (?,?,?)',
+    'column_members': 'insert into column_members (iteration,cluster,order_num) values (?,?,?)',
+    'row_member_snapshots': '''insert into row_member_snapshots (iteration,cluster,order_num)
+                               values (?,?,?)''',
+    'column_member_snapshots': '''insert into column_member_snapshots (iteration,cluster,
+                                  order_num) values (?,?,?)''',
+    'row_member_changes': '''insert into row_member_changes (iteration,order_num,old_cluster,
+                             new_cluster) values (?,?,?,?)''',
+    'column_member_changes': '''insert into column_member_changes (iteration,order_num,
+                                old_cluster,new_cluster) values (?,?,?,?)''',
+    'membership_iterations': '''insert into membership_iterations (iteration,snapshot_iteration)
+                                values (?,?)''',
+    'motif_infos': '''insert into motif_infos (rowid,iteration,cluster,seqtype,motif_num,evalue)
+                      values (?,?,?,?,?,?)''',
+    'motif_pssm_rows': '''insert into motif_pssm_rows (motif_info_id,iteration,row,a,c,g,t)
+                          values (?,?,?,?,?,?,?)''',
+    'motif_annotations': '''insert into motif_annotations (motif_info_id,iteration,gene_num,
+                            position,reverse,pvalue) values (?,?,?,?,?,?)''',
+    'meme_motif_sites': '''insert into meme_motif_sites (motif_info_id,seq_name,reverse,start,
+                           pvalue,flank_left,seq,flank_right) values (?,?,?,?,?,?,?,?)''',
+    'cluster_stats': '''insert into cluster_stats (iteration,cluster,num_rows,num_cols,residual)
+                        values (?,?,?,?,?)''',
+    'iteration_stats': 'insert into iteration_stats (statstype,iteration,score) values (?,?,?)',
+    'last_iteration': 'update run_infos set last_iteration = ?'
+}
+
+
+def connect(dbpath, timeout=15):
+    """Returns a connection to the output database"""
+    conn = sqlite3.connect(dbpath, timeout, isolation_level='DEFERRED')
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def table_names(conn):
+    """the names of the tables in the database"""
+    return {row[0] for row in conn.execute("select name from sqlite_master where type='table'")}
+
+
+def create_indexes(conn):
+    """creates the result indexes if they do not exist yet, the membership
+    indexes are only created for databases with a membership history"""
+    tables = table_names(conn)
+    with conn:
+        for name, table, columns in INDEXES:
+            if table in tables:
+                conn.execute('create index if not exists %s on %s (%s)' % (name, table, columns))
+
+
+def create_membership_tables(conn):
+    """creates the membership history tables and the row_members and
+    column_members views that reconstruct the members of every iteration"""
+    with conn:
+        conn.execute('create table membership_iterations (iteration int, snapshot_iteration int)')
+        for member_type in MEMBER_TYPES:
+            conn.execute('''create table %s_member_snapshots (iteration int, cluster int,
+                            order_num int)''' % member_type)
+            conn.execute('''create table %s_member_changes (iteration int, order_num int,
+                            old_cluster int, new_cluster int)''' % member_type)
+            conn.execute(MEMBERS_VIEW % {'type': member_type})
+
+
+def delete_after_iteration(conn, iteration):
+    """deletes the results of the iterations after the specified iteration,
+    e.g. the results that a run wrote after the checkpoint it is resumed
+    from. The motif rows without an iteration are deleted with their motifs"""
+    tables = table_names(conn)
+    motif_ids = 'select rowid from motif_infos where iteration > ?'
+    with conn:
+        if 'motif_infos' in tables:
+            for table, column in [('meme_motif_sites', 'motif_info_id'),
+                                  ('tomtom_results', 'motif_info_id1'),
+                                  ('tomtom_results', 'motif_info_id2')]:
+                if table in tables:
+                    conn.execute('delete from %s where %s in (%s)' % (table, column, motif_ids),
+                                 [iteration])
+        for table in sorted(tables):
+            columns = [row[1] for row in conn.execute('pragma table_info(%s)' % table)]
+            if 'iteration' in columns:
+                conn.execute('delete from %s where iteration > ?' % table, [iteration])
+        if 'run_infos' in tables:
+            conn.execute('update run_infos set last_iteration = ? where last_iteration > ?',
+                         [iteration, iteration])
+
+
+def has_membership_history(conn):
+    """False for databases that store the full members of every iteration
+    in row_members and column_members tables"""
+    return 'membership_iterations' in table_names(conn)
+
+
+def last_member_iteration(conn):
+    """the last iteration that members were written for or None"""
+    if has_membership_history(conn):
+        query = 'select max(iteration) from membership_iterations'
+    else:
+        query = 'select max(iteration) from row_members'
+    return conn.execute(query).fetchone()[0]
+
+
+def read_members(conn, member_type, iteration):
+    """Returns the sorted (cluster, order_num) pairs of the row or column
+    ('row' or 'column') members of the specified iteration"""
+    if not has_membership_history(conn):
+        return sorted(conn.execute('select cluster, order_num from %s_members where iteration=?'
+                                   % member_type, [iteration]).fetchall())
+
+    row = conn.execute('select snapshot_iteration from membership_iterations where iteration=?',
+                       [iteration]).fetchone()
+    if row is None:
+        return []
+    snapshot_iteration = row[0]
+    members = set(conn.execute('select cluster, order_num from %s_member_snapshots '
+                               'where iteration=?' % member_type, [snapshot_iteration]))
+    changes = conn.execute('select order_num, old_cluster, new_cluster from %s_member_changes '
+                           'where iteration > ? and iteration <= ? order by iteration, rowid'
+                           % member_type, [snapshot_iteration, iteration])
+    for order_num, old_cluster, new_cluster in changes:
+        if old_cluster is not None:
+            members.discard((old_cluster, order_num))
+        if new_cluster is not None:
+            members.add((new_cluster, order_num))
+    return sorted(members)
+
+
+def member_changes(old_members, new_members):
+    """Returns the (order_num, old_cluster, new_cluster) changes from the old
+    to the new (cluster, order_num) pairs. A row that moves from one cluster
+    to another is a single change, additions and removals without a
+    counterpart have None as their old or new cluster"""
+    removed = collections.defaultdict(list)
+    added = collections.defaultdict(list)
+    for cluster, order_num in old_members - new_members:
+        removed[order_num].append(cluster)
+    for cluster, order_num in new_members - old_members:
+        added[order_num].append(cluster)
+    changes = []
+    for order_num in sorted(set(removed.keys()) | set(added.keys())):
+        old_clusters = sorted(removed[order_num])
+        new_clusters = sorted(added[order_num])
+        for index in xrange(max(len(old_clusters), len(new_clusters))):
+            changes.append((order_num,
+                            old_clusters[index] if index < len(old_clusters) else None,
+                            new_clusters[index] if index < len(new_clusters) else None))
+    return changes
+
+
+class ResultBatch:
+    """The rows of a result write, by statement name. They are written
+    in the order the statements were first added"""
+
+    def __init__(self):
+        self.rows = collections.OrderedDict()
+
+    def add(self, statement, rows):
+        """adds the rows for the specified statement"""
+        self.rows.setdefault(statement, []).extend(rows)
+
+    def num_rows(self):
+        return sum([len(rows) for rows in self.rows.values()])
+
+
+class MembershipHistory:
+    """Encodes the members of the written iterations as a full snapshot
+    every snapshot_interval iterations and the changes to the previously
+    written iteration in between.
+    The state of the last written iteration is read from the database, so
+    a resumed run continues its history. Databases without membership
+    history tables get the full members of every iteration"""
+
+    def __init__(self, conn, snapshot_interval):
+        self.snapshot_interval = snapshot_interval
+        self.__full_members = not has_membership_history(conn)
+        self.__snapshot_iteration = None
+        self.__members = None
+        iteration = last_member_iteration(conn)
+        self.__last_iteration = iteration
+        if not self.__full_members and iteration is not None:
+            self.__snapshot_iteration = conn.execute(
+                'select snapshot_iteration from membership_iterations where iteration=?',
+                [iteration]).fetchone()[0]
+            self.__members = {member_type: set(read_members(conn, member_type, iteration))
+                              for member_type in MEMBER_TYPES}
+
+    def add(self, batch, iteration, members, snapshot=False):
+        """adds the members of the iteration to the batch, members is a
+        dictionary from 'row' and 'column' to sets of (cluster, order_num) pairs.
+        snapshot=True enforces a snapshot"""
+        if self.__last_iteration is not None and iteration <= self.__last_iteration:
+            # e.g. the first iteration of a resumed run
+            logging.debug("members of iteration %d were already written", iteration)
+            return
+        self.__last_iteration = iteration
+        if self.__full_members:
+            for member_type in MEMBER_TYPES:
+                batch.add('%s_members' % member_type,
+                          [(iteration, cluster, order_num)
+                           for cluster, order_num in sorted(members[member_type])])
+            return
+
+        if (snapshot or self.__members is None or
+            iteration - self.__snapshot_iteration >= self.snapshot_interval):
+            self.__snapshot_iteration = iteration
+            for member_type in MEMBER_TYPES:
+                batch.add('%s_member_snapshots' % member_type,
+                          [(iteration, cluster, order_num)
+                           for cluster, order_num in sorted(members[member_type])])
+        else:
+            for member_type in MEMBER_TYPES:
+                batch.add('%s_member_changes' % member_type,
+                          [(iteration,) + change
+                           for change in member_changes(self.__members[member_type],
+                                                        members[member_type])])
+        batch.add('membership_iterations', [(iteration, self.__snapshot_iteration)])
+        self.__members = {member_type: set(members[member_type])
+                          for member_type in MEMBER_TYPES}
+
+
+class ResultWriter:
+    """Writes ResultBatch objects with one executemany() per statement and
+    a single transaction per batch.
+    Motif info ids are assigned in-process with next_motif_info_id(), so the
+    rows that refer to a motif can be built before it was inserted.
+    With background=True, the batches are written by a writer thread and
+    write() only blocks if queue_size batches are waiting to be written"""
+
+    def __init__(self, dbpath, background=False, queue_size=4):
+        self.dbpath = dbpath
+        self.num_rows = 0
+        self.seconds = 0.0
+        self.__conn = None
+        self.__error = None
+        conn = connect(dbpath)
+        try:
+            last_id = conn.execute('select max(rowid) from motif_infos').fetchone()[0]
+            self.__last_motif_info_id = last_id if last_id is not None else 0
+        finally:
+            conn.close()
+
+        self.__queue = None
+        self.__thread = None
+        if background:
+            self.__queue = Queue.Queue(queue_size)
+            self.__thread = threading.Thread(target=self.__run, name='ResultWriter')
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def next_motif_info_id(self):
+        """allocates the id of a new motif_infos row"""
+        self.__last_motif_info_id += 1
+        return self.__last_motif_info_id
+
+    def write(self, batch):
+        """writes or enqueues the batch"""
+        self.__check_error()
+        if self.__queue is not None:
+            self.__queue.put(batch)
+        else:
+            self.__write(batch)
+
+    def flush(self):
+        """waits until all enqueued batches are written"""
+        if self.__queue is not None:
+            self.__queue.join()
+        self.__check_error()
+
+    def close(self):
+        """writes the enqueued batches and closes the connection"""
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+            self.__queue = None
+        else:
+            self.__close_connection()
+        if self.num_rows > 0:
+            logging.info("result writer: %d rows in %.2f s (%.0f rows/s)",
+                         self.num_rows, self.seconds, self.rows_per_second())
+        self.__check_error()
+
+    def rows_per_second(self):
+        """the write throughput so far"""
+        return self.num_rows / self.seconds if self.seconds > 0.0 else 0.0
+
+    def __write(self, batch):
+        """writes the batch in one transaction"""
+        if self.__conn is None:
+            self.__conn = connect(self.dbpath)
+        start_time = time.time()
+        with self.__conn:
+            for statement, rows in batch.rows.iteritems():
+                if len(rows) > 0:
+                    self.__conn.executemany(STATEMENTS[statement], rows)
+        elapsed = time.time() - start_time
+        num_rows = batch.num_rows()
+        self.num_rows += num_rows
+        self.seconds += elapsed
+        logging.debug("wrote %d result rows in %.3f s (%.0f rows/s)", num_rows, elapsed,
+                      num_rows / elapsed if elapsed > 0.0 else 0.0)
+
+    def __close_connection(self):
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+    def __run(self):
+        """the writer thread, batches after an error are dropped"""
+        while True:
+            batch = self.__queue.get()
+            try:
+                if batch is None:
+                    # the connection belongs to this thread
+                    self.__close_connection()
+                    return
+                if self.__error is None:
+                    self.__write(batch)
+            except:
+                self.__error = sys.exc_info()
+            finally:
+                self.__queue.task_done()
+
+    def __check_error(self):
+        """re-raises an error of the writer thread"""
+        if self.__error is not None:
+            error, self.__error = self.__error, None
+            raise error[0], error[1], error[2]
@@ -0,0 +1,188 @@
+# vi: sw=4 ts=4 et:
+"""scorestore.py - storage for the score matrices of the scoring functions
+
+The score matrices of a run are kept in RAM up to a memory budget that
+is shared by all scoring functions. When the budget is exceeded, the
+least recently used matrices are spilled to .npy files in the store
+directory. Matrix files are overwritten in place and loaded as copy-on-write
+memory maps, so reading a spilled matrix does not copy it and modifying the
+loaded matrix does not change the file. The row and column names of a
+matrix are written to a separate file, only when they change.
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import os
+import logging
+import collections
+import weakref
+import numpy as np
+import datamatrix as dm
+
+
+SCORE_STORE_DIR = 'scores'
+
+# the stores of the runs in this process by directory, see run_store()
+STORES = {}
+
+
+def make_matrix(values, row_names, column_names):
+    """creates a DataMatrix that uses values without copying them"""
+    matrix = dm.DataMatrix(len(row_names), len(column_names), row_names, column_names)
+    matrix.values = values
+    return matrix
+
+
+class ScoreStore:
+    """A store of named score matrices with an in-RAM tier of max_bytes
+    (None means unlimited) and .npy files in directory. If dtype is given,
+    the matrix values are stored with this type"""
+
+    def __init__(self, directory, max_bytes=None, dtype=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.__ram = collections.OrderedDict()  # key -> DataMatrix, LRU order
+        self.__ram_bytes = 0
+        self.__names = {}  # key -> (row_names, column_names) of the matrix file
+        self.__mapped = {}  # key -> weak reference to the loaded memory map
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def __names_path(self, key):
+        return os.path.join(self.directory, key + '.names.npz')
+
+    def __values(self, matrix):
+        if self.dtype is None or matrix.values.dtype == self.dtype:
+            return matrix.values
+        return matrix.values.astype(self.dtype)
+
+    def ram_bytes(self, key=None):
+        """the number of bytes of the matrices in the RAM tier, or of the
+        matrix for key"""
+        if key is None:
+            return self.__ram_bytes
+        return self.__ram[key].values.nbytes if key in self.__ram else 0
+
+    def in_ram(self, key):
+        """determines whether the matrix for key is in the RAM tier"""
+        return key in self.__ram
+
+    def put(self, key, matrix, ram=True):
+        """stores the matrix for key. If ram is False or the matrix does not
+        fit into the budget, it is written to its file directly"""
+        self.__remove_ram(key)
+        if self.dtype is not None and matrix.values.dtype != self.dtype:
+            matrix = make_matrix(self.__values(matrix), matrix.row_names, matrix.column_names)
+        nbytes = matrix.values.nbytes
+        if ram and (self.max_bytes is None or nbytes <= self.max_bytes):
+            self.__ram[key] = matrix
+            self.__ram_bytes += nbytes
+            while self.max_bytes is not None and self.__ram_bytes > self.max_bytes:
+                spill_key, spill_matrix = self.__ram.popitem(last=False)
+                self.__ram_bytes -= spill_matrix.values.nbytes
+                logging.debug("spilling score matrix '%s' to disk", spill_key)
+                self.write(spill_key, spill_matrix)
+        else:
+            self.write(key, matrix)
+
+    def __remove_ram(self, key):
+        if key in self.__ram:
+            self.__ram_bytes -= self.__ram.pop(key).values.nbytes
+
+    def write(self, key, matrix):
+        """writes the matrix for key to its file. An existing file of the
+        same shape and type is overwritten in place, unless a memory map
+        of it that get() returned is still in use"""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        values = self.__values(matrix)
+        path = self.__path(key)
+        mapped = self.__mapped.pop(key, None)
+        in_use = mapped is not None and mapped() is not None
+        outvalues = None
+        if os.path.exists(path) and not in_use:
+            outvalues = np.load(path, mmap_mode='r+')
+            if outvalues.shape != values.shape or outvalues.dtype != values.dtype:
+                del outvalues
+                outvalues = None
+        if outvalues is None:
+            tmp_path = '%s.tmp%d' % (path, os.getpid())
+            outvalues = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=values.dtype,
+                                                  shape=values.shape)
+            outvalues[...] = values
+            outvalues.flush()
+            del outvalues
+            os.rename(tmp_path, path)
+        else:
+            outvalues[...] = values
+            outvalues.flush()
+            del outvalues
+        self.__write_names(key, matrix.row_names, matrix.column_names)
+
+    def __write_names(self, key, row_names, column_names):
+        path = self.__names_path(key)
+        names = self.__read_names(key)
+        if names is not None and os.path.exists(path) and \
+                (names[0] is row_names or names[0] == row_names) and \
+                (names[1] is column_names or names[1] == column_names):
+            return
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as outfile:
+            np.savez(outfile, row_names=np.array(row_names),
+                     column_names=np.array(column_names))
+        os.rename(tmp_path, path)
+        self.__names[key] = (row_names, column_names)
+
+    def __read_names(self, key):
+        if key not in self.__names:
+            path = self.__names_path(key)
+            if not os.path.exists(path):
+                return None
+            with np.load(path) as names:
+                self.__names[key] = (names['row_names'].tolist(),
+                                     names['column_names'].tolist())
+        return self.__names[key]
+
+    def get(self, key):
+        """returns the matrix for key or None. Matrices that are not in
+        the RAM tier are loaded as copy-on-write memory maps"""
+        if key in self.__ram:
+            matrix = self.__ram.pop(key)
+            self.__ram[key] = matrix
+            return matrix
+        path = self.__path(key)
+        names = self.__read_names(key)
+        if names is None or not os.path.exists(path):
+            return None
+        values = np.load(path, mmap_mode='c')
+        self.__mapped[key] = weakref.ref(values)
+        return make_matrix(values, names[0], names[1])
+
+    def remove(self, key):
+        """removes the matrix for key from the store"""
+        self.__remove_ram(key)
+        self.__names.pop(key, None)
+        self.__mapped.pop(key, None)
+        for path in [self.__path(key), self.__names_path(key)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def run_store(config_params):
+    """returns the score store of the run with config_params, it is shared
+    by all its scoring functions. The RAM tier budget is the score_cache_mb
+    parameter"""
+    directory = os.path.join(config_params['output_dir'], SCORE_STORE_DIR)
+    if directory not in STORES:
+        max_mb = config_params.get('score_cache_mb', None)
+        STORES[directory] = ScoreStore(directory,
+                                       None if max_mb is None else max_mb * 1024 * 1024)
+    return STORES[directory]
+
+
+def discard_run_store(config_params):
+    """forgets the score store of the run with config_params, the next
+    run_store() call starts with an empty store"""
+    STORES.pop(os.path.join(config_params['output_dir'], SCORE_STORE_DIR), None)
@@ -13,10 +13,11 @@ from datetime import date
 import util
 import membership as memb
 import numpy as np
-import cPickle
 import gc
 import sqlite3
 import BSCM
+import checkpoint
+import scorestore
 
 
 # Official keys to access values in the configuration map
@@ -68,9 +69,10 @@ class ScoringFunctionBase:
 
         # the cache_result parameter can be used by scoring functions
         # or users to fine-tune the behavior during non-compute operations
-        # either recall a previous result from RAM or from a pickled
-        # state. In general, setting this to True will be the best, but
-        # if your environment has little memory, set this to False
+        # either recall a previous result from RAM or from the file of
+        # the score store. In general, setting this to True will be the best,
+        # but if your environment has little memory, set this to False.
+        # The RAM used by all cached results is limited by score_cache_mb
         self.cache_result = True
         self.config_params = config_params
         if config_params is None:
@@ -84,18 +86,36 @@ class ScoringFunctionBase:
     def run_in_iteration(self, i):
         return self.config_params[self.id]['schedule'](i)
 
-    def pickle_path(self):
-        """returns the function-specific pickle-path"""
-        return '%s/%s_last.pkl' % (self.config_params['output_dir'], self.id)
+    def score_store(self):
+        """returns the store that holds the results of this function"""
+        return scorestore.run_store(self.config_params)
+
+    def store_result(self, result):
+        """stores the result of the last computation in the score store,
+        in its RAM tier if cache_result is set"""
+        self.score_store().put(self.id, result, ram=self.cache_result)
 
     def last_cached(self):
-        if self.cache_result and ('cached_result' in dir(self)):
-            return self.cached_result
-        elif os.path.exists(self.pickle_path()):
-            with open(self.pickle_path()) as infile:
-                return cPickle.load(infile)
-        else:
-            return None
+        """returns the result of the last computation or None"""
+        return self.score_store().get(self.id)
+
+    def memory_usage(self):
+        """returns the number of bytes of the arrays this function keeps
+        between iterations, the default is its result in the score store"""
+        return self.score_store().ram_bytes(self.id)
+
+    def checkpoint_state(self):
+        """returns the state of this function for a run checkpoint, a map
+        from names to arrays. The default state is the last result"""
+        last_result = self.last_cached()
+        if last_result is None:
+            return {}
+        return checkpoint.matrix_state(last_result)
+
+    def restore_checkpoint(self, state):
+        """restores the state returned by checkpoint_state()"""
+        if 'values' in state:
+            self.store_result(checkpoint.state_matrix(state))
 
     def current_score_means(self, result_matrix):
         """This function can be overridden by custom functions to provide their
@@ -122,23 +142,10 @@ class ScoringFunctionBase:
                           self.id, iteration, self.scaling(iteration))
             computed_result = self.do_compute(iteration_result,
                                               reference_matrix)
-            # store the result for later, either by pickling them
-            # or caching them
-            if self.cache_result:
-                self.cached_result = computed_result
-            else:
-                # pickle the result for future use
-                logging.debug("pickle result to %s", self.pickle_path())
-                with open(self.pickle_path(), 'w') as outfile:
-                    cPickle.dump(computed_result, outfile)
-
-        elif self.cache_result and ('cached_result' in dir(self)):
-            computed_result = self.cached_result
-        elif os.path.exists(self.pickle_path()):
-            with open(self.pickle_path()) as infile:
-                computed_result = cPickle.load(infile)
+            # store the result for the iterations this function does not run in
+            self.store_result(computed_result)
         else:
-            computed_result = None
+            computed_result = self.last_cached()
 
         self.run_log.log(iteration,
                          self.run_in_iteration(iteration),
@@ -151,8 +158,7 @@ class ScoringFunctionBase:
         iteration = iteration_result['iteration']
         computed_result = self.do_compute(iteration_result,
                                           reference_matrix)
-        with open(self.pickle_path(), 'w') as outfile:
-            cPickle.dump(computed_result, outfile)
+        self.store_result(computed_result)
 
         self.run_log.log(iteration,
                          self.run_in_iteration(iteration),
@@ -212,7 +218,9 @@ class ColumnScoringFunction(ScoringFunctionBase):
         #BSCM.  Danziger et al. 2015
         self.BSCM_obj = None
         if config_params['use_BSCM']:
-            self.BSCM_obj = BSCM.BSCM(ratios, verbose=False) #How to pass verbose and so on? More parameters?
+            self.BSCM_obj = BSCM.BSCM(ratios, verbose=False, #How to pass verbose and so on? More parameters?
+                                      store=BSCM.run_null_store(config_params),
+                                      interpolation=config_params['bscm_interpolation'])
             #Note: Ratios normalized upstream during loading by config.py module
         self.run_log = RunLog("column_scoring", config_params)
 
@@ -321,92 +329,111 @@ def compute_column_scores_submatrix(matrix):
     return (matrix.column_names, result)
 
 
-def combine(result_matrices, score_scalings, membership, iteration, config_params):
-    """This is  the combining function, taking n result matrices and scalings"""
+def cluster_member_values(matrix, membership):
+    """the values of the score matrix in the clusters of their rows, they
+    are selected with the row x cluster membership mask"""
+    num_clusters = membership.num_clusters()
+    mask = memb.member_mask(membership.row_membs, num_clusters)
+    mask = mask[[membership.rowidx[row] for row in matrix.row_names]]
+    return matrix.values[:, :num_clusters][mask]
+
+
+def combine(result_matrices, score_scalings, membership, iteration, config_params,
+            timings=None):
+    """This is  the combining function, taking n result matrices and scalings.
+    The weighted sum is accumulated in place, the weighted matrices share
+    one scratch array. If a timings map is given, the milliseconds of the
+    combining steps are added to it"""
+    if timings is None:
+        timings = {}
+
+    def step_done(step, start_time):
+        now = util.current_millis()
+        timings[step] = timings.get(step, 0.0) + now - start_time
+        return now
+
     quantile_normalize = config_params['quantile_normalize']
+    start_time = util.current_millis()
 
     for i, m in enumerate(result_matrices):
         m.fix_extreme_values()
-        m.subtract_with_quantile(0.99)
 
         # debug mode: print scoring matrices before combining
         if ('dump_scores' in config_params['debug'] and
             (iteration == 1 or (iteration % config_params['debug_freq'] == 0))):
             funs = config_params['pipeline']['row-scoring']['args']['functions']
             m.write_tsv_file(os.path.join(config_params['output_dir'], 'score-%s-%04d.tsv' % (funs[i]['id'], iteration)), compressed=False)
+    start_time = step_done('fix_extreme_values', start_time)
+
+    if len(result_matrices) == 0:
+        return None
+
+    matrix0 = result_matrices[0]  # as reference for names
+    combined_score = np.empty(matrix0.values.shape, dtype=dm.VALUE_TYPE)
+    # the divisor of each matrix, the matrix is divided by it and multiplied
+    # with the absolute 1% quantile of the expression scores
+    divisors = [None] * len(result_matrices)
 
     if quantile_normalize:
         if len(result_matrices) > 1:
-            start_time = util.current_millis()
             result_matrices = dm.quantile_normalize_scores(result_matrices,
                                                            score_scalings)
-            elapsed = util.current_millis() - start_time
-            logging.debug("quantile normalize in %f s.", elapsed / 1000.0)
-
+            start_time = step_done('quantile_normalize', start_time)
         in_matrices = [m.values for m in result_matrices]
 
     else:
-        in_matrices = []
-        num_clusters = membership.num_clusters()
-        mat = result_matrices[0]
-        index_map = {name: index for index, name in enumerate(mat.row_names)}
         # we assume matrix 0 is always the gene expression score
         # we also assume that the matrices are already extreme value
         # fixed
-        rsm = []
-        for cluster in range(1, num_clusters + 1):
-            row_members = sorted(membership.rows_for_cluster(cluster))
-            rsm.extend([mat.values[index_map[row], cluster - 1] for row in row_members])
+        rsm = cluster_member_values(matrix0, membership)
         scale = util.mad(rsm)
         if scale == 0:  # avoid that we are dividing by 0
             scale = util.r_stddev(rsm)
         if scale != 0:
             median_rsm = util.median(rsm)
-            rsvalues = (mat.values - median_rsm) / scale
-            num_rows, num_cols = rsvalues.shape
-            rscores = dm.DataMatrix(num_rows, num_cols,
-                                    mat.row_names,
-                                    mat.column_names,
-                                    values=rsvalues)
-            rscores.fix_extreme_values()
+            np.subtract(matrix0.values, median_rsm, out=combined_score)
+            combined_score /= scale
+            scorestore.make_matrix(combined_score, matrix0.row_names,
+                                   matrix0.column_names).fix_extreme_values()
         else:
             logging.warn("combiner scaling -> scale == 0 !!!")
-            rscores = mat
-        in_matrices.append(rscores.values)
+            combined_score[:, :] = matrix0.values
+        in_matrices = [combined_score] + [m.values for m in result_matrices[1:]]
 
         if len(result_matrices) > 1:
-            rs_quant = util.quantile(rscores.values, 0.01)
+            rs_quant = abs(util.quantile(combined_score, 0.01))
             logging.debug("RS_QUANT = %f", rs_quant)
             for i in range(1, len(result_matrices)):
-                values = result_matrices[i].values
+                values = in_matrices[i]
                 qqq = abs(util.quantile(values, 0.01))
                 if qqq == 0:
                     logging.debug('SPARSE SCORES - %d attempt 1: pick from sorted values', i)
-                    qqq = sorted(values.ravel())[9]
+                    qqq = np.partition(values.ravel(), 9)[9]
                 if qqq == 0:
                     logging.debug('SPARSE SCORES - %d attempt 2: pick minimum value', i)
                     qqq = abs(values.min())
                 if qqq != 0:
-                    values = values / qqq * abs(rs_quant)
+                    divisors[i] = qqq
                 else:
                     logging.debug('SPARSE SCORES - %d not normalizing!', i)
-                in_matrices.append(values)
-
-    if len(result_matrices) > 0:
-        start_time = util.current_millis()
-        # assuming same format of all matrices
-        combined_score = np.zeros(in_matrices[0].shape)
-        for i in xrange(len(in_matrices)):
-            combined_score += in_matrices[i] * score_scalings[i]
-
-        elapsed = util.current_millis() - start_time
-        logging.debug("combined score in %f s.", elapsed / 1000.0)
-        matrix0 = result_matrices[0]  # as reference for names
-        return dm.DataMatrix(matrix0.num_rows, matrix0.num_columns,
-                             matrix0.row_names, matrix0.column_names,
-                             values=combined_score)
-    else:
-        return None
+        start_time = step_done('scale', start_time)
+
+    combined_score = np.multiply(in_matrices[0], score_scalings[0], out=combined_score)
+    if len(in_matrices) > 1:
+        scratch = np.empty(combined_score.shape, dtype=combined_score.dtype)
+        for i in xrange(1, len(in_matrices)):
+            if divisors[i] is not None:
+                np.divide(in_matrices[i], divisors[i], out=scratch)
+                scratch *= rs_quant
+                scratch *= score_scalings[i]
+            else:
+                np.multiply(in_matrices[i], score_scalings[i], out=scratch)
+            combined_score += scratch
+    step_done('sum', start_time)
+    logging.debug("combined score in %s.", ', '.join(['%s: %.1f ms' % (step, timings[step])
+                                                      for step in sorted(timings)]))
+
+    return scorestore.make_matrix(combined_score, matrix0.row_names, matrix0.column_names)
 
 
 class ScoringFunctionCombiner:
@@ -421,6 +448,8 @@ class ScoringFunctionCombiner:
         self.membership = membership
         self.scoring_functions = scoring_functions
         self.config_params = config_params
+        # the milliseconds of the steps of the last combine() call
+        self.combine_timings = {}
 
     def check_requirements(self):
         """Give the scoring module an opportunity to check whether the
@@ -448,8 +477,9 @@ class ScoringFunctionCombiner:
 
                 if self.config_params['log_subresults']:
                     self.log_subresult(scoring_function, matrix)
+        self.combine_timings = {}
         return combine(result_matrices, score_scalings, self.membership,
-                       iteration, self.config_params)
+                       iteration, self.config_params, self.combine_timings)
 
     def compute(self, iteration_result, ref_matrix=None):
         """compute scores for one iteration"""
@@ -475,8 +505,9 @@ class ScoringFunctionCombiner:
                 if self.config_params['log_subresults']:
                     self.log_subresult(scoring_function, matrix)
 
+        self.combine_timings = {}
         return combine(result_matrices, score_scalings, self.membership,
-                       iteration, self.config_params)
+                       iteration, self.config_params, self.combine_timings)
 
     def combine_cached(self, iteration):
         """Combine the cached results of the contained scoring function.
@@ -489,10 +520,29 @@ class ScoringFunctionCombiner:
                 result_matrices.append(matrix)
                 score_scalings.append(scoring_function.scaling(iteration))
 
+        self.combine_timings = {}
         return combine(result_matrices, score_scalings, self.membership,
-                       iteration, self.config_params)
+                       iteration, self.config_params, self.combine_timings)
 
 
+    def memory_usage(self):
+        """the memory usage of the contained functions"""
+        return sum([fun.memory_usage() for fun in self.scoring_functions])
+
+    def checkpoint_state(self):
+        """the checkpoint states of the contained functions, by function id"""
+        state = {}
+        for scoring_function in self.scoring_functions:
+            checkpoint.add_component_state(state, scoring_function.id,
+                                           scoring_function.checkpoint_state())
+        return state
+
+    def restore_checkpoint(self, state):
+        """restores the contained functions from checkpoint_state()"""
+        for scoring_function in self.scoring_functions:
+            scoring_function.restore_checkpoint(
+                checkpoint.component_state(state, scoring_function.id))
+
     def log_subresult(self, score_function, matrix):
         """output an accumulated subresult to the log"""
         scores = []
@@ -10,6 +10,7 @@ import logging
 import random
 import string
 import collections
+import numpy as np
 from util import DelimitedFile
 
 logger = logging.getLogger('seqtools')
@@ -109,25 +110,80 @@ def subsequence(sequence, start, stop, reverse=False):
 
 
 REV_DICT = {'A': 'T', 'G': 'C', 'C': 'G', 'T': 'A'}
+# translation table for the complement, other characters are upper-cased
+REV_TABLE = string.maketrans(''.join([chr(c) for c in xrange(256)]),
+                             ''.join([REV_DICT.get(chr(c).upper(), chr(c).upper())
+                                      for c in xrange(256)]))
 
 
 def revcomp(sequence):
     """compute the reverse complement of the input string"""
-    return "".join([__revchar(c) for c in sequence[::-1]])
+    return sequence[::-1].translate(REV_TABLE)
 
 
-def __revchar(nucleotide):
-    """for a nucleotide character, return its complement"""
-    nucleotide = nucleotide.upper()
-    if nucleotide in REV_DICT:
-        return REV_DICT[nucleotide]
-    else:
-        return nucleotide
+# Sequences are encoded as arrays of uint8 base codes for k-mer counting.
+# BASES are the characters after replace_degenerate_residues(), all other
+# characters are encoded as BREAK_CODE, which also separates the sequences.
+# A k-mer is identified by its base-len(BASES) number
+BASES = 'ACGTX'
+BREAK_CODE = len(BASES)
+BASE_CODES = np.array([BASES.find(chr(c)) if chr(c) in BASES else BREAK_CODE
+                       for c in xrange(256)], dtype=np.uint8)
+
+
+def encode_sequences(seqs):
+    """encodes the sequences into one uint8 array of base codes, each
+    sequence is followed by a BREAK_CODE"""
+    text = ' '.join(seqs) + ' '
+    return BASE_CODES[np.frombuffer(text, dtype=np.uint8)]
+
+
+def is_encodable(seqs):
+    """True if the sequences only consist of BASES"""
+    return all([len(seq.translate(None, BASES)) == 0 for seq in seqs])
+
+
+def kmer_count_arrays(codes, max_length):
+    """counts the k-mers of length 1,...,max_length in the encoded sequences
+    with a rolling hash. Returns a list of count arrays, where the index of a
+    count is the k-mer's number, see kmer_string(). Count arrays are additive,
+    so counts of sequence sets can be combined or subtracted. k-mers that
+    span a BREAK_CODE are not counted"""
+    result = []
+    numbase = len(BASES)
+    hashes = codes.astype(np.int64)
+    valid = codes != BREAK_CODE
+    for length in xrange(1, max_length + 1):
+        if length > 1:
+            hashes = hashes[:-1] * numbase + codes[length - 1:]
+            valid = valid[:-1] & (codes[length - 1:] != BREAK_CODE)
+        result.append(np.bincount(hashes[valid], minlength=numbase ** length))
+    return result
+
+
+def kmer_string(kmer, length):
+    """returns the k-mer string for a k-mer number"""
+    chars = []
+    for _ in xrange(length):
+        kmer, code = divmod(kmer, len(BASES))
+        chars.append(BASES[code])
+    return ''.join(reversed(chars))
+
+
+def kmer_counts_to_dict(counts, length):
+    """converts a count array into a {kmer: count} dictionary of the
+    k-mers that occur"""
+    return {kmer_string(kmer, length): int(counts[kmer])
+            for kmer in np.nonzero(counts)[0]}
 
 
 def subseq_counts(seqs, subseq_len):
     """return a dictionary containing for each subsequence of length
     subseq_len their respective count in the input sequences"""
+    if is_encodable(seqs):
+        counts = kmer_count_arrays(encode_sequences(seqs), subseq_len)[-1]
+        return kmer_counts_to_dict(counts, subseq_len)
+
     counts = {}
     for seq in seqs:
         for index in xrange(0, len(seq) - subseq_len + 1):
@@ -138,28 +194,40 @@ def subseq_counts(seqs, subseq_len):
     return counts
 
 
-def subseq_frequencies(seqs, subseq_len):
-    """return a dictionary containing for each subsequence of
-    length subseq_len their respective frequency within the
-    input sequences"""
+def counts_to_frequencies(counts):
+    """converts a {subsequence: count} dictionary into frequencies"""
     result = {}
-    counts = subseq_counts(seqs, subseq_len)
     total = sum([count for count in counts.values()])
     for subseq, count in counts.iteritems():
         result[subseq] = float(count) / float(total)
     return result
 
 
+def subseq_frequencies(seqs, subseq_len):
+    """return a dictionary containing for each subsequence of
+    length subseq_len their respective frequency within the
+    input sequences"""
+    return counts_to_frequencies(subseq_counts(seqs, subseq_len))
+
+
+def markov_background_from_counts(count_arrays):
+    """computes the markov background model from the k-mer count arrays
+    of length 1,...,(order + 1)"""
+    return [counts_to_frequencies(kmer_counts_to_dict(counts, length))
+            for length, counts in enumerate(count_arrays, 1)]
+
+
 def markov_background(seqs, order):
     """computes the markov background model of the specified
     order for the given input sequences. This is implemented
     by gathering the frequencies of subsequences of length
     1,..,(order + 1)"""
-    result = []
     seqs = replace_degenerate_residues(seqs)
-    for subseq_len in xrange(1, (order + 2)):
-        result.append(subseq_frequencies(seqs, subseq_len))
-    return result
+    if is_encodable(seqs):
+        return markov_background_from_counts(
+            kmer_count_arrays(encode_sequences(seqs), order + 1))
+    return [subseq_frequencies(seqs, subseq_len)
+            for subseq_len in xrange(1, (order + 2))]
 
 
 def all_kmers(length, seqs, seq=[], pos=0, choices=['A', 'C', 'G', 'T']):
@@ -178,24 +246,30 @@ def all_kmers(length, seqs, seq=[], pos=0, choices=['A', 'C', 'G', 'T']):
             all_kmers(length, seqs, seq, pos + 1, choices)
 
 
-def replace_degenerate_residues(seqs):
+def replace_degenerate_residues(seqs, seeded=False):
     """gets rid of funny characters in gene sequences by employing a
-    replacement strategy"""
+    replacement strategy. If seeded is True, the replacements in a sequence
+    are chosen by a random generator that is seeded with the sequence
+    itself, so the result is reproducible"""
     replacements = {'R': ['G', 'A'], 'Y': ['T', 'C'], 'K': ['G', 'T'],
                     'M': ['A', 'C'], 'S': ['G', 'C'], 'W': ['A', 'T'],
                     'N': ['G', 'A', 'T', 'C'],
                     ' ': [' ']}
 
-    pat = re.compile('[ACGTX]*([^ACGTX])[ACGTX]*')
+    pat = re.compile('[^ACGTX]')
     result = []
     for seq in seqs:
         seq = seq.strip()  # For some reasons, there were cases with newlines in the beginning
+        if len(seq.translate(None, 'ACGTX')) == 0:
+            result.append(seq)
+            continue
+        rand = random.Random(seq) if seeded else random
+        chars = list(seq)
         for match in pat.finditer(seq):
-            replace_chars = replacements[seq[match.start(1)]]
-            replace_char = replace_chars[random.randint(
+            replace_chars = replacements[seq[match.start()]]
+            chars[match.start()] = replace_chars[rand.randint(
                 0, len(replace_chars) - 1)]
-            seq = seq[:match.start(1)] + replace_char + seq[match.end(1):]
-        result.append(seq)
+        result.append(''.join(chars))
     return result
 
 
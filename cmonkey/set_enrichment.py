@@ -10,10 +10,11 @@ import os
 import json
 import logging
 import numpy as np
+from scipy import sparse
 
 import scoring
 import datamatrix as dm
-import multiprocessing as mp
+import membership as memb
 
 from collections import defaultdict
 
@@ -86,18 +87,6 @@ class SetType:
         return result
 
 
-# global variables that are shared by the child processe
-# when running in multiprocessing. This is an attempt to avoid
-# that the scoring function slows itself down by using to much
-# memory
-SET_MATRIX = None
-SET_MEMBERSHIP = None
-SET_SET_TYPE = None
-SET_SYNONYMS = None
-CANONICAL_ROWNAMES = None
-CANONICAL_ROW_INDEXES = None
-
-
 def read_set_types(config_params, thesaurus, input_genes):
     """Reads sets from a JSON file. We also ensure that genes
     are stored in canonical form in the set, so that set operations based on
@@ -171,14 +160,124 @@ def read_sets_csv(infile, sep1=',', sep2=';'):
         raise Exception("3 column set files not supported yet")
 
 
+class CompiledSetType:
+    """A set type compiled for scoring: the sets in sorted name order form a
+    sparse set x gene incidence matrix, whose columns are the row indexes of
+    the ratios"""
+
+    def __init__(self, set_type, canonical_row_indexes, num_rows):
+        """compiles set_type, canonical_row_indexes maps the canonical gene
+        names to their ratio row indexes"""
+        self.name = set_type.name
+        self.weight = set_type.weight
+        self.set_names = sorted(set_type.sets.keys())
+        for set_name in self.set_names:
+            if set_type.sets[set_name].cutoff != 'discrete':
+                raise Exception("weighted enrichment sets not supported yet")
+        self.incidence = incidence_matrix([set_type.sets[set_name].genes_above_cutoff()
+                                           for set_name in self.set_names],
+                                          canonical_row_indexes, num_rows)
+        self.set_sizes = np.asarray(self.incidence.sum(axis=1), dtype=np.int64).ravel()
+        self.genes_mask = np.zeros(num_rows, dtype=bool)
+        self.genes_mask[[canonical_row_indexes[gene] for gene in set_type.genes()]] = True
+        self.num_genes = len(set_type.genes())
+        self.log_factorials = util.log_factorial_table(self.num_genes)
+
+
+def incidence_matrix(gene_sets, canonical_row_indexes, num_rows):
+    """the sparse len(gene_sets) x num_rows matrix with a 1 for each gene of a set"""
+    rows = []
+    columns = []
+    for index, genes in enumerate(gene_sets):
+        columns.extend([canonical_row_indexes[gene] for gene in genes])
+        rows.extend([index] * len(genes))
+    result = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)),
+                               shape=(len(gene_sets), num_rows))
+    result.sum_duplicates()
+    result.data[:] = 1.0
+    return result
+
+
+def canonical_row_indexes(row_names, synonyms):
+    """maps the canonical names of the rows to the row indexes"""
+    return {canonical_name(row, synonyms): index for index, row in enumerate(row_names)}
+
+
+def canonical_name(row, synonyms):
+    """the canonical name of a row"""
+    return synonyms[row] if row in synonyms else row
+
+
+def membership_row_indexes(membership, row_indexes, synonyms):
+    """maps the membership row indexes to the ratio row indexes of the
+    canonical row names, -1 for rows that are not in the ratios"""
+    result = np.repeat(-1, len(membership.row_names))
+    for row in membership.row_names:
+        result[membership.rowidx[row]] = row_indexes.get(canonical_name(row, synonyms), -1)
+    return result
+
+
+def cluster_gene_mask(membership, row_indexes, num_rows, num_clusters):
+    """the num_rows x num_clusters indicator of the cluster members, row_indexes
+    maps the membership row indexes to the ratio row indexes of the canonical
+    row names or -1. Rows with the same canonical name count as one gene"""
+    mask = memb.member_mask(membership.row_membs, num_clusters)
+    result = np.zeros((num_rows, num_clusters), dtype=bool)
+    in_ratios = row_indexes >= 0
+    np.logical_or.at(result, row_indexes[in_ratios], mask[in_ratios])
+    return result
+
+
+def compute_set_type_scores(set_type, cluster_genes, cutoff, ref_min_score):
+    """Computes the scores of all clusters for a compiled set type. cluster_genes
+    is the row x cluster indicator of cluster_gene_mask(). The overlaps of all
+    clusters and sets are the product of the incidence matrix and the cluster
+    genes, each cluster is scored by its most enriched set. Returns the
+    rows x clusters score matrix and the names and p-values of the most
+    enriched sets"""
+    num_clusters = cluster_genes.shape[1]
+    cluster_genes = cluster_genes & set_type.genes_mask[:, np.newaxis]
+    overlaps = np.asarray(set_type.incidence.dot(cluster_genes.astype(np.float64)))
+    overlaps = np.rint(overlaps).astype(np.int64)
+    set_indexes, clusters = np.nonzero(overlaps)
+    set_sizes = set_type.set_sizes[set_indexes]
+    pvalues = np.empty(overlaps.shape)
+    pvalues.fill(np.inf)
+    pvalues[set_indexes, clusters] = util.hypergeom_upper_tail(
+        overlaps[set_indexes, clusters], set_sizes, set_type.num_genes - set_sizes,
+        cluster_genes.sum(axis=0)[clusters], set_type.log_factorials)
+
+    # the first set in name order with the smallest p-value
+    has_sets = np.any(overlaps > 0, axis=0)
+    min_indexes = np.argmin(pvalues, axis=0)
+    min_pvalues = np.where(has_sets, pvalues[min_indexes, np.arange(num_clusters)], np.nan)
+    min_sets = [set_type.set_names[min_indexes[cluster]] if has_sets[cluster] else 'NA'
+                for cluster in xrange(num_clusters)]
+
+    # the genes of the most enriched set score 0.5, those in the cluster 1.0,
+    # both are dampened by the p-value
+    min_set_genes = set_type.incidence[min_indexes].T.toarray() > 0.0
+    min_set_genes &= has_sets
+    scores = np.where(min_set_genes, np.where(cluster_genes, 1.0, 0.5), 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dampened = np.where(min_pvalues <= cutoff, 1.0,
+                            np.log10(min_pvalues) / math.log10(cutoff))
+        scores[min_set_genes] = (dampened[np.newaxis, :] / scores)[min_set_genes]
+    return scores * ref_min_score, min_sets, min_pvalues
+
+
 class ScoringFunction(scoring.ScoringFunctionBase):
     """Set enrichment scoring function"""
     def __init__(self, organism, membership, ratios, config_params=None):
         """Create scoring function instance"""
         scoring.ScoringFunctionBase.__init__(self, "SetEnrichment", organism, membership,
                                              ratios, config_params)
-        self.__set_types = read_set_types(config_params, organism.thesaurus(),
-                                          ratios.row_names)
+        synonyms = organism.thesaurus()
+        self.__row_indexes = canonical_row_indexes(ratios.row_names, synonyms)
+        self.__set_types = [CompiledSetType(set_type, self.__row_indexes, ratios.num_rows)
+                            for set_type in read_set_types(config_params, synonyms,
+                                                           ratios.row_names)]
+        self.__membership_row_indexes = None
         self.run_log = scoring.RunLog('set_enrichment', config_params)
 
     def bonferroni_cutoff(self):
@@ -190,28 +289,15 @@ class ScoringFunction(scoring.ScoringFunctionBase):
         Note: will return None if not computed yet and the result of a previous
         scoring if the function is not supposed to actually run in this iteration
         """
-        global SET_MATRIX, SET_MEMBERSHIP, SET_SET_TYPE, SET_SYNONYMS, CANONICAL_ROWNAMES, CANONICAL_ROW_INDEXES
         logging.info("Compute scores for set enrichment...")
         start_time = util.current_millis()
         matrix = dm.DataMatrix(len(self.gene_names()), self.num_clusters(),
                                self.gene_names())
-        use_multiprocessing = self.config_params[scoring.KEY_MULTIPROCESSING]
-        SET_MATRIX = self.ratios
-        SET_MEMBERSHIP = self.membership
-        SET_SYNONYMS = self.organism.thesaurus()
-
-        if CANONICAL_ROWNAMES is None:
-            CANONICAL_ROWNAMES = set(map(lambda n: SET_SYNONYMS[n] if n in SET_SYNONYMS else n,
-                                         self.ratios.row_names))
-
-        if CANONICAL_ROW_INDEXES is None:
-            CANONICAL_ROW_INDEXES = {}
-            for index, row in enumerate(self.ratios.row_names):
-                if row in SET_SYNONYMS:
-                    CANONICAL_ROW_INDEXES[SET_SYNONYMS[row]] = index
-                else:
-                    CANONICAL_ROW_INDEXES[row] = index
-
+        if self.__membership_row_indexes is None:
+            self.__membership_row_indexes = membership_row_indexes(
+                self.membership, self.__row_indexes, self.organism.thesaurus())
+        cluster_genes = cluster_gene_mask(self.membership, self.__membership_row_indexes,
+                                          self.ratios.num_rows, self.num_clusters())
         ref_min_score = ref_matrix.min()
         logging.info('REF_MIN_SCORE: %f', ref_min_score)
 
@@ -221,19 +307,11 @@ class ScoringFunction(scoring.ScoringFunctionBase):
                                      'setEnrichment_pvalue.csv')
 
         for set_type in self.__set_types:
-            SET_SET_TYPE = set_type
             logging.info("PROCESSING SET TYPE '%s'", set_type.name)
             start1 = util.current_millis()
-            if use_multiprocessing:
-                with util.get_mp_pool(self.config_params) as pool:
-                    results = pool.map(compute_cluster_score,
-                                       [(cluster, self.bonferroni_cutoff(), ref_min_score)
-                                        for cluster in xrange(1, self.num_clusters() + 1)])
-            else:
-                results = []
-                for cluster in xrange(1, self.num_clusters() + 1):
-                    results.append(compute_cluster_score((cluster, self.bonferroni_cutoff(), ref_min_score)))
-
+            scores, minSets, pValues = compute_set_type_scores(set_type, cluster_genes,
+                                                               self.bonferroni_cutoff(),
+                                                               ref_min_score)
             elapsed1 = util.current_millis() - start1
             logging.info("ENRICHMENT SCORES COMPUTED in %f s, STORING...",
                          elapsed1 / 1000.0)
@@ -247,16 +325,7 @@ class ScoringFunction(scoring.ScoringFunctionBase):
                 setFile = open(set_filepath, 'a')
                 pvFile = open(pval_filepath, 'a')
 
-            minSets = []
-            pValues = []
-            for cluster in xrange(1, self.num_clusters() + 1):
-                # store the best enriched set determined
-                scores, min_set, min_pvalue = results[cluster - 1]
-                minSets.append(min_set)
-                pValues.append(min_pvalue)
-
-                for row in xrange(len(self.gene_names())):
-                    matrix.values[row][cluster - 1] += scores[row] * set_type.weight
+            matrix.values += scores * set_type.weight
             setFile.write('\n'+str(iteration_result['iteration'])+','+','.join([str(i) for i in minSets]))
             pvFile.write('\n'+str(iteration_result['iteration'])+','+','.join([str(i) for i in pValues]))
             setFile.close()
@@ -264,89 +333,8 @@ class ScoringFunction(scoring.ScoringFunctionBase):
 
         logging.info("SET ENRICHMENT FINISHED IN %f s.\n",
                      (util.current_millis() - start_time) / 1000.0)
-        # cleanup
-        SET_SET_TYPE = None
-        SET_MATRIX = None
-        SET_MEMBERSHIP = None
-        SET_SYNONYMS = None
-
         return matrix
 
     def run_logs(self):
         """return the run logs"""
         return [self.run_log]
-
-
-def compute_cluster_score(args):
-    """Computes the cluster score for a given set type"""
-    global SET_MATRIX, SET_MEMBERSHIP, SET_SET_TYPE, SET_SYNONYMS, CANONICAL_ROWNAMES, CANONICAL_ROW_INDEXES
-
-    cluster, cutoff, ref_min_score = args
-    set_type = SET_SET_TYPE
-    matrix = SET_MATRIX
-    cluster_rows = set()
-    for gene in SET_MEMBERSHIP.rows_for_cluster(cluster):
-        if gene in SET_SYNONYMS:
-            cluster_rows.add(SET_SYNONYMS[gene])
-        else:
-            cluster_rows.add(gene)
-    set_type_genes = set_type.genes()
-
-    cluster_genes = {gene for gene in cluster_rows if gene in set_type_genes}
-    overlap_sizes = []
-    set_sizes = []
-    set_names = []
-    for set_name in sorted(set_type.sets.keys()):
-        eset = set_type.sets[set_name]
-        set_genes = eset.genes_above_cutoff()
-        intersect = len(cluster_genes.intersection(set_genes))
-        if intersect > 0:
-            set_names.append(set_name)
-            set_sizes.append(len(set_genes))
-            overlap_sizes.append(intersect)
-
-    num_sets = len(overlap_sizes)
-    scores = np.zeros(matrix.num_rows)
-    if not num_sets==0:
-        num_genes = len(set_type_genes)
-        phyper_n = list(np.array([num_genes] * num_sets) - np.array(set_sizes))
-        phyper_k = [len(cluster_genes)] * num_sets
-
-        enrichment_pvalues = np.array(util.phyper(overlap_sizes, set_sizes, phyper_n, phyper_k))
-        min_pvalue = enrichment_pvalues[np.isfinite(enrichment_pvalues)].min()
-        min_index = np.where(enrichment_pvalues == min_pvalue)[0][0]
-        min_set = set_names[min_index]
-        min_set_overlap = overlap_sizes[min_index]
-
-        min_genes = set_type.sets[min_set].genes()
-        # ensure all row names are in canonical form
-        min_genes = [gene for gene in min_genes if gene in CANONICAL_ROWNAMES]
-        min_indexes = [CANONICAL_ROW_INDEXES[gene] for gene in min_genes]
-
-        if set_type.sets[min_set].cutoff == 'discrete':
-            overlap_genes = cluster_genes.intersection(set(min_genes))
-            overlap_indexes = [CANONICAL_ROW_INDEXES[gene] for gene in overlap_genes]
-            scores[min_indexes] = 0.5
-            scores[overlap_indexes] = 1.0
-        else:
-            # scaling
-            for index in min_indexes:
-                scores[index] = set_type.sets[min_set].weights[index]
-            min_weight = min_set_weights.min()
-            max_weight = min_set_weights.max()
-            weight_range = max_weight - min_weight
-            scores[min_indexes] -= min_weight
-            scores[min_indexes] /= weight_range
-
-        if min_pvalue <= cutoff:
-            dampened_pvalue = 1
-        else:
-            dampened_pvalue = math.log10(min_pvalue) / math.log10(cutoff)
-
-        scores[scores != 0.0] = dampened_pvalue / scores[scores != 0.0]
-        scores *= ref_min_score
-    else:
-        min_set = 'NA'
-        min_pvalue = np.nan
-
-    return scores, min_set, min_pvalue
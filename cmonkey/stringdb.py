@@ -13,6 +13,7 @@ import patches
 
 STRING_FILE2 = 'string_links_64091.tab'
 PROTEIN_PREFIX = re.compile('^string:\d+[.]')
+PROGRESS_LINES = 1000000
 
 
 def normalize_edges_to_max_score(edges, max_score):
@@ -25,11 +26,13 @@ def normalize_edges_to_max_score(edges, max_score):
 
 
 def get_network_factory(organism_code, filename, weight, sep='\t',
-                        normalized=False):
+                        normalized=False, cache_dir=None):
     """STRING network factory from preprocessed edge file
     (protein1, protein2, combined_score), scores are already
     normalized to 1000.
     This is the standard factory method used for Microbes.
+    If cache_dir is specified, the resulting network is stored in
+    the binary network cache and reused by subsequent runs.
     """
     def can_add_edge(node1, node2, thesaurus, cano_genes):
         """check whether we can add the edge"""
@@ -42,8 +45,7 @@ def get_network_factory(organism_code, filename, weight, sep='\t',
     def read_edges2(filename, organism, ratios):
         """just read a preprocessed file, much faster to debug"""
         logging.info("stringdb.read_edges2()")
-        dfile = util.read_dfile(filename, sep)
-        logging.info("Finished loading %s", filename)
+        dfile = util.stream_dfile(filename, sep)
         result = []
         max_score = 0.0
         thesaurus = organism.thesaurus()
@@ -62,12 +64,12 @@ def get_network_factory(organism_code, filename, weight, sep='\t',
         keep_bool = {} #Big Speedup: Use to search thesaurus and cano_genes only once for each gene
         idx = 1 #Used to display progress
         for line in dfile.lines:
-            #This can be slow, display progress every 5%
-            frac = idx % (len(dfile.lines)/20)
+            #This can be slow, the file is streamed, so display progress
+            #every PROGRESS_LINES lines
+            if idx % PROGRESS_LINES == 0:
+                logging.info("Processing network, %d lines", idx)
             idx += 1
-            if frac == 0:
-                logging.info("Processing network %d%%", round(100*float(idx)/len(dfile.lines)))
-            
+
             node1 = patches.patch_string_gene(organism_code, line[0])
             node2 = patches.patch_string_gene(organism_code, line[1])
             for node in (node1, node2):
@@ -112,10 +114,17 @@ def get_network_factory(organism_code, filename, weight, sep='\t',
 
     def make_network(organism, ratios=None, check_size=False):
         """make network"""
-        return network.Network.create("STRING",
-                                      read_edges2(filename, organism, ratios),
-                                      weight,
-                                      organism, ratios)
+        def create():
+            return network.Network.create("STRING",
+                                          read_edges2(filename, organism, ratios),
+                                          weight,
+                                          organism, ratios)
+
+        if cache_dir is None:
+            return create()
+        key = network.network_cache_key(util.file_digest(filename),
+                                        organism_code, ratios, sep, normalized)
+        return network.cached_network(cache_dir, "STRING", weight, key, create)
 
     return make_network
 
@@ -10,14 +10,21 @@ from collections import defaultdict
 import math
 import numpy as np
 import scipy.stats
+import scipy.special
 import urllib
 import os
-import rpy2.robjects as robjects
+import ast
 import gzip
 import shelve
 import time
 import logging
 import multiprocessing as mp
+import sys
+import shutil
+import tempfile
+import cPickle
+import hashlib
+import weakref
 
 # RSAT organism finding is an optional feature, which we can skip in case that
 # the user imports all the features through own text files
@@ -34,55 +41,72 @@ except ImportError:
         # ignored !!!
         print "WARN: could not import BeautifulSoup, RSAT organism finding won't work"
 
+# rpy2 is only required for the R statistics backend. Without it, all
+# statistics functions below are computed by the native NumPy backend
+try:
+    import rpy2.robjects as robjects
+except ImportError:
+    robjects = None
+
 
 # this tuple structure holds data of a delimited file
 DelimitedFile = collections.namedtuple('DelimitedFile', ['lines', 'header'])
 
 
-def make_delimited_file_from_lines(lines, sep, has_header, comment, quote):
-    """Creates a delimited file from a list of lines"""
+def open_file(filepath):
+    """opens the specified file for reading, files ending in '.gz'
+    are decompressed on the fly"""
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath)
+    else:
+        return open(filepath)
 
-    def remove_quotes(astring, quote):
-        """removes the quote character from the input string if given"""
-        if quote:
-            return astring.replace(quote, "")
-        else:
-            return astring
-
-    def next_non_comment_index(lines, comment, line_index):
-        """utility method that takes a list of strings and returns the next
-        line index of a non-comment line. it also skips empty lines
-        """
-        if comment:
-            num_lines = len(lines)
-            line = lines[line_index].lstrip()
-            while line_index < num_lines and (len(line) == 0 or
-                                              line.startswith(comment)):
-                line_index += 1
-                if (line_index < num_lines):
-                    line = lines[line_index].lstrip()
-        return line_index
 
-    file_header = None
-    file_lines = []
-    line_index = next_non_comment_index(lines, comment, 0)
-    if has_header:
-        file_header = lines[line_index].rstrip().split(sep)
-        file_header = [remove_quotes(elem, quote) for elem in file_header]
-        line_index += 1
+def __remove_quotes(elems, quote):
+    """removes the quote character from the input strings if given"""
+    if quote:
+        return [elem.replace(quote, "") for elem in elems]
+    else:
+        return elems
+
 
-    num_lines = len(lines)
-    while line_index < num_lines:
-        line_index = next_non_comment_index(lines, comment, line_index)
-        if line_index < num_lines:
-            stripped_line = lines[line_index].rstrip('\r\n')
-            if len(stripped_line) > 0:  # to catch newline at the end of file
-                line = stripped_line.split(sep)
-                line = [remove_quotes(elem, quote) for elem in line]
-                file_lines.append(line)
-            line_index += 1
+def __is_comment(line, comment):
+    """comment lines and, if comment is given, empty lines are skipped"""
+    if comment:
+        line = line.lstrip()
+        return len(line) == 0 or line.startswith(comment)
+    return False
 
-    return DelimitedFile(file_lines, file_header)
+
+def read_header(lines, sep='\t', comment=None, quote=None):
+    """reads the header from the first non-comment line of the lines
+    iterator, the iterator is advanced past the header"""
+    for line in lines:
+        if not __is_comment(line, comment):
+            return __remove_quotes(line.rstrip().split(sep), quote)
+    return None
+
+
+def delimited_rows(lines, sep='\t', comment=None, quote=None):
+    """generator over the rows of the specified lines, which can be any
+    iterable, e.g. an open file. Comment lines and empty lines are skipped,
+    each row is returned as the list of its unquoted fields"""
+    for line in lines:
+        if __is_comment(line, comment):
+            continue
+        stripped_line = line.rstrip('\r\n')
+        if len(stripped_line) > 0:  # to catch newline at the end of file
+            yield __remove_quotes(stripped_line.split(sep), quote)
+
+
+def make_delimited_file_from_lines(lines, sep, has_header, comment, quote):
+    """Creates a delimited file from a list of lines"""
+    lines = iter(lines)
+    file_header = None
+    if has_header:
+        file_header = read_header(lines, sep, comment, quote)
+    return DelimitedFile(list(delimited_rows(lines, sep, comment, quote)),
+                         file_header)
 
 
 def dfile_from_text(text, sep='\t', has_header=False,
@@ -95,15 +119,29 @@ def dfile_from_text(text, sep='\t', has_header=False,
 def read_dfile(filepath, sep='\t', has_header=False, comment=None,
                quote=None):
     """Creates the reader object"""
-    lines = None
-    if filepath.endswith('.gz'):
-        with gzip.open(filepath) as inputfile:
-            lines = inputfile.readlines()
-    else:
-        with open(filepath) as inputfile:
-            lines = inputfile.readlines()
-    return make_delimited_file_from_lines(lines, sep, has_header,
-                                          comment, quote)
+    with open_file(filepath) as inputfile:
+        return make_delimited_file_from_lines(inputfile, sep, has_header,
+                                              comment, quote)
+
+
+def stream_dfile(filepath, sep='\t', has_header=False, comment=None,
+                 quote=None):
+    """Streaming version of read_dfile(): the header is read immediately,
+    but the lines of the returned DelimitedFile are a generator that reads
+    the file row by row. The file is closed when the generator is exhausted"""
+    inputfile = open_file(filepath)
+    header = None
+    if has_header:
+        header = read_header(inputfile, sep, comment, quote)
+
+    def rows():
+        try:
+            for row in delimited_rows(inputfile, sep, comment, quote):
+                yield row
+        finally:
+            inputfile.close()
+
+    return DelimitedFile(rows(), header)
 
 
 def make_dfile_map(dfile, key_column, value_column):
@@ -161,13 +199,21 @@ def quantile(values, probability):
     """does the same as R's quantile function.
     values a list of numeric values
     probability a value in the range between 0 and 1
+    The result is the one of scipy.stats.scoreatpercentile(), but the order
+    statistics are selected with a partition instead of sorting the values
     """
-    values = np.array(values)
+    values = np.asarray(values).ravel()
     values = values[np.isfinite(values)]
-    if len(values):
-        return scipy.stats.scoreatpercentile(values, probability * 100)
-    else:
+    if len(values) == 0:
         return np.nan
+    index = probability * 100 / 100. * (len(values) - 1)
+    lower = int(index)
+    if lower == index:
+        values.partition(lower)
+        return values[lower] / 1.0
+    values.partition([lower, lower + 1])
+    weights = np.array([lower + 1 - index, index - lower])
+    return (values[lower] * weights[0] + values[lower + 1] * weights[1]) / weights.sum()
 
 
 def r_stddev(values):
@@ -193,7 +239,7 @@ def r_variance_columns(matrix):
 def max_row_var(matrix):
     """computes the maximum row variance of a matrix"""
     masked = np.ma.masked_array(matrix, np.isnan(matrix))
-    return np.mean(np.var(masked, 1, ddof=1))
+    return np.mean(np.var(masked, 1, ddof=1, dtype=np.float64))
 
 
 def r_outer(x, y, f):
@@ -206,7 +252,7 @@ def r_outer(x, y, f):
 
 def mean(nparray):
     """computes the mean of a numpy array, ignoring NaN values"""
-    return np.mean(np.ma.masked_array(nparray, np.isnan(nparray)))
+    return np.mean(np.ma.masked_array(nparray, np.isnan(nparray)), dtype=np.float64)
 
 
 def median(values):
@@ -219,13 +265,13 @@ def median(values):
 def column_means(matrix):
     """computes the column means of a matrix"""
     return np.ma.filled(np.mean(np.ma.masked_array(matrix, np.isnan(matrix)),
-                                axis=0), np.nan)
+                                axis=0, dtype=np.float64), np.nan)
 
 
 def row_means(matrix):
     """computes the row means of a matrix"""
     return np.ma.filled(np.mean(np.ma.masked_array(matrix, np.isnan(matrix)),
-                                axis=1), np.nan)
+                                axis=1, dtype=np.float64), np.nan)
 
 
 class DocumentNotFound(Exception):
@@ -339,10 +385,145 @@ def trim_mean(values, trim):
 
 
 ######################################################################
-### RPY2 abstraction
+### Statistics backends
 ######################################################################
+# The statistics functions that cMonkey originally delegated to R can be
+# computed either through rpy2 ('r') or natively with NumPy ('native').
+# The backend is selected through the 'stats_backend' setting in the
+# General section, R is the default if rpy2 is available
+STATS_BACKEND_R = 'r'
+STATS_BACKEND_NATIVE = 'native'
+STATS_BACKEND = STATS_BACKEND_R if robjects is not None else STATS_BACKEND_NATIVE
+
+# the native backend draws all its random numbers from this single stream
+STATS_RNG = np.random.RandomState()
+
+
+def set_stats_backend(backend):
+    """select the statistics backend, falls back to the native backend
+    if R was requested, but rpy2 is not available"""
+    global STATS_BACKEND
+    if backend not in {STATS_BACKEND_R, STATS_BACKEND_NATIVE}:
+        raise Exception("unknown statistics backend: '%s'" % backend)
+    if backend == STATS_BACKEND_R and robjects is None:
+        logging.warn("rpy2 not available, using the native statistics backend")
+        backend = STATS_BACKEND_NATIVE
+    STATS_BACKEND = backend
+
+
+def use_native_stats():
+    """returns true if the native statistics backend is active"""
+    return STATS_BACKEND == STATS_BACKEND_NATIVE
+
+
 def density(kvalues, cluster_values, bandwidth, dmin, dmax):
     """generic function to compute density scores"""
+    if use_native_stats():
+        return native_density(kvalues, cluster_values, bandwidth, dmin, dmax)
+    return r_density(kvalues, cluster_values, bandwidth, dmin, dmax)
+
+
+def set_random_seed(value):
+    """seeds the random number generator of the active statistics backend"""
+    if use_native_stats():
+        STATS_RNG.seed(value)
+    else:
+        r_set_seed(value)
+
+
+def rnorm(num_values, std_deviation):
+    """returns the result of R's rnorm function"""
+    if use_native_stats():
+        return native_rnorm(num_values, std_deviation)
+    return r_rnorm(num_values, std_deviation)
+
+
+def phyper(q, m, n, k, lower_tail=False):
+    """computes the hypergeometric distribution function like R's phyper"""
+    if use_native_stats():
+        return native_phyper(q, m, n, k, lower_tail)
+    return r_phyper(q, m, n, k, lower_tail)
+
+
+def rrank(values):
+    """ranks the values like R's rank(ties='min', na='keep')"""
+    if use_native_stats():
+        return native_rank(values)
+    return r_rank(values)
+
+
+def mad(values):
+    """median absolute deviation like R's mad"""
+    if use_native_stats():
+        return native_mad(values)
+    return r_mad(values)
+
+
+def sd_rnorm(values, num_rnorm_values, fuzzy_coeff):
+    """computes standard deviation on values and then calls rnorm to
+    generate the num_rnorm_values. This combines stddev and rnorm
+    in one function for reducing rpy2 call overhead"""
+    if use_native_stats():
+        return native_sd_rnorm(values, num_rnorm_values, fuzzy_coeff)
+    return r_sd_rnorm(values, num_rnorm_values, fuzzy_coeff)
+
+
+def rrank_matrix(npmatrix):
+    """0-based ranks (ties='min') of the matrix values in row-major order"""
+    if use_native_stats():
+        return native_rank_matrix(npmatrix)
+    return r_rank_matrix(npmatrix)
+
+
+def order_fast(values, result_size, reverse=True):
+    ranked = zip(values, xrange(1, len(values) + 1))
+    ranked.sort(key=operator.itemgetter(0), reverse=reverse)
+    return [ranked[i][1] for i in xrange(result_size)]
+
+
+def rorder(values, result_size):
+    """1-based indexes of the result_size largest values like R's
+    order(decreasing=TRUE)"""
+    if use_native_stats():
+        return native_order(values, result_size)
+    return r_order(values, result_size)
+
+
+def get_rvec_fun(rvecstr):
+    """make scaling function based on an R vector expression string"""
+    native_rvec = eval_rvec(rvecstr) if use_native_stats() else None
+
+    def scale(iteration):
+        if native_rvec is not None:
+            rvec = native_rvec
+        else:
+            rvec = robjects.r(rvecstr)
+        if iteration > len(rvec):
+            return rvec[-1]
+        else:
+            return rvec[iteration - 1]
+    return scale
+
+
+def get_iter_fun(params, prefix, num_iterations):
+    """returns an iteration function for the given prefix from the configuration parameters"""
+    try:
+        constval = params[prefix + '_const']
+        return lambda i: constval
+    except:
+        pass
+    try:
+        rvec = params[prefix + '_rvec']
+        return get_rvec_fun(rvec.replace('num_iterations', str(num_iterations)))
+    except:
+        raise Exception("no rvec found for prefix '%s'" % prefix)
+
+
+######################################################################
+### RPY2 backend
+######################################################################
+def r_density(kvalues, cluster_values, bandwidth, dmin, dmax):
+    """density scores computed by R"""
     kwargs = {'bw': bandwidth, 'adjust': 2, 'from': dmin,
               'to': dmax, 'n': 256, 'na.rm': True}
     rdens = robjects.r("""
@@ -367,14 +548,14 @@ def r_runif(value):
     return runif(value)
 
 
-def rnorm(num_values, std_deviation):
+def r_rnorm(num_values, std_deviation):
     """returns the result of R's rnorm function"""
     r_rnorm = robjects.r['rnorm']
     kwargs = {'sd': std_deviation}
     return r_rnorm(num_values, **kwargs)
 
 
-def phyper(q, m, n, k, lower_tail=False):
+def r_phyper(q, m, n, k, lower_tail=False):
     """calls the R function phyper"""
     r_phyper = robjects.r['phyper']
     kwargs = {'lower.tail': lower_tail}
@@ -384,24 +565,22 @@ def phyper(q, m, n, k, lower_tail=False):
                     robjects.FloatVector(k), **kwargs)
 
 
-def rrank(values):
+def r_rank(values):
     """invokes the R function rank"""
     r_rank = robjects.r['rank']
     kwargs = {'ties': 'min', 'na': 'keep'}
     return r_rank(robjects.FloatVector(values), **kwargs)
 
 
-def mad(values):
+def r_mad(values):
     """invokes the R function mad"""
     r_mad = robjects.r['mad']
     kwargs = {'na.rm': False}
     return r_mad(robjects.FloatVector(values), **kwargs)
 
 
-def sd_rnorm(values, num_rnorm_values, fuzzy_coeff):
-    """computes standard deviation on values and then calls rnorm to
-    generate the num_rnorm_values. This combines stddev and rnorm
-    in one function for reducing rpy2 call overhead"""
+def r_sd_rnorm(values, num_rnorm_values, fuzzy_coeff):
+    """sd_rnorm, R version"""
     func = robjects.r("""
       sd_rnorm <- function(values, num_out_values, fuzzy_coeff) {
         sdval <- sd(values, na.rm=T) * fuzzy_coeff
@@ -412,7 +591,7 @@ def sd_rnorm(values, num_rnorm_values, fuzzy_coeff):
                 fuzzy_coeff)
 
 
-def rrank_matrix(npmatrix):
+def r_rank_matrix(npmatrix):
     func = robjects.r("""
       rank_mat <- function(values, nrow, ncol) {
         xr <- t(matrix(values, nrow=nrow, ncol=ncol, byrow=T))
@@ -427,13 +606,7 @@ def rrank_matrix(npmatrix):
     return np.array(res, dtype=np.int32)
 
 
-def order_fast(values, result_size, reverse=True):
-    ranked = zip(values, xrange(1, len(values) + 1))
-    ranked.sort(key=operator.itemgetter(0), reverse=reverse)
-    return [ranked[i][1] for i in xrange(result_size)]
-
-
-def rorder(values, result_size):
+def r_order(values, result_size):
     """call the R version of order"""
     r_order = robjects.r['order']
     kwargs = {'decreasing': True}
@@ -441,29 +614,280 @@ def rorder(values, result_size):
     return res[:result_size]
 
 
-def get_rvec_fun(rvecstr):
-    """make scaling function based on an R vector expression string"""
-    def scale(iteration):
-        rvec = robjects.r(rvecstr)
-        if iteration > len(rvec):
-            return rvec[-1]
-        else:
-            return rvec[iteration - 1]
-    return scale
-        
+######################################################################
+### Native backend
+######################################################################
+# R's density() computes at least 512 points, which are interpolated
+# to the 256 points that we request
+DENSITY_NUM_POINTS = 256
+DENSITY_FFT_POINTS = 512
+
+
+def __fft_kde(values, groups, weights, lo, up, bandwidths, num_points):
+    """Gaussian kernel density estimates for several groups of values at once.
+    For each group, this is what R's density() does: linear binning of the values
+    (BinDist() in density.c) and FFT convolution with the kernel. Returns a
+    matrix with the densities at linspace(lo, up, num_points) for each group"""
+    num_groups = len(lo)
+    xdelta = (up - lo) / (num_points - 1)
+    xpos = (values - lo[groups]) / xdelta[groups]
+    ix = np.floor(xpos).astype(np.int64)
+    fx = xpos - ix
+    offsets = groups * 2 * num_points
+    size = num_groups * 2 * num_points
+
+    binned = np.zeros(size)
+    inside = (ix >= 0) & (ix <= num_points - 2)
+    binned += np.bincount(offsets[inside] + ix[inside],
+                          weights=weights[inside] * (1.0 - fx[inside]), minlength=size)
+    binned += np.bincount(offsets[inside] + ix[inside] + 1,
+                          weights=weights[inside] * fx[inside], minlength=size)
+    left = ix == -1
+    binned += np.bincount(offsets[left], weights=weights[left] * fx[left],
+                          minlength=size)
+    right = ix == num_points - 1
+    binned += np.bincount(offsets[right] + num_points - 1,
+                          weights=weights[right] * (1.0 - fx[right]), minlength=size)
+    binned = binned.reshape(num_groups, 2 * num_points)
+
+    kords = (np.linspace(0.0, 1.0, 2 * num_points)[np.newaxis, :] *
+             (2.0 * (up - lo))[:, np.newaxis])
+    kords[:, num_points + 1:] = -kords[:, num_points - 1:0:-1]
+    kords = scipy.stats.norm.pdf(kords, scale=bandwidths[:, np.newaxis])
+    kords = np.fft.ifft(np.fft.fft(binned, axis=1) *
+                        np.conj(np.fft.fft(kords, axis=1)), axis=1)
+    return np.maximum(0.0, kords.real[:, :num_points])
+
+
+def __approx_uniform(x, lo, up, fp):
+    """linear interpolation like R's approx() for each row of fp, which is given
+    on the uniform grid linspace(lo, up). Values outside of the grid are NaN"""
+    num_points = fp.shape[1]
+    pos = (x - lo[:, np.newaxis]) / ((up - lo) / (num_points - 1))[:, np.newaxis]
+    with np.errstate(invalid='ignore'):
+        outside = ~((pos >= -1e-9) & (pos <= num_points - 1 + 1e-9))
+    pos[outside] = 0.0
+    pos = np.clip(pos, 0.0, num_points - 1)
+    ix = np.minimum(np.floor(pos).astype(np.int64), num_points - 2)
+    fx = pos - ix
+    rows = np.arange(fp.shape[0])[:, np.newaxis]
+    result = fp[rows, ix] * (1.0 - fx) + fp[rows, ix + 1] * fx
+    result[outside] = np.nan
+    return result
+
+
+def __density_tails(kvalues, values, groups, weights, bandwidths, dmin, dmax):
+    """the upper tail probabilities of each row of kvalues, computed from the
+    densities of the values in the matching group with R's density(adjust=2, n=256)
+    and approx(), not yet normalized"""
+    bandwidths = 2.0 * bandwidths
+    lo = dmin - 4.0 * bandwidths
+    up = dmax + 4.0 * bandwidths
+    kde = __fft_kde(values, groups, weights, lo, up, bandwidths, DENSITY_FFT_POINTS)
+    dens_x = (np.linspace(0.0, 1.0, DENSITY_NUM_POINTS)[np.newaxis, :] *
+              (dmax - dmin)[:, np.newaxis] + dmin[:, np.newaxis])
+    dens_y = __approx_uniform(dens_x, lo, up, kde)
+    tails = np.cumsum(dens_y[:, ::-1], axis=1)[:, ::-1]
+    return __approx_uniform(kvalues, dmin, dmax, tails)
+
+
+def native_density(kvalues, cluster_values, bandwidth, dmin, dmax):
+    """density scores computed with NumPy, mimics the Gaussian FFT
+    kernel density estimation of R's density(adjust=2, n=256)"""
+    values = np.asarray(cluster_values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    p = __density_tails(np.array([kvalues], dtype=np.float64), values,
+                        np.zeros(len(values), dtype=np.int64),
+                        np.repeat(1.0 / len(values), len(values)),
+                        np.array([bandwidth], dtype=np.float64),
+                        np.array([dmin], dtype=np.float64),
+                        np.array([dmax], dtype=np.float64))[0]
+    return p / np.nansum(p)
+
+
+def batch_density(kvalues, member_mask, bandwidths):
+    """density scores for all columns of the kvalues matrix in one pass.
+    For each column, this is native_density() with the finite kvalues that
+    are selected in the member_mask column as cluster values, and the range
+    of the finite column values extended by 1 on both sides.
+    Each column needs at least one finite member value"""
+    kvalues = np.asarray(kvalues, dtype=np.float64)
+    finite = np.isfinite(kvalues)
+    dmin = np.where(finite, kvalues, np.inf).min(axis=0) - 1.0
+    dmax = np.where(finite, kvalues, -np.inf).max(axis=0) + 1.0
+    rows, groups = np.nonzero(member_mask & finite)
+    counts = np.bincount(groups, minlength=kvalues.shape[1])
+    p = __density_tails(kvalues.T, kvalues[rows, groups], groups,
+                        1.0 / counts[groups],
+                        np.asarray(bandwidths, dtype=np.float64), dmin, dmax)
+    return (p / np.nansum(p, axis=1)[:, np.newaxis]).T
+
+
+def native_rnorm(num_values, std_deviation):
+    """normally distributed values with mean 0 from the native random stream"""
+    if not np.isfinite(std_deviation):
+        return np.repeat(np.nan, num_values)
+    return STATS_RNG.normal(0.0, std_deviation, num_values)
+
+
+def native_phyper(q, m, n, k, lower_tail=False):
+    """hypergeometric distribution function with R's phyper() parameters:
+    m white balls, n black balls, k balls drawn"""
+    q = np.asarray(q, dtype=np.float64)
+    m = np.asarray(m, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    k = np.asarray(k, dtype=np.float64)
+    if lower_tail:
+        return scipy.stats.hypergeom.cdf(q, m + n, m, k)
+    return scipy.stats.hypergeom.sf(q, m + n, m, k)
+
+
+def log_factorial_table(max_value):
+    """the table of log(x!) for x = 0, 1, ..., max_value"""
+    return scipy.special.gammaln(np.arange(1, max_value + 2, dtype=np.float64))
+
+
+def hypergeom_upper_tail(q, m, n, k, log_factorials):
+    """P[X > q] of the hypergeometric distribution with m white balls, n
+    black balls and k balls drawn, like phyper(q, m, n, k, lower_tail=False).
+    The arguments are integer arrays of the same shape, log_factorials is the
+    log_factorial_table() of at least max(m + n).
+    The tail that does not contain the mode of the distribution is summed,
+    starting with the term next to q, which is computed from the table.
+    The following terms decrease and are computed from their predecessors,
+    the summation stops when they become negligible"""
+    q, m, n, k = np.broadcast_arrays(*[np.asarray(value, dtype=np.int64)
+                                       for value in [q, m, n, k]])
+    shape = q.shape
+    q, m, n, k = [value.ravel() for value in [q, m, n, k]]
+    min_x = np.maximum(0, k - n)
+    max_x = np.minimum(m, k)
+    upper = q >= (k + 1) * (m + 1) // (m + n + 2)
+    x = np.where(upper, q + 1, q)
+    end = np.where(upper, max_x, min_x)
+    nonempty = np.where(upper, x <= max_x, x >= min_x)
+
+    start = np.clip(x, min_x, max_x)
+    terms = np.exp(log_factorials[m] - log_factorials[start] - log_factorials[m - start] +
+                   log_factorials[n] - log_factorials[k - start] -
+                   log_factorials[n - k + start] - log_factorials[m + n] +
+                   log_factorials[k] + log_factorials[m + n - k])
+    sums = np.where(nonempty, terms, 0.0)
+    active = np.where(nonempty & (x != end))[0]
+    x = x[active]
+    terms = terms[active]
+    while len(active) > 0:
+        mi, ni, ki, up = m[active], n[active], k[active], upper[active]
+        terms *= np.where(up, (mi - x) * (ki - x) / ((x + 1.0) * (ni - ki + x + 1)),
+                          x * (ni - ki + x) / ((mi - x + 1.0) * (ki - x + 1)))
+        x += np.where(up, 1, -1)
+        sums[active] += terms
+        more = (x != end[active]) & (terms > sums[active] * 1e-17)
+        active, x, terms = active[more], x[more], terms[more]
+    return np.clip(np.where(upper, sums, 1.0 - sums), 0.0, 1.0).reshape(shape)
+
+
+def native_rank(values):
+    """ranks with ties='min' and na='keep'"""
+    values = np.asarray(values, dtype=np.float64)
+    result = np.repeat(np.nan, len(values))
+    finite = ~np.isnan(values)
+    result[finite] = scipy.stats.rankdata(values[finite], method='min')
+    return result
+
+
+def native_mad(values):
+    """median absolute deviation, scaled with R's default constant"""
+    values = np.asarray(values, dtype=np.float64)
+    if np.any(np.isnan(values)):
+        return np.nan
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+
+def native_sd_rnorm(values, num_rnorm_values, fuzzy_coeff):
+    """sd_rnorm, NumPy version"""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) > 1:
+        sdval = np.std(values, ddof=1) * fuzzy_coeff
+    else:
+        sdval = np.nan
+    return native_rnorm(num_rnorm_values, sdval)
+
+
+def native_rank_matrix(npmatrix):
+    """rrank_matrix, NumPy version"""
+    ranks = scipy.stats.rankdata(npmatrix.ravel(), method='min') - 1
+    return ranks.astype(np.int32)
+
+
+def native_order(values, result_size):
+    """order(decreasing=TRUE), ties are kept in their original order and
+    NaN values come last"""
+    values = np.asarray(values, dtype=np.float64)
+    return (np.argsort(-values, kind='mergesort')[:result_size] + 1).tolist()
+
+
+def __rvec_arg(values):
+    """scalar argument of an R vector function"""
+    return values[0]
+
+
+def __rvec_c(*args):
+    """R's c()"""
+    result = []
+    for arg in args:
+        result.extend(arg)
+    return result
+
+
+def __rvec_rep(x, times=[1]):
+    """R's rep(), only the times argument is supported"""
+    return x * int(__rvec_arg(times))
+
+
+def __rvec_seq(start, end=[1.0], by=None, length=None, len=None):
+    """R's seq(), length is R's partially matched length.out"""
+    start, end = __rvec_arg(start), __rvec_arg(end)
+    length = length if length is not None else len
+    if length is not None:
+        length = int(math.ceil(__rvec_arg(length)))
+        if length == 1:
+            return [start]
+        return np.linspace(start, end, length).tolist()
+    by = 1.0 if by is None else __rvec_arg(by)
+    num = int(math.floor((end - start) / by + 1e-10)) + 1
+    return [start + i * by for i in xrange(num)]
+
+
+RVEC_FUNCTIONS = {'c': __rvec_c, 'rep': __rvec_rep, 'seq': __rvec_seq}
+RVEC_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub,
+                  ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+
+def eval_rvec(rvecstr):
+    """evaluates the R vector expressions that are used in the configuration
+    (c(), rep(), seq() and arithmetic on numbers) without R"""
+    def evaluate(node):
+        if isinstance(node, ast.Num):
+            return [float(node.n)]
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return [-value for value in evaluate(node.operand)]
+        elif isinstance(node, ast.BinOp) and type(node.op) in RVEC_OPERATORS:
+            op = RVEC_OPERATORS[type(node.op)]
+            left, right = evaluate(node.left), evaluate(node.right)
+            size = max(len(left), len(right))
+            return [op(left[i % len(left)], right[i % len(right)])
+                    for i in xrange(size)]
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+              node.func.id in RVEC_FUNCTIONS):
+            args = [evaluate(arg) for arg in node.args]
+            kwargs = {kw.arg: evaluate(kw.value) for kw in node.keywords}
+            return RVEC_FUNCTIONS[node.func.id](*args, **kwargs)
+        raise Exception("unsupported R vector expression: '%s'" % rvecstr)
+
+    return evaluate(ast.parse(rvecstr.strip(), mode='eval').body)
 
-def get_iter_fun(params, prefix, num_iterations):
-    """returns an iteration function for the given prefix from the configuration parameters"""
-    try:
-        constval = params[prefix + '_const']
-        return lambda i: constval
-    except:
-        pass
-    try:
-        rvec = params[prefix + '_rvec']
-        return get_rvec_fun(rvec.replace('num_iterations', str(num_iterations)))
-    except:
-        raise Exception("no rvec found for prefix '%s'" % prefix)
 
 ######################################################################
 ### Misc functionality
@@ -494,6 +918,15 @@ def current_millis():
     return int(math.floor(time.time() * 1000))
 
 
+def file_digest(path, blocksize=1 << 20):
+    """returns the SHA1 hex digest of the contents of the specified file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(blocksize), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def which_multiple(elems):
     result = defaultdict(int)
     for elem in elems:
@@ -501,12 +934,199 @@ def which_multiple(elems):
     return {elem for elem, count in result.iteritems() if count > 1}
 
 
+######################################################################
+### Worker pools
+######################################################################
+# The run-scoped worker pool. If it is set, get_mp_pool() hands it out
+# instead of creating a new pool for every use
+RUN_POOL = None
+
+# worker side cache of the published values: (module, name) -> {version: value}
+PUBLISHED_VALUES = {}
+
+# the number of versions of a published global that are kept, this allows
+# alternating values (e.g. the networks) without publishing them again
+MAX_PUBLISHED_VERSIONS = 4
+
+
+class WorkerPool:
+    """A process pool that stays alive for the whole cMonkey run.
+    The workers are forked only once, so the module globals that mapped functions
+    read need to be published to them: values are written once into a shared
+    directory (in /dev/shm if available) and loaded by the workers when their
+    version changes. NumPy arrays are memory-mapped. Values that provide
+    worker_delta() and apply_worker_delta(), like the membership, are published
+    in full once and afterwards only through their changes"""
+
+    def __init__(self, num_cores=None):
+        """create the pool with num_cores worker processes"""
+        self.num_cores = num_cores
+        self.pool = mp.Pool(num_cores)
+        self.shared_dir = tempfile.mkdtemp(
+            prefix='cmonkey-pool-',
+            dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self.versions = {}
+        self.published = {}
+
+    def close(self):
+        """stop the workers and remove the published values"""
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+    def __publish(self, key, value):
+        """publishes a module global, returns its (version, delta_version).
+        The published values are only weakly referenced if possible, the
+        files of values that are gone are removed"""
+        entries = self.published.setdefault(key, [])
+        for entry in list(entries):
+            if entry[0]() is None:
+                entries.remove(entry)
+                self.__remove_files(key, entry[1])
+        for entry in entries:
+            if entry[0]() is value:
+                break
+        else:
+            version = self.versions.get(key, 0) + 1
+            write_published(self.__path(key, version), value)
+            self.versions[key] = version
+            entry = [published_ref(value), version, 0, None]
+            entries.append(entry)
+            if len(entries) > MAX_PUBLISHED_VERSIONS:
+                self.__remove_files(key, entries.pop(0)[1])
+            if hasattr(value, 'worker_delta'):
+                entry[3] = [np.copy(a) for a in value.worker_delta()]
+            return entry[1], entry[2]
+
+        if hasattr(value, 'worker_delta'):
+            delta = value.worker_delta()
+            if not all(np.array_equal(a, b) for a, b in zip(delta, entry[3])):
+                write_published(self.__path(key, entry[1], entry[2] + 1), delta)
+                entry[2] += 1
+                entry[3] = [np.copy(a) for a in delta]
+                # a delta is the complete changing state, the workers only
+                # read the latest one, the maps that used the previous one are done
+                if entry[2] > 1:
+                    os.remove(self.__path(key, entry[1], entry[2] - 1))
+        return entry[1], entry[2]
+
+    def __remove_files(self, key, version):
+        """removes the files of a published version and its deltas"""
+        prefix = '%s.%s.%d.' % (key[0], key[1], version)
+        for filename in os.listdir(self.shared_dir):
+            if filename.startswith(prefix):
+                os.remove(os.path.join(self.shared_dir, filename))
+
+    def __path(self, key, version, delta_version=0):
+        return published_path(self.shared_dir, key, version, delta_version)
+
+    def map(self, func, args, shared=()):
+        """applies func to all args in the workers. shared are the names of
+        the globals in func's module that func reads"""
+        module = sys.modules[func.__module__]
+        try:
+            versions = {name: self.__publish((func.__module__, name),
+                                             getattr(module, name))
+                        for name in shared}
+        except (cPickle.PicklingError, TypeError):
+            # the globals can't be serialized, so we need to fork them
+            logging.debug("can't publish %s, using a new pool", str(shared))
+            pool = mp.Pool(self.num_cores)
+            try:
+                return pool.map(func, args)
+            finally:
+                pool.close()
+                pool.join()
+        return self.pool.map(call_with_published,
+                             [(func, self.shared_dir, versions, arg) for arg in args])
+
+
+def published_ref(value):
+    """a weak reference to a published value, values that do not support
+    weak references are referenced strongly"""
+    try:
+        return weakref.ref(value)
+    except TypeError:
+        return lambda: value
+
+
+def published_path(shared_dir, key, version, delta_version):
+    """path to a published value or its delta"""
+    return os.path.join(shared_dir, '%s.%s.%d.%d' % (key[0], key[1], version,
+                                                       delta_version))
+
+
+def write_published(path, value):
+    """writes a value to publish into the shared directory. It is written to
+    a temporary file that is renamed, so path only exists if the value could
+    be serialized completely"""
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as outfile:
+            if isinstance(value, np.ndarray):
+                np.save(outfile, value)
+            else:
+                cPickle.dump(value, outfile, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_published(path):
+    """reads a published value, arrays are memory-mapped"""
+    with open(path, 'rb') as infile:
+        is_array = infile.read(6) == '\x93NUMPY'
+    if is_array:
+        return np.load(path, mmap_mode='r')
+    with open(path, 'rb') as infile:
+        return cPickle.load(infile)
+
+
+def call_with_published(task):
+    """runs a task in a worker of a WorkerPool after making sure that the
+    module globals of the mapped function are up to date"""
+    func, shared_dir, versions, arg = task
+    module = sys.modules[func.__module__]
+    for name, (version, delta_version) in versions.iteritems():
+        key = (func.__module__, name)
+        cached = PUBLISHED_VALUES.setdefault(key, {})
+        if version not in cached:
+            value = read_published(published_path(shared_dir, key, version, 0))
+            cached[version] = [value, 0]
+            for old_version in sorted(cached)[:-MAX_PUBLISHED_VERSIONS]:
+                del cached[old_version]
+        entry = cached[version]
+        if entry[1] != delta_version:
+            entry[0].apply_worker_delta(read_published(
+                published_path(shared_dir, key, version, delta_version)))
+            entry[1] = delta_version
+        setattr(module, name, entry[0])
+    return func(arg)
+
+
+class WorkerPoolSession:
+    """maps functions on the run-scoped pool with a fixed set of shared globals"""
+    def __init__(self, worker_pool, shared):
+        self.worker_pool = worker_pool
+        self.shared = shared
+
+    def map(self, func, args):
+        return self.worker_pool.map(func, args, self.shared)
+
+
 class get_mp_pool:
-    """pool manager"""
-    def __init__(self, config_params={}):
+    """pool manager. Returns the run-scoped worker pool if there is one,
+    in that case, shared names the module globals that the mapped
+    functions read"""
+    def __init__(self, config_params={}, shared=()):
         """use the configuration to return a pool with user-defined number of cores
         if possible"""
-        if 'num_cores' in config_params:
+        self.owned = RUN_POOL is None
+        if not self.owned:
+            self.pool = WorkerPoolSession(RUN_POOL, shared)
+        elif 'num_cores' in config_params:
             self.pool = mp.Pool(config_params['num_cores'])
         else:
             self.pool = mp.Pool()
@@ -515,8 +1135,9 @@ class get_mp_pool:
         return self.pool
 
     def __exit__(self, type, value, tb):
-        self.pool.close()
-        self.pool.join()
+        if self.owned:
+            self.pool.close()
+            self.pool.join()
 
 __all__ = ['DelimitedFile', 'best_matching_links', 'quantile',
            'DocumentNotFound', 'CMonkeyURLopener', 'read_url',
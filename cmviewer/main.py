@@ -50,6 +50,14 @@ def normalize_js(value):
         return value
     
 
+def member_iterations_table(cursor):
+    """the table that lists the iterations with members. The row_members
+    view of the membership history rebuilds all memberships, so it is
+    only used for databases without the history"""
+    cursor.execute("select count(*) from sqlite_master where type='table' and name='membership_iterations'")
+    return 'membership_iterations' if cursor.fetchone()[0] > 0 else 'row_members'
+
+
 def format_float(value):
     if value <= 1e-3:
         return "%.2e" % value
@@ -235,7 +243,7 @@ class ClusterViewerApp:
         try:
             conn = dbconn()
             cursor = conn.cursor()
-            cursor.execute('select max(iteration) from row_members')
+            cursor.execute('select max(iteration) from %s' % member_iterations_table(cursor))
             iteration = cursor.fetchone()[0]
         except:
             tmpl = env.get_template('not_available.html')
@@ -374,7 +382,8 @@ class ClusterViewerApp:
     def iterations(self):
         conn = dbconn()
         cursor = conn.cursor()
-        cursor.execute("select distinct iteration from row_members order by iteration")
+        cursor.execute("select distinct iteration from %s order by iteration" %
+                       member_iterations_table(cursor))
         result = [row[0] for row in cursor.fetchall()]
         cursor.close()
         conn.close()
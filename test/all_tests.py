@@ -17,6 +17,11 @@ import operon_nw_test as opnwt
 import network_test as nwt
 import microarray_test as mat
 import meme_test as met
+import motif_test as mott
+import motifscan_test as mst
+import resultdb_test as rdbt
+import checkpoint_test as cpt
+import scorestore_test as sst
 import pssm_test as pt
 import combiner_test as ct
 import read_wee_test as rwt
@@ -28,6 +33,8 @@ import microbes_online_test as mo_test
 import iteration_test
 import postproc_test
 import setenrichment_test as se_test
+import bscm_test as bt
+import cmonkey_run_test as cmrt
 
 # pylint: disable-msg=C0301
 if __name__ == '__main__':
@@ -36,13 +43,17 @@ if __name__ == '__main__':
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(dmtest.DataMatrixFactoryTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(dmtest.NoChangeFilterTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(dmtest.CenterScaleFilterTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(dmtest.FilterPipelineTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(dmtest.QuantileNormalizeTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(dmtest.PrecisionTest))
 
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ut.DelimitedFileTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ut.UtilsTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ut.LevenshteinDistanceTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ut.BestMatchingLinksTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ut.Order2StringTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ut.NativeStatsTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ut.WorkerPoolTest))
 
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ot.MicrobeTest))
 
@@ -58,9 +69,21 @@ if __name__ == '__main__':
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(nwt.NetworkTest))
 
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(omembtest.OrigMembershipTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(omembtest.DensityScoresTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(omembtest.KMeansSeederTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(mat.ComputeArrayScoresTest))
 
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(met.MemeTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(met.ScanDatabaseTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(met.NativeScanTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(mott.SequenceFilterTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(mott.MotifResultCacheTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(mott.MotifJobSchedulerTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(mst.MotifScanTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(rdbt.ResultWriterTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(rdbt.MembershipHistoryTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(cpt.CheckpointTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(sst.ScoreStoreTest))
 
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(pt.PssmTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ct.CombinerTest))
@@ -68,6 +91,11 @@ if __name__ == '__main__':
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(se_test.DiscreteEnrichmentSetTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(se_test.CutoffEnrichmentSetTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(se_test.SetTypeTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(se_test.CompiledSetTypeTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(bt.SampleVariancesTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(bt.BSCMTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(bt.NullDistributionStoreTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(cmrt.CMonkeyRunTest))
 
     # web based tests
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(
@@ -0,0 +1,189 @@
+"""bscm_test.py - unit tests for BSCM module
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import datamatrix as dm
+import BSCM
+
+
+def make_ratios(num_rows=200, num_cols=4):
+    rng = np.random.RandomState(11)
+    values = rng.normal(0.0, 1.0, (num_rows, num_cols))
+    values[::10, 1] = np.nan
+    return dm.DataMatrix(num_rows, num_cols, ['G%d' % row for row in xrange(num_rows)],
+                         values=values)
+
+
+class SampleVariancesTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for the background variance sampler"""
+
+    def test_sample_variances(self):
+        """the samples are drawn without replacement and converge to the
+        expected variance of a sample of size n"""
+        values = np.arange(10, dtype=np.float64)
+        values[3] = np.nan
+        result = BSCM.sample_variances(values, [1, 9, 10, 3], np.random.RandomState(3),
+                                       tolerance=0.01, chunkSize=100)
+        self.assertEquals([1, 3, 9, 10], sorted(result.keys()))
+        self.assertTrue(np.isnan(result[1]).all())
+        self.assertTrue(np.isnan(result[10]).all())
+        # all 9 non-NaN values are in every sample
+        self.assertTrue(np.allclose(np.var(values[~np.isnan(values)]), result[9]))
+        self.assertEquals(0, len(result[9]) % 100)
+
+        # sampling stops at the time limit, before the variances converged
+        converged = set()
+        result = BSCM.sample_variances(values, [3, 9], np.random.RandomState(3),
+                                       tolerance=0.0, maxTime=-1, chunkSize=100,
+                                       converged=converged)
+        self.assertEquals(set(), converged)
+        self.assertEquals(1000, len(result[3]))
+        converged = set()
+        BSCM.sample_variances(values, [3, 9], np.random.RandomState(3), tolerance=0.01,
+                              chunkSize=100, converged=converged)
+        self.assertEquals({3, 9}, converged)
+
+        # E[var] = (n - 1) / n * N / (N - 1) * population variance
+        population = values[~np.isnan(values)]
+        expected = 2.0 / 3.0 * 9.0 / 8.0 * np.var(population)
+        self.assertAlmostEquals(expected, np.mean(result[3]), delta=0.05 * expected)
+
+    def test_convergence(self):
+        """sampling stops at the first chunk where the mean and the variance
+        of the variances change less than the tolerance"""
+        moments = {2: (0, 0.0, 0.0)}
+        variances = np.array([1.0, 3.0, 1.0, 3.0, 5.0, 5.0, 7.0, 7.0])
+        self.assertEquals((2, True), BSCM.add_variance_chunks(moments, 2, variances, 2, 0.01))
+        self.assertEquals((4, 8.0, 20.0), moments[2])
+        self.assertEquals((4, False), BSCM.add_variance_chunks(moments, 2, variances, 2, 0.0))
+        self.assertEquals((12, 40.0, 188.0), moments[2])
+
+
+class BSCMTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for BSCM"""
+
+    def test_get_pvals(self):
+        """the p-value is the fraction of background variances below the
+        variance of the genes, the backgrounds are kept"""
+        ratios = make_ratios()
+        bscm = BSCM.BSCM(ratios, tolerance=0.01)
+        genes = ['G%d' % row for row in xrange(12)] + ['unknown']
+        pvals = bscm.getPvals(genes)
+        self.assertEquals(ratios.column_names, sorted(pvals.keys()))
+        self.assertEquals(['12'], bscm.allVars['Col 0'].keys())
+        self.assertEquals(['10'], bscm.allVars['Col 1'].keys())
+        for column, name in enumerate(ratios.column_names):
+            values = ratios.values[:12, column]
+            variance = np.var(values[~np.isnan(values)])
+            background = bscm.allVars[name].values()[0]
+            self.assertAlmostEquals(np.mean(background < variance), pvals[name])
+        self.assertEquals(pvals, bscm.getPvals(genes))
+
+    def test_get_pvals_single_gene(self):
+        """a single gene is not significant"""
+        bscm = BSCM.BSCM(make_ratios(), tolerance=0.01)
+        self.assertEquals([1, 1, 1, 1], bscm.getPvals(['G0']).values())
+
+    def test_get_pvals_store(self):
+        """the backgrounds are written to the store and reused by other
+        instances on the same ratios, also from the workers"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ratios = make_ratios()
+            genes = ['G%d' % row for row in xrange(12)]
+            store = BSCM.NullDistributionStore(tmpdir)
+            bscm = BSCM.BSCM(ratios, tolerance=0.01, store=store)
+            pvals = bscm.getPvals(genes)
+            key = BSCM.column_key(ratios.values[:, 1], 0.01, 200)
+            self.assertEquals({10}, store.sizes(key))
+            self.assertEquals(4, len(os.listdir(tmpdir)))
+
+            reused = BSCM.BSCM(ratios, tolerance=0.01, store=BSCM.NullDistributionStore(tmpdir))
+            self.assertEquals(pvals, reused.getPvals(genes))
+            self.assertTrue(isinstance(reused.allVars['Col 1']['10'], np.memmap))
+
+            # with multiple cores, the workers store the neighbours
+            pvals = reused.getPvals(genes[:6], num_cores=2)
+            self.assertEquals({2, 3, 4, 5, 6, 7, 8, 10},
+                              BSCM.NullDistributionStore(tmpdir).sizes(key))
+            self.assertEquals(pvals, BSCM.BSCM(ratios, tolerance=0.01,
+                                               store=BSCM.NullDistributionStore(tmpdir))
+                              .getPvals(genes[:6]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_pvals_store_unconverged(self):
+        """backgrounds that did not converge within the time limit are used,
+        but not stored"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ratios = make_ratios()
+            store = BSCM.NullDistributionStore(tmpdir)
+            bscm = BSCM.BSCM(ratios, tolerance=0.0, maxTime=-1, store=store)
+            pvals = bscm.getPvals(['G%d' % row for row in xrange(12)])
+            self.assertEquals(ratios.column_names, sorted(pvals.keys()))
+            self.assertEquals(2000, len(bscm.allVars['Col 0']['12']))
+            self.assertEquals([], os.listdir(tmpdir))
+            key = BSCM.column_key(ratios.values[:, 0], 0.0, 200)
+            self.assertEquals(set(), BSCM.NullDistributionStore(tmpdir).sizes(key))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_pvals_interpolation(self):
+        """missing backgrounds between backgrounds within the interpolation
+        distance are interpolated"""
+        ratios = make_ratios()
+        bscm = BSCM.BSCM(ratios, tolerance=0.01, interpolation=2)
+        lower = bscm.getPvals(['G%d' % row for row in xrange(4)])
+        upper = bscm.getPvals(['G%d' % row for row in xrange(6)])
+        pvals = bscm.getPvals(['G%d' % row for row in xrange(5)])
+        self.assertEquals(['4', '6'], sorted(bscm.allVars['Col 0'].keys()))
+        variance = np.var(ratios.values[:5, 0])
+        expected = np.mean([BSCM.background_pvalue(bscm.allVars['Col 0'][n], variance)
+                            for n in ['4', '6']])
+        self.assertAlmostEquals(expected, pvals['Col 0'])
+
+
+class NullDistributionStoreTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for NullDistributionStore"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get(self):
+        """the variances are stored sorted and loaded as memory maps"""
+        store = BSCM.NullDistributionStore(os.path.join(self.tmpdir, 'bscm'))
+        self.assertEquals(None, store.get('key', 3))
+        self.assertEquals(set(), store.sizes('key'))
+        store.put('key', 3, np.array([3.0, 1.0, 2.0]))
+        self.assertEquals([1.0, 2.0, 3.0], store.get('key', 3).tolist())
+
+        other = BSCM.NullDistributionStore(os.path.join(self.tmpdir, 'bscm'))
+        self.assertEquals({3}, other.sizes('key'))
+        self.assertTrue(isinstance(other.get('key', 3), np.memmap))
+        self.assertEquals([], [name for name in os.listdir(os.path.join(self.tmpdir, 'bscm', 'key'))
+                               if 'tmp' in name])
+
+    def test_column_key(self):
+        """the key depends on the non-NaN ratios and the sampling parameters"""
+        key = BSCM.column_key([1.0, np.nan, 2.0], 0.01, 200)
+        self.assertEquals(key, BSCM.column_key([np.nan, 1.0, 2.0], 0.01, 200))
+        self.assertNotEquals(key, BSCM.column_key([1.0, 2.5], 0.01, 200))
+        self.assertNotEquals(key, BSCM.column_key([1.0, 2.0], 0.001, 200))
+        self.assertNotEquals(key, BSCM.column_key([1.0, 2.0], 0.01, 100))
+
+    def test_run_null_store(self):
+        """the store of a run is in its cache directory"""
+        store = BSCM.run_null_store({'cache_dir': self.tmpdir})
+        self.assertEquals(os.path.join(self.tmpdir, 'bscm'), store.directory)
@@ -0,0 +1,140 @@
+"""checkpoint_test.py - unit tests for checkpoint module
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+import checkpoint
+import datamatrix as dm
+import membership as memb
+import scoring
+import scorestore
+import util
+
+CONFIG_PARAMS = {
+    'memb.clusters_per_row': 2,
+    'memb.clusters_per_col': 3,
+    'num_clusters': 4
+}
+
+
+class DummyScoringFunction(scoring.ScoringFunctionBase):
+    """a scoring function that returns a fixed matrix"""
+
+    def __init__(self, id, value, config_params):
+        scoring.ScoringFunctionBase.__init__(self, id, None, None, None, config_params)
+        self.value = value
+
+    def do_compute(self, iteration_result, ref_matrix=None):
+        return dm.DataMatrix(3, 4, ['R1', 'R2', 'R3'], init_value=self.value)
+
+
+def make_membership():
+    return memb.OrigMembership(['R1', 'R2', 'R3'], ['C1', 'C2'],
+                               {'R1': [1, 2], 'R2': [2], 'R3': [4, 3]},
+                               {'C1': [1, 2, 3], 'C2': [4]},
+                               CONFIG_PARAMS)
+
+
+class CheckpointTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for checkpoint"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = checkpoint.checkpoint_path(self.tmpdir)
+        self.fingerprint = checkpoint.run_fingerprint(['R1', 'R2', 'R3'], ['C1', 'C2'], 4)
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        for run in ['run1', 'run2']:
+            scorestore.discard_run_store({'output_dir': os.path.join(self.tmpdir, run)})
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_read(self):
+        """the state is read back as written, the temporary file is renamed"""
+        state = {}
+        checkpoint.add_component_state(state, 'membership',
+                                       make_membership().checkpoint_state())
+        checkpoint.add_component_state(state, 'motifs',
+                                       {'results': checkpoint.object_array({1: {'G1': 0.5}})})
+        checkpoint.write_checkpoint(self.path, 12, self.fingerprint, state)
+        self.assertEquals([checkpoint.CHECKPOINT_FILE], os.listdir(self.tmpdir))
+
+        iteration, read_state = checkpoint.read_checkpoint(self.path, self.fingerprint)
+        self.assertEquals(12, iteration)
+        self.assertEquals(sorted(state.keys()), sorted(read_state.keys()))
+        membership = checkpoint.component_state(read_state, 'membership')
+        self.assertEquals([[1, 2], [2, 0], [4, 3]], membership['row_membs'].tolist())
+        self.assertEquals({1: {'G1': 0.5}}, checkpoint.array_object(
+            checkpoint.component_state(read_state, 'motifs')['results']))
+
+    def test_read_other_input(self):
+        """a checkpoint of a different input or version is rejected"""
+        checkpoint.write_checkpoint(self.path, 1, self.fingerprint, {})
+        other = checkpoint.run_fingerprint(['R1', 'R2', 'R3'], ['C1', 'C2'], 5)
+        self.assertRaises(checkpoint.CheckpointError, checkpoint.read_checkpoint,
+                          self.path, other)
+        checkpoint.CHECKPOINT_VERSION += 1
+        try:
+            self.assertRaises(checkpoint.CheckpointError, checkpoint.read_checkpoint,
+                              self.path, self.fingerprint)
+        finally:
+            checkpoint.CHECKPOINT_VERSION -= 1
+
+    def test_restore_membership(self):
+        """the restored membership arrays replace the current ones and the
+        cluster member indexes follow them"""
+        membership = make_membership()
+        self.assertEquals({'R1', 'R2'}, membership.rows_for_cluster(2))
+        state = {'row_membs': np.array([[3, 0], [2, 1], [4, 3]]),
+                 'col_membs': np.array([[1, 2, 3], [4, 0, 0]])}
+        membership.restore_checkpoint(state)
+        self.assertEquals({'R2'}, membership.rows_for_cluster(2))
+        self.assertEquals({'R1', 'R3'}, membership.rows_for_cluster(3))
+        self.assertRaises(checkpoint.CheckpointError, membership.restore_checkpoint,
+                          {'row_membs': np.zeros((3, 3)), 'col_membs': np.zeros((2, 3))})
+
+    def test_restore_combiner(self):
+        """the cached results of the combined functions are restored by function id"""
+        config_params = dict(CONFIG_PARAMS, output_dir=os.path.join(self.tmpdir, 'run1'))
+        functions = [DummyScoringFunction('Rows', 1.0, config_params),
+                     DummyScoringFunction('Networks', 2.0, config_params)]
+        for function in functions:
+            function.store_result(function.do_compute({}))
+        combiner = scoring.ScoringFunctionCombiner(None, None, functions)
+        state = combiner.checkpoint_state()
+        self.assertEquals(['Networks/column_names', 'Networks/row_names', 'Networks/values',
+                           'Rows/column_names', 'Rows/row_names', 'Rows/values'],
+                          sorted(state.keys()))
+
+        config_params = dict(CONFIG_PARAMS, output_dir=os.path.join(self.tmpdir, 'run2'))
+        restored = [DummyScoringFunction('Rows', 0.0, config_params),
+                    DummyScoringFunction('Networks', 0.0, config_params)]
+        self.assertEquals(None, restored[0].last_cached())
+        scoring.ScoringFunctionCombiner(None, None, restored).restore_checkpoint(state)
+        for function, restored_function in zip(functions, restored):
+            matrix = restored_function.last_cached()
+            self.assertEquals(['R1', 'R2', 'R3'], matrix.row_names)
+            self.assertEquals(function.last_cached().column_names, matrix.column_names)
+            self.assertTrue((function.last_cached().values == matrix.values).all())
+
+    def test_restore_rng_state(self):
+        """the random number generators continue with the same numbers"""
+        random.seed(3)
+        util.STATS_RNG.seed(3)
+        random.gauss(0.0, 1.0)
+        util.STATS_RNG.normal(0.0, 1.0)
+        state = checkpoint.rng_state()
+        expected = (random.random(), random.gauss(0.0, 1.0),
+                    util.STATS_RNG.normal(0.0, 1.0, 3).tolist())
+        random.seed(4)
+        util.STATS_RNG.seed(4)
+        checkpoint.restore_rng_state(state)
+        self.assertEquals(expected, (random.random(), random.gauss(0.0, 1.0),
+                                     util.STATS_RNG.normal(0.0, 1.0, 3).tolist()))
@@ -0,0 +1,149 @@
+"""cmonkey_run_test.py - integration tests for the cmonkey_run module
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import unittest
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import ConfigParser
+import numpy as np
+import config
+import datamatrix as dm
+import util
+import network as nw
+import motif
+import cmonkey_run as cmr
+
+
+NUM_CLUSTERS = 20
+NUM_ITERATIONS = 20
+RATIOS_FILE = 'example_data/hal/halo_ratios5.tsv'
+
+
+def make_params(outdir, precision):
+    """the configuration of a ratios only run, like the one setup_default()
+    creates for it"""
+    config_parser = ConfigParser.ConfigParser()
+    config_parser.read('config/default.ini')
+    params = config.set_config(config_parser)
+    params.update({'output_dir': outdir, 'cache_dir': os.path.join(outdir, 'cache'),
+                   'out_database': os.path.join(outdir, params['dbfile_name']),
+                   'precision': precision, 'num_iterations': NUM_ITERATIONS,
+                   'num_clusters': NUM_CLUSTERS, 'stats_freq': 1,
+                   'memb.clusters_per_row': 2,
+                   'memb.clusters_per_col': int(round(NUM_CLUSTERS * 2.0 / 3.0)),
+                   'multiprocessing': False, 'stats_backend': 'native',
+                   'organism_code': None, 'ratios_file': RATIOS_FILE, 'string_file': None,
+                   'logfile': None, 'rsat_organism': None, 'remap_network_nodes': False,
+                   'ncbi_code': None, 'operon_file': None, 'rsat_dir': None,
+                   'rsat_features': 'feature', 'debug': set(), 'nomotifs': True,
+                   'nonetworks': True, 'minimize_io': False, 'pipeline_file': None,
+                   'synonym_file': None, 'fasta_file': None, 'interactive': False,
+                   'resume': False, 'new_data_file': False, 'case_sensitive': False,
+                   'command_line': 'cmonkey_run_test', 'use_BSCM': False,
+                   'random_seed': 10})
+    params['MEME']['version'] = None
+    return params
+
+
+def read_ratios():
+    """the normalized example ratios"""
+    matrix_factory = dm.DataMatrixFactory([dm.nochange_filter, dm.center_scale_filter])
+    infile = util.read_dfile(RATIOS_FILE,
+                             has_header=True, quote='\"')
+    return matrix_factory.create_from(infile)
+
+
+class CMonkeyRunTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for ratios only runs"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.tmpdir = tempfile.mkdtemp()
+        util.set_stats_backend('native')
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        dm.set_precision('double')
+        shutil.rmtree(self.tmpdir)
+
+    def __run(self, precision):
+        """runs the example ratios with a fixed seed, returns the run"""
+        outdir = os.path.join(self.tmpdir, precision)
+        os.makedirs(outdir)
+        random.seed(10)
+        util.set_random_seed(10)
+        run = cmr.CMonkeyRun(read_ratios(), make_params(outdir, precision))
+        run.run()
+        run.cleanup()
+        return run
+
+    def test_run_single_precision(self):
+        """a single precision run writes its statistics and finds the
+        clusters of the double precision run"""
+        double = self.__run('double')
+        single = self.__run('single')
+        self.assertEquals(np.float32, single.ratios.values.dtype)
+
+        conn = sqlite3.connect(single['out_database'])
+        try:
+            cursor = conn.cursor()
+            cursor.execute('select count(distinct iteration) from iteration_stats ' +
+                           'where iteration <= ?', [NUM_ITERATIONS])
+            self.assertEquals(NUM_ITERATIONS, cursor.fetchone()[0])
+            cursor.execute('select count(*) from cluster_stats where iteration=?',
+                           [NUM_ITERATIONS])
+            self.assertEquals(NUM_CLUSTERS, cursor.fetchone()[0])
+        finally:
+            conn.close()
+
+        num_members = 0
+        num_same = 0
+        for cluster in xrange(1, NUM_CLUSTERS + 1):
+            rows = set(double.membership().rows_for_cluster(cluster))
+            num_members += len(rows)
+            num_same += len(rows & set(single.membership().rows_for_cluster(cluster)))
+        self.assertTrue(num_same >= 0.95 * num_members)
+
+    def test_write_stats_single_precision(self):
+        """the network and motif score means of single precision scores are
+        stored in the statistics"""
+        run = self.__run('single')
+        membership = run.membership()
+        num_rows = run.ratios.num_rows
+        member_mask = np.zeros((num_rows, NUM_CLUSTERS), dtype=bool)
+        for cluster in xrange(1, NUM_CLUSTERS + 1):
+            member_mask[run.ratios.row_indexes_for(membership.rows_for_cluster(cluster)),
+                        cluster - 1] = True
+        network_score = np.random.rand(num_rows, NUM_CLUSTERS).astype(np.float32)
+        pvalues = dm.DataMatrix(num_rows, NUM_CLUSTERS, run.ratios.row_names,
+                                values=np.random.rand(num_rows, NUM_CLUSTERS))
+        self.assertEquals(np.float32, pvalues.values.dtype)
+
+        conn = sqlite3.connect(run['out_database'])
+        with conn:
+            conn.execute("insert into statstypes values ('network','STRING')")
+            conn.execute("insert into statstypes values ('seqtype','upstream')")
+        iteration = NUM_ITERATIONS + 2
+        run.write_stats({'iteration': iteration, 'score_means': {},
+                         'networks': {'STRING': nw.compute_score_mean(network_score,
+                                                                      member_mask)},
+                         'motif-pvalue': {'upstream': motif.compute_mean_score(
+                             pvalues, membership, None)}})
+        try:
+            cursor = conn.cursor()
+            cursor.execute('select name, score from iteration_stats its join statstypes st ' +
+                           'on st.rowid=its.statstype where category in (?,?) ' +
+                           'and iteration=? order by name',
+                           ['network', 'seqtype', iteration])
+            scores = cursor.fetchall()
+            self.assertEquals(['STRING', 'upstream'], [name for name, _ in scores])
+            for _, score in scores:
+                self.assertTrue(isinstance(score, float))
+                self.assertTrue(0.0 < score < 1.0)
+        finally:
+            conn.close()
@@ -4,8 +4,11 @@ This file is part of cMonkey Python. Please see README and LICENSE for
 more information and licensing details.
 """
 import unittest
+import numpy as np
 import datamatrix as dm
+import membership as memb
 import scoring as s
+import util
 
 class CombinerTest(unittest.TestCase):  # pylint: disable-msg=R0904
     """Test class for Pssm"""
@@ -15,3 +18,29 @@ class CombinerTest(unittest.TestCase):  # pylint: disable-msg=R0904
         m = dm.DataMatrix(2, 2, [[0.1, 0.2], [0.1, 0.2]])
         result = s.combine([m], [1.0], None, 1, {'quantile_normalize': True, 'debug': {},
                                                  'num_clusters': 42})
+
+    def test_combine_scaled(self):
+        """without quantile normalization, the expression scores are scaled by the
+        median and MAD of their in-cluster values, the other scores by the 1%
+        quantiles"""
+        row_names = ['R1', 'R2', 'R3', 'R4']
+        membership = memb.OrigMembership(row_names, ['C1'],
+                                         {'R1': [1], 'R2': [1], 'R3': [2], 'R4': [2]},
+                                         {'C1': [1, 2]},
+                                         {'memb.clusters_per_row': 1,
+                                          'memb.clusters_per_col': 2, 'num_clusters': 2})
+        rows = dm.DataMatrix(4, 2, row_names, values=[[1.0, 5.0], [3.0, 2.0],
+                                                      [4.0, -2.0], [0.5, 6.0]])
+        networks = dm.DataMatrix(4, 2, row_names, values=[[-1.0, 0.0], [0.0, -0.5],
+                                                          [-2.0, 0.0], [np.nan, -1.0]])
+        timings = {}
+        result = s.combine([rows, networks], [6.0, 0.5], membership, 1,
+                           {'quantile_normalize': False, 'debug': {}}, timings)
+
+        in_cluster = np.array([1.0, 3.0, -2.0, 6.0])
+        rscores = (rows.values - util.median(in_cluster)) / util.mad(in_cluster)
+        net_scores = (networks.values / abs(util.quantile(networks.values, 0.01)) *
+                      abs(util.quantile(rscores, 0.01)))
+        self.assertEquals(row_names, result.row_names)
+        self.assertTrue(np.allclose(rscores * 6.0 + net_scores * 0.5, result.values))
+        self.assertEquals(['fix_extreme_values', 'scale', 'sum'], sorted(timings.keys()))
@@ -8,6 +8,10 @@ import copy
 import datamatrix as dm
 import numpy as np
 import util
+import os
+import gzip
+import shutil
+import tempfile
 
 
 class DataMatrixTest(unittest.TestCase):  # pylint: disable-msg=R0904
@@ -282,6 +286,36 @@ class DataMatrixTest(unittest.TestCase):  # pylint: disable-msg=R0904
                                            [-19.9, -19.9]]).all())
 
 
+class PrecisionTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for the precision policy"""
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        dm.set_precision('double')
+
+    def test_default(self):
+        """matrices are double precision by default"""
+        self.assertEquals(np.float64, dm.DataMatrix(2, 2).values.dtype)
+
+    def test_single(self):
+        """with single precision, new matrices are float32 unless specified"""
+        dm.set_precision('single')
+        self.assertEquals(np.float32, dm.DataMatrix(2, 2).values.dtype)
+        self.assertEquals(np.float32,
+                          dm.DataMatrix(1, 2, values=[[0.5, 1.0]]).values.dtype)
+        self.assertEquals(np.float64, dm.DataMatrix(2, 2, dtype=np.float64).values.dtype)
+
+    def test_means_accumulate_double(self):
+        """the means of float32 values are computed in float64"""
+        values = np.array([[0.1, np.nan], [0.2, 0.4]], dtype=np.float32)
+        self.assertEquals(np.float64, util.column_means(values).dtype)
+        self.assertEquals(np.float64, util.row_means(values).dtype)
+
+    def test_unknown_precision(self):
+        """unknown precisions are rejected"""
+        self.assertRaises(ValueError, dm.set_precision, 'half')
+
+
 class MockDelimitedFile:  # pylint: disable-msg=R0903
     """Mock DelimitedFile"""
 
@@ -345,6 +379,51 @@ class DataMatrixFactoryTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertTrue((matrix.values[0] == [2, 4]).all())
         self.assertTrue((matrix.values[1] == [6, 8]).all())
 
+    def test_create_from_file(self):
+        """the file fast path reads the same matrix as create_from(),
+        also from gzipped files and across several blocks"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            text = ('"GENE"\t"C1"\t"C2"\t"C3"\t"C4"\n' +
+                    'R3\t1.5\tNA\tNA\t-2\n' +
+                    'R1\t\t\t\t4e-1\n' +
+                    '\n' +
+                    'R2\tNA\t3\t\tNA\n')
+            path = os.path.join(tmpdir, 'ratios.tsv')
+            with open(path, 'w') as outfile:
+                outfile.write(text)
+            with gzip.open(path + '.gz', 'w') as outfile:
+                outfile.write(text)
+            expected = dm.DataMatrixFactory([]).create_from(
+                util.dfile_from_text(text, has_header=True, quote='"'))
+            for matrix in [dm.DataMatrixFactory([]).create_from_file(path),
+                           dm.DataMatrixFactory([]).create_from_file(path + '.gz'),
+                           dm.read_matrix_file(path, block_rows=2).sorted_by_row_name()]:
+                self.assertEquals(['R1', 'R2', 'R3'], matrix.row_names)
+                self.assertEquals(['C1', 'C2', 'C3', 'C4'], matrix.column_names)
+                self.assertTrue(np.array_equal(np.isnan(expected.values),
+                                               np.isnan(matrix.values)))
+                self.assertTrue(np.allclose(expected.values, matrix.values,
+                                            equal_nan=True))
+                self.assertEquals(8, np.isnan(matrix.values).sum())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_create_from_file_no_0_column(self):
+        """header formats that omit the 0-column and rows with too many
+        cells are handled as in create_from()"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'ratios.tsv')
+            with open(path, 'w') as outfile:
+                outfile.write('C1\tC2\nR1\t1\t2\nR2\t3\t4\t5\n')
+            matrix = dm.DataMatrixFactory([times2]).create_from_file(path, False)
+            self.assertEquals(['R1', 'R2'], matrix.row_names)
+            self.assertEquals(['C1', 'C2'], matrix.column_names)
+            self.assertEquals([[2.0, 4.0], [6.0, 8.0]], matrix.values.tolist())
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 def times2(matrix):
     """a simple filter that multiplies all values in the matrix by 2"""
@@ -400,6 +479,37 @@ class CenterScaleFilterTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertAlmostEqual(-0.70710678237309499, filtered[1][0])
         self.assertAlmostEqual(0.70710678237309499, filtered[1][1])
 
+    def test_filter_with_nan(self):
+        """NaN values are ignored and kept"""
+        matrix = dm.DataMatrix(1, 4, ['R1'], ['C1', 'C2', 'C3', 'C4'],
+                               values=[[2, np.nan, 3, 4]])
+        filtered = dm.center_scale_filter(matrix).values
+        self.assertAlmostEqual(-1.0, filtered[0][0])
+        self.assertTrue(np.isnan(filtered[0][1]))
+        self.assertAlmostEqual(0.0, filtered[0][2])
+        self.assertAlmostEqual(1.0, filtered[0][3])
+        self.assertEquals(3, matrix.values[0][2])
+
+
+class FilterPipelineTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for filter_pipeline"""
+
+    def test_pipeline(self):
+        """a pipeline gives the same result as applying the filters one
+        after the other, also with filters that are not array based"""
+        matrix = dm.DataMatrix(3, 3, ['R1', 'R2', 'R3'], ['C1', 'C2', 'C3'],
+                               values=[[0.24, -0.35, 0.01], [-0.001, np.nan, 0.05],
+                                       [1.5, 0.8, -0.03]])
+        filters = [dm.nochange_filter, times2, dm.center_scale_filter]
+        expected = matrix
+        for matrix_filter in filters:
+            expected = matrix_filter(expected)
+        filtered = dm.filter_pipeline(filters)(matrix)
+        self.assertEquals(['R1', 'R3'], filtered.row_names)
+        self.assertEquals(expected.column_names, filtered.column_names)
+        self.assertTrue(np.allclose(expected.values, filtered.values))
+        self.assertEquals(0.24, matrix.values[0][0])
+
 
 def as_sorted_flat_values(matrices):
     """this method is now inlined into quantile_normalize_scores
@@ -445,6 +555,23 @@ class QuantileNormalizeTest(unittest.TestCase): # pylint: disable-msg=R0904
         self.assertTrue((qm1.values == [[2, 1], [3, 4]]).all())
         self.assertTrue((qm2.values == [[4, 3], [2, 1]]).all())
 
+    def test_sorted_min_ranks(self):
+        """ties get the rank of their first value, like R's rank(ties='min')"""
+        values = np.array([[4.0, 1.0], [3.0, 1.0], [4.0, np.nan]])
+        order = np.argsort(values.ravel())
+        min_ranks = dm.sorted_min_ranks(values.ravel()[order], np.empty(6, dtype=np.int64))
+        ranks = np.empty(6, dtype=np.int64)
+        ranks[order] = min_ranks
+        self.assertEquals([3, 0, 2, 0, 3, 5], ranks.tolist())
+        self.assertEquals(util.native_rank_matrix(values).tolist(), ranks.tolist())
+
+    def test_qm_result_matrices_ties(self):
+        """tied values get the mean at the position of the first of them"""
+        m1 = dm.DataMatrix(2, 2, values=[[2, 2], [1, 2]])
+        tmp_mean = np.array([1.0, 2.0, 3.0, 4.0])
+        result = dm.qm_result_matrices([m1], tmp_mean)
+        self.assertEquals([[2.0, 2.0], [1.0, 2.0]], result[0].values.tolist())
+
     def test_quantile_normalize_scores_with_all_defined_weights(self):
         """happy path for quantile normalization"""
         m1 = dm.DataMatrix(2, 2, values=[[1, 3], [2, 4]])
@@ -506,4 +633,5 @@ if __name__ == '__main__':
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(DataMatrixTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(DataMatrixFactoryTest))
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(CenterScaleFilterTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(FilterPipelineTest))
     unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -4,7 +4,11 @@ This file is part of cMonkey Python. Please see README and LICENSE for
 more information and licensing details.
 """
 import meme
+import seqtools as st
 import unittest
+import os
+import re
+import subprocess
 
 
 class MemeTest(unittest.TestCase):  # pylint: disable-msg=R0904
@@ -52,6 +56,39 @@ class MemeTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertEquals('TGATAAAACACTTTATCTCTGTAT', sites0[3][5])
         self.assertEquals('ACGTAGACCGTATCGCGGAGATCT', sites0[4][5])
 
+    def test_iter_meme_motifs_stream(self):
+        """motifs are read from a file object like from the output text"""
+        with open('testdata/meme.out') as inputfile:
+            motif_infos = list(meme.iter_meme_motifs(inputfile))
+        with open('testdata/meme.out') as inputfile:
+            expected = meme.read_meme_output(inputfile.read(), 2)
+        self.assertEquals([1, 2], [motif_info.motif_num for motif_info in motif_infos])
+        self.assertEquals([24, 20], [len(motif_info.pssm) for motif_info in motif_infos])
+        for motif_info, expected_info in zip(motif_infos, expected):
+            self.assertEquals(expected_info.pssm, motif_info.pssm)
+            self.assertEquals(expected_info.sites, motif_info.sites)
+            self.assertEquals(expected_info.evalue, motif_info.evalue)
+
+    def test_iter_meme_motifs_consensus_names(self):
+        """newer MEME versions name the motifs by their consensus"""
+        with open('testdata/meme.out') as inputfile:
+            text = inputfile.read()
+        text = re.sub('MOTIF  (\\d)', 'MOTIF ACGT MEME-\\1', text)
+        text = re.sub('\tMotif (\\d) ', '\tMotif ACGT MEME-\\1 ', text)
+        motif_infos = list(meme.iter_meme_motifs(text.split('\n')))
+        self.assertEquals([1, 2], [motif_info.motif_num for motif_info in motif_infos])
+        self.assertEquals(5, len(motif_infos[0].sites))
+        self.assertEquals(95, motif_infos[0].llr)
+
+    def test_run_meme(self):
+        """motifs are read from the output pipe of the command"""
+        motif_infos, output = meme.run_meme(['cat', 'testdata/meme.out'], 1)
+        with open('testdata/meme.out') as inputfile:
+            self.assertEquals(inputfile.read(), output)
+        self.assertEquals(1, len(motif_infos))
+        self.assertEquals(24, motif_infos[0].width)
+        self.assertRaises(subprocess.CalledProcessError, meme.run_meme, ['false'], 1)
+
     def test_read_mast_output_oldstyle(self):
         """tests the read_mast_output function"""
         with open('testdata/mast.out') as inputfile:
@@ -115,3 +152,87 @@ class MemeTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertAlmostEquals(0.322, pev[0][1])
         self.assertAlmostEquals(130.0, pev[0][2])
         self.assertTrue('NP_280363.1' in annotations)
+
+
+class ScanDatabaseTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for ScanDatabase"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.seqs = {'F1': (None, 'ACGTTGCA'), 'F2': (None, 'GGGATTAC'),
+                     'F3': (None, 'GGGATTAC'), 'F4': (None, 'GTAATCCC'),
+                     'F5': (None, 'TTTTAAAG')}
+        self.database = meme.ScanDatabase(True, 2)
+        self.database.update(self.seqs)
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        self.database.close()
+
+    def assert_models_equal(self, expected, model):
+        self.assertEquals(len(expected), len(model))
+        for expected_order, order in zip(expected, model):
+            self.assertEquals(sorted(expected_order.keys()), sorted(order.keys()))
+            for kmer, frequency in expected_order.iteritems():
+                self.assertAlmostEquals(frequency, order[kmer])
+
+    def test_leave_out_model(self):
+        """the leave-cluster-out background is the same as the one
+        computed on the remaining sequences"""
+        for cluster in [['F1'], ['F2'], ['F2', 'F3'], ['F4', 'F5'], ['F1', 'X']]:
+            bgseqs = {feature_id: seq for feature_id, seq in self.seqs.items()
+                      if feature_id not in cluster}
+            filename, expected = meme.make_background_file(bgseqs, True, 2)
+            os.remove(filename)
+            self.assert_models_equal(expected,
+                                     self.database.leave_out_model(cluster, self.seqs))
+
+    def test_update(self):
+        """the database file contains all sequences and is only rewritten
+        when the sequences change"""
+        dbfile = self.database.dbfile
+        with open(dbfile) as infile:
+            self.assertEquals(sorted(self.seqs.keys()),
+                              sorted([name for name, _ in
+                                      st.read_sequences_from_fasta_string(infile.read())]))
+        self.database.update(dict(self.seqs))
+        self.assertEquals(dbfile, self.database.dbfile)
+        self.database.update({'F1': (None, 'ACGTTGCA')})
+        self.assertFalse(os.path.exists(dbfile))
+        self.assertTrue(os.path.exists(self.database.dbfile))
+
+    def test_scanner(self):
+        """the native scanner is built over the database sequences"""
+        scanner = self.database.scanner()
+        self.assertEquals(sorted(self.seqs.keys()), sorted(scanner.names))
+        self.assertTrue(scanner is self.database.scanner())
+
+
+class NativeScanTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for MemeSuite.scan_motifs()"""
+
+    def test_scan_motifs(self):
+        """the results of the native scanner have the format of the MAST results"""
+        config_params = {'MEME': {'max_width': '24', 'background_order': '1',
+                                  'use_revcomp': 'True', 'arg_mod': 'zoops',
+                                  'scanner': 'native'}}
+        seqs = {'F1': (None, 'CCCCACGTTGCACCCC'), 'F2': (None, 'GGGATTACGGGCCCTA'),
+                'F3': (None, 'GGGTGCAACGTGGGAT'), 'F4': (None, 'TTTTAAAGCCCGGGTA')}
+        pssm = [[0.97, 0.01, 0.01, 0.01], [0.01, 0.97, 0.01, 0.01],
+                [0.01, 0.01, 0.97, 0.01], [0.01, 0.01, 0.01, 0.97],
+                [0.01, 0.01, 0.01, 0.97], [0.01, 0.01, 0.97, 0.01],
+                [0.01, 0.97, 0.01, 0.01], [0.97, 0.01, 0.01, 0.01]]
+        motif_info = meme.MemeMotifInfo(pssm, 1, 8, 2, None, 0.1, [])
+        suite = meme.MemeSuite(config_params)
+        self.assertTrue(suite.uses_native_scanner())
+        try:
+            results = suite.scan_motifs([(['F1', 'F3'], ['F1', 'F3'], [motif_info]),
+                                         (['F2'], ['F2'], [])], seqs)
+        finally:
+            suite.scan_database().close()
+        pe_values, annotations = results[0]
+        self.assertEquals(['F1', 'F3'], sorted([name for name, _, _ in pe_values[:2]]))
+        self.assertEquals(4, len(pe_values))
+        self.assertEquals([(7, 1)], [hit[1:] for hit in annotations['F1'] if hit[0] < 0.01])
+        self.assertEquals([(6, -1)], [hit[1:] for hit in annotations['F3'] if hit[0] < 0.01])
+        self.assertEquals(([], {}), results[1])
@@ -75,6 +75,39 @@ class ComputeArrayScoresTest(unittest.TestCase):
         print "(comparing computed with reference results...)"
         self.__compare_with_refresult(refresult, result)
 
+    def test_compute_row_scores_chunked_cached(self):
+        """chunked processing and cached column means give the same results"""
+        membership = self.__read_members()
+        ratios = self.__read_ratios()
+        column_means = ma.ClusterColumnMeans(ratios)
+        ma.compute_row_scores(membership, ratios, 43, {}, column_means)
+        membership.replace_row_cluster(membership.row_names[0], 0, 5)
+        result = ma.compute_row_scores(membership, ratios, 43,
+                                       {'row_score_chunk_bytes': 1}, column_means)
+        expected = ma.compute_row_scores(membership, ratios, 43, {})
+        self.assertTrue(numpy.allclose(expected.values, result.values, equal_nan=True))
+
+    def test_compute_row_scores_single_precision(self):
+        """single precision scores stay within tolerance of the double precision
+        scores and assign the rows to the same best clusters"""
+        membership = self.__read_members()
+        expected = ma.compute_row_scores(membership, self.__read_ratios(), 43, {})
+        dm.set_precision('single')
+        try:
+            ratios = self.__read_ratios()
+            result = ma.compute_row_scores(membership, ratios, 43, {})
+        finally:
+            dm.set_precision('double')
+        self.assertEquals(numpy.float32, ratios.values.dtype)
+        self.assertEquals(numpy.float32, result.values.dtype)
+        self.assertTrue(numpy.allclose(expected.values, result.values, rtol=1e-4,
+                                       atol=1e-5, equal_nan=True))
+        expected.fix_extreme_values()
+        result.fix_extreme_values()
+        agree = numpy.mean(numpy.argmin(expected.values, axis=1) ==
+                           numpy.argmin(result.values, axis=1))
+        self.assertTrue(agree >= 0.99)
+
     def test_compute_column_scores(self):
         membership = self.__read_members()
         ratios = self.__read_ratios()
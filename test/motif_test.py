@@ -0,0 +1,214 @@
+"""motif_test.py - unit tests for motif module
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import cPickle
+import meme
+import motif
+
+
+def make_run_result(motif_num):
+    """a run result with a single motif"""
+    motif_info = meme.MemeMotifInfo([[0.25, 0.25, 0.25, 0.25]], motif_num, 1, 2,
+                                    None, 0.01, [])
+    return meme.MemeRunResult([('F1', 0.1, 0.2)], {}, [motif_info])
+
+
+class FakeMemeRunner:
+    """a MEME runner for the scheduler tests. It sleeps for the given time and
+    fails its first num_failures attempts, by exiting without a result if
+    silent is True. Attempts are counted in files because every job runs in
+    its own process"""
+    def __init__(self, attempts_dir, seconds=0.0, num_failures=0, silent=False):
+        self.attempts_dir = attempts_dir
+        self.seconds = seconds
+        self.num_failures = num_failures
+        self.silent = silent
+
+    def __call__(self, params):
+        with tempfile.NamedTemporaryFile(dir=self.attempts_dir,
+                                         prefix='%d.' % params.cluster, delete=False):
+            pass
+        time.sleep(self.seconds)
+        if len(self.attempts(params.cluster)) <= self.num_failures:
+            if self.silent:
+                os._exit(0)
+            raise Exception('failed')
+        return make_run_result(params.cluster)
+
+    def attempts(self, cluster):
+        return [name for name in os.listdir(self.attempts_dir)
+                if name.startswith('%d.' % cluster)]
+
+
+def make_job_params(cluster, num_seqs, meme_runner):
+    seqs = {'F%d' % i: (None, 'ACGT') for i in range(num_seqs)}
+    return motif.ComputeScoreParams(1, cluster, sorted(seqs), seqs, seqs, meme_runner,
+                                    1, 100, 1, None, None, 2, [])
+
+
+class SequenceFilterTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for the sequence filters"""
+
+    def test_remove_atgs(self):
+        """the ATG window is masked"""
+        atg_filter = motif.get_remove_atgs_filter((-5, 2))
+        self.assertEquals({'F1': 'ACNNNNTT'},
+                          atg_filter({'F1': 'ACATGATT'}, ['F1']))
+
+    def test_pickle(self):
+        """the filters can be published to the workers"""
+        meme_suite = meme.MemeSuite481({'MEME': {'max_width': '24', 'background_order': '3',
+                                                 'use_revcomp': 'True', 'arg_mod': 'zoops'}})
+        meme_suite.update_scan_database({'F1': 'ACGTACGTAACCGGTT'})
+        filters = cPickle.loads(cPickle.dumps(
+            [motif.unique_filter, motif.get_remove_low_complexity_filter(meme_suite),
+             motif.get_remove_atgs_filter((-5, 2))], cPickle.HIGHEST_PROTOCOL))
+        self.assertEquals(24, filters[1].meme_suite.max_width)
+        self.assertEquals({}, filters[1]({'F1': 'ACGT'}, ['F1']))
+        self.assertEquals({'F1': 'ACNNNNTT'}, filters[2]({'F1': 'ACATGATT'}, ['F1']))
+
+
+class MotifResultCacheTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for MotifResultCache"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        shutil.rmtree(self.cache_dir)
+
+    def test_key(self):
+        """keys depend on the fingerprint, the feature ids and the number
+        of motifs, but not on the order of the feature ids"""
+        cache = motif.MotifResultCache(self.cache_dir, 'fingerprint')
+        key = cache.key(['F1', 'F2'], 2)
+        self.assertEquals(key, cache.key(['F2', 'F1'], 2))
+        self.assertNotEquals(key, cache.key(['F1', 'F2'], 1))
+        self.assertNotEquals(key, cache.key(['F1', 'F3'], 2))
+        self.assertNotEquals(key, motif.MotifResultCache(self.cache_dir,
+                                                         'other').key(['F1', 'F2'], 2))
+
+    def test_put_get(self):
+        """stored results survive the cache instance"""
+        cache = motif.MotifResultCache(self.cache_dir, 'fingerprint')
+        key = cache.key(['F1', 'F2'], 2)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, ['F1', 'F2'], {'F1': 0.1}, make_run_result(1))
+
+        pvalues, run_result = motif.MotifResultCache(self.cache_dir,
+                                                     'fingerprint').get(key)
+        self.assertEquals({'F1': 0.1}, pvalues)
+        self.assertEquals([('F1', 0.1, 0.2)], run_result.pe_values)
+        self.assertEquals(1, run_result.motif_infos[0].motif_num)
+
+    def test_similar_motif_infos(self):
+        """seeds are taken from the most similar cluster of this run"""
+        cache = motif.MotifResultCache(self.cache_dir, 'fingerprint')
+        cache.put('a', ['F%d' % i for i in range(10)], {}, make_run_result(1))
+        cache.put('b', ['F%d' % i for i in range(9)], {}, make_run_result(2))
+        cache.put('c', ['F%d' % i for i in range(5)], {}, None)
+        infos = cache.similar_motif_infos(['F%d' % i for i in range(9)])
+        self.assertEquals(2, infos[0].motif_num)
+        infos = cache.similar_motif_infos(['F%d' % i for i in range(11)])
+        self.assertEquals(1, infos[0].motif_num)
+        self.assertIsNone(cache.similar_motif_infos(['F%d' % i for i in range(5)]))
+
+    def test_evict(self):
+        """the least recently used entries are evicted first"""
+        cache = motif.MotifResultCache(self.cache_dir, 'fingerprint')
+        for index, key in enumerate(['a', 'b', 'c']):
+            cache.put(key, ['F1'], {'F1': 0.1}, make_run_result(1))
+            path = os.path.join(self.cache_dir, key + '.pkl')
+            os.utime(path, (1000 + index, 1000 + index))
+        entry_size = os.path.getsize(os.path.join(self.cache_dir, 'a.pkl'))
+        cache.get('a')
+        cache.max_bytes = 2 * entry_size
+        cache.evict()
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+class MotifJobSchedulerTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for MotifJobScheduler"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.attempts_dir = tempfile.mkdtemp()
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        shutil.rmtree(self.attempts_dir)
+
+    def test_run_longest_first(self):
+        """jobs with more sequences start first, results arrive as they finish"""
+        runner = FakeMemeRunner(self.attempts_dir)
+        scheduler = motif.MotifJobScheduler(1)
+        jobs = [make_job_params(cluster, num_seqs, runner)
+                for cluster, num_seqs in [(1, 3), (2, 10), (3, 5)]]
+        results = list(scheduler.run(jobs))
+        self.assertEquals([2, 3, 1], [cluster for cluster, _, _ in results])
+        self.assertEquals({'F1': 0.1}, results[0][1])
+
+    def test_run_retries(self):
+        """failed jobs are retried"""
+        runner = FakeMemeRunner(self.attempts_dir, num_failures=1)
+        scheduler = motif.MotifJobScheduler(2, retries=1)
+        results = list(scheduler.run([make_job_params(1, 3, runner)]))
+        self.assertEquals([(1, {'F1': 0.1})], [result[:2] for result in results])
+        self.assertEquals(2, len(runner.attempts(1)))
+
+    def test_run_timeout(self):
+        """jobs that run too long are stopped and finally have no result"""
+        runner = FakeMemeRunner(self.attempts_dir, seconds=30)
+        scheduler = motif.MotifJobScheduler(2, timeout=0.5, retries=1, abort_on_failure=False)
+        start_time = time.time()
+        results = list(scheduler.run([make_job_params(1, 3, runner)]))
+        self.assertTrue(time.time() - start_time < 10)
+        self.assertEquals([(1, None, None)], results)
+        self.assertEquals(2, len(runner.attempts(1)))
+
+    def test_run_abort(self):
+        """by default, a job that finally fails raises an error"""
+        runner = FakeMemeRunner(self.attempts_dir, num_failures=2)
+        scheduler = motif.MotifJobScheduler(2, retries=1)
+        self.assertRaises(motif.MotifJobError, list,
+                          scheduler.run([make_job_params(1, 3, runner)]))
+        self.assertEquals(2, len(runner.attempts(1)))
+
+    def test_run_exit_without_result(self):
+        """a job that exits normally without sending a result has failed"""
+        runner = FakeMemeRunner(self.attempts_dir, num_failures=1, silent=True)
+        scheduler = motif.MotifJobScheduler(2, timeout=30, retries=1)
+        start_time = time.time()
+        results = list(scheduler.run([make_job_params(1, 3, runner)]))
+        self.assertTrue(time.time() - start_time < 10)
+        self.assertEquals([(1, {'F1': 0.1})], [result[:2] for result in results])
+        self.assertEquals(2, len(runner.attempts(1)))
+
+    def test_start_wait(self):
+        """jobs can run in the background"""
+        runner = FakeMemeRunner(self.attempts_dir, seconds=0.2)
+        scheduler = motif.MotifJobScheduler(2)
+        scheduler.start([make_job_params(cluster, 3, runner) for cluster in [1, 2, 3]])
+        self.assertTrue(scheduler.is_started())
+        results = scheduler.wait()
+        self.assertFalse(scheduler.is_started())
+        self.assertEquals([1, 2, 3], sorted([cluster for cluster, _, _ in results]))
+
+    def test_start_wait_abort(self):
+        """failures of background jobs are raised by wait()"""
+        runner = FakeMemeRunner(self.attempts_dir, num_failures=1)
+        scheduler = motif.MotifJobScheduler(2)
+        scheduler.start([make_job_params(1, 3, runner)])
+        self.assertRaises(motif.MotifJobError, scheduler.wait)
+        self.assertFalse(scheduler.is_started())
@@ -0,0 +1,179 @@
+"""motifscan_test.py - unit tests for motifscan module
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import unittest
+import math
+import random
+import xml.etree.ElementTree as ET
+import numpy as np
+import meme
+import motifscan as ms
+
+
+BG_FREQUENCIES = [0.187, 0.313, 0.313, 0.187]
+# a sharp motif, its best match is ACGTTGCA
+PSSM = [[0.97, 0.01, 0.01, 0.01], [0.01, 0.97, 0.01, 0.01], [0.01, 0.01, 0.97, 0.01],
+        [0.01, 0.01, 0.01, 0.97], [0.01, 0.01, 0.01, 0.97], [0.01, 0.01, 0.97, 0.01],
+        [0.01, 0.97, 0.01, 0.01], [0.97, 0.01, 0.01, 0.01]]
+
+
+def random_seq(length):
+    return ''.join([random.choice('ACGT') for _ in xrange(length)])
+
+
+def random_pssm(width):
+    rows = []
+    for _ in xrange(width):
+        row = [random.random() ** 3 for _ in xrange(4)]
+        rows.append([value / sum(row) for value in row])
+    return rows
+
+
+def make_motif_info(pssm, motif_num, evalue=1.0):
+    return meme.MemeMotifInfo(pssm, motif_num, len(pssm), 5, None, evalue, [])
+
+
+def reference_scan(seqs, motif_set):
+    """scans a single motif set position by position"""
+    bg_frequencies = np.array(motif_set.bg_frequencies)
+    seq_pvalues = []
+    hits = []
+    for motif_info in motif_set.motif_infos:
+        log_odds = ms.log_odds_matrix(motif_info.pssm, bg_frequencies)
+        forward = ms.scaled_matrix(log_odds, bg_frequencies)
+        reverse = ms.scaled_matrix(log_odds[::-1, ::-1], bg_frequencies)
+        pvalues = ms.score_pvalues(forward, bg_frequencies)
+        width = len(forward)
+        motif_pvalues = []
+        for seqnum, (name, seq) in enumerate(seqs):
+            codes = [ms.SCAN_CODES[ord(char)] for char in seq]
+            num_positions = len(seq) - width + 1
+            best = -1
+            for position in xrange(num_positions):
+                fscore = sum([forward[i][codes[position + i]] for i in xrange(width)])
+                rscore = sum([reverse[i][codes[position + i]] for i in xrange(width)])
+                best = max(best, fscore, rscore)
+                hit_pvalue = 1.0 - (1.0 - pvalues[max(fscore, rscore)]) ** num_positions
+                if name in motif_set.genes and hit_pvalue < ms.MAX_HIT_PVALUE:
+                    motif_num = -motif_info.motif_num if rscore > fscore else motif_info.motif_num
+                    hits.append((hit_pvalue, seqnum, position, motif_num, width))
+            if num_positions > 0:
+                motif_pvalues.append(1.0 - (1.0 - pvalues[best]) ** (2 * num_positions))
+            else:
+                motif_pvalues.append(1.0)
+        seq_pvalues.append(motif_pvalues)
+
+    combined = ms.qfast(len(seq_pvalues), np.prod(seq_pvalues, axis=0))
+    pe_values = sorted([(combined[seqnum], seqnum) for seqnum in xrange(len(seqs))])
+    annotations = {gene: [] for gene in motif_set.genes}
+    occupied = {}
+    for pvalue, seqnum, position, motif_num, width in sorted(hits):
+        covered = occupied.setdefault(seqnum, set())
+        if covered.isdisjoint(xrange(position, position + width)):
+            covered.update(xrange(position, position + width))
+            annotations[seqs[seqnum][0]].append((position + 3, pvalue, motif_num))
+    return ([(seqs[seqnum][0], pvalue) for pvalue, seqnum in pe_values],
+            {gene: sorted(gene_hits) for gene, gene_hits in annotations.items()})
+
+
+class MotifScanTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for the native motif scanner"""
+
+    def test_qfast(self):
+        """the p-value of a product of p-values"""
+        self.assertAlmostEquals(0.01, ms.qfast(1, [0.01])[0])
+        self.assertAlmostEquals(0.01 * (1.0 - math.log(0.01)), ms.qfast(2, [0.01])[0])
+        self.assertEquals(0.0, ms.qfast(2, [0.0])[0])
+
+    def test_score_pvalues(self):
+        """the score distribution starts at p-value 1 and decreases"""
+        bg_frequencies = np.array(BG_FREQUENCIES)
+        matrix = ms.scaled_matrix(ms.log_odds_matrix(PSSM, bg_frequencies), bg_frequencies)
+        pvalues = ms.score_pvalues(matrix, bg_frequencies)
+        self.assertAlmostEquals(1.0, pvalues[0])
+        self.assertEquals(1.0, pvalues[-1])
+        self.assertTrue(np.all(np.diff(pvalues[:-1]) <= 1e-12))
+        best_score = matrix[:, :4].max(axis=1).sum()
+        self.assertAlmostEquals(0.187 ** 4 * 0.313 ** 4, pvalues[best_score])
+
+    def test_combined_pvalues_match_mast(self):
+        """the combined p-values and E-values of a MAST 4.8.1 run
+        follow from the sequence adjusted p-values of the best hits"""
+        root = ET.parse('testdata/mast-481.xml').getroot()
+        num_seqs = len(list(root.iter('sequence')))
+        width = int(root.find('motifs').find('motif').get('width'))
+        for sequence in root.iter('sequence'):
+            score = sequence.find('score')
+            hit_pvalues = [float(hit.get('pvalue')) for hit in sequence.iter('hit')]
+            if len(hit_pvalues) == 0:
+                continue
+            num_positions = int(sequence.get('length')) - width + 1
+            position_pvalue = 1.0 - (1.0 - min(hit_pvalues)) ** (1.0 / num_positions)
+            combined = ms.qfast(1, ms.sequence_pvalues(np.array([position_pvalue]),
+                                                       np.array([num_positions]), 2))[0]
+            expected = float(score.get('combined_pvalue'))
+            self.assertTrue(abs(combined - expected) <= 0.05 * expected)
+            evalue = float(score.get('evalue'))
+            self.assertTrue(abs(expected * num_seqs - evalue) <= 0.05 * evalue)
+
+    def test_scan_parity_with_reference(self):
+        """the batched scan reproduces the position by position scan"""
+        random.seed(42)
+        seqs = [('G%02d' % i, random_seq(random.randint(10, 60))) for i in xrange(12)]
+        seqs.append(('SHORT', 'ACG'))
+        seqs.append(('AMBIGUOUS', 'ACGTNNACGTRYACGTACGTACGT'))
+        motif_sets = [ms.MotifSet([make_motif_info(random_pssm(6), 1),
+                                   make_motif_info(random_pssm(9), 2)],
+                                  BG_FREQUENCIES, ['G01', 'G03', 'G07', 'AMBIGUOUS']),
+                      ms.MotifSet([make_motif_info(random_pssm(7), 1)],
+                                  [0.25, 0.25, 0.25, 0.25], ['G02', 'G05'])]
+        results = ms.MotifScanner(seqs).scan(motif_sets)
+        self.assertEquals(2, len(results))
+        for motif_set, (pe_values, annotations) in zip(motif_sets, results):
+            ref_pe_values, ref_annotations = reference_scan(seqs, motif_set)
+            self.assertEquals(len(seqs), len(pe_values))
+            self.assertEquals(sorted([name for name, _ in ref_pe_values]),
+                              sorted([name for name, _, _ in pe_values]))
+            ref_pvalues = dict(ref_pe_values)
+            for name, pvalue, evalue in pe_values:
+                self.assertTrue(abs(pvalue - ref_pvalues[name]) <= 0.005 * ref_pvalues[name])
+                self.assertTrue(abs(pvalue * len(seqs) - evalue) <= 0.05 * evalue)
+            self.assertEquals(sorted(ref_annotations.keys()), sorted(annotations.keys()))
+            for gene, gene_hits in annotations.items():
+                self.assertEquals([(pos, num) for pos, _, num in ref_annotations[gene]],
+                                  [(pos, num) for _, pos, num in gene_hits])
+                for (_, ref_pvalue, _), (pvalue, _, _) in zip(ref_annotations[gene],
+                                                              gene_hits):
+                    self.assertEquals(ms.mast_round(ref_pvalue, 2), pvalue)
+
+    def test_scan_planted_sites(self):
+        """sites on both strands are found at the positions that
+        read_mast_output_xml() reports"""
+        random.seed(7)
+        seqs = [('G%02d' % i, random_seq(80)) for i in xrange(20)]
+        seqs[3] = ('G03', seqs[3][1][:10] + 'ACGTTGCA' + seqs[3][1][18:])
+        seqs[5] = ('G05', seqs[5][1][:20] + 'TGCAACGT' + seqs[5][1][28:])
+        motif_set = ms.MotifSet([make_motif_info(PSSM, 1)], BG_FREQUENCIES, ['G03', 'G05'])
+        pe_values, annotations = ms.MotifScanner(seqs).scan([motif_set])[0]
+        self.assertEquals(['G03', 'G05'], sorted([name for name, _, _ in pe_values[:2]]))
+        self.assertTrue(pe_values[1][1] < 0.01)
+        best_hits = {gene: min(hits) for gene, hits in annotations.items()}
+        self.assertEquals((13, 1), best_hits['G03'][1:])
+        self.assertEquals((23, -1), best_hits['G05'][1:])
+
+    def test_scan_forward_only(self):
+        """without reverse complements, reverse sites are not found"""
+        seqs = [('G1', 'CCCCCCACGTTGCACCCCC'), ('G2', 'CCCCCCTGCAACGTCCCCC')]
+        motif_set = ms.MotifSet([make_motif_info(PSSM, 1)], BG_FREQUENCIES, ['G1', 'G2'])
+        pe_values, annotations = ms.MotifScanner(seqs, use_revcomp=False).scan([motif_set])[0]
+        self.assertEquals('G1', pe_values[0][0])
+        self.assertTrue(all([num > 0 for hits in annotations.values() for _, _, num in hits]))
+
+    def test_scan_motif_evalue_cutoff(self):
+        """motifs with a large E-value are ignored, like MAST does"""
+        seqs = [('G1', 'CCCCCCACGTTGCACCCCC')]
+        motif_set = ms.MotifSet([make_motif_info(PSSM, 1, evalue=1e6)],
+                                BG_FREQUENCIES, ['G1'])
+        self.assertEquals([([], {})], ms.MotifScanner(seqs).scan([motif_set]))
@@ -5,6 +5,9 @@ more information and licensing details.
 """
 import unittest
 import network as nw
+import numpy
+import tempfile
+import shutil
 
 
 class NetworkTest(unittest.TestCase):  # pylint: disable-msg=R0904
@@ -70,3 +73,103 @@ class NetworkTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertEquals(1, len(res_edges))
         self.assertTrue(edge2 in res_edges)
         
+
+    def test_adjacency_matrix(self):
+        """the adjacency matrix is symmetric over the row indexes and
+        follows normalization"""
+        edge1 = ('n1', 'n2', 1.0)
+        edge2 = ('n3', 'n2', 2.0)
+        edge3 = ('n5', 'n2', 4.0)
+        network = nw.Network.create('network', [edge1, edge2, edge3], 42,
+                                    check_size=False)
+        row_names = ['n2', 'n1', 'n3', 'n4']
+        adjacency = network.adjacency_matrix(row_names).toarray()
+        self.assertEquals([0.0, 1.0, 2.0, 0.0], adjacency[0].tolist())
+        self.assertEquals([1.0, 0.0, 0.0, 0.0], adjacency[1].tolist())
+        self.assertEquals(0.0, adjacency[3].sum())
+        network.normalize_scores_to(28.0)
+        adjacency = network.adjacency_matrix(row_names).toarray()
+        self.assertEquals([0.0, 2.0, 4.0, 0.0], adjacency[0].tolist())
+
+    def test_compute_network_scores(self):
+        """network scores are -log(sum of edge weights into the cluster /
+        cluster size + 1)"""
+        edge1 = ('n1', 'n2', 1.0)
+        edge2 = ('n3', 'n2', 2.0)
+        edge3 = ('n4', 'n1', 3.0)
+        network = nw.Network.create('network', [edge1, edge2, edge3], 42,
+                                    check_size=False)
+        row_names = ['n1', 'n2', 'n3', 'n4']
+        # cluster 1: n1, n2, cluster 2: n4, cluster 3: empty
+        member_mask = numpy.array([[True, False, False], [True, False, False],
+                                   [False, False, False], [False, True, False]])
+        scores = nw.compute_network_scores(network.adjacency_matrix(row_names),
+                                           member_mask, numpy.array([2, 1, 0]))
+        self.assertAlmostEquals(-numpy.log(1.5), scores[0, 0])
+        self.assertAlmostEquals(-numpy.log(1.5), scores[1, 0])
+        self.assertAlmostEquals(-numpy.log(2.0), scores[2, 0])
+        self.assertAlmostEquals(-numpy.log(2.5), scores[3, 0])
+        self.assertAlmostEquals(-numpy.log(4.0), scores[0, 1])
+        self.assertAlmostEquals(0.0, scores[1, 1])
+        self.assertEquals(0.0, numpy.abs(scores[:, 2]).sum())
+
+    def test_compute_score_mean(self):
+        """trimmed means of the cluster members' scores, averaged"""
+        scores = numpy.array([[-1.0, -2.0], [-3.0, -4.0]])
+        member_mask = numpy.array([[True, False], [True, True]])
+        self.assertAlmostEquals(-3.0, nw.compute_score_mean(scores, member_mask))
+        # NaN scores are ignored
+        scores[1, 0] = numpy.nan
+        member_mask[0, 1] = True
+        self.assertAlmostEquals(-2.0, nw.compute_score_mean(scores, member_mask))
+
+    def test_network_cache(self):
+        """a cached network is read back with the same edges and the
+        network factory is only called on a cache miss"""
+        edge1 = ('n1', 'n2', 1.0)
+        edge2 = ('n3', 'n2', 2.0)
+        edge3 = ('n4', 'n1', 3.0)
+        calls = []
+
+        def make_network():
+            calls.append(True)
+            return nw.Network.create('network', [edge1, edge2, edge3], 42,
+                                     check_size=False)
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            key = nw.network_cache_key('digest', 'hal', None, False)
+            network = nw.cached_network(cache_dir, 'network', 42, key, make_network)
+            network = nw.cached_network(cache_dir, 'network', 42, key, make_network)
+            self.assertEquals(1, len(calls))
+            self.assertEquals('network', network.name)
+            self.assertEquals(42, network.weight)
+            self.assertEquals(3, network.num_edges())
+            self.assertEquals(12.0, network.total_score())
+            row_names = ['n1', 'n2', 'n3', 'n4']
+            self.assertEquals(make_network().adjacency_matrix(row_names).toarray().tolist(),
+                              network.adjacency_matrix(row_names).toarray().tolist())
+            self.assertEquals([edge2], network.edges_with_node('n3'))
+            self.assertTrue(edge1 in network.edges)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_network_cache_key(self):
+        """the cache key depends on the source, organism, ratio rows and
+        construction parameters"""
+        class MockRatios:
+            def __init__(self, row_names):
+                self.row_names = row_names
+
+        key = nw.network_cache_key('digest', 'hal', MockRatios(['a', 'b']), False)
+        self.assertEquals(key, nw.network_cache_key('digest', 'hal',
+                                                    MockRatios(['b', 'a']), False))
+        self.assertNotEquals(key, nw.network_cache_key('digest2', 'hal',
+                                                       MockRatios(['a', 'b']), False))
+        self.assertNotEquals(key, nw.network_cache_key('digest', 'eco',
+                                                       MockRatios(['a', 'b']), False))
+        self.assertNotEquals(key, nw.network_cache_key('digest', 'hal',
+                                                       MockRatios(['a']), False))
+        self.assertNotEquals(key, nw.network_cache_key('digest', 'hal',
+                                                       MockRatios(['a', 'b']), True))
+        self.assertNotEquals(key, nw.network_cache_key('digest', 'hal', None, False))
@@ -4,10 +4,12 @@ This file is part of cMonkey Python. Please see README and LICENSE for
 more information and licensing details.
 """
 import unittest
+import numpy as np
 import membership as memb
 import datamatrix as dm
 import microarray as ma
 import scoring
+import util
 
 CONFIG_PARAMS = {
     'memb.clusters_per_row': 2,
@@ -198,7 +200,152 @@ class OrigMembershipTest(unittest.TestCase):
         self.assertEquals(0, len(m.free_slots_for_column('C2')))
         self.assertEquals(4, len(m.free_slots_for_column('C1')))
 
+    def test_row_indexes_for_cluster(self):
+        """the row index follows additions and replacements"""
+        m = memb.OrigMembership(['R1', 'R2', 'R3'], ['C1', 'C2'],
+                                {'R1': [1, 5], 'R2': [], 'R3': [1]}, {'C1': [3], 'C2': []},
+                                CONFIG_PARAMS)
+        self.assertEquals([0, 2], m.row_indexes_for_cluster(1).tolist())
+        self.assertEquals(0, len(m.row_indexes_for_cluster(2)))
+        m.add_cluster_to_row('R2', 1)
+        self.assertEquals([0, 1, 2], m.row_indexes_for_cluster(1).tolist())
+        m.replace_row_cluster('R1', 0, 2)
+        self.assertEquals([1, 2], m.row_indexes_for_cluster(1).tolist())
+        self.assertEquals([0], m.row_indexes_for_cluster(2).tolist())
+        self.assertEquals(np.int32, m.row_indexes_for_cluster(1).dtype)
+
+    def test_row_indexes_for_cluster_same_cluster_twice(self):
+        """a row stays in a cluster as long as one of its slots has it"""
+        m = memb.OrigMembership(['R1', 'R2'], ['C1', 'C2'],
+                                {'R1': [1, 1], 'R2': []}, {'C1': [3], 'C2': []},
+                                CONFIG_PARAMS)
+        self.assertEquals([0], m.row_indexes_for_cluster(1).tolist())
+        m.replace_row_cluster('R1', 1, 3)
+        self.assertEquals([0], m.row_indexes_for_cluster(1).tolist())
+        m.replace_row_cluster('R1', 0, 3)
+        self.assertEquals(0, m.num_row_members(1))
+        self.assertEquals({'R1'}, m.rows_for_cluster(3))
+
+    def test_column_indexes_for_cluster_force(self):
+        """the column index follows additions that grow the array"""
+        m = memb.OrigMembership(['R1', 'R2'], ['C1', 'C2'],
+                                {'R1': [1, 5], 'R2': []}, {'C1': [1, 2, 3, 4, 5], 'C2': [2]},
+                                CONFIG_PARAMS)
+        m.add_cluster_to_column('C1', 2, force=True)
+        m.add_cluster_to_column('C1', 6, force=True)
+        self.assertEquals([0, 1], m.column_indexes_for_cluster(2).tolist())
+        self.assertEquals([0], m.column_indexes_for_cluster(6).tolist())
+
+    def test_index_after_array_change(self):
+        """the index is rebuilt when the arrays are replaced or invalidated"""
+        m = memb.OrigMembership(['R1', 'R2'], ['C1', 'C2'],
+                                {'R1': [1, 5], 'R2': []}, {'C1': [3], 'C2': []},
+                                CONFIG_PARAMS)
+        self.assertEquals({'C1'}, m.columns_for_cluster(3))
+        m.col_membs = np.array([[0, 0], [3, 4]], dtype='int32')
+        self.assertEquals({'C2'}, m.columns_for_cluster(3))
+        m.row_membs[1] = [1, 2]
+        m.invalidate_index()
+        self.assertEquals({'R1', 'R2'}, m.rows_for_cluster(1))
+
+
+class KMeansSeederTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for the native k-means row seeding"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        util.set_stats_backend('native')
+
+    def test_native_kmeans_seeded(self):
+        """the clustering only depends on the random seed"""
+        values = np.random.RandomState(3).normal(0.0, 1.0, (50, 4))
+        util.set_random_seed(10)
+        labels = memb.native_kmeans(values, 5)
+        np.random.seed(1)
+        util.set_random_seed(10)
+        self.assertEquals(labels.tolist(), memb.native_kmeans(values, 5).tolist())
+        self.assertEquals(range(5), sorted(set(labels)))
+
+    def test_native_kmeans_no_empty_clusters(self):
+        """rows are moved into the clusters that end up empty"""
+        values = np.zeros((8, 2))
+        values[6] = [5.0, 5.0]
+        values[7] = [10.0, 10.0]
+        util.set_random_seed(10)
+        labels = memb.native_kmeans(values, 4)
+        self.assertTrue(np.all(np.bincount(labels, minlength=4) > 0))
+        self.assertNotEquals(labels[6], labels[7])
+
+    def test_seeder(self):
+        """the seeder assigns 1-based clusters in the first row membership
+        column"""
+        matrix = dm.DataMatrix(6, 2, ['R%d' % row for row in xrange(6)], ['C1', 'C2'],
+                               values=[[0.0, 0.0], [0.1, 0.0], [5.0, 5.0],
+                                       [5.1, 5.0], [9.9, 10.0], [10.0, 10.1]])
+        row_membership = [[0, 0] for _ in xrange(6)]
+        util.set_random_seed(10)
+        memb.make_kmeans_row_seeder(3)(row_membership, matrix)
+        clusters = [row[0] for row in row_membership]
+        self.assertEquals([1, 2, 3], sorted(set(clusters)))
+        self.assertEquals(clusters[0], clusters[1])
+        self.assertEquals(clusters[2], clusters[3])
+        self.assertEquals(clusters[4], clusters[5])
+
+
+class DensityScoresTest(unittest.TestCase):
+    """Test class for the batched density score computation"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.backend = util.STATS_BACKEND
+        util.set_stats_backend(util.STATS_BACKEND_NATIVE)
+        random = np.random.RandomState(7)
+        row_names = ['R%d' % i for i in range(30)]
+        col_names = ['C%d' % i for i in range(8)]
+        # cluster 6 has no rows, cluster 7 has only a single column
+        row_members = {row: [1 + i % 5, 1 + (i + 2) % 5] for i, row in enumerate(row_names)}
+        row_members['R0'] = [7]
+        col_members = {col: [1, 2, 3, 4, 5] for col in col_names}
+        col_members['C0'] = [1, 2, 3, 6, 7]
+        self.membership = memb.OrigMembership(row_names, col_names,
+                                              row_members, col_members,
+                                              CONFIG_PARAMS)
+        cluster_names = ['%d' % i for i in range(1, 44)]
+        self.row_scores = dm.DataMatrix(30, 43, row_names, cluster_names,
+                                        values=random.normal(size=(30, 43)))
+        self.row_scores.values[3, 2] = np.nan
+        self.col_scores = dm.DataMatrix(8, 43, col_names, cluster_names,
+                                        values=random.normal(size=(8, 43)))
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        util.STATS_BACKEND = self.backend
+
+    def test_row_density_scores(self):
+        """batched row density scores are the per-cluster density scores"""
+        rscore_range = abs(self.row_scores.max() - self.row_scores.min())
+        bandwidth = max(rscore_range / 100.0, 0.001)
+        result = memb.get_row_density_scores(self.membership, self.row_scores)
+        for cluster in range(1, 44):
+            expected = memb.get_rr_scores(self.membership, self.row_scores,
+                                          bandwidth, cluster)
+            self.assertTrue(np.allclose(expected, result.column_values(cluster - 1),
+                                        equal_nan=True))
+
+    def test_col_density_scores(self):
+        """batched column density scores are the per-cluster density scores"""
+        cscore_range = abs(self.col_scores.max() - self.col_scores.min())
+        bandwidth = max(cscore_range / 100.0, 0.001)
+        result = memb.get_col_density_scores(self.membership, self.col_scores)
+        for cluster in range(1, 44):
+            expected = memb.get_cc_scores(self.membership, self.col_scores,
+                                          bandwidth, cluster)
+            self.assertTrue(np.allclose(expected, result.column_values(cluster - 1),
+                                        equal_nan=True))
+
+
 if __name__ == '__main__':
     SUITE = []
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(OrigMembershipTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(DensityScoresTest))
     unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,251 @@
+"""resultdb_test.py - unit tests for resultdb module
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import unittest
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import resultdb
+
+
+def make_database(dbpath):
+    """creates the result tables that are written by the tests"""
+    conn = sqlite3.connect(dbpath)
+    conn.execute('create table row_members (iteration int, cluster int, order_num int)')
+    conn.execute('create table column_members (iteration int, cluster int, order_num int)')
+    conn.execute('''create table motif_infos (iteration int, cluster int,
+                    seqtype text, motif_num int, evalue decimal)''')
+    conn.execute('''create table motif_pssm_rows (motif_info_id int,
+                    iteration int, row int, a decimal, c decimal, g decimal,
+                    t decimal)''')
+    conn.execute('create table cluster_stats (iteration int, cluster int, num_rows int, ' +
+                 'num_cols int, residual decimal)')
+    conn.execute('create table row_names (order_num int, name text)')
+    conn.execute("insert into motif_infos values (1, 1, 'upstream', 1, 0.1)")
+    conn.commit()
+    conn.close()
+
+
+def make_batch(writer, iteration):
+    """a batch with memberships and a motif"""
+    batch = resultdb.ResultBatch()
+    batch.add('row_members', [(iteration, cluster, order_num)
+                              for cluster in xrange(1, 4) for order_num in xrange(10)])
+    motif_info_id = writer.next_motif_info_id()
+    batch.add('motif_infos', [(motif_info_id, iteration, 1, 'upstream', 1, 0.01)])
+    batch.add('motif_pssm_rows', [(motif_info_id, iteration, row, 0.25, 0.25, 0.25, 0.25)
+                                  for row in xrange(6)])
+    return batch
+
+
+class ResultWriterTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for ResultWriter"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmpdir, 'cmonkey_run.db')
+        make_database(self.dbpath)
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        shutil.rmtree(self.tmpdir)
+
+    def count(self, query):
+        conn = sqlite3.connect(self.dbpath)
+        try:
+            return conn.execute(query).fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_write(self):
+        """the rows of a batch are written and refer to the allocated motif ids"""
+        writer = resultdb.ResultWriter(self.dbpath)
+        batch = make_batch(writer, 2)
+        self.assertEquals(37, batch.num_rows())
+        writer.write(batch)
+        writer.close()
+        self.assertEquals(37, writer.num_rows)
+        self.assertEquals(30, self.count('select count(*) from row_members'))
+        self.assertEquals(2, self.count("select rowid from motif_infos where iteration=2"))
+        self.assertEquals(6, self.count('select count(*) from motif_pssm_rows ' +
+                                        'where motif_info_id=2'))
+
+    def test_write_background(self):
+        """the batches of a background writer are written after flush()"""
+        writer = resultdb.ResultWriter(self.dbpath, background=True, queue_size=2)
+        for iteration in xrange(2, 12):
+            writer.write(make_batch(writer, iteration))
+        writer.flush()
+        self.assertEquals(300, self.count('select count(*) from row_members'))
+        self.assertEquals(11, self.count('select max(rowid) from motif_infos'))
+        self.assertEquals(60, self.count('select count(distinct motif_info_id) * 6 ' +
+                                         'from motif_pssm_rows'))
+        writer.close()
+        self.assertEquals(370, writer.num_rows)
+        self.assertTrue(writer.rows_per_second() > 0.0)
+
+    def test_write_background_error(self):
+        """an error in the writer thread is raised by the next call"""
+        conn = sqlite3.connect(self.dbpath)
+        conn.execute('drop table column_members')
+        conn.close()
+        writer = resultdb.ResultWriter(self.dbpath, background=True)
+        batch = resultdb.ResultBatch()
+        batch.add('column_members', [(1, 1, 1)])
+        writer.write(batch)
+        self.assertRaises(sqlite3.OperationalError, writer.flush)
+        writer.close()
+
+    def test_create_indexes(self):
+        """the result indexes are created on finalization, membership history
+        indexes only if there is a membership history"""
+        conn = resultdb.connect(self.dbpath)
+        resultdb.create_indexes(conn)
+        names = [row[0] for row in conn.execute("select name from sqlite_master " +
+                                                "where type='index'")]
+        self.assertTrue('cluststat_iter_index' in names)
+        self.assertTrue('motinf_clust_index' in names)
+        self.assertFalse('rowsnap_iter_index' in names)
+        self.assertEquals('wal', conn.execute('pragma journal_mode').fetchone()[0])
+        conn.close()
+
+
+def make_history_database(dbpath):
+    """a database with membership history tables"""
+    conn = resultdb.connect(dbpath)
+    resultdb.create_membership_tables(conn)
+    conn.execute('''create table motif_infos (iteration int, cluster int,
+                    seqtype text, motif_num int, evalue decimal)''')
+    conn.commit()
+    return conn
+
+
+def random_members(num_rows, num_clusters, previous=None, num_changes=5):
+    """(cluster, order_num) pairs, with previous members, num_changes rows move"""
+    if previous is None:
+        return {(random.randint(1, num_clusters), order_num) for order_num in xrange(num_rows)}
+    members = set(previous)
+    for cluster, order_num in random.sample(sorted(members), num_changes):
+        members.discard((cluster, order_num))
+        members.add((random.randint(1, num_clusters), order_num))
+    return members
+
+
+class MembershipHistoryTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for the membership history"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        random.seed(17)
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmpdir, 'cmonkey_run.db')
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        shutil.rmtree(self.tmpdir)
+
+    def write_history(self, conn, iterations, members=None, snapshot_interval=30):
+        """writes random memberships for the iterations, returns them by iteration"""
+        history = resultdb.MembershipHistory(conn, snapshot_interval)
+        writer = resultdb.ResultWriter(self.dbpath)
+        result = {}
+        for iteration in iterations:
+            members = {'row': random_members(50, 6, members and members['row']),
+                       'column': random_members(20, 6, members and members['column'], 2)}
+            batch = resultdb.ResultBatch()
+            history.add(batch, iteration, members)
+            writer.write(batch)
+            result[iteration] = members
+        writer.close()
+        return result
+
+    def assert_members(self, conn, written):
+        """the Python API and the views return the written members"""
+        for iteration, members in written.items():
+            for member_type in ['row', 'column']:
+                expected = sorted(members[member_type])
+                self.assertEquals(expected, resultdb.read_members(conn, member_type, iteration))
+                query = 'select cluster, order_num from %s_members where iteration=?'
+                self.assertEquals(expected, sorted(conn.execute(query % member_type,
+                                                                [iteration]).fetchall()))
+
+    def test_member_changes(self):
+        """moves are paired, additions and removals have no counterpart"""
+        old_members = {(1, 0), (2, 0), (1, 1), (3, 2)}
+        new_members = {(1, 0), (4, 0), (2, 1), (3, 1), (5, 3)}
+        self.assertEquals([(0, 2, 4), (1, 1, 2), (1, None, 3), (2, 3, None), (3, None, 5)],
+                          resultdb.member_changes(old_members, new_members))
+
+    def test_reconstruct(self):
+        """every written iteration is reconstructed from snapshots and changes"""
+        conn = make_history_database(self.dbpath)
+        written = self.write_history(conn, range(10, 110, 10))
+        snapshots = [row[0] for row in conn.execute('select distinct iteration from ' +
+                                                     'row_member_snapshots order by iteration')]
+        self.assertEquals([10, 40, 70, 100], snapshots)
+        self.assertEquals(100, resultdb.last_member_iteration(conn))
+        self.assert_members(conn, written)
+        resultdb.create_indexes(conn)
+        self.assert_members(conn, written)
+        conn.close()
+
+    def test_resume(self):
+        """a new history continues the changes of the last written iteration"""
+        conn = make_history_database(self.dbpath)
+        written = self.write_history(conn, [1, 2, 3])
+        written.update(self.write_history(conn, [3, 4, 5], written[3]))
+        self.assertEquals(1, conn.execute('select count(*) from membership_iterations ' +
+                                          'where iteration=3').fetchone()[0])
+        self.assertEquals(1, conn.execute('select count(distinct iteration) from ' +
+                                          'row_member_snapshots').fetchone()[0])
+        del written[3]
+        self.assert_members(conn, written)
+        conn.close()
+
+    def test_delete_after_iteration(self):
+        """a run resumed from an earlier iteration replaces the later results"""
+        conn = make_history_database(self.dbpath)
+        conn.execute('create table meme_motif_sites (motif_info_id int, seq_name text)')
+        conn.execute('create table cluster_stats (iteration int, cluster int, num_rows int, ' +
+                     'num_cols int, residual decimal)')
+        conn.execute('create table run_infos (num_iterations int, last_iteration int)')
+        conn.execute('insert into run_infos values (10, 5)')
+        for iteration in [1, 3, 5]:
+            conn.execute('insert into cluster_stats values (?, 1, 3, 2, 0.5)', [iteration])
+            conn.execute("insert into motif_infos values (?, 1, 'upstream', 1, 0.1)",
+                         [iteration])
+            conn.execute("insert into meme_motif_sites values (?, 'F1')",
+                         [conn.execute('select max(rowid) from motif_infos').fetchone()[0]])
+        conn.commit()
+        written = self.write_history(conn, [1, 2, 3, 4, 5])
+
+        resultdb.delete_after_iteration(conn, 3)
+        self.assertEquals(3, resultdb.last_member_iteration(conn))
+        self.assertEquals([(1,), (3,)], conn.execute('select iteration from cluster_stats ' +
+                                                     'order by iteration').fetchall())
+        self.assertEquals(2, conn.execute('select count(*) from meme_motif_sites').fetchone()[0])
+        self.assertEquals(3, conn.execute('select last_iteration from run_infos').fetchone()[0])
+
+        del written[4], written[5]
+        written.update(self.write_history(conn, [4, 5], written[3]))
+        self.assertEquals(5, conn.execute('select count(*) from membership_iterations')
+                          .fetchone()[0])
+        self.assert_members(conn, written)
+        conn.close()
+
+    def test_full_members(self):
+        """databases with row_members tables get the members of every iteration"""
+        make_database(self.dbpath)
+        conn = sqlite3.connect(self.dbpath)
+        written = self.write_history(conn, [1, 2])
+        self.assertEquals(100, conn.execute('select count(*) from row_members').fetchone()[0])
+        self.assertEquals(2, resultdb.last_member_iteration(conn))
+        for iteration in [1, 2]:
+            self.assertEquals(sorted(written[iteration]['row']),
+                              resultdb.read_members(conn, 'row', iteration))
+        conn.close()
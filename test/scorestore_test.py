@@ -0,0 +1,109 @@
+"""scorestore_test.py - unit tests for scorestore module
+
+This file is part of cMonkey Python. Please see README and LICENSE for
+more information and licensing details.
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import datamatrix as dm
+import scorestore
+
+
+def make_matrix(value, nrows=4, ncols=3):
+    return dm.DataMatrix(nrows, ncols, ['R%d' % row for row in xrange(nrows)],
+                         init_value=value)
+
+
+class ScoreStoreTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for ScoreStore"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'scores')
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        shutil.rmtree(self.tmpdir)
+
+    def test_ram_tier(self):
+        """matrices within the budget are returned as stored, without files"""
+        store = scorestore.ScoreStore(self.directory)
+        matrix = make_matrix(1.0)
+        store.put('Rows', matrix)
+        self.assertTrue(store.get('Rows') is matrix)
+        self.assertEquals(96, store.ram_bytes())
+        self.assertFalse(os.path.exists(self.directory))
+        self.assertEquals(None, store.get('Columns'))
+
+    def test_spill_least_recently_used(self):
+        """matrices beyond the budget are spilled in least recently used order"""
+        store = scorestore.ScoreStore(self.directory, max_bytes=200)
+        store.put('Rows', make_matrix(1.0))
+        store.put('Networks', make_matrix(2.0))
+        store.get('Rows')
+        store.put('Motifs', make_matrix(3.0))
+        self.assertTrue(store.in_ram('Rows'))
+        self.assertFalse(store.in_ram('Networks'))
+        self.assertTrue(store.in_ram('Motifs'))
+        self.assertEquals(192, store.ram_bytes())
+        self.assertEquals(96, store.ram_bytes('Rows'))
+        self.assertEquals(0, store.ram_bytes('Networks'))
+
+        spilled = store.get('Networks')
+        self.assertTrue(isinstance(spilled.values, np.memmap))
+        self.assertEquals(['R0', 'R1', 'R2', 'R3'], spilled.row_names)
+        self.assertEquals(['Col 0', 'Col 1', 'Col 2'], spilled.column_names)
+        self.assertTrue((spilled.values == 2.0).all())
+
+    def test_write_in_place(self):
+        """files are overwritten in place and modifying a loaded matrix
+        does not change its file"""
+        store = scorestore.ScoreStore(self.directory)
+        store.put('Rows', make_matrix(1.0), ram=False)
+        path = os.path.join(self.directory, 'Rows.npy')
+        names_mtime = os.stat(os.path.join(self.directory, 'Rows.names.npz')).st_mtime
+        inode = os.stat(path).st_ino
+
+        matrix = store.get('Rows')
+        matrix.values[0, 0] = 5.0
+        del matrix
+        store.put('Rows', make_matrix(2.0), ram=False)
+        self.assertEquals(inode, os.stat(path).st_ino)
+        self.assertEquals(names_mtime,
+                          os.stat(os.path.join(self.directory, 'Rows.names.npz')).st_mtime)
+        self.assertTrue((np.load(path) == 2.0).all())
+
+    def test_write_mapped(self):
+        """a matrix that is still in use keeps its values when its key is written"""
+        store = scorestore.ScoreStore(self.directory)
+        store.put('Rows', make_matrix(1.0), ram=False)
+        matrix = store.get('Rows')
+        store.put('Rows', make_matrix(2.0), ram=False)
+        self.assertTrue((matrix.values == 1.0).all())
+        self.assertTrue((store.get('Rows').values == 2.0).all())
+
+        store.put('Rows', make_matrix(3.0, 5, 2), ram=False)
+        matrix = store.get('Rows')
+        self.assertEquals((5, 2), matrix.values.shape)
+        self.assertEquals(['R0', 'R1', 'R2', 'R3', 'R4'], matrix.row_names)
+
+    def test_dtype(self):
+        """the values are converted to the store's type"""
+        store = scorestore.ScoreStore(self.directory, dtype=np.float32)
+        store.put('Rows', make_matrix(0.5))
+        self.assertEquals(np.float32, store.get('Rows').values.dtype)
+        self.assertEquals(48, store.ram_bytes())
+
+    def test_run_store(self):
+        """the functions of a run share a store until it is discarded"""
+        config_params = {'output_dir': self.tmpdir, 'score_cache_mb': 1}
+        store = scorestore.run_store(config_params)
+        self.assertTrue(store is scorestore.run_store(config_params))
+        self.assertEquals(1024 * 1024, store.max_bytes)
+        scorestore.discard_run_store(config_params)
+        self.assertFalse(store is scorestore.run_store(config_params))
+        scorestore.discard_run_store(config_params)
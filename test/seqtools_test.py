@@ -91,6 +91,26 @@ class SeqtoolsTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertEquals(4, len(background[0]))
         self.assertEquals(7, len(background[1]))
 
+    def test_kmer_count_arrays(self):
+        """test kmer_count_arrays() with length 2"""
+        seqs = ["ACCGTATA", "CACAT", "GGT"]
+        counts = st.kmer_count_arrays(st.encode_sequences(seqs), 3)
+        self.assertEquals({'AC': 2, 'CC': 1, 'CG': 1, 'GT': 2, 'TA': 2,
+                           'AT': 2, 'CA': 2, 'GG': 1},
+                          st.kmer_counts_to_dict(counts[1], 2))
+        self.assertEquals(16, sum(counts[0]))
+
+    def test_kmer_count_arrays_additive(self):
+        """counts of a union of sequences are the sum of the counts"""
+        seqs1 = ["ACCGTATA", "CACAT"]
+        seqs2 = ["GGTAC"]
+        counts1 = st.kmer_count_arrays(st.encode_sequences(seqs1), 2)
+        counts2 = st.kmer_count_arrays(st.encode_sequences(seqs2), 2)
+        counts = st.kmer_count_arrays(st.encode_sequences(seqs1 + seqs2), 2)
+        for length in range(2):
+            self.assertEquals(list(counts1[length] + counts2[length]),
+                              list(counts[length]))
+
     def test_revcomp(self):
         """test revcomp function"""
         self.assertEquals("GNCAT", st.revcomp('ATGNC'))
@@ -4,6 +4,8 @@ This file is part of cMonkey Python. Please see README and LICENSE for
 more information and licensing details.
 """
 import unittest
+import numpy as np
+import membership as memb
 import set_enrichment as se
 
 class DiscreteEnrichmentSetTest(unittest.TestCase):  # pylint: disable-msg=R0904
@@ -38,3 +40,46 @@ class SetTypeTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertEquals('mysettype', set_type.name)
         self.assertEquals({'gene1', 'gene2', 'gene3', 'gene4'},
                           set_type.genes())
+
+
+class CompiledSetTypeTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for CompiledSetType and the set enrichment scores"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.row_names = ['g1', 'g2', 'g3', 'g4', 'g5', 'g6']
+        self.synonyms = {'g%d' % row: 'G%d' % row for row in xrange(1, 7)}
+        sets = {'setB': se.DiscreteEnrichmentSet({'G1', 'G2', 'G3'}),
+                'setA': se.DiscreteEnrichmentSet({'G4', 'G5'}),
+                'setC': se.DiscreteEnrichmentSet({'G1', 'G2', 'G3'})}
+        self.row_indexes = se.canonical_row_indexes(self.row_names, self.synonyms)
+        self.set_type = se.CompiledSetType(se.SetType('mysettype', sets, 1.0),
+                                           self.row_indexes, 6)
+
+    def test_compile(self):
+        """the sets are the rows of the incidence matrix in name order"""
+        self.assertEquals(['setA', 'setB', 'setC'], self.set_type.set_names)
+        self.assertEquals([[0, 0, 0, 1, 1, 0], [1, 1, 1, 0, 0, 0], [1, 1, 1, 0, 0, 0]],
+                          self.set_type.incidence.toarray().tolist())
+        self.assertEquals([2, 3, 3], self.set_type.set_sizes.tolist())
+        self.assertEquals(5, self.set_type.num_genes)
+
+    def test_scores(self):
+        """each cluster is scored by the first of its most enriched sets"""
+        membership = memb.OrigMembership(
+            self.row_names, ['c1'],
+            {'g1': [1], 'g2': [1], 'g3': [2], 'g4': [1], 'g5': [2], 'g6': [3]},
+            {'c1': [1, 2, 3]},
+            {'memb.clusters_per_row': 1, 'memb.clusters_per_col': 3, 'num_clusters': 3})
+        row_indexes = se.membership_row_indexes(membership, self.row_indexes,
+                                                self.synonyms)
+        cluster_genes = se.cluster_gene_mask(membership, row_indexes, 6, 3)
+        scores, min_sets, min_pvalues = se.compute_set_type_scores(
+            self.set_type, cluster_genes, 60.0, -2.0)
+        self.assertEquals(['setB', 'setA', 'NA'], min_sets)
+        self.assertAlmostEquals(0.1, min_pvalues[0])
+        self.assertAlmostEquals(0.1, min_pvalues[1])
+        self.assertTrue(np.isnan(min_pvalues[2]))
+        self.assertEquals([[-2.0, 0.0, 0.0], [-2.0, 0.0, 0.0], [-4.0, 0.0, 0.0],
+                           [0.0, -4.0, 0.0], [0.0, -2.0, 0.0], [0.0, 0.0, 0.0]],
+                          scores.tolist())
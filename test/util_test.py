@@ -4,9 +4,12 @@ This file is part of cMonkey Python. Please see README and LICENSE for
 more information and licensing details.
 """
 import unittest
+import os
 import util
+import membership as memb
 import operator
 import numpy as np
+import scipy.stats
 
 
 class DelimitedFileTest(unittest.TestCase):  # pylint: disable-msg=R0904
@@ -72,6 +75,17 @@ class DelimitedFileTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertEquals(["value21", "value22"], lines[1])
         self.assertIsNone(dfile.header)
 
+    def test_stream_with_empty_lines(self):
+        """streaming a file yields the same rows as reading it"""
+        dfile = util.stream_dfile("testdata/withemptylines.ssv", sep=';',
+                                  has_header=True, comment='#', quote='"')
+        self.assertEquals(["header1", "header2"], dfile.header)
+        self.assertFalse(isinstance(dfile.lines, list))
+        self.assertEquals(util.read_dfile("testdata/withemptylines.ssv", sep=';',
+                                          has_header=True, comment='#',
+                                          quote='"').lines,
+                          list(dfile.lines))
+
 
 class LevenshteinDistanceTest(unittest.TestCase):  # pylint: disable-msg=R0904
     """Test class for levenshtein_distance"""
@@ -282,6 +296,207 @@ class UtilsTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertTrue(2 in multiple)
 
 
+class NativeStatsTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for the native statistics backend"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.backend = util.STATS_BACKEND
+        util.set_stats_backend(util.STATS_BACKEND_NATIVE)
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        util.STATS_BACKEND = self.backend
+
+    def test_density(self):
+        """density(), compare with R results"""
+        kvalues = [3.4268700450682301, 3.3655160468930152, -8.0654569044842539,
+                   2.0762815314005487, 4.8537715329554203, 1.2374476248622075]
+        cluster_values = [-3.5923001345962162, 0.77069901513184735,
+                           -4.942909785931378, -3.1580950032999096]
+        result = util.density(kvalues, cluster_values, 2.69474878768,
+                              -13.8848342423, 12.6744452247)
+        expected = [0.08663036966690765, 0.08809242907902183, 0.49712338305039777,
+                    0.12248549621579163, 0.05708884005243133, 0.14857948193544993]
+        for i in range(len(expected)):
+            self.assertAlmostEquals(expected[i], result[i])
+
+    def test_density_outside_range(self):
+        """values outside the density range are NaN and ignored"""
+        result = util.density([0.0, 20.0], [0.5, 1.0], 1.0, -10.0, 10.0)
+        self.assertAlmostEquals(1.0, result[0])
+        self.assertTrue(np.isnan(result[1]))
+
+    def test_rrank(self):
+        """rank(ties='min', na='keep')"""
+        result = util.rrank([3.0, 1.0, np.nan, 3.0, 2.0])
+        self.assertEquals([3.0, 1.0, 3.0, 2.0],
+                          [result[i] for i in [0, 1, 3, 4]])
+        self.assertTrue(np.isnan(result[2]))
+
+    def test_rrank_matrix(self):
+        """ranks in row-major order, 0-based"""
+        matrix = np.array([[3.0, 1.0], [2.0, 1.0]])
+        self.assertEquals([3, 0, 2, 0], list(util.rrank_matrix(matrix)))
+
+    def test_rorder(self):
+        """order(decreasing=TRUE) keeps ties in original order"""
+        self.assertEquals([2, 4, 1], util.rorder([1.0, 3.0, 0.5, 3.0, np.nan], 3))
+
+    def test_mad(self):
+        """mad()"""
+        self.assertAlmostEquals(1.4826, util.mad([1.0, 2.0, 3.0, 4.0, 100.0]))
+        self.assertTrue(np.isnan(util.mad([1.0, np.nan])))
+
+    def test_phyper(self):
+        """phyper(q, m, n, k, lower.tail=F)"""
+        result = util.phyper([2, 0], [10, 5], [20, 15], [5, 3])
+        self.assertAlmostEquals(0.1912341, result[0])
+        self.assertAlmostEquals(0.6008772, result[1])
+
+    def test_quantile(self):
+        """the quantiles are the ones of scoreatpercentile(), without NaN values"""
+        values = [3.0, np.nan, 1.0, 7.5, 2.0, 2.0, np.inf]
+        for probability in [0.0, 0.01, 0.5, 0.75, 1.0]:
+            self.assertEquals(scipy.stats.scoreatpercentile([3.0, 1.0, 7.5, 2.0, 2.0],
+                                                            probability * 100),
+                              util.quantile(values, probability))
+        self.assertTrue(np.isnan(util.quantile([np.nan], 0.5)))
+
+    def test_hypergeom_upper_tail(self):
+        """the log factorial table version gives phyper()'s results"""
+        log_factorials = util.log_factorial_table(30)
+        result = util.hypergeom_upper_tail([2, 0, 5, -1], [10, 5, 10, 10], [20, 15, 20, 20],
+                                           [5, 3, 5, 5], log_factorials)
+        self.assertAlmostEquals(0.1912341, result[0])
+        self.assertAlmostEquals(0.6008772, result[1])
+        self.assertEquals(0.0, result[2])
+        self.assertAlmostEquals(1.0, result[3])
+
+    def test_sd_rnorm_seeded(self):
+        """the random seed makes sd_rnorm() reproducible"""
+        util.set_random_seed(42)
+        result1 = util.sd_rnorm([1.3, 1.6, 1.2, 1.05], 9, 0.748951)
+        util.set_random_seed(42)
+        result2 = util.sd_rnorm([1.3, 1.6, 1.2, 1.05], 9, 0.748951)
+        self.assertEquals(9, len(result1))
+        self.assertEquals(list(result1), list(result2))
+
+    def test_get_rvec_fun(self):
+        """R vector expressions used in the configuration"""
+        fun = util.get_rvec_fun('c(0, rep(1e-5, 2), seq(1e-5, 1, length=3))')
+        self.assertEquals(0.0, fun(1))
+        self.assertEquals(1e-5, fun(3))
+        self.assertAlmostEquals(0.500005, fun(5))
+        self.assertEquals(1.0, fun(100))
+
+    def test_eval_rvec(self):
+        """arithmetic and seq() with by"""
+        self.assertEquals([2.0, 4.0, 6.0], util.eval_rvec('seq(1, 3) * 2'))
+        self.assertEquals([1.0, 1.5, 2.0], util.eval_rvec('seq(1, 2, by=0.5)'))
+        self.assertRaises(Exception, util.eval_rvec, 'sqrt(2)')
+
+    def test_set_stats_backend_invalid(self):
+        """unknown backends are rejected"""
+        self.assertRaises(Exception, util.set_stats_backend, 'julia')
+
+
+WORKER_VALUE = None
+WORKER_MEMBERSHIP = None
+
+
+def worker_value_sum(offset):
+    """mapped by WorkerPoolTest"""
+    return float(np.sum(WORKER_VALUE)) + offset
+
+
+def worker_num_row_members(cluster):
+    """mapped by WorkerPoolTest"""
+    return WORKER_MEMBERSHIP.num_row_members(cluster)
+
+
+def worker_call_value(arg):
+    """mapped by WorkerPoolTest"""
+    return WORKER_VALUE[0](arg)
+
+
+class WorkerPoolTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for the run-scoped WorkerPool"""
+
+    def setUp(self):  # pylint: disable-msg=C0103
+        """test fixture"""
+        self.pool = util.WorkerPool(2)
+        util.RUN_POOL = self.pool
+
+    def tearDown(self):  # pylint: disable-msg=C0103
+        """test cleanup"""
+        global WORKER_VALUE, WORKER_MEMBERSHIP
+        util.RUN_POOL = None
+        self.pool.close()
+        WORKER_VALUE = None
+        WORKER_MEMBERSHIP = None
+
+    def test_map_published_values(self):
+        """the workers see the current value of the shared global"""
+        global WORKER_VALUE
+        WORKER_VALUE = np.array([1.0, 2.0])
+        with util.get_mp_pool({}, shared=['WORKER_VALUE']) as pool:
+            self.assertEquals([3.0, 4.0], pool.map(worker_value_sum, [0, 1]))
+        WORKER_VALUE = np.array([5.0])
+        with util.get_mp_pool({}, shared=['WORKER_VALUE']) as pool:
+            self.assertEquals([5.0, 6.0], pool.map(worker_value_sum, [0, 1]))
+
+    def test_map_membership_changes(self):
+        """membership changes reach the workers as deltas"""
+        global WORKER_MEMBERSHIP
+        WORKER_MEMBERSHIP = memb.OrigMembership(
+            ['R1', 'R2'], ['C1'], {'R1': [1], 'R2': [1]}, {'C1': [1]},
+            {'memb.clusters_per_row': 1, 'memb.clusters_per_col': 1})
+        with util.get_mp_pool({}, shared=['WORKER_MEMBERSHIP']) as pool:
+            self.assertEquals([2, 0], pool.map(worker_num_row_members, [1, 2]))
+        WORKER_MEMBERSHIP.replace_row_cluster('R2', 0, 2)
+        with util.get_mp_pool({}, shared=['WORKER_MEMBERSHIP']) as pool:
+            self.assertEquals([1, 1], pool.map(worker_num_row_members, [1, 2]))
+
+    def test_map_unpicklable(self):
+        """values that can not be serialized are forked to a new pool and
+        leave neither files nor versions behind"""
+        global WORKER_VALUE
+        offset = 2
+        WORKER_VALUE = [lambda arg: arg + offset]
+        for _ in xrange(3):
+            with util.get_mp_pool({}, shared=['WORKER_VALUE']) as pool:
+                self.assertEquals([3, 4], pool.map(worker_call_value, [1, 2]))
+        self.assertEquals([], os.listdir(self.pool.shared_dir))
+        self.assertEquals({}, self.pool.versions)
+
+    def test_superseded_files_removed(self):
+        """only the latest delta of a value is kept, and the files of values
+        that are gone are removed"""
+        global WORKER_MEMBERSHIP, WORKER_VALUE
+        WORKER_MEMBERSHIP = memb.OrigMembership(
+            ['R1', 'R2'], ['C1'], {'R1': [1], 'R2': [1]}, {'C1': [1]},
+            {'memb.clusters_per_row': 1, 'memb.clusters_per_col': 1})
+        for change in xrange(20):
+            WORKER_MEMBERSHIP.replace_row_cluster('R2', 0, 2 if change % 2 == 0 else 1)
+            with util.get_mp_pool({}, shared=['WORKER_MEMBERSHIP']) as pool:
+                self.assertEquals(2 if change % 2 == 1 else 1,
+                                  pool.map(worker_num_row_members, [1])[0])
+        self.assertEquals([['1', '0'], ['1', '19']],
+                          sorted([filename.rsplit('.', 2)[1:]
+                                  for filename in os.listdir(self.pool.shared_dir)]))
+
+        for value in [np.array([1.0]), np.array([2.0])]:
+            WORKER_VALUE = value
+            with util.get_mp_pool({}, shared=['WORKER_VALUE']) as pool:
+                pool.map(worker_value_sum, [0])
+        del value
+        with util.get_mp_pool({}, shared=['WORKER_VALUE']) as pool:
+            pool.map(worker_value_sum, [0])
+        self.assertEquals(1, len([filename for filename in os.listdir(self.pool.shared_dir)
+                                  if 'WORKER_VALUE' in filename]))
+
+
 class Order2StringTest(unittest.TestCase):  # pylint: disable-msg=R09042
     """Test class for order2string"""
 
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""benchmark_meme_parser.py - compares the line index scanning MEME output
+reader that cMonkey used before with the single pass parser in meme.py
+
+Usage: benchmark_meme_parser.py [--memeout <file>] [--repeats n]
+
+The MEME output (by default the test fixture testdata/meme.out) is parsed
+--repeats times with each reader, the single pass parser once from the
+output text and once streaming from the file.
+"""
+import sys
+import os
+import argparse
+import re
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cmonkey'))
+import meme
+
+MEME_OUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'testdata', 'meme.out')
+
+
+def next_regex_index(pat, start_index, lines):
+    line_index = start_index
+    pattern = re.compile(pat)
+    while not pattern.match(lines[line_index]):
+        line_index += 1
+        if line_index >= len(lines):
+            return -1
+    return line_index
+
+
+def extract_regex(pattern, infoline):
+    match = re.search(pattern, infoline)
+    return infoline[match.start():match.end()].split('=')[1].strip()
+
+
+def read_meme_output_legacy(output_text, num_motifs):
+    """the previous reader: every section is searched from the start
+    of the output with a newly compiled pattern"""
+    def read_rows(index, pattern, make_row):
+        rows = []
+        while not lines[index].startswith('----------------------'):
+            rows.append(make_row(re.match(pattern, lines[index])))
+            index += 1
+        return rows
+
+    lines = output_text.split('\n')
+    result = []
+    for motif_number in xrange(1, num_motifs + 1):
+        info_index = next_regex_index('MOTIF\s+' + str(motif_number) + '.*', 0, lines)
+        info_line = lines[info_index]
+        pssm_index = next_regex_index('[\t]Motif \d+ position-specific probability matrix',
+                                      info_index + 1, lines)
+        sites_index = next_regex_index('[\t]Motif \d+ sites sorted by position p-value',
+                                       info_index + 1, lines)
+        pssm = read_rows(pssm_index + 3, "\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)",
+                         lambda m: [float(m.group(i)) for i in xrange(1, 5)])
+        sites = read_rows(sites_index + 4, "(\S+)\s+([+-])\s+(\d+)\s+(\S+)\s+(\S+) (\S+) (\S+)?",
+                          lambda m: (m.group(1), m.group(2), int(m.group(3)),
+                                     float(m.group(4)), m.group(5), m.group(6), m.group(7)))
+        result.append(meme.MemeMotifInfo(pssm, motif_number,
+                                         int(extract_regex('width =\s+\d+', info_line)),
+                                         int(extract_regex('sites =\s+\d+', info_line)),
+                                         int(extract_regex('llr =\s+\d+', info_line)),
+                                         float(extract_regex('E-value =\s+\S+', info_line)),
+                                         sites))
+    return result
+
+
+def parse_legacy(path, num_motifs):
+    with open(path) as infile:
+        return read_meme_output_legacy(infile.read(), num_motifs)
+
+
+def parse_text(path, num_motifs):
+    with open(path) as infile:
+        return meme.read_meme_output(infile.read(), num_motifs)
+
+
+def parse_stream(path, num_motifs):
+    with open(path) as infile:
+        return list(meme.iter_meme_motifs(infile))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MEME output parser benchmark')
+    parser.add_argument('--memeout', default=MEME_OUT, help='MEME text output to parse')
+    parser.add_argument('--repeats', type=int, default=2000)
+    args = parser.parse_args()
+
+    num_motifs = len(parse_stream(args.memeout, None))
+    print '%s: %d motifs, %d repeats' % (args.memeout, num_motifs, args.repeats)
+    for name, reader in [('legacy line scanning', parse_legacy),
+                         ('read_meme_output', parse_text),
+                         ('iter_meme_motifs (file)', parse_stream)]:
+        start_time = time.time()
+        for _ in xrange(args.repeats):
+            motif_infos = reader(args.memeout, num_motifs)
+        elapsed = time.time() - start_time
+        print '%-26s %8.3f ms per output' % (name, elapsed * 1000.0 / args.repeats)
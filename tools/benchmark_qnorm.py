@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""benchmark_qnorm.py - compares the time of the quantile normalization of
+score matrices (datamatrix.quantile_normalize_scores()) with the previous
+approach, which sorted the matrices, ranked each of them with
+util.rrank_matrix() in a worker pool and copied the results into new
+matrices.
+
+Usage: benchmark_qnorm.py [--rows n] [--clusters n] [--matrices n] [--repeat n]
+
+The score matrices are random, every second one is rounded to 2 digits to
+have many ties, like the motif and network scores. The results of both
+approaches are compared.
+"""
+import sys
+import os
+import argparse
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cmonkey'))
+import util
+import datamatrix as dm
+
+
+def make_matrices(num_rows, num_clusters, num_matrices):
+    """random score matrices, every second one with ties"""
+    row_names = ['VNG%05d' % row for row in xrange(num_rows)]
+    result = []
+    for index in xrange(num_matrices):
+        values = np.random.normal(0.0, 1.0, (num_rows, num_clusters))
+        if index % 2 == 1:
+            values = np.round(values, 2)
+        result.append(dm.DataMatrix(num_rows, num_clusters, row_names, values=values))
+    return result
+
+
+def rank_fun(mat_mean):
+    values, row_names, column_names, tmp_mean = mat_mean
+    num_rows, num_cols = values.shape
+    rankvals = util.rrank_matrix(values)
+    values = np.reshape(tmp_mean[rankvals], (num_rows, num_cols))
+    return dm.DataMatrix(num_rows, num_cols, row_names, column_names, values=values)
+
+
+def previous_qnorm(matrices, weights):
+    """the sort + rank approach that quantile_normalize_scores() replaced"""
+    flat_values = np.transpose(np.asarray([np.sort(matrix.values.flatten())
+                                           for matrix in matrices]))
+    scaled = weights * flat_values
+    scale = np.sum(np.ma.masked_array(weights, np.isnan(weights)))
+    tmp_mean = util.row_means(scaled) / scale
+    with util.get_mp_pool() as pool:
+        return pool.map(rank_fun, [(matrix.values, matrix.row_names, matrix.column_names,
+                                    tmp_mean) for matrix in matrices])
+
+
+def measure(qnorm, matrices, weights, repeat):
+    """returns the best time of repeat runs and the result"""
+    times = []
+    for _ in xrange(repeat):
+        start_time = time.time()
+        result = qnorm(matrices, weights)
+        times.append(time.time() - start_time)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='quantile normalization benchmark')
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--clusters', type=int, default=400)
+    parser.add_argument('--matrices', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stats', default=util.STATS_BACKEND, help="'r' or 'native'")
+    args = parser.parse_args()
+    util.set_stats_backend(args.stats)
+
+    matrices = make_matrices(args.rows, args.clusters, args.matrices)
+    weights = np.array([6.0] + [0.5] * (args.matrices - 1))
+    print '%d matrices of %d x %d, ranking with the %s backend' % (
+        args.matrices, args.rows, args.clusters, util.STATS_BACKEND)
+    previous_time, previous = measure(previous_qnorm, matrices, weights, args.repeat)
+    current_time, current = measure(dm.quantile_normalize_scores, matrices, weights,
+                                    args.repeat)
+    print 'sort + rrank_matrix in pool:  %8.3f s' % previous_time
+    print 'quantile_normalize_scores:    %8.3f s' % current_time
+    print 'identical results: %s' % all([(p.values == c.values).all()
+                                         for p, c in zip(previous, current)])
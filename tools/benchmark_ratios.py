@@ -0,0 +1,88 @@
+#!/usr/bin/python
+"""benchmark_ratios.py - compares load time and peak memory of the
+delimited file ratio reader (util.read_dfile() + DataMatrixFactory.create_from())
+with the block parsing fast path (DataMatrixFactory.create_from_file()).
+
+Usage: benchmark_ratios.py [--ratios <file>] [--rows n] [--columns n] [--gzip]
+
+Without --ratios, a random ratio matrix with the given dimensions and 5% NA
+values is generated in a temporary directory. Each reader runs in its own
+process, the reported memory is the increase of the process' peak resident
+set size while loading.
+"""
+import sys
+import os
+import argparse
+import gzip
+import random
+import resource
+import shutil
+import tempfile
+import time
+import multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cmonkey'))
+import util
+import datamatrix as dm
+
+
+def write_ratios(path, num_rows, num_columns, na_fraction=0.05):
+    """writes a random ratio matrix"""
+    outfile = gzip.open(path, 'w') if path.endswith('.gz') else open(path, 'w')
+    with outfile:
+        outfile.write('\t'.join(['GENE'] + ['cond%d' % col for col in xrange(num_columns)]))
+        outfile.write('\n')
+        for row in xrange(num_rows):
+            cells = ['NA' if random.random() < na_fraction else '%.6f' % random.gauss(0.0, 1.0)
+                     for _ in xrange(num_columns)]
+            outfile.write('\t'.join(['VNG%05d' % row] + cells))
+            outfile.write('\n')
+
+
+def read_delimited(path):
+    infile = util.read_dfile(path, has_header=True, quote='\"')
+    return dm.DataMatrixFactory([]).create_from(infile)
+
+
+def read_fast(path):
+    return dm.DataMatrixFactory([]).create_from_file(path)
+
+
+def measure(reader, path, queue):
+    """runs the reader and reports (seconds, peak memory increase in MB)"""
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    matrix = reader(path)
+    elapsed = time.time() - start_time
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, (rss_after - rss_before) / 1024.0, matrix.values.shape))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ratio reader benchmark')
+    parser.add_argument('--ratios', default=None, help='ratio file to read')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--columns', type=int, default=1000)
+    parser.add_argument('--gzip', action='store_true', help='gzip the generated file')
+    args = parser.parse_args()
+
+    tmpdir = None
+    path = args.ratios
+    if path is None:
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'ratios.tsv.gz' if args.gzip else 'ratios.tsv')
+        print 'generating %d x %d ratios in %s...' % (args.rows, args.columns, path)
+        write_ratios(path, args.rows, args.columns)
+    try:
+        for name, reader in [('read_dfile + create_from', read_delimited),
+                             ('create_from_file', read_fast)]:
+            queue = mp.Queue()
+            process = mp.Process(target=measure, args=(reader, path, queue))
+            process.start()
+            elapsed, peak_mb, shape = queue.get()
+            process.join()
+            print '%-26s %s: %8.2f s, peak memory +%8.1f MB' % (name, str(shape),
+                                                                 elapsed, peak_mb)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
@@ -3,7 +3,9 @@
 # comparing the motifs discovered in the run with the
 # transcription factors in RegulonDB
 import util
+import meme
 import collections
+import os
 import numpy
 import sqlite3
 import sys
@@ -57,19 +59,22 @@ def read_pssms():
         line_number += 1
     return pssms
 
+def write_motif(outfile, name, scores):
+    outfile.write('\n')
+    outfile.write('MOTIF %s\n' % name)
+    outfile.write('BL   MOTIF %s width=0 seqs=0\n' % name)
+    outfile.write(('letter-probability matrix: alength= 4 w= %d nsites= 20 ' +
+                   'E= 1.000e+00\n') % len(scores))
+    for row in scores:
+        outfile.write('%5.3f %5.3f %5.3f %5.3f\n' %
+                      (row[0], row[1], row[2], row[3]))
+
 def write_pssm_file(pssms):
     with open(REGULONDB_PSSMS, 'w') as outfile:
         outfile.write(MEME_HEADER)
         outfile.write('A 0.283 C 0.217 G 0.217 T 0.283\n')
         for pssm in pssms:
-            outfile.write('\n')
-            outfile.write('MOTIF %s\n' % pssm.name)
-            outfile.write('BL   MOTIF %s width=0 seqs=0\n' % pssm.name)
-            outfile.write('letter-probability matrix: alength= 4 w= %s nsites= 20 E= 1.000e+00\n'
-                          % pssm.scores.shape[0])
-            for row in pssm.scores:
-                outfile.write('%5.3f %5.3f %5.3f %5.3f\n' %
-                              (row[0], row[1], row[2], row[3]))
+            write_motif(outfile, pssm.name, pssm.scores)
 
 
 def write_motifs(dbname, iteration, seqtype):
@@ -84,30 +89,42 @@ def write_motifs(dbname, iteration, seqtype):
         outfile.write('A 0.283 C 0.217 G 0.217 T 0.283\n')
 
         for motif_id, cluster, motif_num in motifs:
-            name = 'MOT_%d_%d' % (cluster, motif_num)
-            outfile.write('\n')
-            outfile.write('MOTIF %s\n' % name)
-            outfile.write('BL   MOTIF %s width=0 seqs=0\n' % name)
             cursor.execute('select a, c, g, t from motif_pssm_rows where motif_info_id = ?' +
                            ' order by row', [motif_id])
             scores = numpy.array(cursor.fetchall())
-            outfile.write(('letter-probability matrix: alength= 4 w= %d nsites= 20 ' +
-                          'E= 1.000e+00\n') % scores.shape[0])
-            for row in scores:
-                outfile.write('%5.3f %5.3f %5.3f %5.3f\n' %
-                              (row[0], row[1], row[2], row[3]))
-        
+            write_motif(outfile, 'MOT_%d_%d' % (cluster, motif_num), scores)
+
     cursor.close()
     conn.close()
 
+def write_memeout_motifs(paths):
+    """writes the motifs of kept MEME output files (meme-out-<iteration>-<cluster>)"""
+    with open(MEME_PSSMS, 'w') as outfile:
+        outfile.write(MEME_HEADER)
+        outfile.write('A 0.283 C 0.217 G 0.217 T 0.283\n')
+
+        for path in paths:
+            cluster = int(os.path.basename(path).split('-')[-1])
+            with open(path) as infile:
+                for motif_info in meme.iter_meme_motifs(infile):
+                    write_motif(outfile, 'MOT_%d_%d' % (cluster, motif_info.motif_num),
+                                motif_info.pssm)
+
 if __name__ == '__main__':
     description = "tomtom_verify - TomTom verification against RegulonDB"
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('--dbfile', required=True, help='E.coli cMonkey database')
+    parser.add_argument('--dbfile', help='E.coli cMonkey database')
+    parser.add_argument('--memeout', nargs='+',
+                        help='kept MEME output files to read the cMonkey PSSMs from')
     args = parser.parse_args()
+    if args.dbfile is None and args.memeout is None:
+        parser.error('one of --dbfile or --memeout is required')
 
     pssms = read_pssms()
     print '# RegulonDB PSSMs: ', len(pssms)
     write_pssm_file(pssms)
     print 'writing cMonkey PSSMs'
-    write_motifs(args.dbfile, 2001, 'upstream')
+    if args.memeout is not None:
+        write_memeout_motifs(args.memeout)
+    else:
+        write_motifs(args.dbfile, 2001, 'upstream')